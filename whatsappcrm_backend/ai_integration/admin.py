@@ -7,13 +7,14 @@ class AIProviderAdmin(admin.ModelAdmin):
     list_display = ('provider', 'is_active', 'rate_limit_status', 'rate_limit_reset_time', 'updated_at')
     list_filter = ('provider', 'is_active')
     search_fields = ('provider',)
-    readonly_fields = ('rate_limit_limit', 'rate_limit_remaining', 'rate_limit_reset_time', 'created_at', 'updated_at')
+    readonly_fields = ('rate_limit_remaining', 'rate_limit_reset_time', 'created_at', 'updated_at')
     fieldsets = (
         (None, {'fields': ('provider', 'api_key', 'is_active')}),
-        ('Rate Limit Status (Read-Only)', {
+        ('Rate Limit', {
             'fields': ('rate_limit_limit', 'rate_limit_remaining', 'rate_limit_reset_time'),
             'classes': ('collapse',),
-            'description': 'This information is updated automatically after an API call.'
+            'description': 'Requests per minute allowed for this key; empty uses GEMINI_REQUESTS_PER_MINUTE. '
+                           'Remaining and reset time are set automatically when Gemini reports the limit was hit.'
         }),
         ('Timestamps', {'fields': ('created_at', 'updated_at'), 'classes': ('collapse',)})
     )
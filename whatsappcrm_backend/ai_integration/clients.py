@@ -0,0 +1,29 @@
+# whatsappcrm_backend/ai_integration/clients.py
+
+"""
+Per-process pool of Gemini clients.
+
+A genai.Client holds its own HTTP connection pool, so creating one per task
+paid for new TLS connections on every AI turn. Clients are kept per API key
+for the life of the worker process; rotating the key in AIProvider simply
+creates a client for the new key.
+"""
+import threading
+
+from google import genai
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_gemini_client(api_key: str) -> genai.Client:
+    """Returns this process's client for `api_key`, creating it on first use."""
+    client = _clients.get(api_key)
+    if client is not None:
+        return client
+    with _lock:
+        client = _clients.get(api_key)
+        if client is None:
+            client = genai.Client(api_key=api_key)
+            _clients[api_key] = client
+    return client
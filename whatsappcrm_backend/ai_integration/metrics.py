@@ -0,0 +1,31 @@
+# whatsappcrm_backend/ai_integration/metrics.py
+
+"""
+Prometheus metrics for Gemini request scheduling (ai_integration/scheduler.py).
+
+The web process exports them through django_prometheus at /prometheus/. Celery
+workers update them in their own process registry, which each worker process serves
+on WORKER_METRICS_PORT (see whatsappcrm_backend/worker_metrics.py).
+"""
+from prometheus_client import Counter, Gauge, Histogram
+
+GEMINI_QUEUE_DEPTH = Gauge(
+    'whatsappcrm_gemini_queue_depth',
+    'Gemini requests waiting for a rate-limit token across all workers, as last seen by this process, by priority.',
+    ['priority']
+)
+GEMINI_WAIT_SECONDS = Histogram(
+    'whatsappcrm_gemini_wait_seconds',
+    'Time Gemini requests spent waiting for a rate-limit token, by priority.',
+    ['priority'],
+    buckets=(0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+)
+GEMINI_REQUESTS = Counter(
+    'whatsappcrm_gemini_requests_total',
+    'Gemini requests seen by the scheduler, by priority and outcome (granted, deferred, timed_out, rate_limited).',
+    ['priority', 'outcome']
+)
+GEMINI_TOKENS = Gauge(
+    'whatsappcrm_gemini_tokens',
+    'Tokens left in the shared Gemini request bucket, as last seen by this process.'
+)
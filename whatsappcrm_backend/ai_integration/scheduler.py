@@ -0,0 +1,256 @@
+# whatsappcrm_backend/ai_integration/scheduler.py
+
+"""
+Rate-limit-aware scheduling of Gemini requests.
+
+Every worker shares one Redis token bucket per AIProvider, refilled at
+`rate_limit_limit` requests per minute (GEMINI_REQUESTS_PER_MINUTE when the
+provider has no limit set) with a burst of one minute's worth. A request
+takes a token before calling the model and waits for one, sleeping
+cooperatively under gevent, when the bucket is empty.
+
+Requests have a priority:
+  * INTERACTIVE - customer chats (flows/tasks.py). They may use every token.
+  * BACKGROUND - email attachment extraction. These leave
+    GEMINI_INTERACTIVE_RESERVE tokens in the bucket, and they do not take a
+    token while an interactive request is waiting for one.
+Waiting requests are registered in a sorted set per priority. The sets give
+the queue depth metric and let background requests yield.
+
+When Gemini answers 429, record_rate_limited() stores the provider as
+exhausted (rate_limit_remaining=0 until rate_limit_reset_time) and blocks the
+shared bucket until then. Every worker then waits instead of sending requests
+that would fail. A request that can't get a token within its priority's
+maximum wait raises GeminiSlotTimeout, a ResourceExhausted, so the task's
+existing Celery retry takes over.
+
+Background tasks don't hold their worker while they wait: try_gemini_slot()
+returns the expected wait instead of sleeping, and the task retries itself
+with that countdown (email_integration/tasks.py).
+
+Only generation calls are scheduled; file uploads and deletes have their own
+quota. Without Redis, requests are only held back while the provider is
+recorded as exhausted.
+"""
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+import redis
+from django.conf import settings
+from django.utils import timezone
+from google.api_core import exceptions as core_exceptions
+from google.genai import errors as genai_errors
+
+from whatsappcrm_backend.redis_client import get_redis_client, mark_redis_unavailable
+from .metrics import GEMINI_QUEUE_DEPTH, GEMINI_REQUESTS, GEMINI_TOKENS, GEMINI_WAIT_SECONDS
+from .models import AIProvider
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
+
+SCHEDULER_KEY_PREFIX = 'ai:gemini:'
+# Longest single sleep; waiting background requests re-check this often whether
+# the interactive requests ahead of them are done.
+MAX_POLL_SECONDS = 1.0
+
+# KEYS[1] = bucket, KEYS[2] = interactive waiters, KEYS[3] = this priority's waiters
+# ARGV = now, rate, burst, reserve, waiter id, waiter expiry, blocked until, background (1/0)
+# Returns {allowed, tokens (string), wait in seconds (string), waiters of this priority}.
+_SCHEDULE_LUA = """
+local now = tonumber(ARGV[1])
+local rate, burst, reserve = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'blocked_until')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local blocked_until = math.max(tonumber(state[3]) or 0, tonumber(ARGV[7]))
+
+local wait = 0
+if blocked_until > now then
+    wait = blocked_until - now
+else
+    local needed = 1 + reserve
+    if ARGV[8] == '1' and redis.call('ZCARD', KEYS[2]) > 0 then
+        wait = 1 / rate
+    end
+    if tokens < needed then wait = math.max(wait, (needed - tokens) / rate) end
+end
+
+if wait > 0 then
+    redis.call('ZADD', KEYS[3], ARGV[6], ARGV[5])
+    redis.call('EXPIRE', KEYS[3], math.ceil(tonumber(ARGV[6]) - now) + 1)
+    return {0, tostring(tokens), tostring(wait), redis.call('ZCARD', KEYS[3])}
+end
+redis.call('ZREM', KEYS[3], ARGV[5])
+redis.call('HSET', KEYS[1], 'tokens', tokens - 1, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1 + math.ceil(math.max(0, blocked_until - now)))
+return {1, tostring(tokens - 1), '0', redis.call('ZCARD', KEYS[3])}
+"""
+
+
+class GeminiSlotTimeout(core_exceptions.ResourceExhausted):
+    """No Gemini rate-limit token became available within the request's maximum wait."""
+
+
+def _bucket_key(provider_id) -> str:
+    return f"{SCHEDULER_KEY_PREFIX}bucket:{provider_id}"
+
+
+def _waiters_key(provider_id, priority: str) -> str:
+    return f"{SCHEDULER_KEY_PREFIX}waiting:{provider_id}:{priority}"
+
+
+def _max_wait(priority: str) -> float:
+    if priority == INTERACTIVE:
+        return settings.GEMINI_INTERACTIVE_MAX_WAIT_SECONDS
+    return settings.GEMINI_BACKGROUND_MAX_WAIT_SECONDS
+
+
+def _blocked_until(provider: AIProvider) -> float:
+    """Epoch seconds until which the provider is recorded as exhausted, or 0."""
+    if provider.rate_limit_remaining == 0 and provider.rate_limit_reset_time:
+        return provider.rate_limit_reset_time.timestamp()
+    return 0.0
+
+
+def try_acquire_gemini_token(provider: AIProvider, priority: str, waiter_id: str, max_wait: float) -> float:
+    """
+    Tries to take one token from `provider`'s bucket. Returns 0.0 when the
+    request may be sent now, otherwise the number of seconds until it is
+    expected to be allowed. Until then the request counts as a waiter of its
+    priority.
+    """
+    now = time.time()
+    blocked_until = _blocked_until(provider)
+    client = get_redis_client()
+    if client is None:
+        return max(0.0, blocked_until - now)
+
+    requests_per_minute = provider.rate_limit_limit or settings.GEMINI_REQUESTS_PER_MINUTE
+    burst = max(1, requests_per_minute)
+    reserve = 0 if priority == INTERACTIVE else min(settings.GEMINI_INTERACTIVE_RESERVE, burst - 1)
+    try:
+        allowed, tokens, wait, waiting = client.register_script(_SCHEDULE_LUA)(
+            keys=[_bucket_key(provider.pk), _waiters_key(provider.pk, INTERACTIVE), _waiters_key(provider.pk, priority)],
+            args=[now, requests_per_minute / 60.0, burst, reserve, waiter_id, now + max_wait + 5, blocked_until,
+                  1 if priority == BACKGROUND else 0],
+        )
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return max(0.0, blocked_until - now)
+    GEMINI_TOKENS.set(float(tokens))
+    GEMINI_QUEUE_DEPTH.labels(priority=priority).set(waiting)
+    return 0.0 if allowed else float(wait)
+
+
+def _leave_queue(provider: AIProvider, priority: str, waiter_id: str):
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        client.zrem(_waiters_key(provider.pk, priority), waiter_id)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+
+
+def acquire_gemini_slot(provider: AIProvider, priority: str = INTERACTIVE, max_wait: float = None) -> float:
+    """
+    Blocks (cooperatively under gevent) until the request may be sent.
+    Returns the seconds spent waiting. Raises GeminiSlotTimeout when no token
+    is expected within `max_wait` seconds (default: the priority's maximum).
+    """
+    if max_wait is None:
+        max_wait = _max_wait(priority)
+    waiter_id = uuid.uuid4().hex
+    started = time.monotonic()
+    while True:
+        wait = try_acquire_gemini_token(provider, priority, waiter_id, max_wait)
+        waited = time.monotonic() - started
+        if not wait:
+            GEMINI_WAIT_SECONDS.labels(priority=priority).observe(waited)
+            GEMINI_REQUESTS.labels(priority=priority, outcome='granted').inc()
+            return waited
+        if waited + wait > max_wait:
+            _leave_queue(provider, priority, waiter_id)
+            GEMINI_WAIT_SECONDS.labels(priority=priority).observe(waited)
+            GEMINI_REQUESTS.labels(priority=priority, outcome='timed_out').inc()
+            logger.info(f"Gemini scheduler: no {priority} slot within {max_wait}s (next in {wait:.1f}s).")
+            raise GeminiSlotTimeout(f"No Gemini rate-limit slot within {max_wait}s; next expected in {wait:.1f}s.")
+        time.sleep(min(wait, MAX_POLL_SECONDS))
+
+
+def try_gemini_slot(provider: AIProvider, priority: str = BACKGROUND, waiter_id: str = None) -> float:
+    """
+    Takes a token without waiting. Returns 0.0 if the request may be sent now,
+    otherwise the seconds until a token is expected, for the caller to retry
+    then. Pass the same `waiter_id` (e.g. the Celery task id) on every attempt
+    so the request counts once in the queue while it waits.
+    """
+    wait = try_acquire_gemini_token(provider, priority, waiter_id or uuid.uuid4().hex, _max_wait(priority))
+    GEMINI_REQUESTS.labels(priority=priority, outcome='deferred' if wait else 'granted').inc()
+    return wait
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    if isinstance(error, GeminiSlotTimeout):
+        return False
+    if isinstance(error, core_exceptions.ResourceExhausted):
+        return True
+    return isinstance(error, genai_errors.ClientError) and error.code == 429
+
+
+def record_rate_limited(provider: AIProvider, cooldown: float = None):
+    """
+    Records that Gemini rejected a request of `provider` for exceeding its
+    rate limit: no request is let through for `cooldown` seconds (default
+    GEMINI_RATE_LIMIT_COOLDOWN_SECONDS) by any worker.
+    """
+    if cooldown is None:
+        cooldown = settings.GEMINI_RATE_LIMIT_COOLDOWN_SECONDS
+    reset_time = timezone.now() + timedelta(seconds=cooldown)
+    provider.rate_limit_remaining = 0
+    provider.rate_limit_reset_time = reset_time
+    AIProvider.objects.filter(pk=provider.pk).update(rate_limit_remaining=0, rate_limit_reset_time=reset_time)
+
+    client = get_redis_client()
+    if client is not None:
+        key = _bucket_key(provider.pk)
+        try:
+            pipe = client.pipeline()
+            pipe.hset(key, mapping={'blocked_until': reset_time.timestamp()})
+            pipe.expire(key, int(cooldown) + 60)
+            pipe.execute()
+        except redis.RedisError as e:
+            mark_redis_unavailable(e)
+    logger.warning(f"Gemini rate limit hit for provider {provider.pk}; holding requests until {reset_time.isoformat()}.")
+
+
+@contextmanager
+def recording_rate_limits(provider: AIProvider, priority: str = INTERACTIVE):
+    """
+    Runs a Gemini call whose slot was already taken. A 429 from the call is
+    recorded with record_rate_limited() and re-raised.
+    """
+    try:
+        yield
+    except Exception as e:
+        if is_rate_limit_error(e):
+            GEMINI_REQUESTS.labels(priority=priority, outcome='rate_limited').inc()
+            record_rate_limited(provider)
+        raise
+
+
+@contextmanager
+def gemini_request(provider: AIProvider, priority: str = INTERACTIVE):
+    """Waits for a rate-limit slot, then runs the Gemini call in the block under recording_rate_limits()."""
+    acquire_gemini_slot(provider, priority)
+    with recording_rate_limits(provider, priority):
+        yield
@@ -1,3 +1,64 @@
-from django.test import TestCase
+from unittest.mock import patch
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .models import AIProvider
+
+
+class GeminiSchedulerTestCase(TestCase):
+    """Tests for the rate-limit-aware Gemini request scheduler (ai_integration/scheduler.py)."""
+
+    def setUp(self):
+        self.provider = AIProvider.objects.create(provider='google_gemini', api_key='key', is_active=True)
+
+    @override_settings(GEMINI_INTERACTIVE_MAX_WAIT_SECONDS=5)
+    @patch('ai_integration.scheduler.time.sleep')
+    @patch('ai_integration.scheduler.try_acquire_gemini_token', side_effect=[2.5, 0.5, 0.0])
+    def test_waits_cooperatively_for_a_token(self, mock_try, mock_sleep):
+        from .scheduler import INTERACTIVE, acquire_gemini_slot
+
+        acquire_gemini_slot(self.provider, INTERACTIVE)
+
+        self.assertEqual([c.args[0] for c in mock_sleep.call_args_list], [1.0, 0.5])
+        self.assertEqual(len({c.args[2] for c in mock_try.call_args_list}), 1)
+
+    @override_settings(GEMINI_BACKGROUND_MAX_WAIT_SECONDS=10)
+    @patch('ai_integration.scheduler.time.sleep')
+    @patch('ai_integration.scheduler.try_acquire_gemini_token', return_value=30.0)
+    def test_wait_beyond_maximum_raises_resource_exhausted(self, mock_try, mock_sleep):
+        from google.api_core import exceptions as core_exceptions
+        from .scheduler import BACKGROUND, acquire_gemini_slot
+
+        with patch('ai_integration.scheduler.get_redis_client', return_value=None):
+            with self.assertRaises(core_exceptions.ResourceExhausted):
+                acquire_gemini_slot(self.provider, BACKGROUND)
+        mock_sleep.assert_not_called()
+
+    @patch('ai_integration.scheduler.time.sleep')
+    @patch('ai_integration.scheduler.try_acquire_gemini_token', return_value=7.5)
+    def test_background_slot_returns_the_wait_without_sleeping(self, mock_try, mock_sleep):
+        from .scheduler import BACKGROUND, try_gemini_slot
+
+        self.assertEqual(try_gemini_slot(self.provider, BACKGROUND, waiter_id='task-1'), 7.5)
+
+        mock_sleep.assert_not_called()
+        self.assertEqual(mock_try.call_args.args[:3], (self.provider, BACKGROUND, 'task-1'))
+
+    @patch('ai_integration.scheduler.get_redis_client', return_value=None)
+    def test_rate_limit_response_holds_requests_until_reset(self, mock_redis):
+        from google.genai import errors as genai_errors
+        from .scheduler import INTERACTIVE, gemini_request, try_acquire_gemini_token
+
+        self.assertEqual(try_acquire_gemini_token(self.provider, INTERACTIVE, 'w1', 5), 0.0)
+
+        error = genai_errors.ClientError(429, {'error': {'code': 429, 'message': 'quota', 'status': 'RESOURCE_EXHAUSTED'}})
+        with override_settings(GEMINI_RATE_LIMIT_COOLDOWN_SECONDS=60):
+            with self.assertRaises(genai_errors.ClientError):
+                with gemini_request(self.provider, INTERACTIVE):
+                    raise error
+
+        self.provider.refresh_from_db()
+        self.assertEqual(self.provider.rate_limit_remaining, 0)
+        self.assertGreater(self.provider.rate_limit_reset_time, timezone.now())
+        self.assertGreater(try_acquire_gemini_token(self.provider, INTERACTIVE, 'w1', 5), 50)
@@ -0,0 +1,235 @@
+# whatsappcrm_backend/conversations/broadcasts.py
+
+"""
+Chunked, resumable broadcast dispatch.
+
+A Broadcast stores its audience and template instead of passing contact ids
+through the task payload. `dispatch_broadcast_chunk` takes the next
+BROADCAST_CHUNK_SIZE recipients after `Broadcast.dispatch_cursor` (contacts are
+processed in id order), creates their Message and BroadcastRecipient rows and
+advances the cursor in one short transaction, then queues the sends for that
+chunk. A crashed dispatch resumes from the cursor. Recipients of a chunk that
+was committed but not fully queued are picked up again, because messages are
+only created for contacts that have no BroadcastRecipient row yet, and every
+message still in 'pending_dispatch' is queued. Send tasks claim a message
+('queued') before sending it, so a message queued twice is sent once.
+
+Template components containing Jinja markup are personalized per recipient
+(see personalization.py); the render throughput is kept in
+`Broadcast.progress_metadata['personalization']`.
+
+Broadcast counters are re-aggregated from the recipients' Message statuses, so
+they reflect what Meta actually reported rather than what was queued.
+"""
+import bisect
+import logging
+import time
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from celery import current_app
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from .models import Broadcast, BroadcastRecipient, Contact, Message
+from .personalization import compile_components, render_recipient_components
+
+logger = logging.getLogger(__name__)
+
+
+def build_group_audience_filter(tags=None, assigned_agent_id=None) -> Q:
+    """CustomerProfile filter for a group broadcast: any of `tags`, or the assigned agent."""
+    profile_filters = Q()
+    if tags:
+        profile_filters |= reduce(or_, [Q(tags__contains=tag) for tag in tags])
+    if assigned_agent_id:
+        profile_filters |= Q(assigned_agent_id=assigned_agent_id)
+    return profile_filters
+
+
+def freeze_audience(audience: dict) -> dict:
+    """
+    Returns `audience` as it is stored on a Broadcast: an explicit contact list
+    is de-duplicated and sorted once here, so every chunk can bisect it.
+    """
+    if 'contact_ids' in audience:
+        return {**audience, 'contact_ids': sorted(set(audience['contact_ids']))}
+    return audience
+
+
+def next_recipient_ids(broadcast: Broadcast, limit: int) -> list:
+    """Returns up to `limit` contact ids after the broadcast's dispatch cursor, in id order."""
+    audience = broadcast.audience or {}
+    cursor = broadcast.dispatch_cursor
+    if 'contact_ids' in audience:
+        contact_ids = audience['contact_ids']  # Sorted by freeze_audience()
+        start = bisect.bisect_right(contact_ids, cursor)
+        chunk = contact_ids[start:start + limit]
+        # Drops ids of contacts deleted since the broadcast was created.
+        return sorted(Contact.objects.filter(id__in=chunk).values_list('id', flat=True))
+
+    from customer_data.models import CustomerProfile
+
+    profile_filters = build_group_audience_filter(audience.get('tags'), audience.get('assigned_agent_id'))
+    if not profile_filters:
+        return []
+    return list(
+        CustomerProfile.objects.filter(profile_filters, contact_id__gt=cursor)
+        .order_by('contact_id').values_list('contact_id', flat=True)[:limit]
+    )
+
+
+def build_template_payload(broadcast: Broadcast) -> dict:
+    from notifications.utils import get_versioned_template_name
+
+    return {
+        "name": get_versioned_template_name(broadcast.template_name),
+        "language": {"code": broadcast.language_code},
+        "components": broadcast.components_template or [],
+    }
+
+
+def _queue_sends(message_ids: list, config_id: int):
+    """
+    Queues send tasks for a chunk over a single broker connection: one task per
+    message, or one bulk-send task per batch when BROADCAST_SEND_MODE is 'bulk'.
+    """
+    from meta_integration.tasks import send_whatsapp_message_task, send_broadcast_batch_task
+
+    with current_app.producer_or_acquire() as producer:
+        if settings.BROADCAST_SEND_MODE == 'bulk':
+            batch_size = settings.BROADCAST_BULK_SEND_BATCH_SIZE
+            for start in range(0, len(message_ids), batch_size):
+                send_broadcast_batch_task.apply_async(
+                    args=[message_ids[start:start + batch_size], config_id], producer=producer
+                )
+            return
+        for message_id in message_ids:
+            send_whatsapp_message_task.apply_async(args=[message_id, config_id], producer=producer)
+
+
+def _record_personalization_progress(broadcast: Broadcast, rendered: int, seconds: float):
+    """Accumulates personalization throughput in the broadcast's progress metadata."""
+    stats = broadcast.progress_metadata.setdefault('personalization', {'recipients': 0, 'seconds': 0.0})
+    stats['recipients'] += rendered
+    stats['seconds'] = round(stats['seconds'] + seconds, 4)
+    stats['recipients_per_second'] = round(stats['recipients'] / stats['seconds'], 1) if stats['seconds'] else None
+
+
+def dispatch_broadcast_chunk(broadcast_id: int, config) -> bool:
+    """
+    Creates and queues the next chunk of a broadcast. Returns True if more
+    recipients may remain, False once the audience is exhausted.
+    """
+    chunk_size = settings.BROADCAST_CHUNK_SIZE
+    with transaction.atomic():
+        # The row lock keeps a redelivered or resumed task from dispatching the same chunk twice.
+        broadcast = Broadcast.objects.select_for_update().get(pk=broadcast_id)
+        if broadcast.status != 'in_progress':
+            return False
+        contact_ids = next_recipient_ids(broadcast, chunk_size)
+        if not contact_ids:
+            return False
+
+        already_created = set(
+            BroadcastRecipient.objects.filter(broadcast=broadcast, contact_id__in=contact_ids)
+            .values_list('contact_id', flat=True)
+        )
+        new_contact_ids = [contact_id for contact_id in contact_ids if contact_id not in already_created]
+        content_payload = build_template_payload(broadcast)
+        compiled = compile_components(broadcast.components_template)
+        personalized = {}
+        if not compiled.is_static and new_contact_ids:
+            started = time.perf_counter()
+            personalized = render_recipient_components(compiled, new_contact_ids)
+            _record_personalization_progress(broadcast, len(personalized), time.perf_counter() - started)
+
+        now = timezone.now()
+        new_messages = Message.objects.bulk_create([
+            Message(
+                contact_id=contact_id,
+                app_config=config,
+                direction='out',
+                message_type='template',
+                content_payload=(
+                    {**content_payload, 'components': personalized[contact_id]}
+                    if contact_id in personalized else content_payload
+                ),
+                status='pending_dispatch',
+                timestamp=now,
+            )
+            for contact_id in new_contact_ids
+        ])
+        BroadcastRecipient.objects.bulk_create([
+            BroadcastRecipient(broadcast=broadcast, contact_id=message.contact_id, message=message)
+            for message in new_messages
+        ])
+
+        broadcast.dispatch_cursor = contact_ids[-1]
+        broadcast.dispatched_count += len(new_messages)
+        broadcast.last_progress_at = now
+        broadcast.save(update_fields=['dispatch_cursor', 'dispatched_count', 'last_progress_at', 'progress_metadata'])
+
+    pending_ids = list(
+        Message.objects.filter(
+            broadcast_recipient__broadcast_id=broadcast_id,
+            contact_id__in=contact_ids,
+            status='pending_dispatch',
+        ).values_list('id', flat=True)
+    )
+    _queue_sends(pending_ids, config.id)
+    logger.info(
+        f"Broadcast {broadcast_id}: queued {len(pending_ids)} message(s) up to contact {contact_ids[-1]} "
+        f"({broadcast.dispatched_count} created so far)."
+    )
+    return len(contact_ids) == chunk_size
+
+
+def requeue_pending_messages(broadcast_id: int, config) -> int:
+    """
+    Queues the messages of a fully dispatched broadcast whose send task was
+    apparently lost: still 'pending_dispatch' BROADCAST_SEND_CLAIM_SECONDS after
+    they were created, or claimed ('queued') by a send that has not finished in
+    that time. Returns how many were queued.
+
+    Messages a send task is still waiting on (throttled, held by the outbound
+    sequencer, in a bulk batch) are left alone, and the send tasks claim a
+    message before sending it, so a re-queued copy can't send it twice.
+    """
+    expired_before = timezone.now() - timedelta(seconds=settings.BROADCAST_SEND_CLAIM_SECONDS)
+    expired = Message.objects.filter(broadcast_recipient__broadcast_id=broadcast_id).filter(
+        Q(status='pending_dispatch', timestamp__lt=expired_before)
+        | Q(status='queued', status_timestamp__lt=expired_before)
+    )
+    pending_ids = list(expired.values_list('id', flat=True))
+    if pending_ids:
+        # Expired claims go back to 'pending_dispatch' so the new send task can claim them.
+        Message.objects.filter(id__in=pending_ids, status='queued', status_timestamp__lt=expired_before).update(
+            status='pending_dispatch'
+        )
+        _queue_sends(pending_ids, config.id)
+    Broadcast.objects.filter(pk=broadcast_id).update(last_progress_at=timezone.now())
+    return len(pending_ids)
+
+
+def refresh_broadcast_counts(broadcast_id: int) -> Broadcast:
+    """
+    Recomputes the broadcast counters from its messages' statuses. Counts are
+    cumulative: a read message also counts as sent and delivered.
+    """
+    by_status = dict(
+        Message.objects.filter(broadcast_recipient__broadcast_id=broadcast_id)
+        .values_list('status').annotate(total=Count('id')).order_by()
+    )
+    counts = {
+        'pending_dispatch_count': by_status.get('pending_dispatch', 0) + by_status.get('queued', 0),
+        'sent_count': sum(by_status.get(s, 0) for s in ('sent', 'delivered', 'read')),
+        'delivered_count': sum(by_status.get(s, 0) for s in ('delivered', 'read')),
+        'read_count': by_status.get('read', 0),
+        'failed_count': by_status.get('failed', 0),
+    }
+    Broadcast.objects.filter(pk=broadcast_id).update(**counts)
+    return Broadcast.objects.get(pk=broadcast_id)
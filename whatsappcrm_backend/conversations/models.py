@@ -118,6 +118,7 @@ class Message(models.Model):
     # Status for outgoing messages, reflecting Meta's statuses
     STATUS_CHOICES = [
         ('pending_dispatch', 'Pending Dispatch'), # CRM has created it, queued for Celery task.
+        ('queued', 'Queued for Sending'), # A send task has claimed it; status_timestamp is the claim time.
         ('sent', 'Sent to Meta'),    # Meta API accepted it (wamid received)
         ('delivered', 'Delivered to User'),
         ('read', 'Read by User'),
@@ -269,6 +270,20 @@ class Broadcast(models.Model):
     read_count = models.PositiveIntegerField(default=0)
     failed_count = models.PositiveIntegerField(default=0)
 
+    # What to send and to whom. `audience` is either {'contact_ids': [...]} or
+    # {'tags': [...], 'assigned_agent_id': ...}; see conversations/broadcasts.py.
+    language_code = models.CharField(max_length=15, default='en_US')
+    components_template = models.JSONField(null=True, blank=True)
+    audience = models.JSONField(default=dict, blank=True)
+
+    # Dispatch checkpoint: recipients are processed in contact id order, so a
+    # resumed dispatch continues after the highest contact id already queued.
+    dispatch_cursor = models.PositiveBigIntegerField(default=0)
+    dispatched_count = models.PositiveIntegerField(default=0)
+    last_progress_at = models.DateTimeField(null=True, blank=True)
+    progress_metadata = models.JSONField(default=dict, blank=True, help_text="Dispatch statistics, e.g. personalization throughput.")
+    dispatch_completed_at = models.DateTimeField(null=True, blank=True, help_text="Set once every recipient's message has been queued.")
+
     def __str__(self):
         return f"Broadcast '{self.name}' ({self.template_name}) at {self.created_at.strftime('%Y-%m-%d %H:%M')}"
 
@@ -0,0 +1,145 @@
+# whatsappcrm_backend/conversations/personalization.py
+
+"""
+Per-recipient personalization of broadcast template components.
+
+The components of a broadcast are compiled once: every parameter value that
+contains Jinja markup (the same fields `_resolve_template_components` in
+flows/services.py resolves) is compiled with the flow engine's Jinja
+environment, and the `contact.*` / `customer_profile.*` attributes the
+templates reference are collected from their AST. Recipients are then loaded
+with one query that selects only those fields, and rendered in a tight loop
+against a pre-serialized copy of the components. The loop is plain: rendering
+is CPU-bound and the dispatching worker runs gevent, so a thread pool would add
+no parallelism.
+"""
+import json
+import logging
+from functools import lru_cache
+
+from jinja2 import nodes
+
+from .models import Contact
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_MARKERS = ('{{', '{%')
+
+
+def _parameter_value_keys(component: dict, param: dict):
+    """Key paths of the personalizable string values of one template parameter."""
+    if 'text' in param:
+        yield ('text',)
+    param_type = param.get('type')
+    if param_type in ('image', 'video', 'document') and isinstance(param.get(param_type), dict):
+        yield (param_type, 'link')
+    if component.get('type') == 'button' and param_type == 'payload':
+        yield ('payload',)
+
+
+def _lookup(obj: dict, keys: tuple):
+    for key in keys:
+        if not isinstance(obj, dict) or key not in obj:
+            return None
+        obj = obj[key]
+    return obj
+
+
+def _referenced_fields(ast, contact_fields: set, profile_fields: set):
+    for node in ast.find_all(nodes.Getattr):
+        owner = node.node
+        if isinstance(owner, nodes.Name) and owner.name == 'contact':
+            contact_fields.add(node.attr)
+        elif isinstance(owner, nodes.Name) and owner.name == 'customer_profile':
+            profile_fields.add(node.attr)
+        elif (isinstance(owner, nodes.Getattr) and owner.attr == 'customer_profile'
+              and isinstance(owner.node, nodes.Name) and owner.node.name == 'contact'):
+            profile_fields.add(node.attr)
+
+
+class CompiledComponents:
+    """Template components with their Jinja parameters compiled once."""
+
+    def __init__(self, components: list):
+        from flows.services import jinja_env, get_compiled_template
+
+        components = components if isinstance(components, list) else []
+        self.base_json = json.dumps(components)
+        self.slots = []  # (component index, parameter index, key path, compiled template, source)
+        self.contact_fields, self.profile_fields = set(), set()
+        for component_index, component in enumerate(components):
+            params = component.get('parameters') if isinstance(component, dict) else None
+            if not isinstance(params, list):
+                continue
+            for param_index, param in enumerate(params):
+                if not isinstance(param, dict):
+                    continue
+                for keys in _parameter_value_keys(component, param):
+                    source = _lookup(param, keys)
+                    if not isinstance(source, str) or not any(marker in source for marker in TEMPLATE_MARKERS):
+                        continue
+                    try:
+                        template = get_compiled_template(source)
+                        _referenced_fields(jinja_env.parse(source), self.contact_fields, self.profile_fields)
+                    except Exception as e:
+                        logger.error(f"Broadcast personalization: could not compile '{source}': {e}")
+                        continue
+                    self.slots.append((component_index, param_index, keys, template, source))
+
+    @property
+    def is_static(self) -> bool:
+        return not self.slots
+
+    def render(self, contact) -> list:
+        components = json.loads(self.base_json)
+        context = {'contact': contact, 'customer_profile': getattr(contact, 'customer_profile', None)}
+        for component_index, param_index, keys, template, source in self.slots:
+            try:
+                value = template.render(context)
+            except Exception as e:
+                logger.error(f"Jinja2 template rendering failed for contact {contact.id}: {e}. Template: '{source}'")
+                value = source
+            target = components[component_index]['parameters'][param_index]
+            for key in keys[:-1]:
+                target = target[key]
+            target[keys[-1]] = value
+        return components
+
+
+@lru_cache(maxsize=64)
+def _compile_cached(components_json: str) -> CompiledComponents:
+    return CompiledComponents(json.loads(components_json))
+
+
+def compile_components(components) -> CompiledComponents:
+    """Returns the compiled form of `components`, compiling each distinct template set once per process."""
+    return _compile_cached(json.dumps(components or [], sort_keys=True))
+
+
+def _recipient_queryset(compiled: CompiledComponents, contact_ids):
+    from customer_data.models import CustomerProfile
+
+    queryset = Contact.objects.filter(id__in=contact_ids)
+    needs_profile = bool(compiled.profile_fields) or 'customer_profile' in compiled.contact_fields
+    if needs_profile:
+        queryset = queryset.select_related('customer_profile')
+
+    # Restrict the SELECT to the referenced columns, unless a template uses a
+    # property or relation, which may need any field.
+    contact_columns = {field.name for field in Contact._meta.concrete_fields}
+    profile_columns = {field.name for field in CustomerProfile._meta.concrete_fields}
+    contact_fields = compiled.contact_fields - {'customer_profile'}
+    if contact_fields <= contact_columns and compiled.profile_fields <= profile_columns:
+        only = {'id', *contact_fields}
+        if needs_profile:
+            only |= {f"customer_profile__{field}" for field in compiled.profile_fields | {'contact'}}
+        queryset = queryset.only(*only)
+    return queryset
+
+
+def render_recipient_components(compiled: CompiledComponents, contact_ids: list) -> dict:
+    """
+    Renders the compiled components for every contact in `contact_ids` and
+    returns {contact_id: components}.
+    """
+    return {contact.id: compiled.render(contact) for contact in _recipient_queryset(compiled, contact_ids)}
@@ -261,5 +261,5 @@ class BroadcastSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'name', 'template_name', 'created_by_username', 'created_at', 'status',
             'total_recipients', 'pending_dispatch_count', 'sent_count', 'delivered_count',
-            'read_count', 'failed_count'
+            'read_count', 'failed_count', 'dispatched_count', 'progress_metadata'
         ]
\ No newline at end of file
@@ -10,11 +10,11 @@ from .serializers import MessageSerializer
 import logging
 logger = logging.getLogger(__name__)
 
-@receiver(post_save, sender=Message)
-def on_new_or_updated_message(sender, instance, created, **kwargs):
+def broadcast_message_update(instance):
     """
-    When a Message is saved, serialize it and broadcast it to the
-    corresponding conversation group.
+    Serializes a Message and broadcasts it to the corresponding conversation group.
+    Also used directly by code paths that update messages with bulk_update(),
+    which does not fire post_save.
     """
     try:
         channel_layer = get_channel_layer()
@@ -35,7 +35,16 @@ def on_new_or_updated_message(sender, instance, created, **kwargs):
         )
         logger.info(f"Broadcasted message {instance.id} to group {conversation_group_name}")
     except Exception as e:
-        logger.error(f"Error in on_new_or_updated_message signal for message {instance.id}: {e}", exc_info=True)
+        logger.error(f"Error broadcasting message {instance.id}: {e}", exc_info=True)
+
+
+@receiver(post_save, sender=Message)
+def on_new_or_updated_message(sender, instance, created, **kwargs):
+    """
+    When a Message is saved, serialize it and broadcast it to the
+    corresponding conversation group.
+    """
+    broadcast_message_update(instance)
 
     # --- NEW: Clear human intervention flag on agent reply ---
     # If an outgoing message is sent, it implies an agent has responded.
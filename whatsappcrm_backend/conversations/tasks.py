@@ -1,77 +1,54 @@
 # conversations/tasks.py
 from celery import shared_task
 import logging
+from datetime import timedelta
 from django.utils import timezone
-from django.db import transaction
 from django.conf import settings
 
-from .models import Broadcast, BroadcastRecipient, Contact, Message
+from .models import Broadcast
+from .broadcasts import dispatch_broadcast_chunk, freeze_audience, refresh_broadcast_counts, requeue_pending_messages
 from meta_integration.models import MetaAppConfig
-from meta_integration.tasks import send_whatsapp_message_task
-from notifications.utils import get_versioned_template_name
-# from flows.services import _resolve_value # For advanced personalization
 
 logger = logging.getLogger(__name__)
 
 @shared_task(bind=True, max_retries=3)
-def dispatch_broadcast_task(self, broadcast_id, contact_ids, language_code, components_template):
+def dispatch_broadcast_task(self, broadcast_id, contact_ids=None, language_code=None, components_template=None):
     """
-    Celery task to fetch a broadcast, create individual messages for each recipient,
-    and queue them for sending.
+    Celery task that dispatches one chunk of a broadcast (see conversations/broadcasts.py)
+    and re-queues itself for the next chunk until the audience is exhausted.
+
+    The audience and template are read from the Broadcast row. `contact_ids`,
+    `language_code` and `components_template` are only accepted for tasks queued
+    before they were stored there.
     """
     try:
-        with transaction.atomic():
-            broadcast = Broadcast.objects.get(pk=broadcast_id)
-            if broadcast.status not in ['pending', 'failed']:
-                logger.warning(f"Broadcast {broadcast_id} is already in progress or completed. Skipping.")
-                return
-
+        broadcast = Broadcast.objects.get(pk=broadcast_id)
+        if broadcast.status in ['pending', 'failed']:
+            update_fields = ['status', 'last_progress_at']
+            if contact_ids and not broadcast.audience:
+                broadcast.audience = freeze_audience({'contact_ids': contact_ids})
+                broadcast.language_code = language_code or broadcast.language_code
+                broadcast.components_template = components_template
+                update_fields += ['audience', 'language_code', 'components_template']
             broadcast.status = 'in_progress'
-            broadcast.save(update_fields=['status'])
-
-            active_config = MetaAppConfig.objects.get_active_config()
-            contacts = Contact.objects.filter(id__in=contact_ids)
-            
-            logger.info(f"Starting broadcast {broadcast_id} for {contacts.count()} recipients.")
-
-            messages_to_create = []
+            broadcast.last_progress_at = timezone.now()
+            broadcast.save(update_fields=update_fields)
+            logger.info(
+                f"Starting broadcast {broadcast_id} for {broadcast.total_recipients} recipients "
+                f"(resuming after contact {broadcast.dispatch_cursor})."
+            )
+        elif broadcast.status != 'in_progress' or broadcast.dispatch_completed_at:
+            logger.warning(f"Broadcast {broadcast_id} is already completed or cancelled. Skipping.")
+            return
 
-            for contact in contacts:
-                # TODO: Implement advanced personalization using a service like _resolve_value
-                # from flows.services if you need to substitute variables like {{name}}.
-                
-                # Append version suffix to template name when sending to Meta
-                template_name_with_version = get_versioned_template_name(broadcast.template_name)
-                
-                content_payload = {
-                    "name": template_name_with_version,
-                    "language": {"code": language_code},
-                    "components": components_template or []
-                }
+        active_config = MetaAppConfig.objects.get_active_config()
+        if dispatch_broadcast_chunk(broadcast_id, active_config):
+            dispatch_broadcast_task.apply_async(args=[broadcast_id])
+            return
 
-                message = Message(
-                    contact=contact,
-                    app_config=active_config,
-                    direction='out',
-                    message_type='template',
-                    content_payload=content_payload,
-                    status='pending_dispatch',
-                    timestamp=timezone.now(),
-                )
-                messages_to_create.append(message)
-
-            created_messages = Message.objects.bulk_create(messages_to_create)
-            
-            broadcast_recipients = [BroadcastRecipient(broadcast=broadcast, contact=msg.contact, message=msg) for msg in created_messages]
-            BroadcastRecipient.objects.bulk_create(broadcast_recipients)
-
-            for message in created_messages:
-                send_whatsapp_message_task.delay(message.id, active_config.id)
-
-            broadcast.status = 'completed'
-            broadcast.pending_dispatch_count = contacts.count()
-            broadcast.save(update_fields=['status', 'pending_dispatch_count'])
-            logger.info(f"All messages for broadcast {broadcast_id} have been queued.")
+        Broadcast.objects.filter(pk=broadcast_id, status='in_progress').update(dispatch_completed_at=timezone.now())
+        logger.info(f"All messages for broadcast {broadcast_id} have been queued.")
+        refresh_broadcast_progress_task.apply_async(args=[broadcast_id], countdown=settings.BROADCAST_PROGRESS_REFRESH_SECONDS)
 
     except Broadcast.DoesNotExist:
         logger.warning(f"Broadcast with ID {broadcast_id} was not found. Task will not be retried.")
@@ -79,6 +56,76 @@ def dispatch_broadcast_task(self, broadcast_id, contact_ids, language_code, comp
         logger.error(f"No active MetaAppConfig found for broadcast {broadcast_id}. Aborting and marking as failed.")
         Broadcast.objects.filter(pk=broadcast_id).update(status='failed')
     except Exception as exc:
+        # The checkpoint on the Broadcast row lets the retry resume where this attempt stopped.
         logger.error(f"Error dispatching broadcast {broadcast_id}: {exc}. Retrying...")
         Broadcast.objects.filter(pk=broadcast_id).update(status='failed')
         raise self.retry(exc=exc, countdown=60)
+
+
+@shared_task(name="conversations.refresh_broadcast_progress_task")
+def refresh_broadcast_progress_task(broadcast_id, checks_left=None):
+    """
+    Re-aggregates a fully queued broadcast's sent/delivered/read/failed counts and
+    marks it completed once no message is pending dispatch any more. Re-schedules
+    itself while messages are pending, up to BROADCAST_PROGRESS_MAX_CHECKS times;
+    a broadcast still pending after that stays in progress, and
+    resume_stalled_broadcasts_task re-queues its pending messages.
+    """
+    if checks_left is None:
+        checks_left = settings.BROADCAST_PROGRESS_MAX_CHECKS
+    try:
+        broadcast = refresh_broadcast_counts(broadcast_id)
+    except Broadcast.DoesNotExist:
+        return
+    if broadcast.status != 'in_progress':
+        return
+    if broadcast.pending_dispatch_count == 0:
+        Broadcast.objects.filter(pk=broadcast_id).update(status='completed')
+        logger.info(
+            f"Broadcast {broadcast_id} completed: {broadcast.sent_count} sent, {broadcast.failed_count} failed."
+        )
+        return
+    if checks_left <= 1:
+        logger.warning(
+            f"Broadcast {broadcast_id} still has {broadcast.pending_dispatch_count} message(s) pending dispatch "
+            f"after {settings.BROADCAST_PROGRESS_MAX_CHECKS} checks; leaving it in progress for the stall sweep."
+        )
+        return
+    refresh_broadcast_progress_task.apply_async(
+        args=[broadcast_id], kwargs={'checks_left': checks_left - 1},
+        countdown=settings.BROADCAST_PROGRESS_REFRESH_SECONDS,
+    )
+
+
+@shared_task(name="conversations.resume_stalled_broadcasts_task")
+def resume_stalled_broadcasts_task():
+    """
+    Re-queues dispatch for in-progress broadcasts that have made no progress for
+    BROADCAST_STALL_SECONDS (e.g. the dispatching worker died between chunks).
+    Fully dispatched broadcasts that still have unsent messages get the ones whose
+    send was lost re-queued (see requeue_pending_messages) and their progress
+    refresh restarted.
+    """
+    stalled_before = timezone.now() - timedelta(seconds=settings.BROADCAST_STALL_SECONDS)
+    stalled = Broadcast.objects.filter(status='in_progress', last_progress_at__lt=stalled_before)
+    stalled_ids = list(stalled.filter(dispatch_completed_at__isnull=True).values_list('id', flat=True))
+    for broadcast_id in stalled_ids:
+        logger.warning(f"Broadcast {broadcast_id} stalled; resuming dispatch from its checkpoint.")
+        dispatch_broadcast_task.apply_async(args=[broadcast_id])
+
+    undelivered_ids = list(
+        stalled.filter(dispatch_completed_at__isnull=False, pending_dispatch_count__gt=0).values_list('id', flat=True)
+    )
+    if undelivered_ids:
+        try:
+            active_config = MetaAppConfig.objects.get_active_config()
+        except MetaAppConfig.DoesNotExist:
+            logger.error(f"No active MetaAppConfig; cannot re-queue pending messages of broadcasts {undelivered_ids}.")
+            return len(stalled_ids)
+        for broadcast_id in undelivered_ids:
+            requeued = requeue_pending_messages(broadcast_id, active_config)
+            logger.warning(f"Broadcast {broadcast_id} stalled after dispatch; re-queued {requeued} pending message(s).")
+            refresh_broadcast_progress_task.apply_async(
+                args=[broadcast_id], countdown=settings.BROADCAST_PROGRESS_REFRESH_SECONDS
+            )
+    return len(stalled_ids) + len(undelivered_ids)
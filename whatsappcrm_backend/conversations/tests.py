@@ -1,3 +1,216 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from unittest.mock import patch
 
-# Create your tests here.
+from .models import Broadcast, BroadcastRecipient, Contact, Message
+
+
+@override_settings(BROADCAST_CHUNK_SIZE=2)
+class BroadcastDispatchTestCase(TestCase):
+    """Tests for chunked, checkpointed broadcast dispatch."""
+
+    def setUp(self):
+        from meta_integration.models import MetaAppConfig
+        self.config = MetaAppConfig.objects.create(
+            name='Broadcast Config', verify_token='verify', access_token='token',
+            phone_number_id='777000111', waba_id='waba', is_active=True,
+        )
+        self.contacts = Contact.objects.bulk_create([
+            Contact(whatsapp_id=f'26377100000{i}', name=f'Recipient {i}') for i in range(5)
+        ])
+        self.broadcast = Broadcast.objects.create(
+            name='Promo', template_name='promo', status='in_progress', total_recipients=5,
+            audience={'contact_ids': [c.id for c in self.contacts]},
+        )
+
+    @patch('conversations.broadcasts._queue_sends')
+    def test_chunk_advances_checkpoint(self, mock_queue):
+        from .broadcasts import dispatch_broadcast_chunk
+
+        self.assertTrue(dispatch_broadcast_chunk(self.broadcast.id, self.config))
+
+        self.broadcast.refresh_from_db()
+        self.assertEqual(self.broadcast.dispatch_cursor, self.contacts[1].id)
+        self.assertEqual(self.broadcast.dispatched_count, 2)
+        self.assertEqual(BroadcastRecipient.objects.filter(broadcast=self.broadcast).count(), 2)
+        self.assertEqual(len(mock_queue.call_args[0][0]), 2)
+
+    @patch('conversations.broadcasts._queue_sends')
+    def test_resumed_chunk_requeues_without_duplicating(self, mock_queue):
+        from .broadcasts import dispatch_broadcast_chunk
+
+        dispatch_broadcast_chunk(self.broadcast.id, self.config)
+        # Simulate a crash after the chunk committed but before the cursor moved on.
+        Broadcast.objects.filter(pk=self.broadcast.id).update(dispatch_cursor=0)
+        dispatch_broadcast_chunk(self.broadcast.id, self.config)
+
+        self.assertEqual(BroadcastRecipient.objects.filter(broadcast=self.broadcast).count(), 2)
+        self.assertEqual(len(mock_queue.call_args[0][0]), 2)
+
+    @patch('conversations.broadcasts._queue_sends')
+    def test_last_chunk_reports_exhausted(self, mock_queue):
+        from .broadcasts import dispatch_broadcast_chunk
+
+        results = [dispatch_broadcast_chunk(self.broadcast.id, self.config) for _ in range(4)]
+
+        self.assertEqual(results, [True, True, False, False])
+        self.assertEqual(BroadcastRecipient.objects.filter(broadcast=self.broadcast).count(), 5)
+
+    def test_refresh_counts_from_message_statuses(self):
+        from .broadcasts import refresh_broadcast_counts
+
+        for contact, status_value in zip(self.contacts, ['pending_dispatch', 'sent', 'delivered', 'read', 'failed']):
+            message = Message.objects.bulk_create([
+                Message(contact=contact, app_config=self.config, direction='out', message_type='template',
+                        content_payload={}, status=status_value),
+            ])[0]
+            BroadcastRecipient.objects.create(broadcast=self.broadcast, contact=contact, message=message)
+
+        broadcast = refresh_broadcast_counts(self.broadcast.id)
+
+        self.assertEqual(broadcast.pending_dispatch_count, 1)
+        self.assertEqual(broadcast.sent_count, 3)
+        self.assertEqual(broadcast.delivered_count, 2)
+        self.assertEqual(broadcast.read_count, 1)
+        self.assertEqual(broadcast.failed_count, 1)
+
+
+    def test_freeze_audience_sorts_contact_ids_once(self):
+        from .broadcasts import freeze_audience
+
+        self.assertEqual(freeze_audience({'contact_ids': [5, 3, 5, 1]}), {'contact_ids': [1, 3, 5]})
+        self.assertEqual(freeze_audience({'tags': ['vip']}), {'tags': ['vip']})
+
+    @patch('conversations.tasks.refresh_broadcast_progress_task.apply_async')
+    def test_progress_checks_running_out_leave_broadcast_in_progress(self, mock_reschedule):
+        from .tasks import refresh_broadcast_progress_task
+
+        message = Message.objects.bulk_create([
+            Message(contact=self.contacts[0], app_config=self.config, direction='out', message_type='template',
+                    content_payload={}, status='pending_dispatch'),
+        ])[0]
+        BroadcastRecipient.objects.create(broadcast=self.broadcast, contact=self.contacts[0], message=message)
+
+        refresh_broadcast_progress_task(self.broadcast.id, checks_left=1)
+
+        self.broadcast.refresh_from_db()
+        self.assertEqual(self.broadcast.status, 'in_progress')
+        mock_reschedule.assert_not_called()
+
+    @override_settings(BROADCAST_STALL_SECONDS=60, BROADCAST_SEND_CLAIM_SECONDS=60)
+    @patch('conversations.tasks.refresh_broadcast_progress_task.apply_async')
+    @patch('conversations.broadcasts._queue_sends')
+    def test_stall_sweep_requeues_pending_messages_of_dispatched_broadcast(self, mock_queue, mock_refresh):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .tasks import resume_stalled_broadcasts_task
+
+        long_ago = timezone.now() - timedelta(minutes=10)
+        message = Message.objects.bulk_create([
+            Message(contact=self.contacts[0], app_config=self.config, direction='out', message_type='template',
+                    content_payload={}, status='pending_dispatch', timestamp=long_ago),
+        ])[0]
+        BroadcastRecipient.objects.create(broadcast=self.broadcast, contact=self.contacts[0], message=message)
+        Broadcast.objects.filter(pk=self.broadcast.id).update(
+            dispatch_completed_at=long_ago, last_progress_at=long_ago, pending_dispatch_count=1,
+        )
+
+        self.assertEqual(resume_stalled_broadcasts_task(), 1)
+
+        mock_queue.assert_called_once_with([message.id], self.config.id)
+        mock_refresh.assert_called_once()
+
+    @override_settings(BROADCAST_SEND_CLAIM_SECONDS=60)
+    @patch('conversations.broadcasts._queue_sends')
+    def test_requeue_skips_sends_that_are_still_in_progress(self, mock_queue):
+        from datetime import timedelta
+        from django.utils import timezone
+        from .broadcasts import requeue_pending_messages
+
+        now = timezone.now()
+        long_ago = now - timedelta(minutes=10)
+        fresh_pending, claimed, expired_claim, delivered = Message.objects.bulk_create([
+            Message(contact=self.contacts[0], app_config=self.config, direction='out', message_type='template',
+                    content_payload={}, status='pending_dispatch', timestamp=now),
+            Message(contact=self.contacts[1], app_config=self.config, direction='out', message_type='template',
+                    content_payload={}, status='queued', timestamp=long_ago, status_timestamp=now),
+            Message(contact=self.contacts[2], app_config=self.config, direction='out', message_type='template',
+                    content_payload={}, status='queued', timestamp=long_ago, status_timestamp=long_ago),
+            Message(contact=self.contacts[3], app_config=self.config, direction='out', message_type='template',
+                    content_payload={}, status='delivered', timestamp=long_ago, status_timestamp=long_ago),
+        ])
+        BroadcastRecipient.objects.bulk_create([
+            BroadcastRecipient(broadcast=self.broadcast, contact_id=message.contact_id, message=message)
+            for message in (fresh_pending, claimed, expired_claim, delivered)
+        ])
+
+        self.assertEqual(requeue_pending_messages(self.broadcast.id, self.config), 1)
+
+        mock_queue.assert_called_once_with([expired_claim.id], self.config.id)
+        expired_claim.refresh_from_db()
+        self.assertEqual(expired_claim.status, 'pending_dispatch')
+
+
+class BroadcastPersonalizationTestCase(TestCase):
+    """Tests for compiled per-recipient broadcast personalization."""
+
+    COMPONENTS = [{
+        'type': 'body',
+        'parameters': [
+            {'type': 'text', 'text': 'Hi {{ customer_profile.first_name or contact.name }}'},
+            {'type': 'text', 'text': 'static'},
+        ],
+    }]
+
+    def setUp(self):
+        from customer_data.models import CustomerProfile
+        self.with_profile, self.without_profile = Contact.objects.bulk_create([
+            Contact(whatsapp_id='263773000001', name='Tendai'),
+            Contact(whatsapp_id='263773000002', name='Rudo'),
+        ])
+        CustomerProfile.objects.create(contact=self.with_profile, first_name='Tee')
+
+    def test_compiles_only_templated_parameters(self):
+        from .personalization import compile_components
+
+        compiled = compile_components(self.COMPONENTS)
+
+        self.assertEqual(len(compiled.slots), 1)
+        self.assertEqual(compiled.profile_fields, {'first_name'})
+        self.assertEqual(compiled.contact_fields, {'name'})
+        self.assertIs(compile_components(self.COMPONENTS), compiled)
+        self.assertTrue(compile_components([{'type': 'body', 'parameters': [{'type': 'text', 'text': 'x'}]}]).is_static)
+
+    def test_renders_each_recipient(self):
+        from .personalization import compile_components, render_recipient_components
+
+        rendered = render_recipient_components(
+            compile_components(self.COMPONENTS), [self.with_profile.id, self.without_profile.id]
+        )
+
+        self.assertEqual(rendered[self.with_profile.id][0]['parameters'][0]['text'], 'Hi Tee')
+        self.assertEqual(rendered[self.without_profile.id][0]['parameters'][0]['text'], 'Hi Rudo')
+        self.assertEqual(rendered[self.with_profile.id][0]['parameters'][1]['text'], 'static')
+        # The compiled base is not mutated between recipients.
+        self.assertIn('{{', compile_components(self.COMPONENTS).base_json)
+
+    @patch('conversations.broadcasts._queue_sends')
+    def test_chunk_stores_personalized_payloads_and_throughput(self, mock_queue):
+        from meta_integration.models import MetaAppConfig
+        from .broadcasts import dispatch_broadcast_chunk
+
+        config = MetaAppConfig.objects.create(
+            name='Personalization Config', verify_token='verify', access_token='token',
+            phone_number_id='777000222', waba_id='waba', is_active=True,
+        )
+        broadcast = Broadcast.objects.create(
+            name='Hello', template_name='hello', status='in_progress', total_recipients=2,
+            audience={'contact_ids': [self.with_profile.id, self.without_profile.id]},
+            components_template=self.COMPONENTS,
+        )
+
+        dispatch_broadcast_chunk(broadcast.id, config)
+
+        message = Message.objects.get(broadcast_recipient__broadcast=broadcast, contact=self.with_profile)
+        self.assertEqual(message.content_payload['components'][0]['parameters'][0]['text'], 'Hi Tee')
+        broadcast.refresh_from_db()
+        self.assertEqual(broadcast.progress_metadata['personalization']['recipients'], 2)
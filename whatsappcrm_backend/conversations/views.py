@@ -4,15 +4,13 @@ from rest_framework import viewsets, permissions, status, mixins
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.db.models import Q, Prefetch, Subquery, OuterRef, Count, F
-from functools import reduce
-from operator import or_
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 import logging # Make sure logging is imported
 
-from .models import Contact, Message
+from .models import Contact, Message, Broadcast
 from .serializers import (
     ContactSerializer,
     MessageSerializer,
@@ -24,6 +22,7 @@ from .serializers import (
     BroadcastGroupCreateSerializer,
 )
 from .tasks import dispatch_broadcast_task
+from .broadcasts import build_group_audience_filter, freeze_audience
 # To get active MetaAppConfig for sending
 from meta_integration.models import MetaAppConfig
 from customer_data.models import CustomerProfile
@@ -263,17 +262,15 @@ class BroadcastViewSet(viewsets.ViewSet):
             template_name=validated_data['template_name'],
             created_by=request.user,
             status='pending',
-            total_recipients=len(validated_data['contact_ids'])
+            total_recipients=len(validated_data['contact_ids']),
+            language_code=validated_data['language_code'],
+            components_template=validated_data.get('components'),
+            audience=freeze_audience({'contact_ids': validated_data['contact_ids']}),
         )
         logger.info(f"Created Broadcast object {broadcast.id} for {broadcast.total_recipients} recipients.")
 
-        # Dispatch a single Celery task to handle the entire broadcast job
-        dispatch_broadcast_task.delay(
-            broadcast_id=broadcast.id,
-            contact_ids=validated_data['contact_ids'],
-            language_code=validated_data['language_code'],
-            components_template=validated_data.get('components')
-        )
+        # Dispatch the chunked broadcast job; it reads the audience from the Broadcast row.
+        dispatch_broadcast_task.delay(broadcast_id=broadcast.id)
 
         # Immediately return the created Broadcast object to the client
         response_serializer = BroadcastSerializer(broadcast)
@@ -293,21 +290,12 @@ class BroadcastViewSet(viewsets.ViewSet):
         tags = validated_data.get('tags', [])
         agent_id = validated_data.get('assigned_agent_id')
 
-        # Build the filter for CustomerProfile
-        profile_filters = Q()
-        if tags:
-            # Create a Q object for each tag and combine with OR
-            tag_queries = [Q(tags__contains=tag) for tag in tags]
-            profile_filters |= reduce(or_, tag_queries)
-        
-        if agent_id:
-            # This will OR with the tag query if it exists
-            profile_filters |= Q(assigned_agent_id=agent_id)
-
-        # Get the primary keys (which are contact_ids) of the matching profiles
-        contact_ids = list(CustomerProfile.objects.filter(profile_filters).values_list('contact_id', flat=True))
+        # Contacts with ANY of the tags, OR assigned to the agent. The dispatcher
+        # re-applies the same filter in chunks, so only the count is needed here.
+        profile_filters = build_group_audience_filter(tags, agent_id)
+        recipient_count = CustomerProfile.objects.filter(profile_filters).count()
 
-        if not contact_ids:
+        if not recipient_count:
             return Response({"message": "No contacts found matching the specified criteria."}, status=status.HTTP_404_NOT_FOUND)
 
         # Create the parent Broadcast object
@@ -316,17 +304,15 @@ class BroadcastViewSet(viewsets.ViewSet):
             template_name=validated_data['template_name'],
             created_by=request.user,
             status='pending',
-            total_recipients=len(contact_ids)
+            total_recipients=recipient_count,
+            language_code=validated_data['language_code'],
+            components_template=validated_data.get('components'),
+            audience={'tags': tags, 'assigned_agent_id': agent_id},
         )
         logger.info(f"Created Broadcast object {broadcast.id} for {broadcast.total_recipients} recipients based on group criteria.")
 
         # Dispatch the Celery task
-        dispatch_broadcast_task.delay(
-            broadcast_id=broadcast.id,
-            contact_ids=contact_ids,
-            language_code=validated_data['language_code'],
-            components_template=validated_data.get('components')
-        )
+        dispatch_broadcast_task.delay(broadcast_id=broadcast.id)
 
         response_serializer = BroadcastSerializer(broadcast)
         return Response(response_serializer.data, status=status.HTTP_202_ACCEPTED)
\ No newline at end of file
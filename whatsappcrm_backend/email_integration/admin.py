@@ -7,7 +7,7 @@ import smtplib
 import imaplib
 import ssl
 from email.mime.text import MIMEText
-from .models import EmailAttachment, ParsedInvoice, EmailAccount, AdminEmailRecipient, SMTPConfig
+from .models import EmailAttachment, ParsedInvoice, EmailAccount, AdminEmailRecipient, SMTPConfig, AttachmentExtractionCache
 from .tasks import process_attachment_with_gemini
 
 logger = logging.getLogger(__name__)
@@ -249,11 +249,11 @@ class EmailAttachmentAdmin(admin.ModelAdmin):
     list_display = ('filename', 'sender', 'processed', 'email_date', 'saved_at')
     list_filter = ('processed', 'email_date', 'sender')
     search_fields = ('filename', 'sender', 'subject')
-    readonly_fields = ('saved_at', 'updated_at', 'pretty_extracted_data')
+    readonly_fields = ('saved_at', 'updated_at', 'pretty_extracted_data', 'content_sha256')
     actions = [retrigger_gemini_processing, mark_as_unprocessed, mark_as_processed]
     fieldsets = (
         (None, {'fields': ('filename', 'sender', 'subject', 'email_date', 'processed')}),
-        ('File Info', {'fields': ('file',)}),
+        ('File Info', {'fields': ('file', 'content_sha256')}),
         ('Extracted Data', {'fields': ('pretty_extracted_data',)}),
         ('Timestamps', {'fields': ('saved_at', 'updated_at')}),
     )
@@ -267,6 +267,13 @@ class EmailAttachmentAdmin(admin.ModelAdmin):
         return "No data extracted."
     pretty_extracted_data.short_description = "Extracted Data (Formatted)"
 
+@admin.register(AttachmentExtractionCache)
+class AttachmentExtractionCacheAdmin(admin.ModelAdmin):
+    list_display = ('content_sha256', 'schema_version', 'source_attachment', 'updated_at')
+    list_filter = ('schema_version',)
+    search_fields = ('content_sha256',)
+    readonly_fields = ('content_sha256', 'schema_version', 'extracted_data', 'source_attachment', 'created_at', 'updated_at')
+
 @admin.register(ParsedInvoice)
 class ParsedInvoiceAdmin(admin.ModelAdmin):
     list_display = ('invoice_number', 'attachment_filename', 'invoice_date', 'total_amount')
@@ -9,7 +9,7 @@ from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from email.utils import parsedate_to_datetime
 
-from email_integration.tasks import process_attachment_with_gemini
+from email_integration.tasks import attachment_content_sha256, process_attachment_with_gemini
 from email_integration.models import EmailAttachment, EmailAccount
 
 class Command(BaseCommand):
@@ -68,7 +68,8 @@ class Command(BaseCommand):
                                     filename=filename,
                                     sender=sender,
                                     subject=subject,
-                                    email_date=email_date_obj
+                                    email_date=email_date_obj,
+                                    content_sha256=attachment_content_sha256(file_content),
                                 )
                                 self.stdout.write(self.style.SUCCESS(f"Saved attachment: {filename} (DB id: {attachment.id}) from account '{account.name}'"))
                                 
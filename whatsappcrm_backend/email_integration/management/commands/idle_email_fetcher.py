@@ -14,7 +14,7 @@ from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from email.utils import parsedate_to_datetime
 
-from email_integration.tasks import process_attachment_with_gemini
+from email_integration.tasks import attachment_content_sha256, process_attachment_with_gemini
 from email_integration.models import EmailAttachment, EmailAccount
 
 logger = logging.getLogger(__name__)
@@ -46,7 +46,8 @@ def process_message(account, message_data):
                 filename=filename,
                 sender=sender,
                 subject=subject,
-                email_date=email_date_obj
+                email_date=email_date_obj,
+                content_sha256=attachment_content_sha256(file_content),
             )
             logger.info(f"Saved attachment: {filename} (DB id: {attachment.id}) from account '{account.name}'")
             
@@ -71,7 +72,7 @@ from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 from email.utils import parsedate_to_datetime
 
-from email_integration.tasks import process_attachment_with_gemini
+from email_integration.tasks import attachment_content_sha256, process_attachment_with_gemini
 from email_integration.models import EmailAttachment, EmailAccount
 
 logger = logging.getLogger(__name__)
@@ -103,7 +104,8 @@ def process_message(account, message_data):
                 filename=filename,
                 sender=sender,
                 subject=subject,
-                email_date=email_date_obj
+                email_date=email_date_obj,
+                content_sha256=attachment_content_sha256(file_content),
             )
             logger.info(f"Saved attachment: {filename} (DB id: {attachment.id}) from account '{account.name}'")
             
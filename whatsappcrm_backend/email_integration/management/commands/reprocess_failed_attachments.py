@@ -13,6 +13,10 @@ class Command(BaseCommand):
     A "failed" attachment is identified as one where `processed` is True, but the
     `extracted_data` JSON field contains `{'status': 'failed'}`. This command
     resets the status and re-triggers the Celery task.
+
+    `--ids` re-queues the given attachments whatever their status, and `--force`
+    sends them to Gemini again instead of reusing a cached extraction of the
+    same file content (which also replaces the cached result).
     """
     help = "Finds and re-queues email attachments that failed during Gemini processing."
 
@@ -28,25 +32,41 @@ class Command(BaseCommand):
             action='store_true',
             help="Lists the attachments that would be re-queued without actually doing anything.",
         )
+        parser.add_argument(
+            '--ids',
+            type=int,
+            nargs='+',
+            help="Re-queues these attachment IDs, whether or not they failed.",
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help="Calls Gemini even when an extraction of the same file content is cached.",
+        )
 
     def handle(self, *args, **options):
         limit = options['limit']
         dry_run = options['dry_run']
+        force = options['force']
 
         if dry_run:
             self.stdout.write(self.style.WARNING("--- DRY RUN MODE ---"))
 
-        self.stdout.write(self.style.NOTICE("Searching for failed attachments..."))
+        if options['ids']:
+            self.stdout.write(self.style.NOTICE("Looking up the requested attachments..."))
+            failed_attachments_query = EmailAttachment.objects.filter(id__in=options['ids']).order_by('id')
+        else:
+            self.stdout.write(self.style.NOTICE("Searching for failed attachments..."))
 
-        # A failed attachment is marked as 'processed' to prevent retries,
-        # but its extracted_data contains a 'status': 'failed' key-value pair.
-        failed_attachments_query = EmailAttachment.objects.filter(
-            processed=True,
-            extracted_data__status='failed'
-        )
+            # A failed attachment is marked as 'processed' to prevent retries,
+            # but its extracted_data contains a 'status': 'failed' key-value pair.
+            failed_attachments_query = EmailAttachment.objects.filter(
+                processed=True,
+                extracted_data__status='failed'
+            )
 
         if not failed_attachments_query.exists():
-            self.stdout.write(self.style.SUCCESS("No failed attachments found to reprocess."))
+            self.stdout.write(self.style.SUCCESS("No matching attachments found to reprocess."))
             return
 
         total_found = failed_attachments_query.count()
@@ -64,7 +84,7 @@ class Command(BaseCommand):
                 attachment.save(update_fields=['processed', 'extracted_data'])
 
                 # Dispatch the Celery task again
-                process_attachment_with_gemini.delay(attachment.id)
+                process_attachment_with_gemini.delay(attachment.id, force=force)
                 requeued_count += 1
 
         if dry_run:
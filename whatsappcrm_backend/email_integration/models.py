@@ -150,10 +150,41 @@ class EmailAttachment(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     processed = models.BooleanField(default=False, db_index=True)
     extracted_data = models.JSONField(blank=True, null=True, help_text="Structured data extracted by AI model.")
+    content_sha256 = models.CharField(
+        max_length=64, blank=True, null=True, db_index=True,
+        help_text="SHA-256 of the file content, set at ingest. Identical files share one extraction."
+    )
 
     def __str__(self):
         return f"{self.filename} (Processed: {self.processed})"
 
+
+class AttachmentExtractionCache(models.Model):
+    """
+    Gemini extraction result for a file content, so the same document arriving
+    again (forwarded, CC'd, resent) is not sent to Gemini twice. Entries are only
+    valid for the extraction prompt/schema version they were produced with.
+    """
+    content_sha256 = models.CharField(max_length=64)
+    schema_version = models.PositiveIntegerField()
+    extracted_data = models.JSONField()
+    source_attachment = models.ForeignKey(
+        EmailAttachment, on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+        help_text="The attachment whose extraction produced this entry."
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "Attachment Extraction Cache Entry"
+        verbose_name_plural = "Attachment Extraction Cache"
+        constraints = [
+            models.UniqueConstraint(fields=['content_sha256', 'schema_version'], name='unique_extraction_per_content_and_schema'),
+        ]
+
+    def __str__(self):
+        return f"{self.content_sha256[:12]}… (schema v{self.schema_version})"
+
 class ParsedInvoice(models.Model):
     """Stores structured data extracted from an email attachment."""
     attachment = models.OneToOneField(
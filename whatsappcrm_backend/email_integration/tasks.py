@@ -3,15 +3,15 @@ import logging
 import re
 from google.api_core import exceptions as core_exceptions
 import smtplib
+import hashlib
 import json
 from datetime import datetime
 from celery import shared_task, chain
 
 from celery import shared_task
-from google import genai
 from google.genai import types as genai_types
 from google.genai import errors as genai_errors
-from .models import EmailAttachment, ParsedInvoice, AdminEmailRecipient
+from .models import EmailAttachment, ParsedInvoice, AdminEmailRecipient, AttachmentExtractionCache
 from decimal import Decimal, InvalidOperation
 # --- ADD JobCard to imports ---
 from customer_data.models import CustomerProfile, Order, OrderItem, JobCard, InstallationRequest
@@ -27,12 +27,18 @@ from django.db.models import Q
 
 # Import the new model to fetch credentials
 from ai_integration.models import AIProvider
+from ai_integration.clients import get_gemini_client
+from ai_integration.scheduler import BACKGROUND, recording_rate_limits, try_gemini_slot
 from django.conf import settings
 from .smtp_utils import get_smtp_connection, get_from_email
 from .json_utils import parse_json_robustly, validate_gemini_response_structure
 
 logger = logging.getLogger(__name__)
 
+# Version of the extraction prompt and schemas in process_attachment_with_gemini.
+# Bump it when they change, so extractions cached under the old ones are not reused.
+EXTRACTION_SCHEMA_VERSION = 1
+
 
 @shared_task(
     bind=True,
@@ -257,11 +263,18 @@ def send_error_notification_email(task_name, attachment_id, error_message, raw_r
     autoretry_for=(core_exceptions.ResourceExhausted, genai_errors.ServerError),
     retry_backoff=True, retry_kwargs={'max_retries': 5}
 )
-def process_attachment_with_gemini(self, attachment_id):
+def process_attachment_with_gemini(self, attachment_id, force=False, slot_attempts=0):
     """
     Fetches an attachment, asks Gemini to classify it (invoice or job_card),
     extracts structured data based on the type, and saves it to the correct model.
     On failure, it sends a notification to the admin.
+
+    A file whose content was already extracted with the current
+    EXTRACTION_SCHEMA_VERSION reuses that result without calling Gemini, unless
+    `force` is set.
+
+    `slot_attempts` counts reschedules while no Gemini rate-limit slot was free.
+    They are kept apart from the task's retries, which are left for API errors.
     """
     log_prefix = f"[Gemini File API Task ID: {self.request.id}]"
     logger.info(f"{log_prefix} Starting Gemini processing for attachment ID: {attachment_id}")
@@ -277,10 +290,20 @@ def process_attachment_with_gemini(self, attachment_id):
             logger.warning(f"{log_prefix} Attachment ID {attachment_id} already processed. Skipping.")
             return f"Skipped: Attachment {attachment_id} already processed."
 
+        content_sha256 = attachment.content_sha256 or _store_attachment_sha256(attachment)
+        if not force:
+            cached = AttachmentExtractionCache.objects.filter(
+                content_sha256=content_sha256, schema_version=EXTRACTION_SCHEMA_VERSION
+            ).only('extracted_data').first()
+            if cached is not None:
+                logger.info(f"{log_prefix} Identical content already extracted; reusing the cached result without calling Gemini.")
+                _apply_extracted_data(attachment, cached.extracted_data, log_prefix)
+                return f"Successfully processed attachment {attachment_id} from the extraction cache."
+
         # --- Configure Gemini ---
         try:
             active_provider = AIProvider.objects.get(provider='google_gemini', is_active=True)
-            client = genai.Client(api_key=active_provider.api_key)
+            client = get_gemini_client(active_provider.api_key)
         except (AIProvider.DoesNotExist, AIProvider.MultipleObjectsReturned) as e:
             error_message = f"Gemini API key configuration error: {e}"
             logger.error(f"{log_prefix} {error_message}")
@@ -291,6 +314,23 @@ def process_attachment_with_gemini(self, attachment_id):
             send_error_notification_email.delay(self.name, attachment_id, error_message)
             return f"Failed: {error_message}"
 
+        # Email extraction yields to customer chats for rate-limit tokens. Without a
+        # free token, reschedule for when one is expected instead of holding the worker.
+        slot_wait = try_gemini_slot(active_provider, BACKGROUND, waiter_id=self.request.id)
+        if slot_wait:
+            if slot_attempts >= settings.GEMINI_BACKGROUND_MAX_SLOT_RETRIES:
+                raise self.MaxRetriesExceededError(
+                    f"No Gemini rate-limit slot after {slot_attempts} reschedules."
+                )
+            logger.info(f"{log_prefix} No Gemini rate-limit slot free; rescheduling in {slot_wait:.1f}s.")
+            # Rescheduled rather than retried, so waiting for a slot doesn't use up the retries
+            # autoretry_for needs for API errors. The task id keeps its place in the slot queue.
+            self.apply_async(
+                args=[attachment_id], kwargs={'force': force, 'slot_attempts': slot_attempts + 1},
+                countdown=slot_wait, task_id=self.request.id, retries=self.request.retries,
+            )
+            return f"Rescheduled: no Gemini rate-limit slot for attachment {attachment_id}."
+
         # 2. Upload the local file to the Gemini API
         file_path = attachment.file.path
         logger.info(f"{log_prefix} Uploading file to Gemini: {file_path}")
@@ -375,10 +415,11 @@ def process_attachment_with_gemini(self, attachment_id):
 
         # 4. Call the Gemini API to process the document
         logger.info(f"{log_prefix} Sending request to Gemini model for analysis.")
-        response = client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=[prompt, uploaded_file],
-        )
+        with recording_rate_limits(active_provider, BACKGROUND):
+            response = client.models.generate_content(
+                model='gemini-2.5-flash',
+                contents=[prompt, uploaded_file],
+            )
 
         # 5. Parse the extracted JSON data using robust parser
         try:
@@ -400,33 +441,11 @@ def process_attachment_with_gemini(self, attachment_id):
             send_error_notification_email.delay(self.name, attachment_id, error_message, raw_response=response.text)
             return f"Failed: {error_message}"
 
-        # --- NEW: Conditional Logic Based on Document Type ---
-        document_type = extracted_data.get("document_type")
-        data = extracted_data.get("data")
-
-        if not document_type or not data:
-            error_message = "AI response missing 'document_type' or 'data' key."
-            raise ValueError(error_message)
-
-        logger.info(f"{log_prefix} Gemini identified document as type: '{document_type}'")
-
-        if document_type == 'invoice':
-            _create_order_from_invoice_data(attachment, data, log_prefix)
-        elif document_type == 'job_card':
-            _create_job_card_from_data(attachment, data, log_prefix)
-        elif document_type == 'unknown':
-            reason = data.get('reason', 'Document type could not be determined')
-            logger.info(f"{log_prefix} Document classified as unknown. Reason: {reason}")
-        else:
-            logger.warning(f"{log_prefix} Unknown document type '{document_type}' received. Skipping database save.")
-
-        # 8. Update the EmailAttachment status
-        attachment.processed = True
-        attachment.extracted_data = extracted_data
-        attachment.save(update_fields=['processed', 'extracted_data', 'updated_at'])
-
-        logger.info(f"{log_prefix} Successfully processed attachment {attachment_id}.")
-        send_receipt_confirmation_email.delay(attachment_id)
+        _apply_extracted_data(attachment, extracted_data, log_prefix)
+        AttachmentExtractionCache.objects.update_or_create(
+            content_sha256=content_sha256, schema_version=EXTRACTION_SCHEMA_VERSION,
+            defaults={'extracted_data': extracted_data, 'source_attachment': attachment},
+        )
         return f"Successfully processed attachment {attachment_id} with Gemini."
 
     except EmailAttachment.DoesNotExist:
@@ -456,6 +475,53 @@ def process_attachment_with_gemini(self, attachment_id):
 
 
 
+def attachment_content_sha256(content: bytes) -> str:
+    """Hash stored on EmailAttachment.content_sha256 by the IMAP fetchers."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def _store_attachment_sha256(attachment: EmailAttachment) -> str:
+    """Hashes the file of an attachment ingested before hashing existed and stores the hash."""
+    digest = hashlib.sha256()
+    with attachment.file.open('rb') as f:
+        for chunk in f.chunks():
+            digest.update(chunk)
+    attachment.content_sha256 = digest.hexdigest()
+    EmailAttachment.objects.filter(pk=attachment.pk).update(content_sha256=attachment.content_sha256)
+    return attachment.content_sha256
+
+
+def _apply_extracted_data(attachment: EmailAttachment, extracted_data: dict, log_prefix: str):
+    """Saves the documents described by a (fresh or cached) extraction and marks the attachment processed."""
+    # --- NEW: Conditional Logic Based on Document Type ---
+    document_type = extracted_data.get("document_type")
+    data = extracted_data.get("data")
+
+    if not document_type or not data:
+        error_message = "AI response missing 'document_type' or 'data' key."
+        raise ValueError(error_message)
+
+    logger.info(f"{log_prefix} Gemini identified document as type: '{document_type}'")
+
+    if document_type == 'invoice':
+        _create_order_from_invoice_data(attachment, data, log_prefix)
+    elif document_type == 'job_card':
+        _create_job_card_from_data(attachment, data, log_prefix)
+    elif document_type == 'unknown':
+        reason = data.get('reason', 'Document type could not be determined')
+        logger.info(f"{log_prefix} Document classified as unknown. Reason: {reason}")
+    else:
+        logger.warning(f"{log_prefix} Unknown document type '{document_type}' received. Skipping database save.")
+
+    # 8. Update the EmailAttachment status
+    attachment.processed = True
+    attachment.extracted_data = extracted_data
+    attachment.save(update_fields=['processed', 'extracted_data', 'updated_at'])
+
+    logger.info(f"{log_prefix} Successfully processed attachment {attachment.id}.")
+    send_receipt_confirmation_email.delay(attachment.id)
+
+
 def _get_or_create_customer_profile(customer_data: dict, log_prefix: str) -> CustomerProfile | None:
     """Finds or creates a customer profile based on data from a document."""
     customer_name = customer_data.get('name')
@@ -1,4 +1,7 @@
-from django.test import TestCase
+import shutil
+import tempfile
+
+from django.test import TestCase, override_settings
 from django.core.files.uploadedfile import SimpleUploadedFile
 from unittest.mock import patch, MagicMock
 
@@ -7,6 +10,15 @@ from .tasks import _create_order_from_invoice_data
 from customer_data.models import CustomerProfile, Order, OrderItem, Contact
 from products_and_services.models import Product
 
+# Attachments created by these tests are written here, not into the real media dir.
+TEMP_MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def tearDownModule():
+    shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class CreateOrderFromInvoiceDataTests(TestCase):
 
     def setUp(self):
@@ -157,6 +169,7 @@ class CreateOrderFromInvoiceDataTests(TestCase):
         mock_queue_notifications.assert_not_called()
 
 
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class AdminActionsTests(TestCase):
     """Test cases for admin actions in email_integration app."""
 
@@ -298,3 +311,105 @@ class AdminActionsTests(TestCase):
         self.attachment2.refresh_from_db()
         self.assertTrue(self.attachment1.processed)
         self.assertTrue(self.attachment2.processed)
+
+
+@patch('email_integration.tasks.send_receipt_confirmation_email')
+@patch('ai_integration.scheduler.get_redis_client', return_value=None)
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class AttachmentExtractionCacheTests(TestCase):
+    """Tests for reusing extractions of identical attachment content."""
+
+    extracted = {"document_type": "unknown", "data": {"reason": "Not an invoice"}}
+
+    def setUp(self):
+        from ai_integration.models import AIProvider
+
+        AIProvider.objects.create(provider='google_gemini', api_key='key', is_active=True)
+
+    def _attachment(self, name):
+        content = b"%PDF-1.4 identical supplier invoice"
+        return EmailAttachment.objects.create(
+            file=SimpleUploadedFile(name, content, content_type="application/pdf"),
+            filename=name,
+            sender="supplier@example.com",
+        )
+
+    @patch('email_integration.tasks.get_gemini_client')
+    def test_repeat_content_reuses_extraction_without_gemini(self, mock_client, mock_redis, mock_receipt):
+        import json
+        from .models import AttachmentExtractionCache
+        from .tasks import process_attachment_with_gemini
+
+        mock_client.return_value.models.generate_content.return_value = MagicMock(text=json.dumps(self.extracted))
+        first = self._attachment("invoice.pdf")
+        process_attachment_with_gemini.apply(args=[first.id])
+
+        first.refresh_from_db()
+        self.assertEqual(len(first.content_sha256), 64)
+        self.assertTrue(AttachmentExtractionCache.objects.filter(content_sha256=first.content_sha256).exists())
+
+        mock_client.reset_mock()
+        second = self._attachment("invoice (forwarded).pdf")
+        process_attachment_with_gemini.apply(args=[second.id])
+
+        mock_client.assert_not_called()
+        second.refresh_from_db()
+        self.assertTrue(second.processed)
+        self.assertEqual(second.extracted_data, self.extracted)
+
+    @patch('email_integration.tasks.get_gemini_client')
+    def test_force_calls_gemini_and_replaces_cached_result(self, mock_client, mock_redis, mock_receipt):
+        import json
+        from .models import AttachmentExtractionCache
+        from .tasks import EXTRACTION_SCHEMA_VERSION, attachment_content_sha256, process_attachment_with_gemini
+
+        attachment = self._attachment("invoice.pdf")
+        content_sha256 = attachment_content_sha256(b"%PDF-1.4 identical supplier invoice")
+        AttachmentExtractionCache.objects.create(
+            content_sha256=content_sha256, schema_version=EXTRACTION_SCHEMA_VERSION,
+            extracted_data={"document_type": "unknown", "data": {"reason": "stale"}},
+        )
+        mock_client.return_value.models.generate_content.return_value = MagicMock(text=json.dumps(self.extracted))
+
+        process_attachment_with_gemini.apply(args=[attachment.id], kwargs={'force': True})
+
+        mock_client.return_value.models.generate_content.assert_called_once()
+        cached = AttachmentExtractionCache.objects.get(content_sha256=content_sha256)
+        self.assertEqual(cached.extracted_data, self.extracted)
+        self.assertEqual(cached.source_attachment_id, attachment.id)
+
+    @patch('email_integration.tasks.try_gemini_slot', return_value=12.0)
+    @patch('email_integration.tasks.get_gemini_client')
+    def test_reschedules_instead_of_waiting_for_a_rate_limit_slot(self, mock_client, mock_slot, mock_redis, mock_receipt):
+        from .tasks import process_attachment_with_gemini
+
+        attachment = self._attachment("invoice.pdf")
+        with patch.object(process_attachment_with_gemini, 'apply_async') as mock_reschedule, \
+                patch.object(process_attachment_with_gemini, 'retry') as mock_retry:
+            process_attachment_with_gemini.apply(args=[attachment.id], kwargs={'slot_attempts': 2}, retries=1)
+
+        # The slot wait is counted in slot_attempts; the API-error retries are passed on untouched.
+        mock_retry.assert_not_called()
+        self.assertEqual(mock_reschedule.call_args.kwargs['kwargs'], {'force': False, 'slot_attempts': 3})
+        self.assertEqual(mock_reschedule.call_args.kwargs['countdown'], 12.0)
+        self.assertEqual(mock_reschedule.call_args.kwargs['retries'], 1)
+        mock_client.return_value.files.upload.assert_not_called()
+        attachment.refresh_from_db()
+        self.assertFalse(attachment.processed)
+
+    @patch('email_integration.tasks.send_error_notification_email')
+    @patch('email_integration.tasks.try_gemini_slot', return_value=12.0)
+    @patch('email_integration.tasks.get_gemini_client')
+    def test_gives_up_after_the_slot_reschedules_run_out(self, mock_client, mock_slot, mock_notify, mock_redis, mock_receipt):
+        from .tasks import process_attachment_with_gemini
+
+        attachment = self._attachment("invoice.pdf")
+        with patch.object(process_attachment_with_gemini, 'apply_async') as mock_reschedule, \
+                override_settings(GEMINI_BACKGROUND_MAX_SLOT_RETRIES=3):
+            process_attachment_with_gemini.apply(args=[attachment.id], kwargs={'slot_attempts': 3})
+
+        mock_reschedule.assert_not_called()
+        attachment.refresh_from_db()
+        self.assertTrue(attachment.processed)
+        self.assertEqual(attachment.extracted_data['status'], 'failed')
+        mock_notify.delay.assert_called_once()
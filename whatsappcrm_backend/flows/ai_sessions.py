@@ -0,0 +1,166 @@
+# whatsappcrm_backend/flows/ai_sessions.py
+
+"""
+Per-contact AI conversation sessions for the Gemini chat tasks.
+
+Every AI turn used to query the contact's last 20 messages and format them
+into Gemini chat history again. A session keeps the formatted turns in Redis
+(`flows:ai_session:<mode>:<contact id>`, expiring after
+AI_SESSION_TTL_SECONDS) together with a watermark: the timestamp of the
+newest message it holds. A turn only loads the messages between the
+watermark and the incoming message (usually the previous reply and the
+previous user message) and appends them.
+
+When the turns exceed AI_SESSION_TOKEN_BUDGET (estimated at 4 characters a
+token), the oldest turns are rolled into a plain-text summary, capped at
+AI_SESSION_SUMMARY_MAX_CHARS, that is appended to the system prompt. Without a
+session (first turn, expired, or Redis unavailable) the history is built from
+the last 20 messages, as before.
+"""
+import json
+import logging
+from datetime import datetime
+
+import redis
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+
+from whatsappcrm_backend.redis_client import get_redis_client, mark_redis_unavailable
+from conversations.models import Message
+
+logger = logging.getLogger(__name__)
+
+AI_SESSION_KEY_PREFIX = 'flows:ai_session:'
+COLD_START_MESSAGES = 20
+# Inbound commands that leave AI mode; they are not conversation turns.
+EXIT_COMMANDS = ('exit', 'menu', 'stop', 'quit')
+CHARS_PER_TOKEN = 4
+SUMMARY_TURN_CHARS = 160
+
+
+def _session_key(mode: str, contact_id) -> str:
+    return f'{AI_SESSION_KEY_PREFIX}{mode}:{contact_id}'
+
+
+def _estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class AISession:
+    """Formatted chat turns of one contact in one AI mode."""
+
+    def __init__(self, contact_id, mode: str, turns=None, summary: str = '', watermark: datetime = None, tokens: int = 0):
+        self.contact_id = contact_id
+        self.mode = mode
+        self.turns = turns or []  # [{'role': 'user' | 'model', 'parts': [{'text': ...}]}]
+        self.summary = summary
+        self.watermark = watermark
+        self.tokens = tokens
+
+    def append_messages(self, messages):
+        """Appends Message rows, oldest first, as chat turns."""
+        for msg in messages:
+            self.watermark = msg.timestamp if self.watermark is None else max(self.watermark, msg.timestamp)
+            if not msg.text_content:
+                continue
+            if msg.direction == 'in' and msg.text_content.lower().strip() in EXIT_COMMANDS:
+                continue
+            role = 'user' if msg.direction == 'in' else 'model'
+            self.turns.append({'role': role, 'parts': [{'text': msg.text_content}]})
+            self.tokens += _estimate_tokens(msg.text_content)
+        self._roll_into_summary()
+
+    def _roll_into_summary(self):
+        budget = settings.AI_SESSION_TOKEN_BUDGET
+        rolled = []
+        while self.tokens > budget and len(self.turns) > 1:
+            turn = self.turns.pop(0)
+            text = turn['parts'][0]['text']
+            self.tokens -= _estimate_tokens(text)
+            speaker = 'Customer' if turn['role'] == 'user' else 'Assistant'
+            line = ' '.join(text.split())
+            if len(line) > SUMMARY_TURN_CHARS:
+                line = line[:SUMMARY_TURN_CHARS - 3] + '...'
+            rolled.append(f"- {speaker}: {line}")
+        if not rolled:
+            return
+        summary = '\n'.join(filter(None, [self.summary] + rolled))
+        max_chars = settings.AI_SESSION_SUMMARY_MAX_CHARS
+        if len(summary) > max_chars:
+            # Keep the most recent summary lines.
+            summary = summary[-max_chars:]
+            summary = summary[summary.find('\n') + 1:] if '\n' in summary else summary
+        self.summary = summary
+
+    def gemini_history(self, system_prompt: str, acknowledgement: str) -> list:
+        """The history for client.chats.create: system prompt, acknowledgement, then the turns."""
+        if self.summary:
+            system_prompt = f"{system_prompt}\n\n---\n### **Earlier in this conversation (summary)**\n\n{self.summary}"
+        return [
+            {'role': 'user', 'parts': [{'text': system_prompt}]},
+            {'role': 'model', 'parts': [{'text': acknowledgement}]},
+        ] + self.turns
+
+    def recent_texts(self, count: int) -> list:
+        """Texts of the last `count` turns, newest first."""
+        return [turn['parts'][0]['text'] for turn in reversed(self.turns[-count:])]
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'turns': self.turns,
+            'summary': self.summary,
+            'watermark': self.watermark.isoformat() if self.watermark else None,
+            'tokens': self.tokens,
+        })
+
+    @classmethod
+    def from_json(cls, contact_id, mode: str, raw) -> 'AISession':
+        data = json.loads(raw)
+        return cls(
+            contact_id, mode, turns=data['turns'], summary=data['summary'],
+            watermark=parse_datetime(data['watermark']) if data['watermark'] else None, tokens=data['tokens'],
+        )
+
+
+def _load(client, key: str, contact_id, mode: str):
+    try:
+        raw = client.get(key)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return None
+    if not raw:
+        return None
+    try:
+        return AISession.from_json(contact_id, mode, raw)
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Discarding unreadable AI session {key}: {e}")
+        return None
+
+
+def get_ai_session(contact, incoming_message: Message, mode: str) -> AISession:
+    """
+    Returns the contact's session for `mode` with every message before
+    `incoming_message` appended, and stores it back.
+    """
+    client = get_redis_client()
+    key = _session_key(mode, contact.id)
+    session = _load(client, key, contact.id, mode) if client is not None else None
+
+    if session is None or session.watermark is None:
+        session = AISession(contact.id, mode)
+        recent = Message.objects.filter(
+            contact=contact, timestamp__lt=incoming_message.timestamp
+        ).order_by('-timestamp')[:COLD_START_MESSAGES]
+        session.append_messages(reversed(list(recent)))
+    else:
+        session.append_messages(Message.objects.filter(
+            contact=contact, timestamp__gt=session.watermark, timestamp__lt=incoming_message.timestamp
+        ).order_by('timestamp'))
+
+    if client is not None:
+        try:
+            client.set(key, session.to_json(), ex=settings.AI_SESSION_TTL_SECONDS)
+        except redis.RedisError as e:
+            mark_redis_unavailable(e)
+    return session
+
@@ -11,3 +11,5 @@ class FlowsConfig(AppConfig):
         # This ensures that your custom flow actions are discovered and registered
         # automatically when the Django application starts.
         import flows.actions
+        # Keeps the compiled flow graph in step with flow definition changes.
+        import flows.signals
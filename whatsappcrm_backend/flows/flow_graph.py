@@ -0,0 +1,173 @@
+# whatsappcrm_backend/flows/flow_graph.py
+
+"""
+Compiled, process-local graph of the flow definitions.
+
+Flow, FlowStep and FlowTransition rows change only when flows are edited or
+reloaded, but the flow engine needs them for every incoming message. The whole
+definition set is loaded with three queries into a FlowGraph: every flow with
+its steps by id, its entry point and each step's outgoing transitions sorted by
+priority, plus the active flows by name and their trigger keyword index
+(trigger_index.py). Transitions point at the graph's own
+step instances, and steps at the graph's flow instances, so walking the graph
+never goes back to the database.
+
+The model instances in a graph are shared by every request of the process and
+must be treated as read-only.
+
+Invalidation follows meta_integration/config_cache.py:
+  * post_save/post_delete on Flow, FlowStep and FlowTransition (see signals.py)
+    drop the local graph and bump a shared Redis version key on commit.
+  * Other processes compare their graph's version with the Redis key at most
+    every FLOW_GRAPH_CACHE_CHECK_SECONDS and rebuild when it moved.
+  * Without Redis, a graph is rebuilt after FLOW_GRAPH_CACHE_TTL_SECONDS.
+
+Building a graph also validates every step config (step_configs.py), compiles
+every transition condition into a predicate (transition_conditions.py) and
+compiles the Jinja templates in step configs into the template cache of
+flows/services.py, so a new version doesn't pay for them on the first messages.
+"""
+import logging
+import time
+from types import MappingProxyType
+from typing import Optional
+
+from django.conf import settings
+from django.db import transaction
+
+from whatsappcrm_backend.redis_client import bump_shared_version, read_shared_version
+from .models import Flow, FlowStep, FlowTransition
+from .step_configs import get_parsed_step_config
+from .transition_conditions import get_condition_predicate
+from .trigger_index import TriggerIndex
+
+logger = logging.getLogger(__name__)
+
+FLOW_GRAPH_VERSION_KEY = 'flows:graph:version'
+
+_graph = None
+
+
+class CompiledFlow:
+    """One flow with its steps, entry point and priority-ordered transitions."""
+    __slots__ = ('flow', 'steps', 'entry_step', 'transitions')
+
+    def __init__(self, flow: Flow, steps: list, transitions_by_step: dict):
+        self.flow = flow
+        self.steps = MappingProxyType({step.pk: step for step in steps})
+        # Steps are in FlowStep.Meta ordering, so this matches `.filter(is_entry_point=True).first()`.
+        self.entry_step = next((step for step in steps if step.is_entry_point), None)
+        self.transitions = MappingProxyType({
+            step.pk: tuple(transitions_by_step.get(step.pk, ())) for step in steps
+        })
+
+
+class FlowGraph:
+    """Immutable snapshot of all flow definitions, built for one shared version."""
+
+    def __init__(self, flows: list, steps: list, transitions: list, version):
+        flows_by_id = {flow.pk: flow for flow in flows}
+        steps_by_flow = {flow.pk: [] for flow in flows}
+        steps_by_id = {}
+        for step in steps:
+            # The three queries aren't one snapshot: skip rows written in between,
+            # the version bump of that write rebuilds the graph anyway.
+            if step.flow_id not in flows_by_id:
+                continue
+            step.flow = flows_by_id[step.flow_id]
+            steps_by_flow[step.flow_id].append(step)
+            steps_by_id[step.pk] = step
+
+        transitions_by_step = {}
+        for transition in sorted(transitions, key=lambda t: (t.priority, t.pk)):
+            if transition.current_step_id not in steps_by_id or transition.next_step_id not in steps_by_id:
+                continue
+            transition.current_step = steps_by_id[transition.current_step_id]
+            transition.next_step = steps_by_id[transition.next_step_id]
+            transitions_by_step.setdefault(transition.current_step_id, []).append(transition)
+
+        self.flows = MappingProxyType({
+            flow.pk: CompiledFlow(flow, steps_by_flow[flow.pk], transitions_by_step) for flow in flows
+        })
+        self.steps = MappingProxyType(steps_by_id)
+        self.active_flows = tuple(
+            compiled for compiled in sorted(self.flows.values(), key=lambda c: c.flow.name)
+            if compiled.flow.is_active
+        )
+        self.active_flows_by_name = MappingProxyType({compiled.flow.name: compiled for compiled in self.active_flows})
+        self.trigger_index = TriggerIndex(self.active_flows)
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.checked_at = self.loaded_at
+
+    def get_flow(self, flow_id) -> Optional[CompiledFlow]:
+        return self.flows.get(flow_id)
+
+    def get_active_flow(self, name: str) -> Optional[CompiledFlow]:
+        """Graph equivalent of `Flow.objects.get(name=name, is_active=True)`, or None."""
+        return self.active_flows_by_name.get(name)
+
+    def get_step(self, step_id) -> Optional[FlowStep]:
+        return self.steps.get(step_id)
+
+    def get_transitions(self, step_id) -> tuple:
+        """Outgoing transitions of a step, lowest priority first."""
+        step = self.steps.get(step_id)
+        if step is None:
+            return ()
+        return self.flows[step.flow_id].transitions[step_id]
+
+
+def get_flow_graph() -> FlowGraph:
+    """Returns this process's FlowGraph, rebuilding it when the definitions changed."""
+    global _graph
+    graph = _graph
+    now = time.monotonic()
+    if graph is not None and now - graph.checked_at < settings.FLOW_GRAPH_CACHE_CHECK_SECONDS:
+        return graph
+
+    shared_version = read_shared_version(FLOW_GRAPH_VERSION_KEY)
+    if graph is not None:
+        if shared_version is not None and shared_version == graph.version:
+            graph.checked_at = now
+            return graph
+        if shared_version is None and now - graph.loaded_at < settings.FLOW_GRAPH_CACHE_TTL_SECONDS:
+            graph.checked_at = now
+            return graph
+
+    graph = FlowGraph(
+        list(Flow.objects.all()),
+        list(FlowStep.objects.all()),
+        list(FlowTransition.objects.all()),
+        shared_version,
+    )
+    _graph = graph
+
+    from .services import precompile_config_templates  # services imports this module
+    for step in graph.steps.values():
+        get_parsed_step_config(step)
+        for source, error in precompile_config_templates(step.config):
+            logger.warning(f"Flow step {step.pk} ('{step.name}') has an invalid template '{source}': {error}")
+        for transition in graph.get_transitions(step.pk):
+            get_condition_predicate(transition)
+    logger.debug(
+        f"Compiled flow graph version {shared_version}: {len(graph.flows)} flow(s), "
+        f"{len(graph.steps)} step(s), {len(graph.active_flows)} active."
+    )
+    return graph
+
+
+def invalidate_flow_graph():
+    """
+    Drops this process's graph right away and, once the surrounding transaction
+    commits, drops it again and bumps the shared version so other processes rebuild.
+    """
+    global _graph
+    _graph = None
+
+    def _on_commit():
+        global _graph
+        _graph = None
+        bump_shared_version(FLOW_GRAPH_VERSION_KEY)
+
+    transaction.on_commit(_on_commit)
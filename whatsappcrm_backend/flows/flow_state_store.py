@@ -0,0 +1,592 @@
+# whatsappcrm_backend/flows/flow_state_store.py
+
+"""
+Storage of ContactFlowState, the per-contact session state of the flow engine.
+
+The flow engine reads, creates, saves and clears states only through this
+module. FLOW_STATE_BACKEND selects where the active states live:
+
+  * 'database' (default): the ContactFlowState table, as before.
+  * 'redis': one hash per contact (`flows:state:contact:<id>`) holding the
+    flow, step, context JSON and timestamps. Every write refreshes its TTL
+    (FLOW_STATE_REDIS_TTL_SECONDS, longer than the idle cleanup threshold, so
+    cleanup_idle_conversations_task still times sessions out first) and adds
+    the contact to a dirty set. `persist_flow_states_task` drains the dirty
+    set after FLOW_STATE_PERSIST_WINDOW_SECONDS and writes the states behind
+    to the table in batches (one upsert and one delete per batch), so the
+    table stays available for audit and analytics.
+
+Inside a database transaction, hash writes are deferred with
+transaction.on_commit, so a rolled back transaction can't leave Redis ahead of
+the table. Until then the transaction reads its own writes from a per-thread
+overlay; if Redis fails at commit time, the state is written to the table
+instead. The persist task moves each batch of dirty contact ids into a
+processing set (`flows:state:persisting:<id>`) that is deleted once the batch
+has committed; a failed batch goes back into the dirty set, and the next run
+requeues batches abandoned by a crashed worker after
+FLOW_STATE_PERSIST_REQUEUE_SECONDS.
+
+In 'redis' mode, load_flow_state(for_update=True) stands in for
+select_for_update with a per-contact lock (`flows:state:lock:<id>`, SET NX PX),
+so two messages for one contact can't overwrite each other's context. The lock
+is held until the transaction commits and its hash writes are done; one that
+is never released (a rolled back transaction, a crashed worker) expires after
+FLOW_STATE_LOCK_TIMEOUT_SECONDS. A read that can't take the lock within
+FLOW_STATE_LOCK_WAIT_SECONDS goes ahead unlocked and logs a warning.
+
+In 'redis' mode, clearing a state leaves a tombstone hash until it has been
+persisted, so a read can't fall back to a row that is about to be deleted. A
+read that finds no hash falls back to the table and warms the hash from the
+row. When Redis is unavailable the table is read and written directly; the
+hashes and rows may disagree after an outage, which
+`manage.py reconcile_flow_states` reports and, with --fix, repairs.
+
+States built from a hash are unsaved ContactFlowState instances: they must be
+written with save_flow_state(), never with .save(). Use same_flow_state() to
+tell whether two loaded states are the same flow session.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Optional
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from whatsappcrm_backend.redis_client import get_redis_client, mark_redis_unavailable
+from .metrics import FLOW_STATES_PERSISTED
+from .models import ContactFlowState, FlowStep
+from .write_buffer import buffer_flow_state, pending_flow_state, discard_flow_state
+
+logger = logging.getLogger(__name__)
+
+FLOW_STATE_KEY_PREFIX = 'flows:state:contact:'
+FLOW_STATE_DIRTY_KEY = 'flows:state:dirty'
+FLOW_STATE_FLUSH_SCHEDULED_KEY = 'flows:state:flush_scheduled'
+FLOW_STATE_PERSISTING_KEY_PREFIX = 'flows:state:persisting:'
+FLOW_STATE_PERSIST_BATCHES_KEY = 'flows:state:persist_batches'
+FLOW_STATE_LOCK_KEY_PREFIX = 'flows:state:lock:'
+
+# KEYS[1] = dirty set, KEYS[2] = new processing set, KEYS[3] = batch index
+# ARGV = batch size, now
+_DRAIN_LUA = """
+local ids = redis.call('SPOP', KEYS[1], tonumber(ARGV[1]))
+if #ids == 0 then return ids end
+redis.call('SADD', KEYS[2], unpack(ids))
+redis.call('ZADD', KEYS[3], ARGV[2], KEYS[2])
+return ids
+"""
+
+# KEYS[1] = processing set, KEYS[2] = dirty set, KEYS[3] = batch index
+_REQUEUE_LUA = """
+local ids = redis.call('SMEMBERS', KEYS[1])
+if #ids > 0 then redis.call('SADD', KEYS[2], unpack(ids)) end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[3], KEYS[1])
+return #ids
+"""
+
+# KEYS[1] = lock key, ARGV[1] = holder token
+_UNLOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+_local = threading.local()
+
+
+def _state_key(contact_id) -> str:
+    return f'{FLOW_STATE_KEY_PREFIX}{contact_id}'
+
+
+def _redis_backend():
+    """Returns a Redis client when the 'redis' backend is enabled and reachable, else None."""
+    if settings.FLOW_STATE_BACKEND != 'redis':
+        return None
+    return get_redis_client()
+
+
+def _decode(raw: dict) -> dict:
+    return {key.decode(): value.decode() for key, value in raw.items()}
+
+
+def _encode_state(state: ContactFlowState) -> dict:
+    return {
+        'token': state._store_token,
+        'flow_id': state.current_flow_id,
+        'step_id': state.current_step_id,
+        'context': json.dumps(state.flow_context_data or {}),
+        'started_at': (state.started_at or timezone.now()).isoformat(),
+        'last_updated_at': (state.last_updated_at or timezone.now()).isoformat(),
+    }
+
+
+def _state_from_hash(contact, fields: dict) -> ContactFlowState:
+    state = ContactFlowState(
+        contact=contact,
+        current_flow_id=int(fields['flow_id']),
+        current_step_id=int(fields['step_id']),
+        flow_context_data=json.loads(fields['context']),
+        started_at=parse_datetime(fields['started_at']),
+        last_updated_at=parse_datetime(fields['last_updated_at']),
+    )
+    state._store_token = fields['token']
+    return state
+
+
+def _uncommitted_hashes() -> dict:
+    """contact id -> (on_commit callback, mapping) for hash writes waiting for their transaction."""
+    if not hasattr(_local, 'uncommitted'):
+        _local.uncommitted = {}
+    return _local.uncommitted
+
+
+def _uncommitted_fields(contact_id) -> Optional[dict]:
+    """The hash this thread's open transaction will write for the contact, or None."""
+    entry = _uncommitted_hashes().get(contact_id)
+    if entry is None:
+        return None
+    callback, mapping = entry
+    # A rolled back transaction or savepoint drops its callbacks, and with them the write.
+    if not any(queued is callback for _, queued, *_ in transaction.get_connection().run_on_commit):
+        _uncommitted_hashes().pop(contact_id, None)
+        return None
+    return {key: str(value) for key, value in mapping.items()}
+
+
+def _held_locks() -> dict:
+    """contact id -> token of the state locks this thread holds until its transaction commits."""
+    if not hasattr(_local, 'locks'):
+        _local.locks = {}
+    return _local.locks
+
+
+def _lock_flow_state(client, contact_id) -> bool:
+    """
+    Takes the contact's state lock for the open transaction, waiting up to
+    FLOW_STATE_LOCK_WAIT_SECONDS. Returns False if it could not be taken.
+    """
+    # Drops a hash write left queued by a rolled back transaction, which would keep the lock from being released.
+    _uncommitted_fields(contact_id)
+    key = f'{FLOW_STATE_LOCK_KEY_PREFIX}{contact_id}'
+    token = _held_locks().get(contact_id) or uuid.uuid4().hex
+    deadline = time.monotonic() + settings.FLOW_STATE_LOCK_WAIT_SECONDS
+    try:
+        while not client.set(key, token, nx=True, px=int(settings.FLOW_STATE_LOCK_TIMEOUT_SECONDS * 1000)):
+            holder = client.get(key)
+            if (holder.decode() if isinstance(holder, bytes) else holder) == token:
+                break  # Already taken by this thread's transaction.
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return False
+    _held_locks()[contact_id] = token
+    transaction.on_commit(lambda: _unlock_flow_state(contact_id))
+    return True
+
+
+def _unlock_flow_state(contact_id):
+    """Releases the contact's state lock, unless a hash write of the committing transaction is still to run."""
+    if contact_id in _uncommitted_hashes():
+        return  # The last queued write calls this again once it's done.
+    token = _held_locks().pop(contact_id, None)
+    client = get_redis_client() if token else None
+    if client is None:
+        return
+    try:
+        client.register_script(_UNLOCK_LUA)(keys=[f'{FLOW_STATE_LOCK_KEY_PREFIX}{contact_id}'], args=[token])
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+
+
+def _write_hash(client, contact_id, mapping: dict, dirty: bool) -> bool:
+    """
+    Replaces a contact's hash, once the open transaction (if any) commits.
+    Returns False if Redis failed.
+    """
+    if not transaction.get_connection().in_atomic_block:
+        return _write_hash_now(client, contact_id, mapping, dirty)
+
+    def write_on_commit():
+        if _uncommitted_hashes().get(contact_id, (None,))[0] is write_on_commit:
+            _uncommitted_hashes().pop(contact_id)
+        commit_client = get_redis_client()
+        if commit_client is None or not _write_hash_now(commit_client, contact_id, mapping, dirty):
+            if dirty:
+                logger.warning(f"Redis failed while saving the flow state of contact {contact_id}; writing it to the table.")
+                persist_states({contact_id: {key: str(value) for key, value in mapping.items()}})
+        _unlock_flow_state(contact_id)
+
+    _uncommitted_hashes()[contact_id] = (write_on_commit, mapping)
+    transaction.on_commit(write_on_commit)
+    return True
+
+
+def _write_hash_now(client, contact_id, mapping: dict, dirty: bool) -> bool:
+    """Replaces a contact's hash right away; returns False if Redis failed."""
+    key = _state_key(contact_id)
+    try:
+        pipe = client.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.hset(key, mapping=mapping)
+        pipe.expire(key, settings.FLOW_STATE_REDIS_TTL_SECONDS)
+        if dirty:
+            pipe.sadd(FLOW_STATE_DIRTY_KEY, contact_id)
+            # The flag expires on its own if the scheduled flush is ever lost.
+            pipe.set(FLOW_STATE_FLUSH_SCHEDULED_KEY, 1, nx=True, ex=settings.FLOW_STATE_PERSIST_WINDOW_SECONDS + 60)
+        results = pipe.execute()
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return False
+    if dirty and results[-1]:
+        from .tasks import persist_flow_states_task  # tasks imports services, which imports this module
+        window = settings.FLOW_STATE_PERSIST_WINDOW_SECONDS
+        transaction.on_commit(lambda: persist_flow_states_task.apply_async(countdown=window))
+    return True
+
+
+def load_flow_state(contact, for_update: bool = False) -> Optional[ContactFlowState]:
+    """
+    Returns the contact's current flow state, or None. `for_update` locks the
+    row (select_for_update) with the database backend, and takes the contact's
+    state lock with the Redis backend. A state saved earlier in the same write
+    buffer (write_buffer.py) is returned as is.
+    """
+    client = _redis_backend()
+    if for_update and client is not None and transaction.get_connection().in_atomic_block:
+        if not _lock_flow_state(client, contact.id):
+            logger.warning(f"Could not lock the flow state of contact {contact.id}; reading it unlocked.")
+    pending = pending_flow_state(contact.id)
+    if pending is not None:
+        return pending
+    if client is not None:
+        fields = _uncommitted_fields(contact.id)
+        if fields is None:
+            try:
+                raw = client.hgetall(_state_key(contact.id))
+            except redis.RedisError as e:
+                mark_redis_unavailable(e)
+                raw = None
+                client = None
+            fields = _decode(raw) if raw else None
+        if fields:
+            if fields.get('deleted'):
+                return None
+            return _state_from_hash(contact, fields)
+
+    queryset = ContactFlowState.objects.filter(contact=contact)
+    if for_update and client is None:
+        queryset = queryset.select_for_update()
+    state = queryset.first()
+    if state is not None:
+        state._store_token = f'db:{state.pk}'
+        if client is not None:
+            # Warm the hash from the row; it is already persisted.
+            _write_hash(client, contact.id, _encode_state(state), dirty=False)
+    return state
+
+
+def create_flow_state(contact, flow, step, flow_context_data: dict) -> ContactFlowState:
+    """Starts a new flow session for the contact (replacing the stored state in 'redis' mode)."""
+    discard_flow_state(contact.id)
+    client = _redis_backend()
+    if client is not None:
+        now = timezone.now()
+        state = ContactFlowState(
+            contact=contact, current_flow=flow, current_step=step,
+            flow_context_data=flow_context_data, started_at=now, last_updated_at=now,
+        )
+        state._store_token = uuid.uuid4().hex
+        if _write_hash(client, contact.id, _encode_state(state), dirty=True):
+            return state
+
+    state = ContactFlowState.objects.create(
+        contact=contact,
+        current_flow=flow,
+        current_step=step,
+        flow_context_data=flow_context_data,
+        started_at=timezone.now(),
+    )
+    state._store_token = f'db:{state.pk}'
+    return state
+
+
+def save_flow_state(state: ContactFlowState, update_fields: Optional[list] = None):
+    """
+    Saves a state returned by load_flow_state() or create_flow_state(). Within
+    a write buffer, the write is deferred to its flush.
+    """
+    if buffer_flow_state(state, update_fields):
+        return
+    write_flow_state(state, update_fields)
+
+
+def write_flow_state(state: ContactFlowState, update_fields: Optional[list] = None):
+    """Writes a state to the backend right away."""
+    client = _redis_backend()
+    if client is not None:
+        if not getattr(state, '_store_token', None):
+            state._store_token = f'db:{state.pk}' if state.pk else uuid.uuid4().hex
+        if not update_fields or 'last_updated_at' in update_fields:
+            state.last_updated_at = timezone.now()
+        if _write_hash(client, state.contact_id, _encode_state(state), dirty=True):
+            return
+
+    if state.pk is None:
+        # Built from a hash while Redis was reachable; upsert the row by contact.
+        existing_pk = ContactFlowState.objects.filter(contact_id=state.contact_id).values_list('pk', flat=True).first()
+        if existing_pk is not None:
+            state.pk = existing_pk
+            state._state.adding = False
+        state.save()
+        return
+    state.save(update_fields=update_fields)
+
+
+def clear_flow_state(contact) -> bool:
+    """Ends the contact's flow session. Returns True if there was one."""
+    discard_flow_state(contact.id)
+    client = _redis_backend()
+    if client is not None:
+        fields = _uncommitted_fields(contact.id)
+        try:
+            if fields is None:
+                raw = client.hgetall(_state_key(contact.id))
+                fields = _decode(raw) if raw else {}
+        except redis.RedisError as e:
+            mark_redis_unavailable(e)
+        else:
+            if fields.get('deleted'):
+                return False
+            # A row that was never warmed into Redis is deleted by the flush as well.
+            if not fields and not ContactFlowState.objects.filter(contact=contact).exists():
+                return False
+            if _write_hash(client, contact.id, {'deleted': 1}, dirty=True):
+                return True
+
+    deleted_count, _ = ContactFlowState.objects.filter(contact=contact).delete()
+    return deleted_count > 0
+
+
+def same_flow_state(first: ContactFlowState, second: ContactFlowState) -> bool:
+    """Whether two loaded states are the same flow session (the same row, or the same hash generation)."""
+    first_token = getattr(first, '_store_token', None)
+    if first_token is not None and first_token == getattr(second, '_store_token', None):
+        return True
+    return first.pk is not None and first.pk == second.pk
+
+
+# --- Write-behind persistence ---
+
+def _drain_dirty(client, batch_size: int):
+    """
+    Moves up to `batch_size` dirty contact ids into a new processing set.
+    Returns (processing set key, current hashes by contact id).
+    """
+    batch_key = f'{FLOW_STATE_PERSISTING_KEY_PREFIX}{uuid.uuid4().hex}'
+    try:
+        contact_ids = [int(cid) for cid in client.register_script(_DRAIN_LUA)(
+            keys=[FLOW_STATE_DIRTY_KEY, batch_key, FLOW_STATE_PERSIST_BATCHES_KEY], args=[batch_size, time.time()]
+        )]
+        if not contact_ids:
+            return None, {}
+        pipe = client.pipeline(transaction=False)
+        for contact_id in contact_ids:
+            pipe.hgetall(_state_key(contact_id))
+        raw_states = pipe.execute()
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return None, {}
+    return batch_key, {contact_id: _decode(raw) for contact_id, raw in zip(contact_ids, raw_states)}
+
+
+def _ack_batch(client, batch_key: str):
+    """Deletes a processing set whose states have been committed to the table."""
+    try:
+        pipe = client.pipeline(transaction=True)
+        pipe.delete(batch_key)
+        pipe.zrem(FLOW_STATE_PERSIST_BATCHES_KEY, batch_key)
+        pipe.execute()
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+
+
+def _requeue_batch(client, batch_key: str) -> int:
+    """Puts a processing set's contact ids back into the dirty set. Returns how many were requeued."""
+    try:
+        return client.register_script(_REQUEUE_LUA)(
+            keys=[batch_key, FLOW_STATE_DIRTY_KEY, FLOW_STATE_PERSIST_BATCHES_KEY]
+        )
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return 0
+
+
+def requeue_abandoned_batches() -> int:
+    """Requeues processing sets older than FLOW_STATE_PERSIST_REQUEUE_SECONDS, left by crashed workers."""
+    client = get_redis_client()
+    if client is None:
+        return 0
+    try:
+        abandoned = client.zrangebyscore(
+            FLOW_STATE_PERSIST_BATCHES_KEY, '-inf', time.time() - settings.FLOW_STATE_PERSIST_REQUEUE_SECONDS
+        )
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return 0
+    requeued = sum(_requeue_batch(client, key.decode()) for key in abandoned)
+    if requeued:
+        logger.warning(f"Requeued {requeued} dirty flow states from {len(abandoned)} abandoned persist batches.")
+    return requeued
+
+
+def persist_states(states_by_contact: dict) -> dict:
+    """
+    Writes hashes to the ContactFlowState table: one bulk upsert for live
+    states and one delete for tombstones and expired hashes. The timestamps of
+    the rows are those of the flush (auto_now_add / auto_now), at most a
+    persist window later than the hash's.
+    """
+    from conversations.models import Contact
+
+    upserts, delete_ids = [], []
+    for contact_id, fields in states_by_contact.items():
+        if not fields or fields.get('deleted'):
+            delete_ids.append(contact_id)
+        else:
+            upserts.append((contact_id, fields))
+
+    # States pointing at steps or contacts deleted since can't be written.
+    step_ids = {int(fields['step_id']) for _, fields in upserts}
+    existing_steps = set(FlowStep.objects.filter(pk__in=step_ids).values_list('pk', flat=True))
+    existing_contacts = set(Contact.objects.filter(pk__in=[cid for cid, _ in upserts]).values_list('pk', flat=True))
+    rows = []
+    for contact_id, fields in upserts:
+        if int(fields['step_id']) not in existing_steps or contact_id not in existing_contacts:
+            delete_ids.append(contact_id)
+            continue
+        rows.append(ContactFlowState(
+            contact_id=contact_id,
+            current_flow_id=int(fields['flow_id']),
+            current_step_id=int(fields['step_id']),
+            flow_context_data=json.loads(fields['context']),
+        ))
+
+    with transaction.atomic():
+        if rows:
+            ContactFlowState.objects.bulk_create(
+                rows, update_conflicts=True, unique_fields=['contact'],
+                update_fields=['current_flow', 'current_step', 'flow_context_data', 'last_updated_at'],
+            )
+        deleted_count = 0
+        if delete_ids:
+            deleted_count, _ = ContactFlowState.objects.filter(contact_id__in=delete_ids).delete()
+
+    FLOW_STATES_PERSISTED.labels(outcome='upserted').inc(len(rows))
+    FLOW_STATES_PERSISTED.labels(outcome='deleted').inc(deleted_count)
+    return {'upserted': len(rows), 'deleted': deleted_count}
+
+
+def clear_flush_flag():
+    """Lets the next state write schedule a new flush."""
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        client.delete(FLOW_STATE_FLUSH_SCHEDULED_KEY)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+
+
+def persist_dirty_states(batch_size: int) -> dict:
+    """Persists every dirty state, `batch_size` contacts at a time."""
+    totals = {'upserted': 0, 'deleted': 0}
+    client = get_redis_client()
+    if client is None:
+        return totals
+    while True:
+        batch_key, states_by_contact = _drain_dirty(client, batch_size)
+        if not states_by_contact:
+            break
+        try:
+            result = persist_states(states_by_contact)
+        except Exception:
+            _requeue_batch(client, batch_key)
+            raise
+        transaction.on_commit(lambda batch_key=batch_key: _ack_batch(client, batch_key))
+        for key in totals:
+            totals[key] += result[key]
+    return totals
+
+
+# --- Reconciliation ---
+
+def _row_matches(row: ContactFlowState, fields: dict) -> bool:
+    return (
+        row.current_flow_id == int(fields['flow_id'])
+        and row.current_step_id == int(fields['step_id'])
+        and row.flow_context_data == json.loads(fields['context'])
+    )
+
+
+def reconcile_flow_states(fix: bool = False) -> dict:
+    """
+    Compares every Redis hash with its ContactFlowState row. A hash is the
+    newer copy of a session, so with `fix` differing or missing rows are
+    rewritten from it, and rows of tombstoned sessions are deleted. Rows
+    without a hash are reported only: reads still fall back to them.
+    """
+    report = {'in_sync': 0, 'differs': 0, 'missing_row': 0, 'stale_row': 0, 'row_only': 0, 'fixed': 0}
+    client = get_redis_client()
+    if client is None:
+        raise RuntimeError("Redis is unavailable; flow states can't be reconciled.")
+
+    hashes = {}
+    try:
+        for key in client.scan_iter(match=f'{FLOW_STATE_KEY_PREFIX}*', count=500):
+            key = key.decode() if isinstance(key, bytes) else key
+            raw = client.hgetall(key)
+            if raw:
+                hashes[int(key[len(FLOW_STATE_KEY_PREFIX):])] = _decode(raw)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        raise RuntimeError(f"Redis failed while reading flow states: {e}") from e
+
+    rows = {row.contact_id: row for row in ContactFlowState.objects.all()}
+    to_persist = {}
+    for contact_id, fields in hashes.items():
+        row = rows.get(contact_id)
+        if fields.get('deleted'):
+            if row is None:
+                report['in_sync'] += 1
+            else:
+                report['stale_row'] += 1
+                to_persist[contact_id] = fields
+        elif row is None:
+            report['missing_row'] += 1
+            to_persist[contact_id] = fields
+        elif _row_matches(row, fields):
+            report['in_sync'] += 1
+        else:
+            report['differs'] += 1
+            to_persist[contact_id] = fields
+    report['row_only'] = len(set(rows) - set(hashes))
+
+    if fix and to_persist:
+        result = persist_states(to_persist)
+        report['fixed'] = result['upserted'] + result['deleted']
+    return report
+
+
+def state_last_updated_at(contact) -> Optional[datetime]:
+    """Last activity of the contact's live state, or None if there is none."""
+    state = load_flow_state(contact)
+    return state.last_updated_at if state is not None else None
@@ -0,0 +1,66 @@
+# whatsappcrm_backend/flows/management/commands/benchmark_step_configs.py
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from conversations.models import Contact
+from flows.models import Flow, FlowStep
+from flows.services import _execute_step_actions
+
+# A send_message step with a 50-row interactive list, as used by product menus.
+LIST_STEP_CONFIG = {
+    'message_type': 'interactive',
+    'interactive': {
+        'type': 'list',
+        'body': {'text': 'Hi {{ contact.name }}, pick a product'},
+        'action': {
+            'button': 'Products',
+            'sections': [
+                {'title': f'Section {s}', 'rows': [
+                    {'id': f'product_{s}_{r}', 'title': f'Product {s}.{r}', 'description': 'In stock'}
+                    for r in range(10)
+                ]}
+                for s in range(5)
+            ],
+        },
+    },
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Times the execution of a send_message list step with its config validated on every '
+        'execution versus the cached parsed config (flows/step_configs.py). All rows created '
+        'are rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200, help='Step executions per timed run.')
+        parser.add_argument('--repeat', type=int, default=3, help='Timed runs per mode; the fastest is reported.')
+
+    def handle(self, *args, **options):
+        iterations, repeat = options['iterations'], options['repeat']
+        with transaction.atomic():
+            contact = Contact.objects.bulk_create([Contact(whatsapp_id='000000000000', name='Benchmark')])[0]
+            flow = Flow.objects.create(name='benchmark_step_configs')
+            step = FlowStep.objects.create(flow=flow, name='product_list', step_type='send_message', config=LIST_STEP_CONFIG)
+
+            def run(cached):
+                started = time.perf_counter()
+                for _ in range(iterations):
+                    if not cached:
+                        step.__dict__.pop('_parsed_config', None)
+                    _execute_step_actions(step, contact, {})
+                return (time.perf_counter() - started) / iterations
+
+            run(cached=True)  # Warm the template cache.
+            per_execution = min(run(cached=False) for _ in range(repeat))
+            cached = min(run(cached=True) for _ in range(repeat))
+            transaction.set_rollback(True)
+
+        self.stdout.write(
+            f"send_message list step: {per_execution * 1e6:.0f} us validating per execution, "
+            f"{cached * 1e6:.0f} us with the cached config ({per_execution / cached:.1f}x)"
+        )
@@ -4,6 +4,7 @@ from django.core.management.base import BaseCommand, CommandError
 from django.core.exceptions import ValidationError
 from django.db import transaction
 from flows.models import Flow, FlowStep, FlowTransition
+from flows.services import precompile_config_templates
 from flows.definitions.erp_quote_flow import ERP_QUOTE_FLOW
 from flows.definitions.payroll_flow import PAYROLL_SOFTWARE_FLOW
 from flows.definitions.fiscalisation_flow import FISCALISATION_FLOW
@@ -91,6 +92,8 @@ class Command(BaseCommand):
             )
             steps_in_db[step_name] = step
             self.stdout.write(f"      - Created step '{step_name}'.")
+            for source, error in precompile_config_templates(step.config):
+                self.stdout.write(self.style.WARNING(f"        Invalid template in step '{step_name}': '{source}' ({error})"))
 
         # Second pass: Create transitions, now that all steps are guaranteed to exist
         for step_def in flow_def['steps']:
@@ -0,0 +1,34 @@
+# whatsappcrm_backend/flows/management/commands/reconcile_flow_states.py
+
+from django.core.management.base import BaseCommand, CommandError
+
+from flows.flow_state_store import reconcile_flow_states
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares the flow states held in Redis (FLOW_STATE_BACKEND=redis) with the ContactFlowState '
+        'table. With --fix, rows that differ from or outlive their Redis state are rewritten from it.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Write the Redis states over the rows that differ.')
+
+    def handle(self, *args, **options):
+        try:
+            report = reconcile_flow_states(fix=options['fix'])
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        self.stdout.write(f"In sync:                       {report['in_sync']}")
+        self.stdout.write(f"Row differs from Redis:        {report['differs']}")
+        self.stdout.write(f"Redis state without a row:     {report['missing_row']}")
+        self.stdout.write(f"Row of an ended Redis state:   {report['stale_row']}")
+        self.stdout.write(f"Row without a Redis state:     {report['row_only']}")
+        out_of_sync = report['differs'] + report['missing_row'] + report['stale_row']
+        if options['fix']:
+            self.stdout.write(self.style.SUCCESS(f"Fixed {report['fixed']} row(s)."))
+        elif out_of_sync:
+            self.stdout.write(self.style.WARNING(f"{out_of_sync} row(s) out of sync; run with --fix to repair."))
+        else:
+            self.stdout.write(self.style.SUCCESS("Flow states are in sync."))
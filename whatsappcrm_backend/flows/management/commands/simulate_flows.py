@@ -0,0 +1,70 @@
+# whatsappcrm_backend/flows/management/commands/simulate_flows.py
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+from flows.simulation import SCENARIOS, run_scenario
+
+
+class Command(BaseCommand):
+    help = (
+        'Replays scripted conversations through the flow engine for synthetic contacts and reports '
+        'messages/second, p50/p99 latency and queries per message for each scenario. Outgoing sends '
+        'are not queued and all rows created are rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scenario', choices=sorted(SCENARIOS) + ['all'], default='all', help='Scenario to run.'
+        )
+        parser.add_argument('--contacts', type=int, default=50, help='Synthetic contacts per scenario.')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON (one object per scenario).')
+        parser.add_argument(
+            '--max-p99-ms', type=float, default=None,
+            help='Fail if any scenario\'s p99 latency exceeds this many milliseconds.'
+        )
+        parser.add_argument(
+            '--max-queries-per-message', type=float, default=None,
+            help='Fail if any scenario averages more database queries per message than this.'
+        )
+
+    def handle(self, *args, **options):
+        names = sorted(SCENARIOS) if options['scenario'] == 'all' else [options['scenario']]
+        results = []
+        # Trace logging would time the log handlers; the histograms are still observed.
+        with override_settings(FLOW_PROFILE_TRACE_SAMPLE_RATE=0, FLOW_PROFILE_SLOW_TRACE_SECONDS=float('inf')), \
+                transaction.atomic():
+            for name in names:
+                results.append(run_scenario(
+                    SCENARIOS[name], contacts=options['contacts'],
+                    on_error=lambda contact, message_data, e: self.stderr.write(
+                        f"{name}: {message_data.get('type')} message for contact {contact.id} failed: {e}"
+                    ),
+                ))
+            transaction.set_rollback(True)
+
+        if options['json']:
+            self.stdout.write(json.dumps([result.as_dict() for result in results], indent=2))
+        else:
+            for result in results:
+                self.stdout.write(
+                    f"{result.scenario:<20} {result.messages:>6} msgs {result.messages_per_second:>8.1f} msg/s  "
+                    f"p50 {result.p50_ms:>7.2f} ms  p99 {result.p99_ms:>7.2f} ms  "
+                    f"{result.queries_per_message:>6.1f} queries/msg  {result.errors} error(s)"
+                )
+
+        failures = []
+        for result in results:
+            if result.errors:
+                failures.append(f"{result.scenario}: {result.errors} message(s) raised")
+            if options['max_p99_ms'] is not None and result.p99_ms > options['max_p99_ms']:
+                failures.append(f"{result.scenario}: p99 {result.p99_ms:.2f} ms > {options['max_p99_ms']} ms")
+            if options['max_queries_per_message'] is not None and result.queries_per_message > options['max_queries_per_message']:
+                failures.append(
+                    f"{result.scenario}: {result.queries_per_message:.1f} queries/msg > {options['max_queries_per_message']}"
+                )
+        if failures:
+            raise CommandError("Flow simulation regressed: " + "; ".join(failures))
@@ -3,6 +3,7 @@ import importlib
 from django.core.management.base import BaseCommand
 from django.db import transaction
 from flows.models import Flow, FlowStep, FlowTransition
+from flows.services import precompile_config_templates
 import logging
 
 logger = logging.getLogger(__name__)
@@ -75,6 +76,8 @@ class Command(BaseCommand):
                     )
                     # Map "flow_name.step_name" to the step object
                     step_map[f"{flow_name}.{step_name}"] = step_instance
+                    for source, error in precompile_config_templates(step_instance.config):
+                        self.stderr.write(self.style.WARNING(f"  Invalid template in step '{flow_name}.{step_name}': '{source}' ({error})"))
             except Exception as e:
                 self.stderr.write(self.style.ERROR(f"Error creating flow or steps for '{flow_def.get('name', 'Unknown')}': {e}"))
                 # The transaction will be rolled back, so we can just stop.
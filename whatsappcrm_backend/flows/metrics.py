@@ -0,0 +1,64 @@
+# whatsappcrm_backend/flows/metrics.py
+
+"""
+Prometheus metrics for the flow engine.
+
+The web process exports them through django_prometheus at /prometheus/. Celery
+workers update them in their own process registry, which each worker process serves
+on WORKER_METRICS_PORT (see whatsappcrm_backend/worker_metrics.py).
+"""
+from prometheus_client import Counter, Histogram
+
+FLOW_TEMPLATE_CACHE_LOOKUPS = Counter(
+    'whatsappcrm_flow_template_cache_lookups_total',
+    'Flow template strings resolved, by compiled-template cache result '
+    '(hit, miss, or plain for strings without Jinja markup).',
+    ['result']
+)
+FLOW_STATES_PERSISTED = Counter(
+    'whatsappcrm_flow_states_persisted_total',
+    'Redis flow states written behind to the ContactFlowState table, by outcome (upserted or deleted).',
+    ['outcome']
+)
+FLOW_QUERY_CACHE_LOOKUPS = Counter(
+    'whatsappcrm_flow_query_cache_lookups_total',
+    'query_model actions with cache_ttl_seconds, by result cache outcome (hit or miss).',
+    ['result']
+)
+
+# Per-step profiling (flows/profiling.py), labelled by flow and step name.
+FLOW_MESSAGE_DURATION_SECONDS = Histogram(
+    'whatsappcrm_flow_message_seconds',
+    'Wall time of process_message_for_flow per incoming message.',
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+FLOW_STEP_DURATION_SECONDS = Histogram(
+    'whatsappcrm_flow_step_seconds',
+    'Wall time of one flow step execution, including its actions and template rendering.',
+    ['flow', 'step', 'step_type'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+FLOW_STEP_DB_QUERIES = Histogram(
+    'whatsappcrm_flow_step_db_queries',
+    'Database queries run by one flow step execution.',
+    ['flow', 'step'],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+)
+FLOW_STEP_TEMPLATE_RENDER_SECONDS = Histogram(
+    'whatsappcrm_flow_step_template_render_seconds',
+    'Time one flow step execution spent rendering Jinja templates.',
+    ['flow', 'step'],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+)
+FLOW_ACTION_DURATION_SECONDS = Histogram(
+    'whatsappcrm_flow_action_seconds',
+    'Wall time of one action of an action step, by action type (built-in or FlowActionRegistry).',
+    ['flow', 'action_type'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+FLOW_TRANSITIONS_EVALUATED = Histogram(
+    'whatsappcrm_flow_transitions_evaluated',
+    'Transitions of a step evaluated for one message before one matched or all failed.',
+    ['flow', 'step'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 20, 50)
+)
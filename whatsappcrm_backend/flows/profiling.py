@@ -0,0 +1,220 @@
+# whatsappcrm_backend/flows/profiling.py
+
+"""
+Per-step profiling of the flow engine.
+
+process_message_for_flow runs inside a message profile. While it is active,
+each execution of a flow step records its wall time, the database queries it
+ran (counted with `connection.execute_wrapper`), the time spent rendering
+Jinja templates and the time and queries of each action it ran
+(`query_model`, `create_model_instance`, custom FlowActionRegistry actions,
+...). The transitions evaluated at each step are counted as well.
+
+When the message is done, each step's figures are observed in the Prometheus
+histograms of flows/metrics.py, labelled by flow and step name. A
+FLOW_PROFILE_TRACE_SAMPLE_RATE share of messages, and every message slower
+than FLOW_PROFILE_SLOW_TRACE_SECONDS, is also logged as a single trace line
+listing its steps in execution order.
+
+Temporary steps built by the engine (a question's prompt, a fallback action)
+have no pk and are accounted to the step that runs them. The profile lives
+in a threading.local, which gevent makes greenlet-local.
+"""
+import functools
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from .metrics import (
+    FLOW_MESSAGE_DURATION_SECONDS, FLOW_STEP_DURATION_SECONDS, FLOW_STEP_DB_QUERIES,
+    FLOW_STEP_TEMPLATE_RENDER_SECONDS, FLOW_ACTION_DURATION_SECONDS, FLOW_TRANSITIONS_EVALUATED,
+)
+from .render_context import render
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class StepProfile:
+    __slots__ = ('step_id', 'flow', 'step', 'step_type', 'seconds', 'queries', 'template_seconds', 'actions', 'transitions')
+
+    def __init__(self, step):
+        self.step_id = step.pk
+        # The graph's steps carry their flow, so reading its name doesn't query.
+        self.flow = step.flow.name
+        self.step = step.name
+        self.step_type = step.step_type
+        self.seconds = 0.0
+        self.queries = 0
+        self.template_seconds = 0.0
+        self.actions = []  # (action_type, seconds, queries)
+        self.transitions = None
+
+    def describe(self) -> str:
+        parts = [f"{self.flow}/{self.step} ({self.step_type}) {self.seconds * 1000:.1f}ms {self.queries}q"]
+        if self.template_seconds:
+            parts.append(f"tmpl {self.template_seconds * 1000:.1f}ms")
+        if self.actions:
+            parts.append("[" + ", ".join(
+                f"{action_type} {seconds * 1000:.1f}ms {queries}q" for action_type, seconds, queries in self.actions
+            ) + "]")
+        if self.transitions is not None:
+            parts.append(f"{self.transitions} transition(s)")
+        return " ".join(parts)
+
+
+class MessageProfile:
+    def __init__(self, contact_id):
+        self.contact_id = contact_id
+        self.started = time.perf_counter()
+        self.steps = []
+        self.stack = []
+        self.queries = 0
+
+    def count_query(self, execute, sql, params, many, context):
+        self.queries += 1
+        if self.stack:
+            self.stack[-1].queries += 1
+        return execute(sql, params, many, context)
+
+    def finish(self):
+        seconds = time.perf_counter() - self.started
+        FLOW_MESSAGE_DURATION_SECONDS.observe(seconds)
+        for profile in self.steps:
+            if profile.seconds:
+                FLOW_STEP_DURATION_SECONDS.labels(profile.flow, profile.step, profile.step_type).observe(profile.seconds)
+                FLOW_STEP_DB_QUERIES.labels(profile.flow, profile.step).observe(profile.queries)
+                FLOW_STEP_TEMPLATE_RENDER_SECONDS.labels(profile.flow, profile.step).observe(profile.template_seconds)
+            for action_type, action_seconds, _ in profile.actions:
+                FLOW_ACTION_DURATION_SECONDS.labels(profile.flow, action_type).observe(action_seconds)
+            if profile.transitions is not None:
+                FLOW_TRANSITIONS_EVALUATED.labels(profile.flow, profile.step).observe(profile.transitions)
+
+        if seconds >= settings.FLOW_PROFILE_SLOW_TRACE_SECONDS or random.random() < settings.FLOW_PROFILE_TRACE_SAMPLE_RATE:
+            logger.info(
+                f"Flow trace for contact {self.contact_id}: {seconds * 1000:.1f}ms, {self.queries} queries. "
+                + ("; ".join(profile.describe() for profile in self.steps) or "no steps executed")
+            )
+
+
+def _current_message():
+    return getattr(_local, 'profile', None)
+
+
+def _current_step():
+    profile = getattr(_local, 'profile', None)
+    if profile is None or not profile.stack:
+        return None
+    return profile.stack[-1]
+
+
+def profile_flow_message(func):
+    """Decorates process_message_for_flow(contact, ...) to profile the message it processes."""
+    @functools.wraps(func)
+    def wrapper(contact, *args, **kwargs):
+        if not settings.FLOW_PROFILING_ENABLED or _current_message() is not None:
+            return func(contact, *args, **kwargs)
+        profile = MessageProfile(contact.id)
+        _local.profile = profile
+        try:
+            with connection.execute_wrapper(profile.count_query):
+                return func(contact, *args, **kwargs)
+        finally:
+            _local.profile = None
+            profile.finish()
+    return wrapper
+
+
+def profile_step_execution(func):
+    """Decorates _execute_step_actions(step, ...) to time each step it executes."""
+    @functools.wraps(func)
+    def wrapper(step, *args, **kwargs):
+        message = _current_message()
+        if message is None or step.pk is None:
+            return func(step, *args, **kwargs)
+        profile = _step_profile(message, step)
+        message.stack.append(profile)
+        started = time.perf_counter()
+        try:
+            return func(step, *args, **kwargs)
+        finally:
+            profile.seconds += time.perf_counter() - started
+            message.stack.pop()
+    return wrapper
+
+
+def _step_profile(message: MessageProfile, step) -> StepProfile:
+    profile = StepProfile(step)
+    message.steps.append(profile)
+    return profile
+
+
+def render_template(template, render_context) -> str:
+    """Renders a compiled template against a RenderContext, adding the render time to the current step."""
+    profile = _current_step()
+    if profile is None:
+        return render(template, render_context)
+    started = time.perf_counter()
+    try:
+        return render(template, render_context)
+    finally:
+        profile.template_seconds += time.perf_counter() - started
+
+
+def record_transitions_evaluated(step, count: int):
+    """Records how many transitions of `step` were evaluated before one matched (or all failed)."""
+    message = _current_message()
+    if message is None or step.pk is None:
+        return
+    profile = next((p for p in reversed(message.steps) if p.step_id == step.pk), None)
+    if profile is None or profile.transitions is not None:
+        # The step was entered by an earlier message, or is re-evaluated in a later loop iteration.
+        profile = _step_profile(message, step)
+    profile.transitions = count
+
+
+class ActionTimer:
+    """Times consecutive actions of an action step: each start() ends the previous action."""
+    __slots__ = ('profile', 'action_type', 'started', 'queries_at_start')
+
+    def __init__(self, profile: StepProfile):
+        self.profile = profile
+        self.action_type = None
+
+    def start(self, action_type: str):
+        self.stop()
+        self.action_type = action_type
+        self.started = time.perf_counter()
+        self.queries_at_start = self.profile.queries
+
+    def stop(self):
+        if self.action_type is None:
+            return
+        self.profile.actions.append((
+            self.action_type, time.perf_counter() - self.started, self.profile.queries - self.queries_at_start,
+        ))
+        self.action_type = None
+
+
+class _NoActionTimer:
+    __slots__ = ()
+
+    def start(self, action_type: str):
+        pass
+
+    def stop(self):
+        pass
+
+
+_NO_ACTION_TIMER = _NoActionTimer()
+
+
+def action_timer():
+    """Returns an ActionTimer for the step being executed, or a no-op timer when not profiling."""
+    profile = _current_step()
+    return ActionTimer(profile) if profile is not None else _NO_ACTION_TIMER
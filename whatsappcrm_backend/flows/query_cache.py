@@ -0,0 +1,203 @@
+# whatsappcrm_backend/flows/query_cache.py
+
+"""
+Result cache for the `query_model` flow action.
+
+Menus built from `query_model` (products, categories, ...) run the same query
+for every contact. An action opts in with `cache_ttl_seconds`; its results are
+then kept per process in a bounded LRU keyed by the model, the resolved
+filters and excludes, order_by, limit and fields_to_return, for at most that
+many seconds.
+
+Invalidation is by a version per model (app_label.model_name), which is part
+of every entry:
+  * post_save/post_delete on any model (see signals.py) bump this process's
+    version of that model right away and again on commit.
+  * Models with cached results are registered in a Redis set. A save of a
+    registered model also bumps the model's shared version in a Redis hash on
+    commit. Each process reads the hash and the set at most every
+    FLOW_QUERY_CACHE_CHECK_SECONDS, so other processes drop their entries
+    within that window.
+  * Without Redis, entries of other processes only expire with their TTL.
+
+A query's results are stored under the version read before the query ran, so
+a save that commits while the query runs outdates them as well.
+
+Bulk writes (update(), bulk_create(), bulk_update()) send no signals and are
+only picked up through the TTL. Only the queried model's own signals bump its
+version: results filtered or ordered across a relation (e.g.
+`category__name`) are not invalidated when the related model changes, so keep
+the TTL of such queries short. Lookups return copies, so callers can't mutate
+the cached results.
+"""
+import copy
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from django.conf import settings
+from django.db import transaction
+
+from whatsappcrm_backend.redis_client import get_redis_client, mark_redis_unavailable
+from .metrics import FLOW_QUERY_CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+QUERY_CACHE_VERSIONS_KEY = 'flows:query_cache:versions'
+QUERY_CACHE_MODELS_KEY = 'flows:query_cache:models'
+
+_entries = OrderedDict()  # key -> (expires_at, version, results)
+_lock = threading.Lock()
+_local_versions = {}  # model label -> int, bumped by this process's saves
+_cached_here = set()  # model labels this process has cached results for
+_registered_here = set()  # model labels this process registered in QUERY_CACHE_MODELS_KEY
+_shared = None
+
+_cache_hit = FLOW_QUERY_CACHE_LOOKUPS.labels(result='hit')
+_cache_miss = FLOW_QUERY_CACHE_LOOKUPS.labels(result='miss')
+
+
+class _SharedState:
+    def __init__(self, versions: dict, models: set):
+        self.versions = versions
+        self.models = models
+        self.checked_at = time.monotonic()
+
+
+def _get_shared_state():
+    """Returns the shared versions and registered models, read from Redis at most every CHECK seconds."""
+    global _shared
+    shared = _shared
+    if shared is not None and time.monotonic() - shared.checked_at < settings.FLOW_QUERY_CACHE_CHECK_SECONDS:
+        return shared
+    versions, models = {}, set()
+    client = get_redis_client()
+    if client is not None:
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.hgetall(QUERY_CACHE_VERSIONS_KEY)
+            pipe.smembers(QUERY_CACHE_MODELS_KEY)
+            raw_versions, raw_models = pipe.execute()
+            versions = {label.decode(): version.decode() for label, version in raw_versions.items()}
+            models = {label.decode() for label in raw_models}
+        except redis.RedisError as e:
+            mark_redis_unavailable(e)
+    shared = _SharedState(versions, models)
+    _shared = shared
+    return shared
+
+
+def _model_version(label: str):
+    return _get_shared_state().versions.get(label, '0'), _local_versions.get(label, 0)
+
+
+def _register_model(label: str):
+    if label in _registered_here:
+        return
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        client.sadd(QUERY_CACHE_MODELS_KEY, label)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return
+    _registered_here.add(label)
+
+
+def make_query_cache_key(model, filters: dict, exclude_filters: dict, order_by, limit, fields_to_return) -> tuple:
+    """Cache key of one query_model query. Filter values that aren't JSON types are keyed by their str()."""
+    return (
+        model._meta.label_lower,
+        json.dumps(filters, sort_keys=True, default=str),
+        json.dumps(exclude_filters, sort_keys=True, default=str),
+        tuple(order_by or ()),
+        limit,
+        tuple(fields_to_return or ()),
+    )
+
+
+def query_cache_version(key: tuple):
+    """
+    Current version of the model queried under `key`. Read it before running the
+    query and pass it to both get_cached_query_results() and cache_query_results().
+    """
+    return _model_version(key[0])
+
+
+def get_cached_query_results(key: tuple, version):
+    """Returns a copy of the cached results for `key`, or None if absent, expired or not of `version`."""
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None:
+            expires_at, entry_version, results = entry
+            if expires_at > time.monotonic() and entry_version == version:
+                _entries.move_to_end(key)
+            else:
+                del _entries[key]
+                entry = None
+    if entry is None:
+        _cache_miss.inc()
+        return None
+    _cache_hit.inc()
+    return copy.deepcopy(results)
+
+
+def cache_query_results(key: tuple, results: list, ttl_seconds: float, version):
+    """Stores a copy of `results`, queried at `version`, under `key` for `ttl_seconds`."""
+    label = key[0]
+    _cached_here.add(label)
+    _register_model(label)
+    entry = (time.monotonic() + ttl_seconds, version, copy.deepcopy(results))
+    with _lock:
+        _entries[key] = entry
+        _entries.move_to_end(key)
+        while len(_entries) > settings.FLOW_QUERY_CACHE_SIZE:
+            _entries.popitem(last=False)
+
+
+def _bump_local_version(label: str):
+    with _lock:
+        _local_versions[label] = _local_versions.get(label, 0) + 1
+
+
+def _bump_shared_version(label: str):
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        client.hincrby(QUERY_CACHE_VERSIONS_KEY, label, 1)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+
+
+def invalidate_model_queries(model):
+    """
+    Outdates this process's cached results for `model` right away and, once the
+    surrounding transaction commits, again; if any process caches results for the
+    model, also bumps its shared version so the others drop theirs.
+    """
+    label = model._meta.label_lower
+    if label not in _cached_here and label not in _get_shared_state().models:
+        return
+    _bump_local_version(label)
+
+    def _on_commit():
+        _bump_local_version(label)
+        _bump_shared_version(label)
+
+    transaction.on_commit(_on_commit)
+
+
+def clear_query_cache():
+    """Drops every cached result of this process."""
+    global _shared
+    with _lock:
+        _entries.clear()
+        _local_versions.clear()
+    _cached_here.clear()
+    _registered_here.clear()
+    _shared = None
@@ -0,0 +1,92 @@
+# whatsappcrm_backend/flows/render_context.py
+
+"""
+Lazy render context for the Jinja templates in flow step configs.
+
+Templates see the flow context's variables plus `contact` and
+`customer_profile`. `_resolve_value` (services.py) renders every template
+leaf of a config separately. Building
+`{**flow_context, 'contact': ..., 'customer_profile': ...}` for each leaf
+copied the whole flow context every time. It also loaded the customer profile
+for templates that never use it.
+
+A RenderContext is a read-only mapping over the live flow context instead:
+  * flow context variables are read from the dict itself, so variables set
+    by earlier actions of the step are visible.
+  * `customer_profile` is only loaded when a template reads it. It comes
+    from the contact's related object cache, so the contact is queried at
+    most once (a missing profile is cached as None), and a profile attached
+    to the contact later (`contact.customer_profile = ...`) is seen.
+  * Jinja globals (`now`) are a fallback, as in Template.render.
+
+get_render_context() hands out one RenderContext per (flow context,
+contact). While a step executes, all of its leaves and its template
+components share one. render() renders against the mapping itself, because
+Template.render would copy it into a dict.
+"""
+import threading
+from collections.abc import Mapping
+
+_local = threading.local()
+
+_MISSING = object()
+
+
+class RenderContext(Mapping):
+    __slots__ = ('flow_context', 'contact', 'globals')
+
+    def __init__(self, flow_context: dict, contact, globals: Mapping):
+        self.flow_context = flow_context
+        self.contact = contact
+        self.globals = globals
+
+    def _customer_profile(self):
+        fields_cache = self.contact._state.fields_cache
+        if 'customer_profile' in fields_cache:
+            return fields_cache['customer_profile']
+        # Loads the profile and caches it on the contact (or None if it has none).
+        return getattr(self.contact, 'customer_profile', None)
+
+    def __getitem__(self, key):
+        if key == 'contact':
+            return self.contact
+        if key == 'customer_profile':
+            return self._customer_profile()
+        value = self.flow_context.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        return self.globals[key]
+
+    def __contains__(self, key):
+        return key in ('contact', 'customer_profile') or key in self.flow_context or key in self.globals
+
+    def __iter__(self):
+        yield 'contact'
+        yield 'customer_profile'
+        for key in self.flow_context:
+            if key not in ('contact', 'customer_profile'):
+                yield key
+        for key in self.globals:
+            if key not in self.flow_context and key not in ('contact', 'customer_profile'):
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def get_render_context(flow_context: dict, contact, globals: Mapping) -> RenderContext:
+    """Returns the RenderContext of `flow_context` and `contact`, reusing the last one handed out for them."""
+    render_context = getattr(_local, 'render_context', None)
+    if render_context is None or render_context.flow_context is not flow_context or render_context.contact is not contact:
+        render_context = RenderContext(flow_context, contact, globals)
+        _local.render_context = render_context
+    return render_context
+
+
+def render(template, render_context: Mapping) -> str:
+    """Equivalent of `template.render(render_context)`, reading variables from the mapping without copying it."""
+    context = template.new_context(render_context, shared=True)
+    try:
+        return template.environment.concat(template.root_render_func(context))
+    except Exception:
+        return template.environment.handle_exception()
@@ -182,6 +182,8 @@ class ActionItem(BaseModel):
     # Used by 'query_model' for optimization
     fields_to_return: Optional[List[str]] = None
     limit: Optional[int] = None
+    # Used by 'query_model': serve identical queries from a per-process cache for this many seconds
+    cache_ttl_seconds: Optional[int] = Field(None, ge=0)
     # Used by 'create_model_instance'
     fields_template: Optional[Dict[str, Any]] = None
     save_to_variable: Optional[str] = None
@@ -13,24 +13,37 @@ from django.forms.models import model_to_dict
 from django.db.models.fields.files import ImageFieldFile, FileField
 from jinja2 import Environment, select_autoescape, Undefined, pass_context
 from django.core.exceptions import ValidationError as DjangoValidationError # Renamed to avoid conflict with Pydantic
-from pydantic import ValidationError
 from django.conf import settings
 from datetime import date, datetime
 import re
 import uuid
 from decimal import Decimal, InvalidOperation
 import json
+import threading
+from collections import OrderedDict
 
 from conversations.models import Contact, Message
 from .models import Flow, FlowStep, FlowTransition, ContactFlowState
+from .flow_graph import get_flow_graph
+from .flow_state_store import (
+    load_flow_state, create_flow_state, save_flow_state, clear_flow_state, same_flow_state,
+)
+from .metrics import FLOW_TEMPLATE_CACHE_LOOKUPS
+from .render_context import RenderContext, get_render_context
+from .query_cache import make_query_cache_key, query_cache_version, get_cached_query_results, cache_query_results
+from .write_buffer import buffer_flow_writes, flush_writes, save_fields, add_instance, memoized_instance, remember_instance
+from .profiling import (
+    profile_flow_message, profile_step_execution, render_template, record_transitions_evaluated, action_timer,
+)
+from .step_configs import get_parsed_step_config, seed_parsed_step_config
+from .transition_conditions import MessageView, get_condition_predicate
 from notifications.services import queue_notifications_to_users
 from customer_data.models import CustomerProfile
 
 # Import Pydantic schemas from the new file
 from .schemas import (
-    StepConfigSendMessage, StepConfigQuestion, StepConfigAction,
-    StepConfigHumanHandover, StepConfigEndFlow, StepConfigSwitchFlow,
-    MediaMessageContent, FallbackConfig, InteractiveMessagePayload # Added InteractiveMessagePayload
+    MediaMessageContent, InteractiveMessagePayload, # Added InteractiveMessagePayload
+    ActionItem,
 )
 
 logger = logging.getLogger(__name__)
@@ -188,13 +201,18 @@ def to_interactive_rows_filter(context, value, row_template=None):
             "description": "{% if item.price is not none %}${{ item.price }}{% endif %}"
         }
 
+    # Compile the row templates once, not once per item.
+    id_template = get_compiled_template(row_template.get('id', ''))
+    title_template = get_compiled_template(row_template.get('title', ''))
+    description_template = get_compiled_template(row_template.get('description', ''))
+
     rows_list = []
     for item in value:
         # For each item in the list, render the id, title, and description from the template
         rendered_row = {
-            "id": jinja_env.from_string(row_template.get('id', '')).render(item=item),
-            "title": jinja_env.from_string(row_template.get('title', '')).render(item=item),
-            "description": jinja_env.from_string(row_template.get('description', '')).render(item=item)
+            "id": id_template.render(item=item),
+            "title": title_template.render(item=item),
+            "description": description_template.render(item=item)
         }
         rows_list.append(rendered_row)
 
@@ -212,6 +230,78 @@ jinja_env.filters['truncatewords'] = truncatewords_filter # Add the filter
 jinja_env.filters['to_interactive_rows'] = to_interactive_rows_filter # Add the new filter
 jinja_env.globals['now'] = timezone.now # Make 'now' globally available for date comparisons
 
+# --- Compiled Template Cache ---
+# Step configs are resolved on every message, so the same template strings are
+# compiled over and over. Compiled templates are kept per process in a bounded
+# LRU keyed by their source; strings that Jinja would return unchanged skip it
+# entirely.
+TEMPLATE_MARKERS = ('{{', '{%', '{#')
+
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+_template_cache_hit = FLOW_TEMPLATE_CACHE_LOOKUPS.labels(result='hit')
+_template_cache_miss = FLOW_TEMPLATE_CACHE_LOOKUPS.labels(result='miss')
+_template_plain = FLOW_TEMPLATE_CACHE_LOOKUPS.labels(result='plain')
+
+
+def is_template_string(value: Any) -> bool:
+    """True if `value` is a string containing Jinja markup."""
+    return isinstance(value, str) and any(marker in value for marker in TEMPLATE_MARKERS)
+
+
+def _renders_unchanged(value: str) -> bool:
+    """
+    True if rendering `value` would return it as is: no Jinja markup, no
+    trailing newline (dropped, as keep_trailing_newline is off) and no carriage
+    returns (normalized to newline_sequence).
+    """
+    return not is_template_string(value) and not value.endswith('\n') and '\r' not in value
+
+
+def get_compiled_template(source: str):
+    """
+    Returns the compiled Jinja template for `source`, compiling it only if it
+    is not in the LRU. Raises the Jinja error for invalid templates, which are
+    not cached.
+    """
+    with _template_cache_lock:
+        template = _template_cache.get(source)
+        if template is not None:
+            _template_cache.move_to_end(source)
+    if template is not None:
+        _template_cache_hit.inc()
+        return template
+
+    _template_cache_miss.inc()
+    template = jinja_env.from_string(source)
+    with _template_cache_lock:
+        _template_cache[source] = template
+        while len(_template_cache) > settings.FLOW_TEMPLATE_CACHE_SIZE:
+            _template_cache.popitem(last=False)
+    return template
+
+
+def precompile_config_templates(config: Any) -> list:
+    """
+    Compiles every template string found in a step config (walking dicts and
+    lists) into the template cache. Returns (source, error) pairs for the
+    templates that failed to compile.
+    """
+    errors = []
+    if isinstance(config, dict):
+        for value in config.values():
+            errors.extend(precompile_config_templates(value))
+    elif isinstance(config, list):
+        for item in config:
+            errors.extend(precompile_config_templates(item))
+    elif is_template_string(config):
+        try:
+            get_compiled_template(config)
+        except Exception as e:
+            errors.append((config, str(e)))
+    return errors
+
+
 def _get_value_from_context_or_contact(variable_path: str, flow_context: dict, contact: Contact) -> Any:
     """
     Resolves a variable path (e.g., 'contact.name', 'flow_context.user_email') to its value.
@@ -273,31 +363,35 @@ def _get_value_from_context_or_contact(variable_path: str, flow_context: dict, c
             return None
     return current_value
 
-def _resolve_value(template_value: Any, flow_context: dict, contact: Contact) -> Any:
+def _resolve_value(template_value: Any, flow_context: dict, contact: Contact, render_context: Optional[RenderContext] = None) -> Any:
     """
     Resolves a template value using Jinja2, which can be a string, dict, or list.
-    Provides 'contact', 'customer_profile', and the flow_context to the template.
+    Provides 'contact', 'customer_profile', and the flow_context to the template,
+    through one lazy RenderContext shared by all leaves (see render_context.py).
     """
     if isinstance(template_value, str):
+        if _renders_unchanged(template_value):
+            _template_plain.inc()
+            return template_value
         # Use Jinja2 for powerful string templating, supporting loops, conditionals, and filters.
         try:
-            template = jinja_env.from_string(template_value)
-            # The context for Jinja includes the contact, their profile, and the flow context flattened.
-            render_context = {
-                **flow_context, # type: ignore
-                'contact': contact,
-                'customer_profile': getattr(contact, 'customer_profile', None)
-            }
-            return template.render(render_context)
+            template = get_compiled_template(template_value)
+            if render_context is None:
+                render_context = get_render_context(flow_context, contact, jinja_env.globals)
+            return render_template(template, render_context)
         except Exception as e:
             logger.error(f"Jinja2 template rendering failed for contact {contact.id}: {e}. Template: '{template_value}'", exc_info=False)
             return template_value # Return original on error
     elif isinstance(template_value, dict):
         # Recursively resolve values in a dictionary
-        return {k: _resolve_value(v, flow_context, contact) for k, v in template_value.items()}
+        if render_context is None:
+            render_context = get_render_context(flow_context, contact, jinja_env.globals)
+        return {k: _resolve_value(v, flow_context, contact, render_context) for k, v in template_value.items()}
     elif isinstance(template_value, list):
         # Recursively resolve values in a list
-        return [_resolve_value(item, flow_context, contact) for item in template_value]
+        if render_context is None:
+            render_context = get_render_context(flow_context, contact, jinja_env.globals)
+        return [_resolve_value(item, flow_context, contact, render_context) for item in template_value]
     
     # For non-string, non-dict, non-list types, return as is
     return template_value
@@ -306,39 +400,72 @@ def _resolve_template_components(components_config: list, flow_context: dict, co
     if not components_config or not isinstance(components_config, list): return []
     try:
         resolved_components_list = json.loads(json.dumps(components_config)) # Deep copy
+        render_context = get_render_context(flow_context, contact, jinja_env.globals)
         for component in resolved_components_list: # type: ignore
             if isinstance(component.get('parameters'), list): # type: ignore
                 for param in component['parameters']: # type: ignore
                     # Resolve text for any parameter type that might contain it
                     if 'text' in param and isinstance(param['text'], str): # type: ignore
-                        param['text'] = _resolve_value(param['text'], flow_context, contact) # type: ignore
+                        param['text'] = _resolve_value(param['text'], flow_context, contact, render_context) # type: ignore
                     
                     # Specific handling for media link in header/body components using image/video/document type parameters
                     param_type = param.get('type') # type: ignore
                     if param_type in ['image', 'video', 'document'] and isinstance(param.get(param_type), dict): # type: ignore
                         media_obj = param[param_type] # type: ignore
                         if 'link' in media_obj and isinstance(media_obj['link'], str): # type: ignore
-                             media_obj['link'] = _resolve_value(media_obj['link'], flow_context, contact) # type: ignore
+                             media_obj['link'] = _resolve_value(media_obj['link'], flow_context, contact, render_context) # type: ignore
                     
                     # Handle payload for button parameters
                     if component.get('type') == 'button' and param.get('type') == 'payload' and 'payload' in param and isinstance(param['payload'], str): # type: ignore
-                         param['payload'] = _resolve_value(param['payload'], flow_context, contact) # type: ignore
+                         param['payload'] = _resolve_value(param['payload'], flow_context, contact, render_context) # type: ignore
 
                     # Handle currency and date_time fallback_values
                     if param_type == 'currency' and isinstance(param.get('currency'), dict) and 'fallback_value' in param['currency']: # type: ignore
-                        param['currency']['fallback_value'] = _resolve_value(param['currency']['fallback_value'], flow_context, contact) # type: ignore
+                        param['currency']['fallback_value'] = _resolve_value(param['currency']['fallback_value'], flow_context, contact, render_context) # type: ignore
                     if param_type == 'date_time' and isinstance(param.get('date_time'), dict) and 'fallback_value' in param['date_time']: # type: ignore
-                        param['date_time']['fallback_value'] = _resolve_value(param['date_time']['fallback_value'], flow_context, contact) # type: ignore
+                        param['date_time']['fallback_value'] = _resolve_value(param['date_time']['fallback_value'], flow_context, contact, render_context) # type: ignore
 
         return resolved_components_list
     except Exception as e:
         logger.error(f"Error resolving template components: {e}. Config: {components_config}", exc_info=True)
         return components_config
 
+def _get_contact_flow_state(contact: Contact) -> Optional[ContactFlowState]:
+    """
+    Loads the contact's flow state (see flow_state_store.py) and attaches its
+    flow and step from the compiled flow graph, so the engine doesn't query the
+    definitions. Falls back to the database when the state points at a step
+    this process's graph doesn't know yet.
+    """
+    contact_flow_state = load_flow_state(contact)
+    if not contact_flow_state:
+        return None
+    graph = get_flow_graph()
+    current_step = graph.get_step(contact_flow_state.current_step_id)
+    compiled_flow = graph.get_flow(contact_flow_state.current_flow_id)
+    if current_step is None or compiled_flow is None:
+        current_step = FlowStep.objects.filter(pk=contact_flow_state.current_step_id).first()
+        current_flow = Flow.objects.filter(pk=contact_flow_state.current_flow_id).first()
+        if current_step is None or current_flow is None:
+            return None
+    else:
+        current_flow = compiled_flow.flow
+    contact_flow_state.current_step = current_step
+    contact_flow_state.current_flow = current_flow
+    return contact_flow_state
+
+
+def _get_outgoing_transitions(step: FlowStep):
+    """Transitions from `step` in priority order, from the flow graph when it has the step."""
+    graph = get_flow_graph()
+    if graph.get_step(step.pk) is not None:
+        return graph.get_transitions(step.pk)
+    return list(step.outgoing_transitions.select_related('next_step').order_by('priority'))
+
+
 def _clear_contact_flow_state(contact: Contact, error: bool = False):
     import traceback
-    deleted_count, _ = ContactFlowState.objects.filter(contact=contact).delete()
-    if deleted_count > 0:
+    if clear_flow_state(contact):
         stack = ''.join(traceback.format_stack(limit=8))
         logger.info(
             f"Contact {contact.id}: Cleared flow state ({contact.whatsapp_id})."
@@ -365,6 +492,52 @@ def _initiate_paynow_giving_payment(contact: Contact, amount_str: str, payment_t
         "paynow_initiation_error": None
     }
 
+def _query_model_results(Model, final_filters: dict, exclude_filters: dict, action_item_conf: ActionItem, contact: Contact, step: FlowStep) -> list:
+    """Runs the query of a 'query_model' action and returns its rows as JSON-serializable dicts."""
+    queryset = Model.objects.filter(**final_filters)
+    if exclude_filters:
+        queryset = queryset.exclude(**exclude_filters)
+
+    order_by_fields = action_item_conf.order_by
+    if order_by_fields and isinstance(order_by_fields, list):
+        queryset = queryset.order_by(*order_by_fields)
+
+    if action_item_conf.limit is not None and isinstance(action_item_conf.limit, int):
+        queryset = queryset[:action_item_conf.limit]
+
+    # --- OPTIMIZATION: Use .values() for performance ---
+    fields_to_return = getattr(action_item_conf, 'fields_to_return', None)
+    if fields_to_return and isinstance(fields_to_return, list):
+        # OPTIMIZED PATH: Use .values() for much faster serialization. This is the recommended approach.
+        results_list = list(queryset.values(*fields_to_return))
+        # .values() handles Decimal and basic types. Dates need manual conversion for JSON.
+        for item in results_list:
+            for key, value in item.items():
+                if isinstance(value, (date, datetime)):
+                    item[key] = value.isoformat()
+                elif isinstance(value, Decimal):
+                    item[key] = str(value) # Convert Decimal to string for JSON
+                elif isinstance(value, uuid.UUID):
+                    item[key] = str(value)
+    else:
+        # BACKWARD COMPATIBILITY PATH: Use model_to_dict (slower)
+        logger.warning(f"Contact {contact.id}: 'query_model' in step {step.id} is not using 'fields_to_return'. "
+                       f"Using slower model_to_dict. Consider specifying fields for performance.")
+        results_list = []
+        for obj in queryset:
+            dict_obj = model_to_dict(obj)
+            # Post-process to ensure all values are JSON serializable
+            for key, value in dict_obj.items():
+                if isinstance(value, (date, datetime)): dict_obj[key] = value.isoformat()
+                elif isinstance(value, Decimal): dict_obj[key] = str(value)
+                elif isinstance(value, (ImageFieldFile, FileField)):
+                    try: dict_obj[key] = value.url if value else None
+                    except ValueError: dict_obj[key] = None
+            results_list.append(dict_obj)
+    return results_list
+
+
+@profile_step_execution
 def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict, suppress_prompt: bool = False) -> tuple[List[Dict[str, Any]], Dict[str, Any]]:
     actions_to_perform = []
     raw_step_config = step.config or {} 
@@ -385,7 +558,12 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                 logger.error(f"Contact {contact.id}: 'send_message' step '{step.name}' (ID: {step.id}) has an empty config. Step cannot be executed.")
                 return actions_to_perform, current_step_context
 
-            send_message_config = StepConfigSendMessage.model_validate(message_config_data)
+            # Validated once per step and cached (see step_configs.py).
+            parsed_config = get_parsed_step_config(step)
+            if not parsed_config.is_valid:
+                logger.error(f"Contact {contact.id}: Pydantic validation error for 'send_message' step '{step.name}' (ID: {step.id}) config: {parsed_config.errors}. Raw config: {raw_step_config}", exc_info=False)
+                return actions_to_perform, current_step_context
+            send_message_config = parsed_config.config
             actual_message_type = send_message_config.message_type
             final_api_data_structure = {}
 
@@ -440,15 +618,13 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                     final_api_data_structure = media_data_to_send
             
             elif actual_message_type == "interactive" and send_message_config.interactive:
-                interactive_payload_validated = send_message_config.interactive # Already validated by StepConfigSendMessage
-                interactive_payload_dict = interactive_payload_validated.model_dump(exclude_none=True, by_alias=True)
+                interactive_payload_dict = parsed_config.payload # Validated and dumped once with the step config
                 
                 # Resolve templates directly within the dictionary structure
                 final_api_data_structure = _resolve_value(interactive_payload_dict, current_step_context, contact)
 
             elif actual_message_type == "template" and send_message_config.template:
-                template_payload_validated = send_message_config.template
-                template_payload_dict = template_payload_validated.model_dump(exclude_none=True, by_alias=True)
+                template_payload_dict = dict(parsed_config.payload) # Copy: the shared payload must not be mutated
                 if 'components' in template_payload_dict and template_payload_dict['components']:
                     template_payload_dict['components'] = _resolve_template_components(
                         template_payload_dict['components'], current_step_context, contact
@@ -456,14 +632,12 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                 final_api_data_structure = template_payload_dict
             
             elif actual_message_type == "contacts" and send_message_config.contacts:
-                contacts_list_of_objects = send_message_config.contacts
-                contacts_list_of_dicts = [c.model_dump(exclude_none=True, by_alias=True) for c in contacts_list_of_objects]
+                contacts_list_of_dicts = parsed_config.payload
                 resolved_contacts = _resolve_value(contacts_list_of_dicts, current_step_context, contact)
                 final_api_data_structure = {"contacts": resolved_contacts}
 
             elif actual_message_type == "location" and send_message_config.location:
-                location_obj = send_message_config.location
-                location_dict = location_obj.model_dump(exclude_none=True, by_alias=True)
+                location_dict = parsed_config.payload
                 final_api_data_structure = {"location": _resolve_value(location_dict, current_step_context, contact)}
 
             if final_api_data_structure:
@@ -476,26 +650,26 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
             elif actual_message_type: # If type was specified but no payload generated
                  logger.warning(f"Contact {contact.id}: No data payload generated for message_type '{actual_message_type}' in step '{step.name}' (ID: {step.id}). Pydantic Config: {send_message_config.model_dump_json(indent=2) if send_message_config else None}")
 
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation error for 'send_message' step '{step.name}' (ID: {step.id}) config: {e.errors()}. Raw config: {raw_step_config}", exc_info=False)
         except Exception as e:
             logger.error(f"Contact {contact.id}: Unexpected error processing 'send_message' step '{step.name}' (ID: {step.id}): {e}", exc_info=True)
 
     elif step.step_type == 'question':
-        try:
-            question_config = StepConfigQuestion.model_validate(raw_step_config)
+        parsed_config = get_parsed_step_config(step)
+        if not parsed_config.is_valid:
+            logger.error(f"Contact {contact.id}: Pydantic validation for 'question' step '{step.name}' (ID: {step.id}) failed: {parsed_config.errors}", exc_info=False)
+        else:
+            question_config = parsed_config.config
             if question_config.message_config and not suppress_prompt: # Only send prompt if not suppressed
-                try:
-                    temp_msg_pydantic_config = StepConfigSendMessage.model_validate(question_config.message_config)
+                if parsed_config.prompt.is_valid:
                     # The config for a send_message step is the message config itself (flat structure).
-                    dummy_config = temp_msg_pydantic_config.model_dump(exclude_none=True, by_alias=True)
                     dummy_send_step = FlowStep(
-                        name=f"{step.name}_prompt", step_type="send_message", config=dummy_config
+                        name=f"{step.name}_prompt", step_type="send_message", config=question_config.message_config
                     )
+                    seed_parsed_step_config(dummy_send_step, parsed_config.prompt)
                     send_actions, _ = _execute_step_actions(dummy_send_step, contact, current_step_context)
                     actions_to_perform.extend(send_actions)
-                except ValidationError as ve:
-                    logger.error(f"Contact {contact.id}: Pydantic validation error for 'message_config' within 'question' step '{step.name}' (ID: {step.id}): {ve.errors()}", exc_info=False)
+                else:
+                    logger.error(f"Contact {contact.id}: Pydantic validation error for 'message_config' within 'question' step '{step.name}' (ID: {step.id}): {parsed_config.prompt.errors}", exc_info=False)
             
             if question_config.reply_config: # This part is always active for a question step
                 current_step_context['_question_awaiting_reply_for'] = {
@@ -505,17 +679,21 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                     'original_question_step_id': step.id 
                 }
                 logger.debug(f"Step '{step.name}' is a question, awaiting reply for: {question_config.reply_config.save_to_variable}")
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation for 'question' step '{step.name}' (ID: {step.id}) failed: {e.errors()}", exc_info=False)
 
     elif step.step_type == 'action':
-        try:
-            action_step_config = StepConfigAction.model_validate(raw_step_config)
+        parsed_config = get_parsed_step_config(step)
+        if not parsed_config.is_valid:
+            logger.error(f"Contact {contact.id}: Pydantic validation for 'action' step '{step.name}' (ID: {step.id}) failed: {parsed_config.errors}", exc_info=False)
+        else:
+            action_step_config = parsed_config.config
+            timer = action_timer()  # Per-action timings for profiling.py
             for action_item_conf in action_step_config.actions_to_run:
                 action_type = action_item_conf.action_type
+                timer.start(action_type)
                 # Handle custom actions registered in flow_action_registry
                 custom_action_func = flow_action_registry.get(action_type)
                 if custom_action_func:
+                    flush_writes()  # Custom actions may read what earlier actions wrote.
                     resolved_params = _resolve_value(action_item_conf.params_template or {}, current_step_context, contact)
                     custom_actions = custom_action_func(contact, current_step_context, resolved_params)
                     actions_to_perform.extend(custom_actions)
@@ -550,6 +728,7 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                     
                     try:
                         Model = apps.get_model(app_label, model_name)
+                        flush_writes()  # The query must see what earlier actions wrote.
 
                         filters_template = action_item_conf.filters_template or {}
                         # --- FIX: Resolve the entire filters dictionary first ---
@@ -577,47 +756,22 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                             else:
                                 final_filters[key] = value
                         
-                        queryset = Model.objects.filter(**final_filters)
-                        if exclude_filters:
-                            queryset = queryset.exclude(**exclude_filters)
-                            
-                        order_by_fields = action_item_conf.order_by
-                        if order_by_fields and isinstance(order_by_fields, list):
-                            queryset = queryset.order_by(*order_by_fields)
-                            
-                        if action_item_conf.limit is not None and isinstance(action_item_conf.limit, int):
-                            queryset = queryset[:action_item_conf.limit]
-                            
-                        # --- OPTIMIZATION: Use .values() for performance ---
-                        fields_to_return = getattr(action_item_conf, 'fields_to_return', None)
-                        if fields_to_return and isinstance(fields_to_return, list):
-                            # OPTIMIZED PATH: Use .values() for much faster serialization. This is the recommended approach.
-                            results_list = list(queryset.values(*fields_to_return))
-                            # .values() handles Decimal and basic types. Dates need manual conversion for JSON.
-                            for item in results_list:
-                                for key, value in item.items():
-                                    if isinstance(value, (date, datetime)):
-                                        item[key] = value.isoformat()
-                                    elif isinstance(value, Decimal):
-                                        item[key] = str(value) # Convert Decimal to string for JSON
-                                    elif isinstance(value, uuid.UUID):
-                                        item[key] = str(value)
-                        else:
-                            # BACKWARD COMPATIBILITY PATH: Use model_to_dict (slower)
-                            logger.warning(f"Contact {contact.id}: 'query_model' in step {step.id} is not using 'fields_to_return'. "
-                                           f"Using slower model_to_dict. Consider specifying fields for performance.")
-                            results_list = []
-                            for obj in queryset:
-                                dict_obj = model_to_dict(obj)
-                                # Post-process to ensure all values are JSON serializable
-                                for key, value in dict_obj.items():
-                                    if isinstance(value, (date, datetime)): dict_obj[key] = value.isoformat()
-                                    elif isinstance(value, Decimal): dict_obj[key] = str(value)
-                                    elif isinstance(value, (ImageFieldFile, FileField)):
-                                        try: dict_obj[key] = value.url if value else None
-                                        except ValueError: dict_obj[key] = None
-                                results_list.append(dict_obj)
-                            
+                        cache_ttl = action_item_conf.cache_ttl_seconds
+                        cache_key = cache_version = None
+                        results_list = None
+                        if cache_ttl:
+                            cache_key = make_query_cache_key(
+                                Model, final_filters, exclude_filters, action_item_conf.order_by,
+                                action_item_conf.limit, action_item_conf.fields_to_return
+                            )
+                            # Read before querying, so a save committed meanwhile outdates the results.
+                            cache_version = query_cache_version(cache_key)
+                            results_list = get_cached_query_results(cache_key, cache_version)
+                        if results_list is None:
+                            results_list = _query_model_results(Model, final_filters, exclude_filters, action_item_conf, contact, step)
+                            if cache_key is not None:
+                                cache_query_results(cache_key, results_list, cache_ttl, cache_version)
+
                         current_step_context[variable_name] = results_list
                         logger.info(f"Contact {contact.id}: Action in step {step.id} queried {model_name} and stored {len(results_list)} items in '{variable_name}'.")
                     except LookupError:
@@ -656,8 +810,15 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                                 resolved_fields.pop('latitude', None)
                                 resolved_fields.pop('longitude', None)
 
-                        instance = Model.objects.create(**resolved_fields)
-                        logger.info(f"Contact {contact.id}: Created new {model_name} instance with ID {instance.pk}.")
+                        instance = Model(**resolved_fields)
+                        if save_to_variable:
+                            # The context needs the row's pk right away.
+                            instance.save(force_insert=True)
+                            logger.info(f"Contact {contact.id}: Created new {model_name} instance with ID {instance.pk}.")
+                        elif add_instance(instance, action=f"Contact {contact.id}: 'create_model_instance' action"):
+                            logger.info(f"Contact {contact.id}: Queued new {model_name} instance for the end of the message.")
+                        else:
+                            logger.info(f"Contact {contact.id}: Created new {model_name} instance with ID {instance.pk}.")
 
                         if save_to_variable:
                             instance_dict = model_to_dict(instance)
@@ -687,12 +848,14 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                         logger.error(f"Contact {contact.id}: 'create_model_instance' action failed with error: {e}", exc_info=True)
                 else:
                     logger.warning(f"Contact {contact.id}: Unknown or misconfigured action_type '{action_type}' in step '{step.name}' (ID: {step.id}).")
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation for 'action' step '{step.name}' (ID: {step.id}) failed: {e.errors()}", exc_info=False)
+            timer.stop()
 
     elif step.step_type == 'switch_flow':
-        try:
-            switch_config = StepConfigSwitchFlow.model_validate(raw_step_config)
+        parsed_config = get_parsed_step_config(step)
+        if not parsed_config.is_valid:
+            logger.error(f"Contact {contact.id}: Pydantic validation for 'switch_flow' step '{step.name}' (ID: {step.id}) failed: {parsed_config.errors}", exc_info=False)
+        else:
+            switch_config = parsed_config.config
             
             # Start with the initial context from the config and resolve any templates in it
             initial_context = _resolve_value(switch_config.initial_context_template or {}, current_step_context, contact)
@@ -715,32 +878,33 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
                 'initial_context': initial_context
             })
             logger.info(f"Contact {contact.id}: Step '{step.name}' queued switch to flow '{resolved_target_flow_name}'.")
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation for 'switch_flow' step '{step.name}' (ID: {step.id}) failed: {e.errors()}", exc_info=False)
 
     elif step.step_type == 'end_flow':
-        try:
-            end_flow_config = StepConfigEndFlow.model_validate(raw_step_config)
+        parsed_config = get_parsed_step_config(step)
+        if not parsed_config.is_valid:
+            logger.error(f"Contact {contact.id}: Pydantic validation for 'end_flow' step '{step.name}' (ID: {step.id}) config: {parsed_config.errors}", exc_info=False)
+        else:
+            end_flow_config = parsed_config.config
             if end_flow_config.message_config:
-                try:
-                    final_msg_pydantic_config = StepConfigSendMessage.model_validate(end_flow_config.message_config)
+                if parsed_config.prompt.is_valid:
                     # The config for a send_message step is the message config itself (flat structure).
-                    dummy_config = final_msg_pydantic_config.model_dump(exclude_none=True, by_alias=True)
                     dummy_end_msg_step = FlowStep(
-                        name=f"{step.name}_final_msg", step_type="send_message", config=dummy_config
+                        name=f"{step.name}_final_msg", step_type="send_message", config=end_flow_config.message_config
                     )
+                    seed_parsed_step_config(dummy_end_msg_step, parsed_config.prompt)
                     send_actions, _ = _execute_step_actions(dummy_end_msg_step, contact, current_step_context)
                     actions_to_perform.extend(send_actions)
-                except ValidationError as ve:
-                     logger.error(f"Contact {contact.id}: Pydantic validation for 'message_config' in 'end_flow' step '{step.name}' (ID: {step.id}): {ve.errors()}", exc_info=False)
+                else:
+                    logger.error(f"Contact {contact.id}: Pydantic validation for 'message_config' in 'end_flow' step '{step.name}' (ID: {step.id}): {parsed_config.prompt.errors}", exc_info=False)
             logger.info(f"Contact {contact.id}: Executing 'end_flow' step '{step.name}' (ID: {step.id}).")
             actions_to_perform.append({'type': '_internal_command_clear_flow_state'})
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation for 'end_flow' step '{step.name}' (ID: {step.id}) config: {e.errors()}", exc_info=False)
 
     elif step.step_type == 'human_handover':
-        try:
-            handover_config = StepConfigHumanHandover.model_validate(raw_step_config)
+        parsed_config = get_parsed_step_config(step)
+        if not parsed_config.is_valid:
+            logger.error(f"Contact {contact.id}: Pydantic validation for 'human_handover' step '{step.name}' (ID: {step.id}) failed: {parsed_config.errors}", exc_info=False)
+        else:
+            handover_config = parsed_config.config
             logger.info(f"Executing 'human_handover' step '{step.name}'.")
             if handover_config.pre_handover_message_text and not suppress_prompt: # Avoid sending pre-handover message on re-execution/fallback
                 resolved_msg = _resolve_value(handover_config.pre_handover_message_text, current_step_context, contact)
@@ -753,8 +917,6 @@ def _execute_step_actions(step: FlowStep, contact: Contact, flow_context: dict,
             notification_info = _resolve_value(handover_config.notification_details or f"Contact {contact.name or contact.whatsapp_id} requires help.", current_step_context, contact)
             logger.info(f"HUMAN INTERVENTION NOTIFICATION: {notification_info}. Context: {current_step_context}")
             actions_to_perform.append({'type': '_internal_command_clear_flow_state'})
-        except ValidationError as e:
-            logger.error(f"Contact {contact.id}: Pydantic validation for 'human_handover' step '{step.name}' (ID: {step.id}) failed: {e.errors()}", exc_info=False)
 
     elif step.step_type in ['condition', 'wait_for_reply', 'start_flow_node']: # 'wait_for_reply' is more a state than an executable step here
         logger.debug(f"'{step.step_type}' step '{step.name}' processed. No direct actions from this function, logic handled by transitions or flow control.")
@@ -799,11 +961,10 @@ def _handle_fallback(current_step: FlowStep, contact: Contact, flow_context: dic
     """
     actions_to_perform = []
     updated_context = flow_context.copy()
-    try:
-        fallback_config = FallbackConfig.model_validate(current_step.config.get('fallback_config', {}) if isinstance(current_step.config, dict) else {})
-    except ValidationError as e:
-        logger.warning(f"Invalid fallback_config for step {current_step.id}. Using defaults. Errors: {e.errors()}")
-        fallback_config = FallbackConfig()
+    parsed_config = get_parsed_step_config(current_step)
+    fallback_config = parsed_config.fallback
+    if parsed_config.fallback_errors:
+        logger.warning(f"Invalid fallback_config for step {current_step.id}. Using defaults. Errors: {parsed_config.fallback_errors}")
 
     # Scenario 1: The step was a question, and the user's reply was invalid.
     if current_step.step_type == 'question':
@@ -830,7 +991,7 @@ def _handle_fallback(current_step: FlowStep, contact: Contact, flow_context: dic
  
             # Save the updated context (with incremented fallback_count) and keep the user in the step
             contact_flow_state.flow_context_data = updated_context
-            contact_flow_state.save(update_fields=['flow_context_data', 'last_updated_at'])
+            save_flow_state(contact_flow_state, update_fields=['flow_context_data', 'last_updated_at'])
             return actions_to_perform
         else: # Retries exhausted or action is not 're_prompt'
             action_after_retries = fallback_config.action_after_retries
@@ -869,54 +1030,28 @@ def _trigger_new_flow(contact: Contact, message_data: dict, incoming_message_obj
         True if a flow was triggered, False otherwise.
     """
     message_text_body = message_data.get('text', {}).get('body', '').strip() # Keep original case for extraction
-    message_text_lower = message_text_body.lower()
 
     triggered_flow = None
+    entry_point_step = None
     initial_context = {} # To hold any data extracted from the trigger
-    
-    active_flows = Flow.objects.filter(is_active=True).order_by('name')
-
-    if message_text_body:  # Only attempt keyword trigger if there's text
-        for flow_candidate in active_flows:
-            if isinstance(flow_candidate.trigger_keywords, list):
-                for keyword in flow_candidate.trigger_keywords:
-                    if keyword.strip().lower() in message_text_lower and (not hasattr(contact, 'flow_state')):
-                        triggered_flow = flow_candidate
-                        
-                        # --- DYNAMIC DATA EXTRACTION FROM TRIGGER ---
-                        trigger_conf = triggered_flow.trigger_config or {}
-                        extraction_regex = trigger_conf.get("extraction_regex")
-                        context_var_name = trigger_conf.get("context_variable")
 
-                        if extraction_regex and context_var_name:
-                            try:
-                                match = re.search(extraction_regex, message_text_body)
-                                if match and match.groups():
-                                    extracted_data = match.group(1) # Use the first capturing group
-                                    initial_context[context_var_name] = extracted_data.strip()
-                                    logger.info(f"Extracted '{extracted_data.strip()}' into '{context_var_name}' from trigger for flow '{flow_candidate.name}'.")
-                            except re.error as e:
-                                logger.error(f"Invalid extraction_regex for flow '{flow_candidate.name}': {e}")
-
-                        logger.info(f"Keyword '{keyword}' triggered flow '{flow_candidate.name}' for contact {contact.whatsapp_id}.")
-                        break
-            if triggered_flow:
-                break
+    # Only attempt keyword trigger if there's text. All active flows' keywords are
+    # matched in one pass by the flow graph's trigger index (see trigger_index.py).
+    if message_text_body:
+        trigger_match = get_flow_graph().trigger_index.match(message_text_body)
+        if trigger_match and load_flow_state(contact) is None:
+            triggered_flow = trigger_match.compiled_flow.flow
+            entry_point_step = trigger_match.compiled_flow.entry_step
+            initial_context = trigger_match.initial_context
+            logger.info(f"Keyword '{trigger_match.keyword}' triggered flow '{triggered_flow.name}' for contact {contact.whatsapp_id}.")
 
     if triggered_flow:
-        entry_point_step = FlowStep.objects.filter(flow=triggered_flow, is_entry_point=True).first()
         if entry_point_step:
             logger.info(f"Setting up new flow '{triggered_flow.name}' for contact {contact.whatsapp_id} at entry step '{entry_point_step.name}'.")
 
             _clear_contact_flow_state(contact)
 
-            ContactFlowState.objects.create(
-                contact=contact,
-                current_flow=triggered_flow,
-                current_step=entry_point_step,
-                flow_context_data=initial_context, # Pass the extracted context
-                started_at=timezone.now()
-            )
+            create_flow_state(contact, triggered_flow, entry_point_step, initial_context) # Pass the extracted context
             return True
         else:
             logger.error(f"Flow '{triggered_flow.name}' is active but has no entry point step defined.")
@@ -926,182 +1061,19 @@ def _trigger_new_flow(contact: Contact, message_data: dict, incoming_message_obj
     return False
 
 
-def _evaluate_transition_condition(transition: FlowTransition, contact: Contact, message_data: dict, flow_context: dict, incoming_message_obj: Message) -> bool:
-    config = transition.condition_config
-    if not isinstance(config, dict):
-        logger.warning(f"Transition {transition.id} has invalid condition_config (not a dict): {config}")
-        return False
-    condition_type = config.get('type')
-    logger.debug(f"Contact {contact.id}, Flow {transition.current_step.flow.id}, Step {transition.current_step.id}: Evaluating condition type '{condition_type}' for transition {transition.id}. Context: {flow_context}, Message Type: {message_data.get('type')}")
-
-    if not condition_type: return False # No condition type means no specific condition to evaluate beyond default
-    if condition_type == 'always_true': return True
-
-    user_text = ""
-    if message_data.get('type') == 'text' and isinstance(message_data.get('text'), dict):
-        user_text = message_data.get('text', {}).get('body', '').strip()
-
-    interactive_reply_id = None
-    nfm_response_data = None 
-    if message_data.get('type') == 'interactive' and isinstance(message_data.get('interactive'), dict):
-        interactive_payload = message_data.get('interactive', {})
-        interactive_type_from_payload = interactive_payload.get('type')
-        if interactive_type_from_payload == 'button_reply' and isinstance(interactive_payload.get('button_reply'), dict):
-            interactive_reply_id = interactive_payload.get('button_reply', {}).get('id')
-        elif interactive_type_from_payload == 'list_reply' and isinstance(interactive_payload.get('list_reply'), dict):
-            interactive_reply_id = interactive_payload.get('list_reply', {}).get('id')
-        elif interactive_type_from_payload == 'nfm_reply' and isinstance(interactive_payload.get('nfm_reply'), dict):
-            nfm_payload = interactive_payload.get('nfm_reply', {})
-            response_json_str = nfm_payload.get('response_json')
-            if response_json_str:
-                try:
-                    nfm_response_data = json.loads(response_json_str)
-                except json.JSONDecodeError:
-                    logger.warning(f"Could not parse nfm_reply response_json for transition {transition.id}")
-    
-    # --- Condition Implementations ---
-    value_for_condition = config.get('value') # Get expected value for comparison
-
-    if condition_type == 'whatsapp_flow_response_received':
-        # By default, look for 'whatsapp_flow_response_received' in context, or allow config to specify variable name
-        variable_name = config.get('variable_name', 'whatsapp_flow_response_received')
-        actual_value = _get_value_from_context_or_contact(variable_name, flow_context, contact)
-        result = bool(actual_value)
-        logger.debug(
-            f"Contact {contact.id}, Flow {transition.current_step.flow.id}, Step {transition.current_step.id}: "
-            f"Condition 'whatsapp_flow_response_received' check for '{variable_name}'. "
-            f"Value: '{actual_value}' (type: {type(actual_value).__name__}). Result: {result}"
-        )
-        return result
-
-    if condition_type == 'user_reply_matches_keyword':
-        keyword = str(config.get('keyword', '')).strip()
-        if not keyword: return False # Cannot match empty keyword
-        case_sensitive = config.get('case_sensitive', False)
-        return (keyword == user_text) if case_sensitive else (keyword.lower() == user_text.lower())
-    
-    elif condition_type == 'user_reply_contains_keyword':
-        keyword = str(config.get('keyword', '')).strip()
-        if not keyword: return False
-        case_sensitive = config.get('case_sensitive', False)
-        return (keyword in user_text) if case_sensitive else (keyword.lower() in user_text.lower())
-    
-    elif condition_type == 'interactive_reply_id_equals':
-        return interactive_reply_id is not None and interactive_reply_id == str(value_for_condition)
-    
-    elif condition_type == 'message_type_is':
-        return message_data.get('type') == str(value_for_condition) # Compare with expected message_type
-    
-    elif condition_type == 'user_reply_matches_regex':
-        regex = config.get('regex')
-        if regex and user_text:
-            try: return bool(re.match(regex, user_text))
-            except re.error as e: logger.error(f"Invalid regex in transition {transition.id}: {regex}. Error: {e}"); return False
-        return False
-        
-    elif condition_type == 'variable_equals':
-        variable_name = config.get('variable_name')
-        if variable_name is None: return False
-        actual_value = _get_value_from_context_or_contact(variable_name, flow_context, contact)
-        
-        # --- NEW LOGIC ---
-        # If the expected value is an empty string, also treat None as a match.
-        # This makes the condition more intuitive for checking "is empty or not set".
-        if value_for_condition == "" and actual_value is None:
-            result = True
-        else:
-            # Original comparison logic
-            result = str(actual_value) == str(value_for_condition)
-        # --- END NEW LOGIC ---
-
-        logger.debug(
-            f"Contact {contact.id}, Flow {transition.current_step.flow.id}, Step {transition.current_step.id}: "
-            f"Condition 'variable_equals' check for '{variable_name}'. "
-            f"Actual: '{actual_value}' (type: {type(actual_value).__name__}), "
-            f"Expected: '{value_for_condition}' (type: {type(value_for_condition).__name__}). "
-            f"Result: {result}"
-        )
-        return result
-        
-    elif condition_type == 'variable_exists':
-        variable_name_template = config.get('variable_name')
-        if variable_name_template is None: return False
-        # Resolve the variable name itself as a template to handle dynamic paths like 'list.{{ index }}'
-        resolved_variable_path = _resolve_value(variable_name_template, flow_context, contact)
-        actual_value = _get_value_from_context_or_contact(resolved_variable_path, flow_context, contact)
-        result = actual_value is not None
-        logger.debug(
-            f"Contact {contact.id}, Flow {transition.current_step.flow.id}, Step {transition.current_step.id}: "
-            f"Condition 'variable_exists' check for '{resolved_variable_path}'. "
-            f"Value: '{str(actual_value)[:100]}' (type: {type(actual_value).__name__}). Result: {result}"
-        )
-        return result
-        
-    elif condition_type == 'variable_contains':
-        variable_name = config.get('variable_name')
-        if variable_name is None: return False
-        actual_value = _get_value_from_context_or_contact(variable_name, flow_context, contact)
-        expected_item = value_for_condition # This is the 'value' field from config
-        result = False
-        if isinstance(actual_value, str) and isinstance(expected_item, str): result = expected_item in actual_value
-        elif isinstance(actual_value, list) and expected_item is not None: result = expected_item in actual_value
-        
-        logger.debug(
-            f"Contact {contact.id}, Flow {transition.current_step.flow.id}, Step {transition.current_step.id}: "
-            f"Condition 'variable_contains' check for '{variable_name}'. "
-            f"Container: '{str(actual_value)[:100]}' (type: {type(actual_value).__name__}), "
-            f"Expected item: '{expected_item}'. Result: {result}"
-        )
-        return result
-
-    elif condition_type == 'nfm_response_field_equals' and nfm_response_data:
-        field_path = config.get('field_path')
-        if not field_path: return False
-        actual_val_from_nfm = nfm_response_data
-        for part in field_path.split('.'):
-            if isinstance(actual_val_from_nfm, dict): actual_val_from_nfm = actual_val_from_nfm.get(part)
-            else: actual_val_from_nfm = None; break
-        return actual_val_from_nfm == value_for_condition
-
-    elif condition_type == 'question_reply_is_valid':
-        # This condition is now implicitly handled by the logic within _handle_active_flow_step
-        # when it processes a reply for a question. If flow_context has the saved variable,
-        # it means the reply was valid according to the question's own reply_config.
-        # The transition would then typically check if that variable_exists or variable_equals.
-        # However, to directly use this condition type, we'd need to re-evaluate validity here.
-        # For now, assume a question step saves valid reply to context, then use 'variable_exists'
-        # or 'variable_equals' on the saved variable in the transition.
-        # If value_for_condition is True, check if the specific variable for the current question (if any) was set.
-        question_expectation = flow_context.get('_question_awaiting_reply_for')
-        if question_expectation and isinstance(question_expectation, dict):
-            var_name = question_expectation.get('variable_name')
-            # If value is True, we check if the variable was set (implying valid reply)
-            # If value is False, we check if the variable was *not* set (implying invalid reply)
-            is_var_set = var_name in flow_context
-            return is_var_set if value_for_condition is True else not is_var_set
-        return False # No question was being awaited or config mismatch
-
-    elif condition_type == 'user_requests_human':
-        human_request_keywords = config.get('keywords', ['help', 'support', 'agent', 'human', 'operator'])
-        if user_text and isinstance(human_request_keywords, list):
-            user_text_lower = user_text.lower()
-            for keyword in human_request_keywords:
-                if isinstance(keyword, str) and keyword.strip() and keyword.strip().lower() in user_text_lower:
-                    logger.info(f"User requested human agent with keyword: '{keyword}'")
-                    return True
-        return False
-
-    elif condition_type == 'contact_is_admin':
-        # This is a custom security check for admin flows.
-        # It checks if the contact is linked to an active staff user.
-        # The Contact model should have a OneToOneField to the User model named 'user'.
-        is_linked_staff_user = hasattr(contact, 'user') and contact.user is not None and contact.user.is_staff and contact.user.is_active
-        result = is_linked_staff_user
-        logger.info(f"Condition 'contact_is_admin' check for contact {contact.id}. Linked staff user: {is_linked_staff_user}. Result: {result}")
-        return result
-
-    logger.warning(f"Unknown or unhandled condition type: '{condition_type}' for transition {transition.id} or condition logic not met.")
-    return False
+def _evaluate_transition_condition(transition: FlowTransition, contact: Contact, message_data: dict, flow_context: dict, incoming_message_obj: Message, message_view: Optional[MessageView] = None) -> bool:
+    """
+    Evaluates the compiled condition of `transition` (see transition_conditions.py).
+    Pass the `message_view` of the incoming message when evaluating several
+    transitions for it, so the message is parsed only once.
+    """
+    if message_view is None:
+        message_view = MessageView(message_data)
+    predicate = get_condition_predicate(transition)
+    if logger.isEnabledFor(logging.DEBUG):
+        condition_type = transition.condition_config.get('type') if isinstance(transition.condition_config, dict) else None
+        logger.debug(f"Contact {contact.id}, Step {transition.current_step_id}: Evaluating condition type '{condition_type}' for transition {transition.id}. Message Type: {message_view.message_type}")
+    return predicate(message_view, contact, flow_context)
 
 
 def _transition_to_step(contact_flow_state: ContactFlowState, next_step: FlowStep, current_flow_context: dict, contact: Contact, message_data: dict) -> tuple[List[Dict[str, Any]], Dict[str, Any]]:
@@ -1120,7 +1092,7 @@ def _transition_to_step(contact_flow_state: ContactFlowState, next_step: FlowSte
     # Use transaction.atomic to ensure that the state update and subsequent actions
     # are treated as a single unit of work where possible.
     # The save() here commits the move to the new step.
-    contact_flow_state.save()
+    save_flow_state(contact_flow_state)
 
     actions_from_new_step, context_after_new_step_execution = _execute_step_actions(
         next_step, contact, current_flow_context.copy() # Pass a copy to avoid modification by reference if new step also modifies
@@ -1129,14 +1101,14 @@ def _transition_to_step(contact_flow_state: ContactFlowState, next_step: FlowSte
     # Re-fetch state to see if it was cleared or changed by _execute_step_actions (e.g., by end_flow, human_handover, switch_flow)
     # This is a critical check for robustness.
     with transaction.atomic():
-        current_db_state = ContactFlowState.objects.select_for_update().filter(contact=contact).first()
+        current_db_state = load_flow_state(contact, for_update=True)
 
-        if current_db_state and current_db_state.pk == contact_flow_state.pk:
+        if current_db_state and same_flow_state(current_db_state, contact_flow_state):
             # If the state still exists and belongs to this flow, then save the context
             # that resulted from executing this 'next_step'.
             if current_db_state.flow_context_data != context_after_new_step_execution:
                 current_db_state.flow_context_data = context_after_new_step_execution
-                current_db_state.save(update_fields=['flow_context_data', 'last_updated_at'])
+                save_flow_state(current_db_state, update_fields=['flow_context_data', 'last_updated_at'])
                 logger.debug(f"Saved updated context for contact {contact.whatsapp_id} after executing step '{next_step.name}'.")
         elif not current_db_state:
             logger.info(f"ContactFlowState for contact {contact.whatsapp_id} was cleared during execution of step '{next_step.name}'. No final context to save.")
@@ -1164,7 +1136,7 @@ def _update_contact_data(contact: Contact, field_path: str, value_to_set: Any):
         try:
             if hasattr(contact, field_name):
                 setattr(contact, field_name, value_to_set)
-                contact.save(update_fields=[field_name])
+                save_fields(contact, [field_name], action=f"Contact {contact.id}: 'update_contact_field' action for '{field_name}'")
                 logger.info(f"Updated Contact {contact.whatsapp_id} field '{field_name}' to '{value_to_set}'.")
             else:
                 logger.warning(f"Contact field '{field_name}' not found.")
@@ -1186,12 +1158,12 @@ def _update_contact_data(contact: Contact, field_path: str, value_to_set: Any):
         final_key = parts[-1]
         if len(parts) > 1 : # Ensure there's at least one key after 'custom_fields'
             current_level[final_key] = value_to_set
-            contact.save(update_fields=['custom_fields'])
+            save_fields(contact, ['custom_fields'], action=f"Contact {contact.id}: 'update_contact_field' action for '{field_path}'")
             logger.info(f"Updated Contact {contact.whatsapp_id} custom_fields path '{'.'.join(parts[1:])}' to '{value_to_set}'.")
         else: # Only 'custom_fields' was specified, meaning replace the whole dict
             if isinstance(value_to_set, dict):
                 contact.custom_fields = value_to_set
-                contact.save(update_fields=['custom_fields'])
+                save_fields(contact, ['custom_fields'], action=f"Contact {contact.id}: 'update_contact_field' action for '{field_path}'")
                 logger.info(f"Replaced Contact {contact.whatsapp_id} custom_fields with: {value_to_set}")
             else:
                 logger.warning(f"Cannot replace Contact.custom_fields with a non-dictionary value for path '{field_path}'.")
@@ -1200,14 +1172,18 @@ def _update_contact_data(contact: Contact, field_path: str, value_to_set: Any):
 
 
 def _update_customer_profile_data(contact: Contact, fields_to_update_config: Dict[str, Any], flow_context: dict):
-    profile, created = CustomerProfile.objects.get_or_create(contact=contact)
-    if created: 
-        logger.info(f"Created new CustomerProfile for contact {contact.whatsapp_id}")
-        profile.notes = "This is a placeholder profile created automatically. Details will be updated as the customer interacts with the system."
-        profile.save(update_fields=['notes'])
-        logger.info(f"Added placeholder note to new profile for contact {contact.whatsapp_id}")
-        # Manually attach the newly created profile to the in-memory contact object
-        # to make it available to subsequent steps in the same flow execution.
+    # Within a message, later steps update the profile fetched by the first one.
+    profile = memoized_instance(('customer_profile', contact.pk))
+    if profile is None:
+        profile, created = CustomerProfile.objects.get_or_create(contact=contact)
+        if created: 
+            logger.info(f"Created new CustomerProfile for contact {contact.whatsapp_id}")
+            profile.notes = "This is a placeholder profile created automatically. Details will be updated as the customer interacts with the system."
+            save_fields(profile, ['notes'], action=f"Contact {contact.id}: 'update_customer_profile' action")
+            logger.info(f"Added placeholder note to new profile for contact {contact.whatsapp_id}")
+        remember_instance(('customer_profile', contact.pk), profile)
+        # Attach the profile to the in-memory contact object so subsequent steps
+        # in the same flow execution read the updated values.
         contact.customer_profile = profile
 
     if not fields_to_update_config or not isinstance(fields_to_update_config, dict):
@@ -1277,11 +1253,13 @@ def _update_customer_profile_data(contact: Contact, fields_to_update_config: Dic
             logger.warning(f"Unsupported field path for CustomerProfile: {field_path}")
 
     if changed_fields:
-        profile.save(update_fields=changed_fields)
+        save_fields(profile, changed_fields, action=f"Contact {contact.id}: 'update_customer_profile' action")
         logger.info(f"CustomerProfile for {contact.whatsapp_id} updated fields: {changed_fields}")
 
 
 @transaction.atomic
+@profile_flow_message
+@buffer_flow_writes
 def process_message_for_flow(contact: Contact, message_data: dict, incoming_message_obj: Message) -> List[Dict[str, Any]]:
     """
     Main entry point to process an incoming message for a contact against flows.
@@ -1422,12 +1400,12 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
             menu_message_data = {'type': 'text', 'text': {'body': 'menu'}}
             flow_was_triggered = _trigger_new_flow(contact, menu_message_data, incoming_message_obj)
             if flow_was_triggered:
-                contact_flow_state = ContactFlowState.objects.select_related('current_flow', 'current_step').get(contact=contact)
+                contact_flow_state = _get_contact_flow_state(contact)
                 entry_step = contact_flow_state.current_step
                 entry_actions, updated_context = _execute_step_actions(entry_step, contact, contact_flow_state.flow_context_data.copy())
                 actions_to_perform.extend(entry_actions)
                 contact_flow_state.flow_context_data = updated_context
-                contact_flow_state.save()
+                save_flow_state(contact_flow_state)
 
             return actions_to_perform
         else:
@@ -1464,8 +1442,11 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
         _clear_contact_flow_state(contact)
         
         try:
-            simple_add_order_flow = Flow.objects.get(name='simple_add_order', is_active=True)
-            entry_point_step = simple_add_order_flow.steps.filter(is_entry_point=True).first()
+            compiled_flow = get_flow_graph().get_active_flow('simple_add_order')
+            if compiled_flow is None:
+                raise Flow.DoesNotExist("Flow 'simple_add_order' not found or inactive.")
+            simple_add_order_flow = compiled_flow.flow
+            entry_point_step = compiled_flow.entry_step
             if not entry_point_step:
                 raise Flow.DoesNotExist("Flow has no entry point.")
 
@@ -1475,9 +1456,9 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                 return []
 
             # Create a temporary flow state for this one-time execution. The main loop will process it.
-            contact_flow_state = ContactFlowState.objects.create(
-                contact=contact, current_flow=simple_add_order_flow, current_step=entry_point_step,
-                flow_context_data={'order_number_from_message': order_number_from_message}
+            contact_flow_state = create_flow_state(
+                contact, simple_add_order_flow, entry_point_step,
+                {'order_number_from_message': order_number_from_message}
             )
 
             # FIX: Manually execute the entry step actions, just like a normal flow trigger,
@@ -1485,7 +1466,7 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
             entry_actions, updated_context = _execute_step_actions(entry_point_step, contact, contact_flow_state.flow_context_data.copy())
             actions_to_perform.extend(entry_actions)
             contact_flow_state.flow_context_data = updated_context
-            contact_flow_state.save(update_fields=['flow_context_data'])
+            save_flow_state(contact_flow_state, update_fields=['flow_context_data'])
         except Flow.DoesNotExist:
             logger.error("The 'simple_add_order' flow is required for the Order Receiver Number but is not found or is inactive.")
             return []
@@ -1506,14 +1487,11 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
 
     # actions_to_perform = [] # This is now initialized at the top of the function.
     
-    # --- OPTIMIZATION: Use prefetch_related to get all necessary data in fewer queries. ---
-    # We fetch the current step's outgoing transitions and their respective next steps.
-    # This avoids hitting the database for transitions inside the main processing loop.
-    prefetch_query = models.Prefetch(
-        'current_step__outgoing_transitions',
-        queryset=FlowTransition.objects.select_related('next_step').order_by('priority')
-    )
-    contact_flow_state = ContactFlowState.objects.select_related('current_flow', 'current_step').prefetch_related(prefetch_query).filter(contact=contact).first()
+    # --- OPTIMIZATION: Steps and transitions come from the compiled flow graph (flow_graph.py). ---
+    # Only the contact's flow state is read (its ContactFlowState row, or its Redis hash
+    # with the Redis flow state backend); the current step, its outgoing transitions
+    # and their next steps are walked in memory.
+    contact_flow_state = _get_contact_flow_state(contact)
 
     try:
         # If no active flow, try to trigger one. This is the only time a user message can start a flow.
@@ -1523,7 +1501,7 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
             
             if flow_was_triggered:
                 # A new flow was started. Execute its entry step's actions now.
-                contact_flow_state = ContactFlowState.objects.select_related('current_flow', 'current_step').prefetch_related(prefetch_query).filter(contact=contact).first()
+                contact_flow_state = _get_contact_flow_state(contact)
                 if not contact_flow_state:
                     logger.warning(f"Flow was triggered for contact {contact.id} but no state was found immediately after (likely ended on first step). Exiting.")
                     return []
@@ -1535,7 +1513,7 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                 actions_to_perform.extend(entry_actions)
                 
                 contact_flow_state.flow_context_data = updated_context
-                contact_flow_state.save(update_fields=['flow_context_data', 'last_updated_at'])
+                save_flow_state(contact_flow_state, update_fields=['flow_context_data', 'last_updated_at'])
                 
                 # If the entry step was a question or ends the flow, we are done with this message.
                 if entry_step.step_type in ['question', 'end_flow', 'human_handover']:
@@ -1572,7 +1550,7 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
             # Re-fetch state in each loop iteration for robustness and to detect changes
             # made by internal commands like end_flow or switch_flow
             is_internal_message = message_data.get('type', '').startswith('internal_') # type: ignore
-            contact_flow_state = ContactFlowState.objects.select_related('current_flow', 'current_step').filter(contact=contact).first()
+            contact_flow_state = _get_contact_flow_state(contact)
 
             if not contact_flow_state:
                 logger.info(f"Flow state was cleared, exiting processing loop for contact {contact.id}.")
@@ -1760,13 +1738,14 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
             # We evaluate all outgoing transitions in priority order until one matches.
             # If no transition matches, we engage fallback logic (see _handle_fallback).
             # 
-            # IMPORTANT: The transitions are prefetched to avoid N+1 queries.
+            # IMPORTANT: The transitions come from the compiled flow graph, already sorted by priority.
             # The condition evaluation is done by _evaluate_transition_condition which
-            # checks various condition types like 'whatsapp_flow_response_received',
-            # 'user_reply_matches_keyword', 'variable_equals', etc.
-            transitions = current_step.outgoing_transitions.all()
+            # runs each transition's compiled predicate (see transition_conditions.py) for
+            # condition types like 'whatsapp_flow_response_received', 'user_reply_matches_keyword',
+            # 'variable_equals', etc.
+            transitions = _get_outgoing_transitions(current_step)
             
-            if not transitions.exists():
+            if not transitions:
                 logger.warning(
                     f"Step '{current_step.name}' (ID: {current_step.id}, Type: {current_step.step_type}) "
                     f"has no outgoing transitions defined. This may indicate a flow design issue. "
@@ -1774,10 +1753,13 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                 )
 
             next_step_to_transition_to = None
+            message_view = MessageView(message_data)  # Parsed once, shared by every transition
+            transitions_evaluated = 0
             for transition in transitions:
+                transitions_evaluated += 1
                 try:
                     condition_met = _evaluate_transition_condition(
-                        transition, contact, message_data, flow_context, incoming_message_obj
+                        transition, contact, message_data, flow_context, incoming_message_obj, message_view
                     )
                     if condition_met:
                         next_step_to_transition_to = transition.next_step
@@ -1794,6 +1776,7 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                     )
                     # Continue to next transition instead of failing completely
                     continue
+            record_transitions_evaluated(current_step, transitions_evaluated)
             
             if next_step_to_transition_to:
                 actions, flow_context = _transition_to_step(contact_flow_state, next_step_to_transition_to, flow_context, contact, message_data)
@@ -1807,20 +1790,19 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                         new_flow_name = switch_action.get('target_flow_name')
                         initial_context_for_new_flow = switch_action.get('initial_context', {})
 
-                        target_flow = Flow.objects.get(name=new_flow_name, is_active=True)
-                        entry_point_step = FlowStep.objects.filter(flow=target_flow, is_entry_point=True).first()
+                        compiled_target_flow = get_flow_graph().get_active_flow(new_flow_name)
+                        if compiled_target_flow is None:
+                            raise Flow.DoesNotExist(f"Flow '{new_flow_name}' not found or inactive.")
+                        target_flow = compiled_target_flow.flow
+                        entry_point_step = compiled_target_flow.entry_step
 
                         if not entry_point_step:
                             raise ValueError(f"Flow '{new_flow_name}' is active but has no entry point step defined.")
                         
                         logger.info(f"Contact {contact.id}: Switching to flow '{target_flow.name}' at entry step '{entry_point_step.name}'.")
                         
-                        new_contact_flow_state = ContactFlowState.objects.create(
-                            contact=contact,
-                            current_flow=target_flow,
-                            current_step=entry_point_step,
-                            flow_context_data=initial_context_for_new_flow,
-                            started_at=timezone.now()
+                        new_contact_flow_state = create_flow_state(
+                            contact, target_flow, entry_point_step, initial_context_for_new_flow
                         )
 
                         # Manually execute the actions for the new entry point step.
@@ -1833,7 +1815,7 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
                         
                         # Save the context after this first execution
                         new_contact_flow_state.flow_context_data = updated_context
-                        new_contact_flow_state.save(update_fields=['flow_context_data', 'last_updated_at'])
+                        save_flow_state(new_contact_flow_state, update_fields=['flow_context_data', 'last_updated_at'])
                         logger.debug(f"Contact {contact.id}: Executed entry step '{entry_point_step.name}' and saved context.")
                         
                         # Check if the new entry point immediately ended the flow.
@@ -1885,7 +1867,7 @@ def process_message_for_flow(contact: Contact, message_data: dict, incoming_mess
             
             # --- Step 3: Loop Control ---
             # If the new step is a question, or if the flow state was cleared (e.g., end_flow), break the loop.
-            new_state = ContactFlowState.objects.filter(contact=contact).first()
+            new_state = _get_contact_flow_state(contact)
             if not new_state or new_state.current_step.step_type in ['question', 'end_flow', 'human_handover']:
                 break
             
@@ -0,0 +1,26 @@
+# whatsappcrm_backend/flows/signals.py
+
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Flow, FlowStep, FlowTransition
+from .flow_graph import invalidate_flow_graph
+from .query_cache import invalidate_model_queries
+
+
+@receiver(post_save, sender=Flow)
+@receiver(post_delete, sender=Flow)
+@receiver(post_save, sender=FlowStep)
+@receiver(post_delete, sender=FlowStep)
+@receiver(post_save, sender=FlowTransition)
+@receiver(post_delete, sender=FlowTransition)
+def invalidate_flow_graph_cache(sender, instance, **kwargs):
+    """Keeps the process-local compiled flow graph in step with the database."""
+    invalidate_flow_graph()
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_query_model_cache(sender, instance, **kwargs):
+    """Outdates query_model results cached for the saved or deleted model (flows/query_cache.py)."""
+    invalidate_model_queries(sender)
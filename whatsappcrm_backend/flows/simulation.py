@@ -0,0 +1,242 @@
+# whatsappcrm_backend/flows/simulation.py
+
+"""
+Offline flow engine simulation, used by the simulate_flows management command
+and by tests.
+
+A Scenario installs flow definitions from flows/definitions into the database
+and replays a scripted sequence of incoming messages (text, button_reply,
+list_reply, nfm_reply) for a number of synthetic contacts. Every message is
+stored as an incoming Message and driven through process_message_for_flow
+inside a savepoint, as process_flow_for_message_task does; the contacts'
+messages are interleaved like concurrent traffic.
+
+Celery tasks queued by the engine (sends, notifications, AI hand-offs) are
+recorded instead of being queued, so neither the Graph API nor any AI
+provider is called. Callers run scenarios inside a transaction they roll
+back.
+"""
+import json
+import math
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Callable, List
+from unittest.mock import patch
+
+from celery.app.task import Task
+from django.db import connection, transaction
+
+from conversations.models import Contact, Message
+from .definitions.main_menu_flow import MAIN_MENU_FLOW
+from .definitions.solar_cleaning_flow import SOLAR_CLEANING_FLOW
+from .definitions.solar_installation_flow import SOLAR_INSTALLATION_FLOW
+from .models import Flow, FlowStep, FlowTransition
+from .services import process_message_for_flow
+
+
+# --- Scripted incoming messages, in the shape of Meta's webhook payloads ---
+
+def text_message(body: str) -> dict:
+    return {'type': 'text', 'text': {'body': body}}
+
+
+def button_reply(reply_id: str, title: str = '') -> dict:
+    return {'type': 'interactive', 'interactive': {
+        'type': 'button_reply', 'button_reply': {'id': reply_id, 'title': title or reply_id},
+    }}
+
+
+def list_reply(reply_id: str, title: str = '') -> dict:
+    return {'type': 'interactive', 'interactive': {
+        'type': 'list_reply', 'list_reply': {'id': reply_id, 'title': title or reply_id},
+    }}
+
+
+def nfm_reply(response: dict) -> dict:
+    return {'type': 'interactive', 'interactive': {
+        'type': 'nfm_reply', 'nfm_reply': {'name': 'flow', 'body': 'Sent', 'response_json': json.dumps(response)},
+    }}
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    definitions: List[dict]
+    script: List[dict]
+
+
+SCENARIOS = {scenario.name: scenario for scenario in [
+    Scenario(
+        name='main_menu',
+        description='Main menu list navigation: open the menu, enter the installation submenu and go back, twice.',
+        definitions=[MAIN_MENU_FLOW],
+        script=[
+            text_message('hi'),
+            list_reply('request_installation'),
+            list_reply('go_back_to_main_menu'),
+            list_reply('request_installation'),
+            list_reply('go_back_to_main_menu'),
+        ],
+    ),
+    Scenario(
+        name='solar_installation',
+        description='Main menu into the solar installation flow (switch_flow), through the legacy questions.',
+        definitions=[MAIN_MENU_FLOW, SOLAR_INSTALLATION_FLOW],
+        script=[
+            text_message('hello'),
+            list_reply('request_installation'),
+            list_reply('switch_to_solar_install'),
+            button_reply('paid'),
+            nfm_reply({'order_number': 'SIM-0001', 'flow_token': 'simulation'}),
+            button_reply('install_commercial'),
+            text_message('AS-0001'),
+        ],
+    ),
+    Scenario(
+        name='solar_cleaning',
+        description='Keyword-triggered solar cleaning request.',
+        definitions=[SOLAR_CLEANING_FLOW],
+        script=[
+            text_message('solar cleaning'),
+            text_message('clean panels'),
+        ],
+    ),
+]}
+
+
+def install_flow_definitions(flow_definitions: List[dict]) -> List[Flow]:
+    """Creates (or recreates) flows, steps and transitions from definition dicts."""
+    flows = []
+    for flow_def in flow_definitions:
+        Flow.objects.filter(name=flow_def['name']).delete()
+        flow = Flow.objects.create(
+            name=flow_def['name'],
+            friendly_name=flow_def.get('friendly_name', ''),
+            description=flow_def.get('description', ''),
+            trigger_keywords=flow_def.get('trigger_keywords', []),
+            trigger_config=flow_def.get('trigger_config', {}),
+            is_active=flow_def.get('is_active', False),
+        )
+        steps = {
+            step_def['name']: FlowStep.objects.create(
+                flow=flow, name=step_def['name'], step_type=step_def['type'],
+                config=step_def.get('config', {}), is_entry_point=step_def.get('is_entry_point', False),
+            )
+            for step_def in flow_def['steps']
+        }
+        FlowTransition.objects.bulk_create([
+            FlowTransition(
+                current_step=steps[step_def['name']], next_step=steps[trans_def['to_step']],
+                condition_config=trans_def.get('condition_config', {}), priority=trans_def.get('priority', 0),
+            )
+            for step_def in flow_def['steps']
+            for trans_def in step_def.get('transitions', [])
+            if trans_def.get('to_step') in steps
+        ])
+        flows.append(flow)
+    return flows
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+@dataclass
+class SimulationResult:
+    scenario: str
+    contacts: int
+    seconds: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+    queries: List[int] = field(default_factory=list)
+    errors: int = 0
+    actions: int = 0
+    tasks_queued: int = 0
+
+    @property
+    def messages(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def messages_per_second(self) -> float:
+        return self.messages / self.seconds if self.seconds else 0.0
+
+    @property
+    def p50_ms(self) -> float:
+        return _percentile(sorted(self.latencies), 0.50) * 1000
+
+    @property
+    def p99_ms(self) -> float:
+        return _percentile(sorted(self.latencies), 0.99) * 1000
+
+    @property
+    def queries_per_message(self) -> float:
+        return sum(self.queries) / self.messages if self.messages else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'scenario': self.scenario,
+            'contacts': self.contacts,
+            'messages': self.messages,
+            'errors': self.errors,
+            'messages_per_second': round(self.messages_per_second, 1),
+            'p50_ms': round(self.p50_ms, 2),
+            'p99_ms': round(self.p99_ms, 2),
+            'queries_per_message': round(self.queries_per_message, 2),
+            'actions': self.actions,
+            'tasks_queued': self.tasks_queued,
+        }
+
+
+def run_scenario(scenario: Scenario, contacts: int = 10, on_error: Callable = None) -> SimulationResult:
+    """
+    Replays `scenario` for `contacts` new synthetic contacts and measures each
+    process_message_for_flow call. `on_error(contact, message_data, exc)` is
+    called for messages whose processing raised.
+    """
+    install_flow_definitions(scenario.definitions)
+    run_id = uuid.uuid4().hex[:8]
+    synthetic_contacts = Contact.objects.bulk_create([
+        Contact(whatsapp_id=f'sim{run_id}{i:05d}', name=f'Simulated {i}') for i in range(contacts)
+    ])
+    result = SimulationResult(scenario=scenario.name, contacts=contacts)
+
+    def record_task(task, *args, **kwargs):
+        result.tasks_queued += 1
+
+    query_count = [0]
+
+    def count_query(execute, sql, params, many, context):
+        query_count[0] += 1
+        return execute(sql, params, many, context)
+
+    with patch.object(Task, 'apply_async', record_task):
+        for message_data in scenario.script:
+            incoming = Message.objects.bulk_create([
+                Message(
+                    contact=contact, direction='in', message_type=message_data['type'],
+                    content_payload=message_data, wamid=f'wamid.SIM{uuid.uuid4().hex}',
+                    text_content=message_data.get('text', {}).get('body'), status='delivered',
+                )
+                for contact in synthetic_contacts
+            ])
+            for contact, incoming_message in zip(synthetic_contacts, incoming):
+                query_count[0] = 0
+                started = time.perf_counter()
+                try:
+                    with connection.execute_wrapper(count_query), transaction.atomic():
+                        actions = process_message_for_flow(contact, message_data, incoming_message)
+                    result.actions += len(actions or [])
+                except Exception as e:
+                    result.errors += 1
+                    if on_error:
+                        on_error(contact, message_data, e)
+                elapsed = time.perf_counter() - started
+                result.seconds += elapsed
+                result.latencies.append(elapsed)
+                result.queries.append(query_count[0])
+    return result
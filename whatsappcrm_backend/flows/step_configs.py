@@ -0,0 +1,129 @@
+# whatsappcrm_backend/flows/step_configs.py
+
+"""
+Validate-once cache of FlowStep configs.
+
+`_execute_step_actions` needs the pydantic form of a step's config (see
+schemas.py) every time the step runs. The config is validated once per step
+instance instead: steps of the compiled flow graph are parsed when the graph
+is built, so after a FlowStep is saved or flows are loaded its config is
+validated again exactly once per process.
+
+A ParsedStepConfig also carries what the engine used to re-derive per
+execution: the prompt of a question / end_flow step as a parsed send_message
+config, the fallback config, and the message payload of a send_message step
+already dumped to the dict shape that gets resolved and sent.
+
+Parsed configs and their payloads are shared by every execution of the step
+and must not be mutated; `_resolve_value` always returns new containers.
+"""
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from pydantic import BaseModel, ValidationError
+
+from .schemas import (
+    StepConfigSendMessage, StepConfigQuestion, StepConfigAction,
+    StepConfigHumanHandover, StepConfigEndFlow, StepConfigSwitchFlow,
+    FallbackConfig,
+)
+
+STEP_CONFIG_SCHEMAS = {
+    'send_message': StepConfigSendMessage,
+    'question': StepConfigQuestion,
+    'action': StepConfigAction,
+    'switch_flow': StepConfigSwitchFlow,
+    'end_flow': StepConfigEndFlow,
+    'human_handover': StepConfigHumanHandover,
+}
+
+# send_message types whose payload is resolved as a whole dumped structure.
+DUMPED_PAYLOAD_TYPES = ('interactive', 'template', 'contacts', 'location')
+
+
+@dataclass(frozen=True)
+class ParsedStepConfig:
+    config: Optional[BaseModel] = None
+    # `ValidationError.errors()` of a config that failed validation.
+    errors: Optional[list] = None
+    # Parsed send_message config of a question / end_flow step's message_config.
+    prompt: Optional['ParsedStepConfig'] = None
+    fallback: Optional[FallbackConfig] = None
+    fallback_errors: Optional[list] = None
+    # For send_message steps of DUMPED_PAYLOAD_TYPES, the payload as a dict (or list for contacts).
+    payload: Any = None
+
+    @property
+    def is_valid(self) -> bool:
+        return self.errors is None
+
+
+def _dump_payload(config: StepConfigSendMessage):
+    message_type = config.message_type
+    if message_type not in DUMPED_PAYLOAD_TYPES:
+        return None
+    value = getattr(config, message_type)
+    if value is None:
+        return None
+    if message_type == 'contacts':
+        return [c.model_dump(exclude_none=True, by_alias=True) for c in value]
+    return value.model_dump(exclude_none=True, by_alias=True)
+
+
+def parse_send_message_config(raw_config) -> ParsedStepConfig:
+    try:
+        config = StepConfigSendMessage.model_validate(raw_config)
+    except ValidationError as e:
+        return ParsedStepConfig(errors=e.errors())
+    return ParsedStepConfig(config=config, payload=_dump_payload(config))
+
+
+def parse_step_config(step_type: str, raw_config) -> ParsedStepConfig:
+    """Validates a step config against the schema of its step type."""
+    raw_config = raw_config or {}
+    fallback, fallback_errors = None, None
+    if isinstance(raw_config, dict):
+        try:
+            fallback = FallbackConfig.model_validate(raw_config.get('fallback_config', {}))
+        except ValidationError as e:
+            fallback_errors = e.errors()
+    if fallback is None:
+        fallback = FallbackConfig()
+
+    if step_type == 'send_message':
+        parsed = parse_send_message_config(raw_config)
+        return ParsedStepConfig(
+            config=parsed.config, errors=parsed.errors, payload=parsed.payload,
+            fallback=fallback, fallback_errors=fallback_errors,
+        )
+
+    schema = STEP_CONFIG_SCHEMAS.get(step_type)
+    if schema is None:
+        return ParsedStepConfig(fallback=fallback, fallback_errors=fallback_errors)
+    try:
+        config = schema.model_validate(raw_config)
+    except ValidationError as e:
+        return ParsedStepConfig(errors=e.errors(), fallback=fallback, fallback_errors=fallback_errors)
+
+    prompt = None
+    if step_type in ('question', 'end_flow') and config.message_config:
+        prompt = parse_send_message_config(config.message_config)
+    return ParsedStepConfig(config=config, prompt=prompt, fallback=fallback, fallback_errors=fallback_errors)
+
+
+def get_parsed_step_config(step) -> ParsedStepConfig:
+    """
+    Returns the parsed config of `step`, validating it on first use. The result
+    is cached on the instance and re-parsed if `step.config` is replaced.
+    """
+    cached = step.__dict__.get('_parsed_config')
+    if cached is not None and cached[0] is step.config and cached[1] == step.step_type:
+        return cached[2]
+    parsed = parse_step_config(step.step_type, step.config)
+    step._parsed_config = (step.config, step.step_type, parsed)
+    return parsed
+
+
+def seed_parsed_step_config(step, parsed: ParsedStepConfig):
+    """Caches an already parsed config on `step`, e.g. a question's prompt on its temporary send_message step."""
+    step._parsed_config = (step.config, step.step_type, parsed)
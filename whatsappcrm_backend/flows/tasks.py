@@ -9,11 +9,12 @@ from django.db import transaction
 from django.conf import settings
 
 # --- Gemini AI Integration Imports ---
-from google import genai
 from google.genai import types
 from google.api_core import exceptions as core_exceptions
 from google.genai import errors as genai_errors
 from ai_integration.models import AIProvider
+from ai_integration.clients import get_gemini_client
+from ai_integration.scheduler import INTERACTIVE, gemini_request
 # -------------------------------------
 
 from conversations.models import Message, Contact
@@ -21,13 +22,17 @@ from conversations.utils import normalize_phone_number
 from .models import ContactFlowState
 from meta_integration.models import MetaAppConfig
 from meta_integration.tasks import send_whatsapp_message_task, download_whatsapp_media_task
+from meta_integration.outbound_sequencer import enqueue_outbound_message
 from .services import process_message_for_flow, _clear_contact_flow_state
+from .flow_state_store import state_last_updated_at
+from .ai_sessions import get_ai_session
 from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
 # --- AI Shopping Configuration ---
-AI_SHOPPING_MAX_PRODUCTS = 50  # Maximum products to include in AI context (token limit consideration)
+AI_SHOPPING_MAX_PRODUCTS = 20  # Products ranked by relevance to include in AI context (token limit consideration)
+AI_SHOPPING_SEARCH_HISTORY_MESSAGES = 6  # Recent messages that help rank products besides the current one
 # ---------------------------------
 
 @shared_task(queue='flow_processing')
@@ -55,7 +60,6 @@ def process_flow_for_message_task(message_id: int):
                 logger.warning(f"Message {message_id} has no associated app_config. Falling back to active config.")
                 config_to_use = MetaAppConfig.objects.get_active_config()
 
-            dispatch_countdown = 0
             for action in actions_to_perform:
                 if action.get('type') == 'send_whatsapp_message':
                     recipient_wa_id = action.get('recipient_wa_id', contact.whatsapp_id)
@@ -74,13 +78,14 @@ def process_flow_for_message_task(message_id: int):
                         message_type=action.get('message_type'), content_payload=action.get('data'),
                         status='pending_dispatch', related_incoming_message=incoming_message
                     )
-                    # Queue the task for dispatch after transaction commits
-                    tasks_to_dispatch.append((outgoing_msg.id, config_to_use.id, dispatch_countdown))
-                    dispatch_countdown += 2
+                    # Queue the message for dispatch after transaction commits
+                    tasks_to_dispatch.append((outgoing_msg.id, config_to_use.id, recipient_contact.id))
         
-        # Dispatch Celery tasks after transaction is committed successfully
-        for msg_id, config_id, countdown in tasks_to_dispatch:
-            send_whatsapp_message_task.apply_async(args=[msg_id, config_id], countdown=countdown)
+        # Hand the messages to the per-contact outbound sequencer once the transaction has
+        # committed; it releases each one after the previous is accepted, keeping replies in order.
+        for msg_id, config_id, recipient_contact_id in tasks_to_dispatch:
+            if not enqueue_outbound_message(msg_id, config_id, recipient_contact_id):
+                send_whatsapp_message_task.delay(msg_id, config_id)
 
     except Message.DoesNotExist:
         logger.error(f"process_flow_for_message_task: Message with ID {message_id} not found.")
@@ -107,7 +112,7 @@ def handle_ai_conversation_task(contact_id: int, message_id: int):
         active_provider = AIProvider.objects.get(provider='google_gemini', is_active=True)
         config_to_use = MetaAppConfig.objects.get_active_config()
 
-        client = genai.Client(api_key=active_provider.api_key)
+        client = get_gemini_client(active_provider.api_key)
 
         if contact.conversation_mode == 'ai_troubleshooting':
             # FIX: Use the correct variable name 'system_prompt'
@@ -171,28 +176,14 @@ Execute the following steps in sequence.
 * `[END_CONVERSATION]`: Use this token ONLY when the user wishes to terminate the session.
 """
 
-        # Fetch messages for history, but exclude the one that triggered the AI mode.
-        # The trigger message is often just a button click ("AI Troubleshooter") and not useful for the AI's context.
-        history_messages = Message.objects.filter(
-            contact=contact, 
-            timestamp__lt=incoming_message.timestamp
-        ).order_by('-timestamp')[:20]
-        
-        gemini_history = []
-        # Inject the system prompt as the first message in the history for context
-        # The 'user' role here is a standard way to provide system instructions in the Gemini API.
-        gemini_history.append({
-            'role': 'user', 
-            'parts': [{'text': system_prompt}]
-        })
-        gemini_history.append({'role': 'model', 'parts': [{'text': "Understood. I will act as Hanna, the solar expert. How can I help you today?"}]})
-
-        for msg in reversed(history_messages):
-            role = 'user' if msg.direction == 'in' else 'model'
-            if msg.text_content:
-                if msg.direction == 'in' and msg.text_content.lower().strip() in ['exit', 'menu', 'stop', 'quit']:
-                    continue
-                gemini_history.append({'role': role, 'parts': [{'text': msg.text_content}]})
+        # History of the messages before this one, kept formatted in the contact's AI session;
+        # only the turns since the previous message are loaded from the database.
+        session = get_ai_session(contact, incoming_message, contact.conversation_mode)
+        # The system prompt goes in as the first 'user' turn, the standard way to give
+        # system instructions through the chat history in the Gemini API.
+        gemini_history = session.gemini_history(
+            system_prompt, "Understood. I will act as Hanna, the solar expert. How can I help you today?"
+        )
 
         chat = client.chats.create(
             model='gemini-2.5-flash', # Use the model identifier
@@ -236,7 +227,8 @@ Execute the following steps in sequence.
             return
 
         logger.info(f"{log_prefix} Sending prompt to Gemini chat model with {len(prompt_parts)} parts.")
-        response = chat.send_message(prompt_parts)
+        with gemini_request(active_provider, INTERACTIVE):
+            response = chat.send_message(prompt_parts)
         ai_response_text = response.text.strip()
         # --- END: Multimodal Input Handling ---
 
@@ -335,18 +327,25 @@ def handle_ai_shopping_task(contact_id: int, message_id: int):
         active_provider = AIProvider.objects.get(provider='google_gemini', is_active=True)
         config_to_use = MetaAppConfig.objects.get_active_config()
 
-        client = genai.Client(api_key=active_provider.api_key)
+        client = get_gemini_client(active_provider.api_key)
 
         if contact.conversation_mode == 'ai_shopping':
-            from products_and_services.models import Product, Cart, CartItem
+            from products_and_services.models import Cart, CartItem
             
-            # Get available products for context
-            products = Product.objects.filter(is_active=True).values('id', 'name', 'description', 'price', 'currency', 'category__name', 'product_type')
-            products_list = list(products)
+            from products_and_services.search_index import search_products
+
+            session = get_ai_session(contact, incoming_message, 'ai_shopping')
+
+            # Only the products relevant to this conversation go into the prompt.
+            products_list = search_products(
+                incoming_message.text_content or '',
+                session.recent_texts(AI_SHOPPING_SEARCH_HISTORY_MESSAGES),
+                limit=AI_SHOPPING_MAX_PRODUCTS,
+            )
             
             # Create structured product catalog for AI
-            product_catalog_text = "**Available Products:**\n"
-            for p in products_list[:AI_SHOPPING_MAX_PRODUCTS]:  # Limit products to avoid token limits
+            product_catalog_text = "**Available Products (most relevant to this conversation):**\n"
+            for p in products_list:
                 price_str = f"{p['price']} {p['currency']}" if p['price'] else "Contact for price"
                 product_catalog_text += f"\n- ID: {p['id']}, Name: {p['name']}, Price: {price_str}, Category: {p.get('category__name', 'N/A')}, Type: {p['product_type']}"
                 if p.get('description'):
@@ -359,7 +358,7 @@ def handle_ai_shopping_task(contact_id: int, message_id: int):
 
 1.  **Customer Focus**: Your primary goal is to understand the customer's needs and recommend the best products from our catalog.
 
-2.  **Product Knowledge**: You have access to our complete product catalog. Always recommend products that are in stock and match the customer's requirements.
+2.  **Product Knowledge**: The catalog below lists the products most relevant to this conversation. Always recommend products that are in stock and match the customer's requirements.
 
 3.  **Efficiency Protocol**:
     *   **Conciseness**: Responses must be clear and under 500 words.
@@ -465,22 +464,10 @@ Would you like to:
 2. 📄 **GET RECOMMENDATION** - Receive a detailed PDF analysis"
 """
 
-            # Fetch message history
-            history_messages = Message.objects.filter(
-                contact=contact, 
-                timestamp__lt=incoming_message.timestamp
-            ).order_by('-timestamp')[:20]
-            
-            gemini_history = []
-            gemini_history.append({'role': 'user', 'parts': [{'text': system_prompt}]})
-            gemini_history.append({'role': 'model', 'parts': [{'text': "Understood. I'm Hanna, your AI shopping assistant. How can I help you find the perfect solar solution today?"}]})
-
-            for msg in reversed(history_messages):
-                role = 'user' if msg.direction == 'in' else 'model'
-                if msg.text_content:
-                    if msg.direction == 'in' and msg.text_content.lower().strip() in ['exit', 'menu', 'stop', 'quit']:
-                        continue
-                    gemini_history.append({'role': role, 'parts': [{'text': msg.text_content}]})
+            gemini_history = session.gemini_history(
+                system_prompt,
+                "Understood. I'm Hanna, your AI shopping assistant. How can I help you find the perfect solar solution today?",
+            )
 
             chat = client.chats.create(
                 model='gemini-2.5-flash',
@@ -601,7 +588,8 @@ Would you like to:
                 return
 
             logger.info(f"{log_prefix} Sending prompt to Gemini.")
-            response = chat.send_message(prompt_parts)
+            with gemini_request(active_provider, INTERACTIVE):
+                response = chat.send_message(prompt_parts)
             ai_response_text = response.text.strip()
 
             # Parse AI response for control tokens
@@ -801,6 +789,11 @@ def cleanup_idle_conversations_task():
     # Process idle flow contacts
     for state in idle_flow_states:
         contact = state.contact
+        if settings.FLOW_STATE_BACKEND == 'redis':
+            # The row lags the live state in Redis by up to a persist window.
+            live_updated_at = state_last_updated_at(contact)
+            if live_updated_at is None or live_updated_at >= idle_threshold:
+                continue
         logger.info(f"{log_prefix} Clearing idle flow '{state.current_flow.name}' for contact {contact.id} ({contact.whatsapp_id}). Last activity: {state.last_updated_at}")
         _clear_contact_flow_state(contact)
         timed_out_contacts.add(contact)
@@ -828,4 +821,23 @@ def cleanup_idle_conversations_task():
             outgoing_msg = Message.objects.create(contact=contact, app_config=config_to_use, direction='out', message_type='text', content_payload={'body': notification_text}, status='pending_dispatch')
             send_whatsapp_message_task.delay(outgoing_msg.id, config_to_use.id)
 
-    logger.info(f"{log_prefix} Cleanup complete. Timed out {len(timed_out_contacts)} contacts.")
\ No newline at end of file
+    logger.info(f"{log_prefix} Cleanup complete. Timed out {len(timed_out_contacts)} contacts.")
+
+
+@shared_task(name="flows.persist_flow_states_task")
+def persist_flow_states_task():
+    """
+    Writes the flow states changed in Redis behind to the ContactFlowState table
+    when FLOW_STATE_BACKEND is 'redis' (see flow_state_store.py).
+    """
+    from .flow_state_store import clear_flush_flag, persist_dirty_states, requeue_abandoned_batches
+
+    clear_flush_flag()
+    requeue_abandoned_batches()
+    totals = persist_dirty_states(settings.FLOW_STATE_PERSIST_BATCH_SIZE)
+    if totals['upserted'] or totals['deleted']:
+        logger.info(
+            f"[Flow State Persist] Wrote {totals['upserted']} flow states and deleted {totals['deleted']} "
+            f"ended ones."
+        )
+    return totals
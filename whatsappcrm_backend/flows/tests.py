@@ -1,4 +1,6 @@
-from django.test import TestCase
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
 from django.utils import timezone
 from unittest.mock import Mock, patch
 
@@ -297,3 +299,942 @@ class CheckoutCartActionTests(TestCase):
         order = Order.objects.get(order_number=order_info['order_number'])
         self.assertEqual(str(order.amount), '30.00')
         self.assertEqual(self.cart.items.count(), 0)
+
+
+@patch('whatsappcrm_backend.redis_client.get_redis_client', return_value=None)
+class FlowGraphTestCase(TestCase):
+    """Tests for the compiled, process-local flow graph."""
+
+    def setUp(self):
+        from flows.models import Flow, FlowStep, FlowTransition
+        from flows.flow_graph import invalidate_flow_graph
+
+        self.flow = Flow.objects.create(name='graph_test_flow', is_active=True, trigger_keywords=['graphtest'])
+        self.entry = FlowStep.objects.create(
+            flow=self.flow, name='welcome', step_type='send_message', is_entry_point=True,
+            config={'message_type': 'text', 'text': {'body': 'Hi'}},
+        )
+        self.first = FlowStep.objects.create(flow=self.flow, name='first', step_type='end_flow', config={})
+        self.second = FlowStep.objects.create(flow=self.flow, name='second', step_type='end_flow', config={})
+        self.low = FlowTransition.objects.create(
+            current_step=self.entry, next_step=self.second, priority=5, condition_config={'type': 'always_true'}
+        )
+        self.high = FlowTransition.objects.create(
+            current_step=self.entry, next_step=self.first, priority=1, condition_config={'type': 'always_true'}
+        )
+        Flow.objects.create(name='graph_inactive_flow', is_active=False)
+        self.contact = Contact.objects.bulk_create([Contact(whatsapp_id='263774000001', name='Graph')])[0]
+        invalidate_flow_graph()
+
+    def test_graph_compiles_entry_points_and_ordered_transitions(self, mock_redis):
+        from flows.flow_graph import get_flow_graph
+
+        graph = get_flow_graph()
+
+        compiled = graph.get_active_flow('graph_test_flow')
+        self.assertEqual(compiled.entry_step.pk, self.entry.pk)
+        self.assertEqual([t.pk for t in graph.get_transitions(self.entry.pk)], [self.high.pk, self.low.pk])
+        self.assertIs(graph.get_transitions(self.entry.pk)[0].next_step, graph.get_step(self.first.pk))
+        self.assertIsNone(graph.get_active_flow('graph_inactive_flow'))
+        self.assertIs(get_flow_graph(), graph)
+
+    def test_definition_change_invalidates_graph(self, mock_redis):
+        from flows.flow_graph import get_flow_graph
+
+        graph = get_flow_graph()
+        self.low.priority = 0
+        self.low.save()
+
+        rebuilt = get_flow_graph()
+        self.assertIsNot(rebuilt, graph)
+        self.assertEqual([t.pk for t in rebuilt.get_transitions(self.entry.pk)], [self.low.pk, self.high.pk])
+
+    def test_trigger_does_not_query_definitions(self, mock_redis):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from flows.flow_graph import get_flow_graph
+        from flows.models import ContactFlowState
+        from flows.services import _trigger_new_flow
+
+        get_flow_graph()
+        with CaptureQueriesContext(connection) as queries:
+            triggered = _trigger_new_flow(self.contact, {'type': 'text', 'text': {'body': 'GraphTest please'}}, None)
+
+        self.assertTrue(triggered)
+        self.assertEqual(ContactFlowState.objects.get(contact=self.contact).current_step_id, self.entry.pk)
+        definition_tables = ('"flows_flow"', '"flows_flowstep"', '"flows_flowtransition"')
+        for query in queries.captured_queries:
+            self.assertFalse(any(f'FROM {table}' in query['sql'] for table in definition_tables), query['sql'])
+
+
+class FlowTemplateCacheTestCase(TestCase):
+    """Tests for the compiled Jinja template cache used by _resolve_value."""
+
+    def setUp(self):
+        from flows import services
+        services._template_cache.clear()
+        self.contact = Contact.objects.bulk_create([Contact(whatsapp_id='263774000002', name='Tariro')])[0]
+
+    def test_plain_strings_skip_jinja(self):
+        from flows import services
+
+        with patch.object(services.jinja_env, 'from_string') as mock_from_string:
+            resolved = services._resolve_value({'body': 'No markup here', 'rows': ['a', 1]}, {}, self.contact)
+
+        self.assertEqual(resolved, {'body': 'No markup here', 'rows': ['a', 1]})
+        mock_from_string.assert_not_called()
+
+    def test_plain_string_fast_path_matches_jinja_output(self):
+        from flows import services
+
+        for value in ('Thanks!\n', 'Line one\r\nLine two', 'Two newlines\n\n'):
+            expected = services.jinja_env.from_string(value).render()
+            self.assertEqual(services._resolve_value(value, {}, self.contact), expected)
+
+    def test_template_is_compiled_once(self):
+        from flows import services
+
+        with patch.object(services.jinja_env, 'from_string', wraps=services.jinja_env.from_string) as mock_from_string:
+            first = services._resolve_value('Hi {{ contact.name }} ({{ plan }})', {'plan': 'Gold'}, self.contact)
+            second = services._resolve_value('Hi {{ contact.name }} ({{ plan }})', {'plan': 'Silver'}, self.contact)
+
+        self.assertEqual((first, second), ('Hi Tariro (Gold)', 'Hi Tariro (Silver)'))
+        self.assertEqual(mock_from_string.call_count, 1)
+
+    @override_settings(FLOW_TEMPLATE_CACHE_SIZE=2)
+    def test_cache_is_bounded_lru(self):
+        from flows import services
+
+        services.get_compiled_template('{{ a }}')
+        services.get_compiled_template('{{ b }}')
+        services.get_compiled_template('{{ a }}')
+        services.get_compiled_template('{{ c }}')
+
+        self.assertEqual(list(services._template_cache), ['{{ a }}', '{{ c }}'])
+
+    def test_precompile_reports_invalid_templates(self):
+        from flows import services
+
+        errors = services.precompile_config_templates({
+            'message_config': {'text': {'body': 'Hello {{ contact.name }}'}},
+            'actions_to_run': [{'value': '{% if %}'}, {'value': 'plain'}],
+        })
+
+        self.assertEqual([source for source, error in errors], ['{% if %}'])
+        self.assertIn('Hello {{ contact.name }}', services._template_cache)
+
+
+class TriggerIndexTestCase(TestCase):
+    """Tests for the Aho-Corasick trigger keyword index."""
+
+    def _index(self, *flows):
+        from flows.flow_graph import CompiledFlow
+        from flows.trigger_index import TriggerIndex
+        return TriggerIndex([CompiledFlow(flow, [], {}) for flow in flows])
+
+    def test_matches_keywords_anywhere_in_text(self):
+        from flows.models import Flow
+
+        index = self._index(
+            Flow(name='a_support', trigger_keywords=['help me', 'support']),
+            Flow(name='b_shop', trigger_keywords=['he', 'buy']),
+        )
+
+        self.assertEqual(index.match('I want to BUY a panel').compiled_flow.flow.name, 'b_shop')
+        self.assertEqual(index.match('Please SUPPORT').keyword, 'support')
+        self.assertIsNone(index.match('nothing relevant'))
+
+    def test_first_flow_in_name_order_wins(self):
+        from flows.models import Flow
+
+        index = self._index(
+            Flow(name='a_support', trigger_keywords=['help me']),
+            Flow(name='b_shop', trigger_keywords=['he']),
+        )
+
+        # 'he' occurs first in the text, but 'a_support' has priority, as with the old loop.
+        match = index.match('hey, help me')
+        self.assertEqual((match.compiled_flow.flow.name, match.keyword), ('a_support', 'help me'))
+
+    def test_extraction_regex_is_applied(self):
+        from flows.models import Flow
+
+        index = self._index(Flow(
+            name='quote', trigger_keywords=['quote for'],
+            trigger_config={'extraction_regex': r'quote for "(.*?)"', 'context_variable': 'product_interest'},
+        ))
+
+        match = index.match('Quote for "5kVA Inverter" please')
+        self.assertEqual(match.initial_context, {})
+        match = index.match('quote for "5kVA Inverter" please')
+        self.assertEqual(match.initial_context, {'product_interest': '5kVA Inverter'})
+
+
+class StepConfigCacheTestCase(TestCase):
+    """Tests for validate-once step configs (flows/step_configs.py)."""
+
+    LIST_CONFIG = {
+        'message_type': 'interactive',
+        'interactive': {
+            'type': 'list',
+            'body': {'text': 'Hi {{ contact.name }}, pick a product'},
+            'action': {
+                'button': 'Products',
+                'sections': [
+                    {'title': f'Section {s}', 'rows': [
+                        {'id': f'product_{s}_{r}', 'title': f'Product {s}.{r}', 'description': 'In stock'}
+                        for r in range(10)
+                    ]}
+                    for s in range(5)
+                ],
+            },
+        },
+    }
+
+    def setUp(self):
+        from flows.models import Flow, FlowStep
+
+        self.contact = Contact.objects.bulk_create([Contact(whatsapp_id='263774000003', name='Chipo')])[0]
+        self.flow = Flow.objects.create(name='step_config_flow')
+        self.step = FlowStep.objects.create(
+            flow=self.flow, name='product_list', step_type='send_message', config=self.LIST_CONFIG
+        )
+
+    def test_config_is_validated_once(self):
+        from flows.schemas import StepConfigSendMessage
+        from flows.services import _execute_step_actions
+
+        with patch.object(StepConfigSendMessage, 'model_validate', wraps=StepConfigSendMessage.model_validate) as mock_validate:
+            first, _ = _execute_step_actions(self.step, self.contact, {})
+            second, _ = _execute_step_actions(self.step, self.contact, {})
+
+        self.assertEqual(mock_validate.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(first[0]['data']['body']['text'], 'Hi Chipo, pick a product')
+
+    def test_replaced_config_is_revalidated(self):
+        from flows.services import _execute_step_actions
+
+        _execute_step_actions(self.step, self.contact, {})
+        self.step.config = {'message_type': 'text', 'text': {'body': 'Changed'}}
+        actions, _ = _execute_step_actions(self.step, self.contact, {})
+
+        self.assertEqual(actions[0]['data']['body'], 'Changed')
+
+    def test_shared_template_payload_is_not_mutated(self):
+        from flows.models import FlowStep
+        from flows.services import _execute_step_actions
+        from flows.step_configs import get_parsed_step_config
+
+        step = FlowStep.objects.create(flow=self.flow, name='template_step', step_type='send_message', config={
+            'message_type': 'template',
+            'template': {'name': 'promo', 'language': {'code': 'en_US'}, 'components': [
+                {'type': 'body', 'parameters': [{'type': 'text', 'text': '{{ offer }}'}]},
+            ]},
+        })
+
+        first, _ = _execute_step_actions(step, self.contact, {'offer': '10% off'})
+        second, _ = _execute_step_actions(step, self.contact, {'offer': 'Free delivery'})
+
+        self.assertEqual(first[0]['data']['components'][0]['parameters'][0]['text'], '10% off')
+        self.assertEqual(second[0]['data']['components'][0]['parameters'][0]['text'], 'Free delivery')
+        self.assertEqual(get_parsed_step_config(step).payload['components'][0]['parameters'][0]['text'], '{{ offer }}')
+
+    def test_invalid_config_is_reported_without_actions(self):
+        from flows.models import FlowStep
+        from flows.services import _execute_step_actions
+
+        step = FlowStep(flow=self.flow, name='broken', step_type='send_message', config={'message_type': 'carousel'})
+
+        actions, _ = _execute_step_actions(step, self.contact, {})
+
+        self.assertEqual(actions, [])
+
+
+class TransitionConditionTestCase(TestCase):
+    """Tests for compiled transition predicates (flows/transition_conditions.py)."""
+
+    def setUp(self):
+        from flows.models import Flow, FlowStep
+
+        self.contact = Contact.objects.bulk_create([Contact(whatsapp_id='263774000004', name='Farai')])[0]
+        self.flow = Flow.objects.create(name='transition_condition_flow')
+        self.step = FlowStep.objects.create(flow=self.flow, name='ask', step_type='question', config={})
+
+    def _transition(self, condition_config):
+        from flows.models import FlowTransition
+        return FlowTransition(id=1, current_step=self.step, next_step=self.step, condition_config=condition_config)
+
+    def _evaluate(self, condition_config, message_data, flow_context=None):
+        from flows.services import _evaluate_transition_condition
+        return _evaluate_transition_condition(
+            self._transition(condition_config), self.contact, message_data, flow_context or {}, None
+        )
+
+    def test_message_view_parses_replies(self):
+        from flows.transition_conditions import MessageView
+
+        text = MessageView({'type': 'text', 'text': {'body': '  Hello  '}})
+        button = MessageView({'type': 'interactive', 'interactive': {'type': 'button_reply', 'button_reply': {'id': 'yes'}}})
+        nfm = MessageView({'type': 'interactive', 'interactive': {'type': 'nfm_reply', 'nfm_reply': {'response_json': '{"a": {"b": 1}}'}}})
+
+        self.assertEqual(text.user_text, 'Hello')
+        self.assertEqual(button.interactive_reply_id, 'yes')
+        self.assertEqual(nfm.nfm_response_data, {'a': {'b': 1}})
+
+    def test_condition_types(self):
+        text = {'type': 'text', 'text': {'body': 'Order 123 please'}}
+        reply = {'type': 'interactive', 'interactive': {'type': 'list_reply', 'list_reply': {'id': '7'}}}
+        nfm = {'type': 'interactive', 'interactive': {'type': 'nfm_reply', 'nfm_reply': {'response_json': '{"a": {"b": "x"}}'}}}
+
+        self.assertTrue(self._evaluate({'type': 'user_reply_contains_keyword', 'keyword': 'ORDER'}, text))
+        self.assertFalse(self._evaluate({'type': 'user_reply_contains_keyword', 'keyword': 'ORDER', 'case_sensitive': True}, text))
+        self.assertFalse(self._evaluate({'type': 'user_reply_matches_keyword', 'keyword': 'order'}, text))
+        self.assertTrue(self._evaluate({'type': 'user_reply_matches_regex', 'regex': r'^Order \d+'}, text))
+        self.assertFalse(self._evaluate({'type': 'user_reply_matches_regex', 'regex': '('}, text))
+        self.assertTrue(self._evaluate({'type': 'interactive_reply_id_equals', 'value': 7}, reply))
+        self.assertTrue(self._evaluate({'type': 'message_type_is', 'value': 'interactive'}, reply))
+        self.assertTrue(self._evaluate({'type': 'nfm_response_field_equals', 'field_path': 'a.b', 'value': 'x'}, nfm))
+        self.assertFalse(self._evaluate({'type': 'nfm_response_field_equals', 'field_path': 'a.b', 'value': 'x'}, text))
+        self.assertTrue(self._evaluate({'type': 'variable_equals', 'variable_name': 'choice', 'value': ''}, text))
+        self.assertTrue(self._evaluate({'type': 'variable_equals', 'variable_name': 'qty', 'value': 2}, text, {'qty': '2'}))
+        self.assertTrue(self._evaluate({'type': 'variable_contains', 'variable_name': 'tags', 'value': 'vip'}, text, {'tags': ['vip']}))
+        self.assertTrue(self._evaluate({'type': 'user_requests_human', 'keywords': ['Please']}, text))
+        self.assertFalse(self._evaluate({'type': 'no_such_condition'}, text))
+        self.assertFalse(self._evaluate(['not', 'a', 'dict'], text))
+
+    def test_predicate_is_compiled_once(self):
+        from flows import transition_conditions
+        from flows.transition_conditions import MessageView, get_condition_predicate
+
+        transition = self._transition({'type': 'user_reply_matches_regex', 'regex': r'^\d+$'})
+        with patch.object(transition_conditions, 'compile_condition', wraps=transition_conditions.compile_condition) as mock_compile:
+            predicate = get_condition_predicate(transition)
+            self.assertIs(get_condition_predicate(transition), predicate)
+            self.assertTrue(predicate(MessageView({'type': 'text', 'text': {'body': '42'}}), self.contact, {}))
+            transition.condition_config = {'type': 'always_true'}
+            get_condition_predicate(transition)
+
+        self.assertEqual(mock_compile.call_count, 2)
+
+
+class _FakeRedis:
+    """In-memory stand-in for the few Redis commands flow_state_store uses."""
+
+    def __init__(self):
+        self.hashes, self.sets, self.values, self.zsets = {}, {}, {}, {}
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+    def hgetall(self, key):
+        return {k.encode(): v.encode() for k, v in self.hashes.get(key, {}).items()}
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update({k: str(v) for k, v in mapping.items()})
+
+    def delete(self, key):
+        self.hashes.pop(key, None)
+        self.values.pop(key, None)
+        self.sets.pop(key, None)
+        self.zsets.pop(key, None)
+
+    def expire(self, key, seconds):
+        return True
+
+    def sadd(self, key, member):
+        self.sets.setdefault(key, set()).add(str(member))
+
+    def spop(self, key, count):
+        members = self.sets.get(key, set())
+        return [members.pop().encode() for _ in range(min(count, len(members)))]
+
+    def zadd(self, key, mapping):
+        self.zsets.setdefault(key, {}).update(mapping)
+
+    def zrem(self, key, member):
+        self.zsets.get(key, {}).pop(member, None)
+
+    def zrangebyscore(self, key, low, high):
+        return [member.encode() for member, score in self.zsets.get(key, {}).items() if score <= high]
+
+    def register_script(self, script):
+        from flows import flow_state_store
+
+        def drain(keys, args):
+            contact_ids = self.spop(keys[0], args[0])
+            if contact_ids:
+                self.sets.setdefault(keys[1], set()).update(cid.decode() for cid in contact_ids)
+                self.zadd(keys[2], {keys[1]: args[1]})
+            return contact_ids
+
+        def requeue(keys, args):
+            contact_ids = self.sets.pop(keys[0], set())
+            self.sets.setdefault(keys[1], set()).update(contact_ids)
+            self.zrem(keys[2], keys[0])
+            return len(contact_ids)
+
+        def unlock(keys, args):
+            if self.values.get(keys[0]) != args[0]:
+                return 0
+            self.values.pop(keys[0])
+            return 1
+
+        scripts = {
+            flow_state_store._DRAIN_LUA: drain, flow_state_store._REQUEUE_LUA: requeue,
+            flow_state_store._UNLOCK_LUA: unlock,
+        }
+        return lambda keys, args=(): scripts[script](keys, args)
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, nx=False, ex=None, px=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    def scan_iter(self, match, count=None):
+        prefix = match.rstrip('*')
+        return [key.encode() for key in list(self.hashes) if key.startswith(prefix)]
+
+
+class _FakePipeline:
+    def __init__(self, client):
+        self.client, self.calls = client, []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+@override_settings(FLOW_STATE_BACKEND='redis')
+class RedisFlowStateStoreTestCase(TestCase):
+    """Tests for the Redis flow state backend with write-behind persistence (flows/flow_state_store.py)."""
+
+    def setUp(self):
+        from flows.models import Flow, FlowStep
+
+        self.redis = _FakeRedis()
+        patcher = patch('flows.flow_state_store.get_redis_client', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # Hash writes wait for the transaction; the persist they schedule is run explicitly by the tests.
+        task_patcher = patch('flows.tasks.persist_flow_states_task.apply_async')
+        task_patcher.start()
+        self.addCleanup(task_patcher.stop)
+        self.contact = Contact.objects.bulk_create([Contact(whatsapp_id='263774000005', name='Tatenda')])[0]
+        self.flow = Flow.objects.create(name='state_store_flow')
+        self.first = FlowStep.objects.create(flow=self.flow, name='first', step_type='question', config={})
+        self.second = FlowStep.objects.create(flow=self.flow, name='second', step_type='question', config={})
+
+    def test_state_lives_in_redis_until_persisted(self):
+        from flows.models import ContactFlowState
+        from flows.flow_state_store import create_flow_state, load_flow_state, persist_dirty_states, save_flow_state
+
+        with self.captureOnCommitCallbacks(execute=True):
+            created = create_flow_state(self.contact, self.flow, self.first, {'name': 'Tee'})
+        self.assertFalse(ContactFlowState.objects.exists())
+
+        state = load_flow_state(self.contact)
+        state.current_step = self.second
+        state.flow_context_data['age'] = 30
+        with self.captureOnCommitCallbacks(execute=True):
+            save_flow_state(state, update_fields=['flow_context_data', 'last_updated_at'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(persist_dirty_states(100), {'upserted': 1, 'deleted': 0})
+        self.assertEqual(self.redis.zsets.get('flows:state:persist_batches'), {})
+        row = ContactFlowState.objects.get(contact=self.contact)
+        self.assertEqual(row.current_step_id, self.second.id)
+        self.assertEqual(row.flow_context_data, {'name': 'Tee', 'age': 30})
+        self.assertEqual(load_flow_state(self.contact)._store_token, created._store_token)
+
+    def test_cleared_state_does_not_fall_back_to_row(self):
+        from flows.models import ContactFlowState
+        from flows.flow_state_store import clear_flow_state, create_flow_state, load_flow_state, persist_dirty_states
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_flow_state(self.contact, self.flow, self.first, {})
+        persist_dirty_states(100)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertTrue(clear_flow_state(self.contact))
+        self.assertIsNone(load_flow_state(self.contact))
+        self.assertTrue(ContactFlowState.objects.exists())
+
+        self.assertEqual(persist_dirty_states(100), {'upserted': 0, 'deleted': 1})
+        self.assertFalse(ContactFlowState.objects.exists())
+
+    def test_row_is_read_and_warmed_without_a_hash(self):
+        from flows.models import ContactFlowState
+        from flows.flow_state_store import load_flow_state, same_flow_state
+
+        row = ContactFlowState.objects.create(contact=self.contact, current_flow=self.flow, current_step=self.first)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            state = load_flow_state(self.contact)
+
+        self.assertEqual(state.pk, row.pk)
+        self.assertIn(f'flows:state:contact:{self.contact.id}', self.redis.hashes)
+        self.assertTrue(same_flow_state(load_flow_state(self.contact), state))
+
+    def test_reconcile_reports_and_fixes_drift(self):
+        from flows.models import ContactFlowState
+        from flows.flow_state_store import create_flow_state, persist_dirty_states, reconcile_flow_states
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_flow_state(self.contact, self.flow, self.first, {'step': 1})
+        persist_dirty_states(100)
+        ContactFlowState.objects.filter(contact=self.contact).update(current_step=self.second)
+
+        report = reconcile_flow_states()
+        self.assertEqual((report['differs'], report['fixed']), (1, 0))
+
+        report = reconcile_flow_states(fix=True)
+        self.assertEqual(report['fixed'], 1)
+        self.assertEqual(ContactFlowState.objects.get(contact=self.contact).current_step_id, self.first.id)
+        self.assertEqual(reconcile_flow_states()['in_sync'], 1)
+
+
+    def test_hash_is_written_on_commit_and_read_back_before(self):
+        from flows.flow_state_store import create_flow_state, load_flow_state
+
+        with self.captureOnCommitCallbacks(execute=True):
+            created = create_flow_state(self.contact, self.flow, self.first, {'name': 'Tee'})
+            self.assertEqual(self.redis.hashes, {})
+            self.assertEqual(load_flow_state(self.contact)._store_token, created._store_token)
+
+        self.assertIn(f'flows:state:contact:{self.contact.id}', self.redis.hashes)
+
+    def test_rolled_back_write_never_reaches_redis(self):
+        from django.db import transaction
+        from flows.flow_state_store import create_flow_state, load_flow_state
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    create_flow_state(self.contact, self.flow, self.first, {})
+                    raise RuntimeError('step failed')
+            except RuntimeError:
+                pass
+            self.assertIsNone(load_flow_state(self.contact))
+
+        self.assertEqual(self.redis.hashes, {})
+
+    def test_locked_read_holds_the_contact_until_its_writes_commit(self):
+        from django.db import transaction
+        from flows.flow_state_store import create_flow_state, load_flow_state, save_flow_state
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_flow_state(self.contact, self.flow, self.first, {})
+        lock_key = f'flows:state:lock:{self.contact.id}'
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                state = load_flow_state(self.contact, for_update=True)
+                self.assertIn(lock_key, self.redis.values)
+                state.flow_context_data = {'answer': 'yes'}
+                save_flow_state(state, update_fields=['flow_context_data', 'last_updated_at'])
+                # Taking it again in the same transaction doesn't wait for itself.
+                self.assertIsNotNone(load_flow_state(self.contact, for_update=True))
+
+        self.assertNotIn(lock_key, self.redis.values)
+        self.assertEqual(load_flow_state(self.contact).flow_context_data, {'answer': 'yes'})
+
+    @override_settings(FLOW_STATE_LOCK_WAIT_SECONDS=0)
+    def test_read_goes_ahead_when_another_worker_holds_the_lock(self):
+        from flows.flow_state_store import create_flow_state, load_flow_state
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_flow_state(self.contact, self.flow, self.first, {})
+        lock_key = f'flows:state:lock:{self.contact.id}'
+        self.redis.values[lock_key] = 'other-worker'
+
+        with self.captureOnCommitCallbacks(execute=True), self.assertLogs('flows.flow_state_store', 'WARNING'):
+            self.assertIsNotNone(load_flow_state(self.contact, for_update=True))
+
+        self.assertEqual(self.redis.values[lock_key], 'other-worker')
+
+    def test_failed_persist_puts_contacts_back_in_the_dirty_set(self):
+        from flows.flow_state_store import create_flow_state, persist_dirty_states
+
+        with self.captureOnCommitCallbacks(execute=True):
+            create_flow_state(self.contact, self.flow, self.first, {})
+
+        with patch('flows.flow_state_store.persist_states', side_effect=RuntimeError('db down')), \
+                self.assertRaises(RuntimeError):
+            persist_dirty_states(100)
+
+        self.assertEqual(self.redis.sets['flows:state:dirty'], {str(self.contact.id)})
+        self.assertEqual(self.redis.zsets['flows:state:persist_batches'], {})
+
+
+@patch('whatsappcrm_backend.redis_client.get_redis_client', return_value=None)
+class FlowProfilingTestCase(TestCase):
+    """Tests for per-step flow profiling (flows/profiling.py)."""
+
+    def setUp(self):
+        from flows.models import Flow, FlowStep, FlowTransition
+        from flows.flow_graph import invalidate_flow_graph
+
+        self.flow = Flow.objects.create(name='profiled_flow', is_active=True, trigger_keywords=['profileme'])
+        self.lookup = FlowStep.objects.create(
+            flow=self.flow, name='lookup', step_type='action', is_entry_point=True,
+            config={'actions_to_run': [
+                {'action_type': 'query_model', 'app_label': 'conversations', 'model_name': 'Contact',
+                 'variable_name': 'matches', 'filters_template': {'whatsapp_id': '{{ contact.whatsapp_id }}'},
+                 'fields_to_return': ['name']},
+                {'action_type': 'set_context_variable', 'variable_name': 'greeting', 'value_template': 'Hi {{ contact.name }}'},
+            ]},
+        )
+        done = FlowStep.objects.create(flow=self.flow, name='done', step_type='end_flow', config={})
+        FlowTransition.objects.create(current_step=self.lookup, next_step=done, priority=1, condition_config={'type': 'always_true'})
+        self.contact = Contact.objects.bulk_create([Contact(whatsapp_id='263774000006', name='Nyasha')])[0]
+        invalidate_flow_graph()
+
+    def _sample(self, name, labels):
+        from prometheus_client import REGISTRY
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    @override_settings(FLOW_PROFILE_TRACE_SAMPLE_RATE=1.0)
+    def test_step_actions_and_transitions_are_recorded(self, mock_redis):
+        from flows.services import process_message_for_flow
+
+        step_labels = {'flow': 'profiled_flow', 'step': 'lookup', 'step_type': 'action'}
+        action_labels = {'flow': 'profiled_flow', 'action_type': 'query_model'}
+        transition_labels = {'flow': 'profiled_flow', 'step': 'lookup'}
+        steps_before = self._sample('whatsappcrm_flow_step_seconds_count', step_labels)
+        actions_before = self._sample('whatsappcrm_flow_action_seconds_count', action_labels)
+        transitions_before = self._sample('whatsappcrm_flow_transitions_evaluated_sum', transition_labels)
+
+        with self.assertLogs('flows.profiling', level='INFO') as logs:
+            process_message_for_flow(self.contact, {'type': 'text', 'text': {'body': 'profileme'}}, None)
+
+        self.assertEqual(self._sample('whatsappcrm_flow_step_seconds_count', step_labels), steps_before + 1)
+        self.assertEqual(self._sample('whatsappcrm_flow_action_seconds_count', action_labels), actions_before + 1)
+        self.assertEqual(self._sample('whatsappcrm_flow_transitions_evaluated_sum', transition_labels), transitions_before + 1)
+        trace = logs.output[-1]
+        self.assertIn('profiled_flow/lookup (action)', trace)
+        self.assertIn('query_model', trace)
+        self.assertIn('set_context_variable', trace)
+
+    @override_settings(FLOW_PROFILING_ENABLED=False)
+    def test_disabled_profiling_records_nothing(self, mock_redis):
+        from flows.services import process_message_for_flow
+
+        labels = {'flow': 'profiled_flow', 'step': 'lookup', 'step_type': 'action'}
+        before = self._sample('whatsappcrm_flow_step_seconds_count', labels)
+
+        process_message_for_flow(self.contact, {'type': 'text', 'text': {'body': 'profileme'}}, None)
+
+        self.assertEqual(self._sample('whatsappcrm_flow_step_seconds_count', labels), before)
+
+
+@patch('whatsappcrm_backend.redis_client.get_redis_client', return_value=None)
+class FlowSimulationTestCase(TestCase):
+    """Tests for the offline flow simulation (flows/simulation.py) and simulate_flows."""
+
+    def test_main_menu_scenario_is_replayed_for_every_contact(self, mock_redis):
+        from flows.flow_state_store import load_flow_state
+        from flows.simulation import SCENARIOS, run_scenario
+
+        scenario = SCENARIOS['main_menu']
+        result = run_scenario(scenario, contacts=2)
+
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(result.messages, 2 * len(scenario.script))
+        self.assertGreater(result.actions, 0)
+        self.assertGreater(result.queries_per_message, 0)
+        self.assertLessEqual(result.p50_ms, result.p99_ms)
+        contacts = Contact.objects.filter(whatsapp_id__startswith='sim')
+        self.assertEqual(contacts.count(), 2)
+        for contact in contacts:
+            state = load_flow_state(contact)
+            self.assertIsNotNone(state)
+            self.assertEqual(state.current_flow.name, 'main_menu')
+
+    def test_command_reports_json_and_fails_on_regression(self, mock_redis):
+        import json
+        from io import StringIO
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+
+        out = StringIO()
+        call_command('simulate_flows', scenario='solar_cleaning', contacts=2, json=True, stdout=out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report[0]['scenario'], 'solar_cleaning')
+        self.assertEqual(report[0]['messages'], 4)
+        self.assertFalse(Contact.objects.filter(whatsapp_id__startswith='sim').exists())
+
+        with self.assertRaises(CommandError):
+            call_command('simulate_flows', scenario='solar_cleaning', contacts=1, max_queries_per_message=0, stdout=StringIO())
+
+
+@patch('whatsappcrm_backend.redis_client.get_redis_client', return_value=None)
+@patch('flows.query_cache.get_redis_client', return_value=None)
+class QueryModelCacheTestCase(TestCase):
+    """Tests for the query_model result cache (flows/query_cache.py)."""
+
+    def setUp(self):
+        from flows.models import Flow, FlowStep
+        from flows.query_cache import clear_query_cache
+
+        clear_query_cache()
+        self.contacts = Contact.objects.bulk_create([
+            Contact(whatsapp_id='263774000007', name='Rudo'), Contact(whatsapp_id='263774000008', name='Tendai'),
+        ])
+        flow = Flow.objects.create(name='cached_query_flow', is_active=True)
+        self.step = FlowStep.objects.create(
+            flow=flow, name='list_contacts', step_type='action', is_entry_point=True,
+            config={'actions_to_run': [
+                {'action_type': 'query_model', 'app_label': 'conversations', 'model_name': 'Contact',
+                 'variable_name': 'contacts', 'filters_template': {'whatsapp_id__startswith': '2637740000'},
+                 'order_by': ['whatsapp_id'], 'fields_to_return': ['whatsapp_id', 'name'], 'cache_ttl_seconds': 60},
+            ]},
+        )
+
+    def _run_step(self, contact):
+        from flows.services import _execute_step_actions
+        _, context = _execute_step_actions(self.step, contact, {})
+        return context['contacts']
+
+    def test_identical_queries_are_served_from_the_cache(self, mock_query_redis, mock_graph_redis):
+        from flows import services
+
+        with patch.object(services, '_query_model_results', wraps=services._query_model_results) as query:
+            first = self._run_step(self.contacts[0])
+            second = self._run_step(self.contacts[1])
+
+        self.assertEqual(query.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual([row['name'] for row in first], ['Rudo', 'Tendai'])
+        first.append({'name': 'mutated'})
+        self.assertEqual(len(self._run_step(self.contacts[0])), 2)
+
+    def test_saving_a_cached_model_invalidates_its_results(self, mock_query_redis, mock_graph_redis):
+        self._run_step(self.contacts[0])
+        contact = self.contacts[1]
+        contact.name = 'Tendai M.'
+        contact.save()
+
+        self.assertEqual([row['name'] for row in self._run_step(self.contacts[0])], ['Rudo', 'Tendai M.'])
+
+    def test_expired_entries_are_not_served(self, mock_query_redis, mock_graph_redis):
+        from flows.query_cache import (
+            cache_query_results, get_cached_query_results, make_query_cache_key, query_cache_version,
+        )
+
+        key = make_query_cache_key(Contact, {'name': 'Rudo'}, {}, None, None, ['name'])
+        version = query_cache_version(key)
+        cache_query_results(key, [{'name': 'Rudo'}], 60, version)
+        self.assertEqual(get_cached_query_results(key, version), [{'name': 'Rudo'}])
+
+        cache_query_results(key, [{'name': 'Rudo'}], 0, version)
+        self.assertIsNone(get_cached_query_results(key, version))
+
+    def test_results_are_stored_under_the_version_read_before_the_query(self, mock_query_redis, mock_graph_redis):
+        from flows import services
+
+        real_query = services._query_model_results
+
+        def query_then_save(*args, **kwargs):
+            results = real_query(*args, **kwargs)
+            contact = self.contacts[1]
+            contact.name = 'Tendai M.'
+            contact.save()
+            return results
+
+        self._run_step(self.contacts[0])
+        self.contacts[0].save()  # outdates the cached results, so the next run queries again
+        with patch.object(services, '_query_model_results', side_effect=query_then_save):
+            self.assertEqual([row['name'] for row in self._run_step(self.contacts[0])], ['Rudo', 'Tendai'])
+
+        self.assertEqual([row['name'] for row in self._run_step(self.contacts[0])], ['Rudo', 'Tendai M.'])
+
+
+@patch('whatsappcrm_backend.redis_client.get_redis_client', return_value=None)
+class FlowWriteBufferTestCase(TestCase):
+    """Tests for the per-message write buffer (flows/write_buffer.py)."""
+
+    def setUp(self):
+        self.contact = Contact.objects.bulk_create([Contact(whatsapp_id='263774000009', name='Farai')])[0]
+
+    def test_updates_to_a_row_are_merged_into_one_write(self, mock_redis):
+        from flows.write_buffer import buffer_flow_writes, save_fields
+
+        @buffer_flow_writes
+        def cycle(contact):
+            contact.name = 'Farai M.'
+            save_fields(contact, ['name'])
+            contact.conversation_mode = 'ai_shopping'
+            save_fields(contact, ['conversation_mode'])
+            contact.name = 'Farai Moyo'
+            save_fields(contact, ['name'])
+
+        with self.assertNumQueries(1):
+            cycle(self.contact)
+
+        contact = Contact.objects.get(pk=self.contact.pk)
+        self.assertEqual((contact.name, contact.conversation_mode), ('Farai Moyo', 'ai_shopping'))
+
+    def test_a_failing_write_is_logged_under_its_action_and_the_others_go_through(self, mock_redis):
+        from flows.write_buffer import add_instance, buffer_flow_writes, save_fields
+
+        other = Contact.objects.bulk_create([Contact(whatsapp_id='263774000011', name='Nyasha')])[0]
+
+        @buffer_flow_writes
+        def cycle():
+            self.contact.name = 'Farai M.'
+            save_fields(self.contact, ['name'], action='rename')
+            other.name = 'Nyasha C.'
+            save_fields(other, ['name'], action='rename other')
+            other.whatsapp_id = self.contact.whatsapp_id
+            save_fields(other, ['whatsapp_id'], action='duplicate number')
+            add_instance(Contact(whatsapp_id='263774000012', name='Tapiwa'), action='new contact')
+            add_instance(Contact(whatsapp_id=self.contact.whatsapp_id), action='duplicate contact')
+
+        with self.assertLogs('flows.write_buffer', level='ERROR') as logs:
+            cycle()
+
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('duplicate number failed', logs.output[0])
+        self.assertIn('duplicate contact failed', logs.output[1])
+        self.assertEqual(Contact.objects.get(pk=self.contact.pk).name, 'Farai M.')
+        self.assertEqual(Contact.objects.get(pk=other.pk).name, 'Nyasha C.')
+        self.assertTrue(Contact.objects.filter(whatsapp_id='263774000012').exists())
+
+    def test_later_steps_read_their_own_writes(self, mock_redis):
+        from flows.models import ContactFlowState, Flow, FlowStep, FlowTransition
+        from flows.flow_graph import invalidate_flow_graph
+        from flows.services import process_message_for_flow
+
+        flow = Flow.objects.create(name='buffered_flow', is_active=True, trigger_keywords=['bufferme'])
+        first = FlowStep.objects.create(
+            flow=flow, name='set_company', step_type='action', is_entry_point=True,
+            config={'actions_to_run': [
+                {'action_type': 'update_contact_field', 'field_path': 'name', 'value_template': 'Farai Moyo'},
+                {'action_type': 'update_customer_profile', 'fields_to_update': {'company': 'Moyo Solar'}},
+            ]},
+        )
+        second = FlowStep.objects.create(
+            flow=flow, name='set_notes', step_type='action',
+            config={'actions_to_run': [
+                {'action_type': 'update_customer_profile',
+                 'fields_to_update': {'notes': '{{ contact.name }} of {{ customer_profile.company }}'}},
+            ]},
+        )
+        done = FlowStep.objects.create(flow=flow, name='done', step_type='end_flow', config={})
+        FlowTransition.objects.create(current_step=first, next_step=second, priority=1, condition_config={'type': 'always_true'})
+        FlowTransition.objects.create(current_step=second, next_step=done, priority=1, condition_config={'type': 'always_true'})
+        invalidate_flow_graph()
+
+        process_message_for_flow(self.contact, {'type': 'text', 'text': {'body': 'bufferme'}}, None)
+
+        profile = CustomerProfile.objects.get(contact=self.contact)
+        self.assertEqual(profile.company, 'Moyo Solar')
+        self.assertEqual(profile.notes, 'Farai Moyo of Moyo Solar')
+        self.assertEqual(Contact.objects.get(pk=self.contact.pk).name, 'Farai Moyo')
+        self.assertFalse(ContactFlowState.objects.filter(contact=self.contact).exists())
+
+
+class RenderContextTestCase(TestCase):
+    """Tests for the lazy render context of flow templates (flows/render_context.py)."""
+
+    def setUp(self):
+        self.contact = Contact.objects.bulk_create([Contact(whatsapp_id='263774000010', name='Chipo')])[0]
+
+    def test_one_context_per_flow_context_and_no_profile_query_unless_used(self):
+        from flows import render_context
+        from flows.services import _resolve_value
+
+        flow_context = {'order_number': 'ORD-1', 'items': [{'name': 'Panel'}, {'name': 'Inverter'}]}
+        config = {
+            'body': {'text': 'Order {{ order_number }} for {{ contact.name }}'},
+            'rows': [{'title': '{{ item }}', 'id': 'row_{{ loop_index }}'} for _ in range(10)],
+            'footer': '{% for item in items %}{{ item.name }} {% endfor %}',
+        }
+
+        with patch.object(render_context, 'RenderContext', wraps=render_context.RenderContext) as context_class:
+            with self.assertNumQueries(0):
+                resolved = _resolve_value(config, flow_context, self.contact)
+                _resolve_value('{{ order_number }}', flow_context, self.contact)
+
+        self.assertEqual(context_class.call_count, 1)
+        self.assertEqual(resolved['body']['text'], 'Order ORD-1 for Chipo')
+        self.assertEqual(resolved['footer'], 'Panel Inverter ')
+
+    def test_customer_profile_is_loaded_once_and_context_lookups_are_live(self):
+        from flows.services import _resolve_value
+
+        CustomerProfile.objects.create(contact=self.contact, company='Chipo Farms')
+        contact = Contact.objects.get(pk=self.contact.pk)
+        flow_context = {}
+        with self.assertNumQueries(1):
+            first = _resolve_value(['{{ customer_profile.company }}', '{{ customer_profile.company }}'], flow_context, contact)
+        self.assertEqual(first, ['Chipo Farms', 'Chipo Farms'])
+
+        flow_context['quote'] = 'Q-7'
+        self.assertEqual(_resolve_value('{{ quote }} {{ now().year > 2000 }}', flow_context, contact), 'Q-7 True')
+
+
+class AISessionTestCase(TestCase):
+    """Tests for the cached Gemini chat history per contact (flows/ai_sessions.py)."""
+
+    def setUp(self):
+        self.redis = _FakeRedis()
+        patcher = patch('flows.ai_sessions.get_redis_client', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.contact = Contact.objects.bulk_create([Contact(whatsapp_id='263774000011', name='Farai')])[0]
+        self.start = timezone.now()
+
+    def _messages(self, *texts, offset=0):
+        from conversations.models import Message
+
+        return Message.objects.bulk_create([
+            Message(contact=self.contact, direction='in' if (offset + i) % 2 == 0 else 'out', content_payload={},
+                    text_content=text, timestamp=self.start + timedelta(seconds=offset + i))
+            for i, text in enumerate(texts)
+        ])
+
+    def test_only_new_messages_are_appended(self):
+        from flows.ai_sessions import get_ai_session
+
+        first, _, incoming = self._messages('I need panels', 'Which size?', '5kW')
+        session = get_ai_session(self.contact, incoming, 'ai_shopping')
+        self.assertEqual(session.recent_texts(5), ['Which size?', 'I need panels'])
+
+        reply, next_incoming = self._messages('Here are 5kW kits', 'menu', offset=3)
+        with self.assertNumQueries(1):
+            session = get_ai_session(self.contact, next_incoming, 'ai_shopping')
+
+        history = session.gemini_history('PROMPT', 'ACK')
+        self.assertEqual([turn['parts'][0]['text'] for turn in history],
+                         ['PROMPT', 'ACK', 'I need panels', 'Which size?', '5kW', 'Here are 5kW kits'])
+        self.assertEqual(session.watermark, reply.timestamp)
+
+    @override_settings(AI_SESSION_TOKEN_BUDGET=30, AI_SESSION_SUMMARY_MAX_CHARS=4000)
+    def test_turns_over_budget_are_rolled_into_the_summary(self):
+        from flows.ai_sessions import get_ai_session
+
+        *_, incoming = self._messages('x' * 60, 'y' * 60, 'z' * 60, 'next')
+        session = get_ai_session(self.contact, incoming, 'ai_troubleshooting')
+
+        self.assertEqual([turn['parts'][0]['text'] for turn in session.turns], ['z' * 60])
+        self.assertIn('- Customer: ' + 'x' * 60, session.summary)
+        self.assertIn('- Assistant: ' + 'y' * 60, session.summary)
+        self.assertIn(session.summary, session.gemini_history('PROMPT', 'ACK')[0]['parts'][0]['text'])
+
+    def test_without_redis_history_is_built_from_recent_messages(self):
+        from flows.ai_sessions import get_ai_session
+
+        *_, incoming = self._messages('hello', 'hi there', 'panels?')
+        with patch('flows.ai_sessions.get_redis_client', return_value=None):
+            session = get_ai_session(self.contact, incoming, 'ai_shopping')
+
+        self.assertEqual(session.recent_texts(5), ['hi there', 'hello'])
+        self.assertEqual(self.redis.values, {})
@@ -0,0 +1,266 @@
+# whatsappcrm_backend/flows/transition_conditions.py
+
+"""
+Compiled FlowTransition conditions.
+
+Every `FlowTransition.condition_config` is compiled once into a predicate
+closure: the condition type is dispatched, keywords are normalised, regexes
+are compiled and field paths are split when the transition is compiled (for
+the flow graph's transitions, when the graph is built), not on every
+evaluation.
+
+The incoming message is parsed once into a MessageView (text, interactive
+reply id, parsed nfm_reply response_json) that is shared by all transitions
+evaluated for that message, so evaluating N transitions parses it once.
+
+A predicate is called as `predicate(view, contact, flow_context)` and returns
+a bool. The condition semantics are those `_evaluate_transition_condition` in
+services.py has always had.
+"""
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HUMAN_REQUEST_KEYWORDS = ['help', 'support', 'agent', 'human', 'operator']
+
+
+class MessageView:
+    """The parts of an incoming message that transition conditions look at, parsed once."""
+    __slots__ = ('message_type', 'user_text', 'interactive_reply_id', 'nfm_response_data')
+
+    def __init__(self, message_data: dict):
+        message_data = message_data or {}
+        self.message_type = message_data.get('type')
+        self.user_text = ""
+        self.interactive_reply_id = None
+        self.nfm_response_data = None
+
+        if self.message_type == 'text' and isinstance(message_data.get('text'), dict):
+            self.user_text = (message_data['text'].get('body') or '').strip()
+
+        if self.message_type == 'interactive' and isinstance(message_data.get('interactive'), dict):
+            interactive_payload = message_data['interactive']
+            interactive_type = interactive_payload.get('type')
+            if interactive_type == 'button_reply' and isinstance(interactive_payload.get('button_reply'), dict):
+                self.interactive_reply_id = interactive_payload['button_reply'].get('id')
+            elif interactive_type == 'list_reply' and isinstance(interactive_payload.get('list_reply'), dict):
+                self.interactive_reply_id = interactive_payload['list_reply'].get('id')
+            elif interactive_type == 'nfm_reply' and isinstance(interactive_payload.get('nfm_reply'), dict):
+                response_json_str = interactive_payload['nfm_reply'].get('response_json')
+                if response_json_str:
+                    try:
+                        self.nfm_response_data = json.loads(response_json_str)
+                    except json.JSONDecodeError:
+                        logger.warning("Could not parse nfm_reply response_json for transition evaluation.")
+
+
+def _never(view, contact, flow_context):
+    return False
+
+
+def _always(view, contact, flow_context):
+    return True
+
+
+def compile_condition(transition):
+    """Compiles `transition.condition_config` into a predicate(view, contact, flow_context) -> bool."""
+    # services imports this module; import lazily to keep the dependency one-way at load time.
+    from .services import _get_value_from_context_or_contact, _resolve_value
+
+    config = transition.condition_config
+    if not isinstance(config, dict):
+        logger.warning(f"Transition {transition.id} has invalid condition_config (not a dict): {config}")
+        return _never
+    condition_type = config.get('type')
+    if not condition_type:
+        return _never  # No condition type means no specific condition to evaluate beyond default
+    if condition_type == 'always_true':
+        return _always
+
+    value_for_condition = config.get('value')  # Expected value for comparison
+
+    if condition_type == 'whatsapp_flow_response_received':
+        # By default, look for 'whatsapp_flow_response_received' in context, or allow config to specify variable name
+        variable_name = config.get('variable_name', 'whatsapp_flow_response_received')
+
+        def predicate(view, contact, flow_context):
+            actual_value = _get_value_from_context_or_contact(variable_name, flow_context, contact)
+            result = bool(actual_value)
+            logger.debug(
+                f"Contact {contact.id}, Transition {transition.id}: "
+                f"Condition 'whatsapp_flow_response_received' check for '{variable_name}'. "
+                f"Value: '{actual_value}' (type: {type(actual_value).__name__}). Result: {result}"
+            )
+            return result
+        return predicate
+
+    if condition_type in ('user_reply_matches_keyword', 'user_reply_contains_keyword'):
+        keyword = str(config.get('keyword', '')).strip()
+        if not keyword:
+            return _never  # Cannot match empty keyword
+        case_sensitive = config.get('case_sensitive', False)
+        keyword = keyword if case_sensitive else keyword.lower()
+        if condition_type == 'user_reply_matches_keyword':
+            if case_sensitive:
+                return lambda view, contact, flow_context: keyword == view.user_text
+            return lambda view, contact, flow_context: keyword == view.user_text.lower()
+        if case_sensitive:
+            return lambda view, contact, flow_context: keyword in view.user_text
+        return lambda view, contact, flow_context: keyword in view.user_text.lower()
+
+    if condition_type == 'interactive_reply_id_equals':
+        expected_id = str(value_for_condition)
+        return lambda view, contact, flow_context: (
+            view.interactive_reply_id is not None and view.interactive_reply_id == expected_id
+        )
+
+    if condition_type == 'message_type_is':
+        expected_type = str(value_for_condition)
+        return lambda view, contact, flow_context: view.message_type == expected_type
+
+    if condition_type == 'user_reply_matches_regex':
+        regex = config.get('regex')
+        if not regex:
+            return _never
+        try:
+            pattern = re.compile(regex)
+        except re.error as e:
+            logger.error(f"Invalid regex in transition {transition.id}: {regex}. Error: {e}")
+            return _never
+        return lambda view, contact, flow_context: bool(view.user_text) and bool(pattern.match(view.user_text))
+
+    if condition_type == 'variable_equals':
+        variable_name = config.get('variable_name')
+        if variable_name is None:
+            return _never
+        expected_str = str(value_for_condition)
+        # If the expected value is an empty string, also treat None as a match.
+        # This makes the condition more intuitive for checking "is empty or not set".
+        none_matches = value_for_condition == ""
+
+        def predicate(view, contact, flow_context):
+            actual_value = _get_value_from_context_or_contact(variable_name, flow_context, contact)
+            result = True if (none_matches and actual_value is None) else str(actual_value) == expected_str
+            logger.debug(
+                f"Contact {contact.id}, Transition {transition.id}: "
+                f"Condition 'variable_equals' check for '{variable_name}'. "
+                f"Actual: '{actual_value}' (type: {type(actual_value).__name__}), "
+                f"Expected: '{value_for_condition}' (type: {type(value_for_condition).__name__}). "
+                f"Result: {result}"
+            )
+            return result
+        return predicate
+
+    if condition_type == 'variable_exists':
+        variable_name_template = config.get('variable_name')
+        if variable_name_template is None:
+            return _never
+
+        def predicate(view, contact, flow_context):
+            # Resolve the variable name itself as a template to handle dynamic paths like 'list.{{ index }}'
+            resolved_variable_path = _resolve_value(variable_name_template, flow_context, contact)
+            actual_value = _get_value_from_context_or_contact(resolved_variable_path, flow_context, contact)
+            result = actual_value is not None
+            logger.debug(
+                f"Contact {contact.id}, Transition {transition.id}: "
+                f"Condition 'variable_exists' check for '{resolved_variable_path}'. "
+                f"Value: '{str(actual_value)[:100]}' (type: {type(actual_value).__name__}). Result: {result}"
+            )
+            return result
+        return predicate
+
+    if condition_type == 'variable_contains':
+        variable_name = config.get('variable_name')
+        if variable_name is None:
+            return _never
+        expected_item = value_for_condition
+
+        def predicate(view, contact, flow_context):
+            actual_value = _get_value_from_context_or_contact(variable_name, flow_context, contact)
+            result = False
+            if isinstance(actual_value, str) and isinstance(expected_item, str):
+                result = expected_item in actual_value
+            elif isinstance(actual_value, list) and expected_item is not None:
+                result = expected_item in actual_value
+            logger.debug(
+                f"Contact {contact.id}, Transition {transition.id}: "
+                f"Condition 'variable_contains' check for '{variable_name}'. "
+                f"Container: '{str(actual_value)[:100]}' (type: {type(actual_value).__name__}), "
+                f"Expected item: '{expected_item}'. Result: {result}"
+            )
+            return result
+        return predicate
+
+    if condition_type == 'nfm_response_field_equals':
+        field_path = config.get('field_path')
+        if not field_path:
+            return _never
+        parts = field_path.split('.')
+
+        def predicate(view, contact, flow_context):
+            actual_value = view.nfm_response_data
+            if not actual_value:
+                return False
+            for part in parts:
+                if not isinstance(actual_value, dict):
+                    return value_for_condition is None
+                actual_value = actual_value.get(part)
+            return actual_value == value_for_condition
+        return predicate
+
+    if condition_type == 'question_reply_is_valid':
+        # A question step saves a valid reply to its variable; if `value` is True the
+        # condition checks the variable was set, otherwise that it was not.
+        def predicate(view, contact, flow_context):
+            question_expectation = flow_context.get('_question_awaiting_reply_for')
+            if question_expectation and isinstance(question_expectation, dict):
+                is_var_set = question_expectation.get('variable_name') in flow_context
+                return is_var_set if value_for_condition is True else not is_var_set
+            return False  # No question was being awaited or config mismatch
+        return predicate
+
+    if condition_type == 'user_requests_human':
+        human_request_keywords = config.get('keywords', DEFAULT_HUMAN_REQUEST_KEYWORDS)
+        if not isinstance(human_request_keywords, list):
+            return _never
+        keywords = [
+            (keyword, keyword.strip().lower()) for keyword in human_request_keywords
+            if isinstance(keyword, str) and keyword.strip()
+        ]
+
+        def predicate(view, contact, flow_context):
+            if not view.user_text:
+                return False
+            user_text_lower = view.user_text.lower()
+            for keyword, keyword_lower in keywords:
+                if keyword_lower in user_text_lower:
+                    logger.info(f"User requested human agent with keyword: '{keyword}'")
+                    return True
+            return False
+        return predicate
+
+    if condition_type == 'contact_is_admin':
+        # A custom security check for admin flows: the contact must be linked to an active staff user.
+        def predicate(view, contact, flow_context):
+            result = hasattr(contact, 'user') and contact.user is not None and contact.user.is_staff and contact.user.is_active
+            logger.info(f"Condition 'contact_is_admin' check for contact {contact.id}. Linked staff user: {result}. Result: {result}")
+            return result
+        return predicate
+
+    logger.warning(f"Unknown or unhandled condition type: '{condition_type}' for transition {transition.id}.")
+    return _never
+
+
+def get_condition_predicate(transition):
+    """
+    Returns the compiled predicate of `transition`, compiling it on first use.
+    Cached on the instance and recompiled if `condition_config` is replaced.
+    """
+    cached = transition.__dict__.get('_condition_predicate')
+    if cached is not None and cached[0] is transition.condition_config:
+        return cached[1]
+    predicate = compile_condition(transition)
+    transition._condition_predicate = (transition.condition_config, predicate)
+    return predicate
@@ -0,0 +1,146 @@
+# whatsappcrm_backend/flows/trigger_index.py
+
+"""
+Keyword index used to start flows from an incoming message.
+
+A flow is triggered when one of its `trigger_keywords` occurs anywhere in the
+lowercased message text. Instead of testing every keyword of every active flow
+with `in`, all keywords are compiled into one Aho-Corasick automaton, so a
+message is matched against every keyword in a single pass over its text.
+
+When several flows match, the flow that comes first in name order wins, which
+is the order flows were tried in before; within that flow, the keyword listed
+first is reported. Each flow's `trigger_config.extraction_regex` is compiled
+with the index.
+
+A TriggerIndex is built from the active flows of a FlowGraph (see
+flow_graph.py) and is rebuilt with it when flow definitions change.
+"""
+import logging
+import re
+from collections import deque
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _KeywordAutomaton:
+    """Aho-Corasick automaton over lowercase keywords; each keyword carries a value."""
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for keyword, value in keywords:
+            state = 0
+            for char in keyword:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                state = next_state
+            self.output[state].append(value)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def iter_matches(self, text: str):
+        """Yields the value of every keyword occurrence in `text`."""
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                yield from output[state]
+
+
+class TriggerMatch:
+    __slots__ = ('compiled_flow', 'keyword', 'initial_context')
+
+    def __init__(self, compiled_flow, keyword: str, initial_context: dict):
+        self.compiled_flow = compiled_flow
+        self.keyword = keyword
+        self.initial_context = initial_context
+
+
+class TriggerIndex:
+    """All trigger keywords of a set of active flows, matched in one pass."""
+
+    def __init__(self, active_flows):
+        # `active_flows` is a sequence of CompiledFlow in priority (name) order.
+        self.flows = tuple(active_flows)
+        self.extraction = {}
+        keywords = []
+        # Blank keywords are rejected by Flow.clean(), but `'' in text` is always
+        # true, so a flow saved with one matches any text, as it did before.
+        self.always_match = None
+        for priority, compiled_flow in enumerate(self.flows):
+            flow = compiled_flow.flow
+            if isinstance(flow.trigger_keywords, list):
+                for keyword_index, keyword in enumerate(flow.trigger_keywords):
+                    if not isinstance(keyword, str):
+                        continue
+                    pattern = keyword.strip().lower()
+                    if pattern:
+                        keywords.append((pattern, (priority, keyword_index, keyword)))
+                    elif self.always_match is None or (priority, keyword_index) < self.always_match[:2]:
+                        self.always_match = (priority, keyword_index, keyword)
+            self.extraction[priority] = self._compile_extraction(flow)
+        self.automaton = _KeywordAutomaton(keywords)
+
+    @staticmethod
+    def _compile_extraction(flow):
+        trigger_conf = flow.trigger_config if isinstance(flow.trigger_config, dict) else {}
+        extraction_regex = trigger_conf.get("extraction_regex")
+        context_var_name = trigger_conf.get("context_variable")
+        if not (extraction_regex and context_var_name):
+            return None
+        try:
+            return re.compile(extraction_regex), context_var_name
+        except re.error as e:
+            logger.error(f"Invalid extraction_regex for flow '{flow.name}': {e}")
+            return None
+
+    def match(self, message_text: str) -> Optional[TriggerMatch]:
+        """
+        Returns the flow triggered by `message_text` (original case, used for
+        extraction), or None if no keyword occurs in it.
+        """
+        best = self.always_match
+        for candidate in self.automaton.iter_matches(message_text.lower()):
+            if best is None or candidate[:2] < best[:2]:
+                best = candidate
+                if candidate[:2] == (0, 0):
+                    break
+        if best is None:
+            return None
+
+        priority, _, keyword = best
+        compiled_flow = self.flows[priority]
+        initial_context = {}
+        extraction = self.extraction[priority]
+        if extraction:
+            regex, context_var_name = extraction
+            match = regex.search(message_text)
+            if match and match.groups():
+                extracted_data = match.group(1)  # Use the first capturing group
+                if extracted_data is not None:
+                    initial_context[context_var_name] = extracted_data.strip()
+                    logger.info(
+                        f"Extracted '{extracted_data.strip()}' into '{context_var_name}' "
+                        f"from trigger for flow '{compiled_flow.flow.name}'."
+                    )
+        return TriggerMatch(compiled_flow, keyword, initial_context)
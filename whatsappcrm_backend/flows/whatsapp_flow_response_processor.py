@@ -49,8 +49,8 @@ class WhatsAppFlowResponseProcessor:
             logger.info(f"Saved WhatsAppFlowResponse for contact {contact.id} and flow {whatsapp_flow.name}.")
 
             # Update the flow context for the contact (if in a flow)
-            from .models import ContactFlowState
-            flow_state = ContactFlowState.objects.select_for_update().filter(contact=contact).first()
+            from .flow_state_store import load_flow_state, save_flow_state
+            flow_state = load_flow_state(contact, for_update=True)
             
             if not flow_state:
                 logger.warning(f"No active flow state for contact {contact.id} when processing WhatsApp flow response.")
@@ -72,7 +72,7 @@ class WhatsAppFlowResponseProcessor:
             # Update the flow state with the new context
             flow_state.flow_context_data = context
             flow_state.last_updated_at = timezone.now()
-            flow_state.save(update_fields=["flow_context_data", "last_updated_at"])
+            save_flow_state(flow_state, update_fields=["flow_context_data", "last_updated_at"])
             
             logger.info(
                 f"Successfully updated flow context for contact {contact.id} with WhatsApp flow data. "
@@ -0,0 +1,233 @@
+# whatsappcrm_backend/flows/write_buffer.py
+
+"""
+Unit of work for the writes of one process_message_for_flow call.
+
+A message can fall through a chain of steps, each of which updates contact
+fields (`update_contact_field`), the customer profile
+(`update_customer_profile`), creates rows (`create_model_instance`) and saves
+the ContactFlowState again. While a buffer is active those writes are
+collected instead of being issued one by one:
+
+  * save_fields(instance, fields) merges the fields to update per row; the
+    row is written once with the union as `update_fields`.
+  * add_instance(instance) queues a new row; rows are written with one
+    bulk_create per model. pre_save/post_save are sent for them as save()
+    would. Models that override save() are saved right away.
+  * save_flow_state() (flow_state_store.py) keeps the latest state per
+    contact; clearing the contact's state drops it.
+
+The engine keeps working on the same in-memory instances, and
+load_flow_state() returns a contact's pending state, so later steps of the
+cycle read their own writes. Actions that read from the database
+(`query_model`, FlowActionRegistry actions) flush the buffer first. The
+buffer is flushed when the message is done, inside its transaction; if
+processing raises, it is dropped with the rolled back transaction. Outside a
+buffer every call writes right away.
+
+Each write is flushed in its own savepoint. A write that fails is rolled back
+and logged under the action that queued it (the `action` argument), and the
+other writes and the message's replies go through. A merged row update or a
+bulk insert that fails is retried per action or per row, so only the failing
+action's fields or the failing row are lost.
+"""
+import functools
+import logging
+import threading
+
+from django.db import models, router, transaction
+from django.db.models.signals import pre_save, post_save
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def _write_in_savepoint(action: str, write, using=None) -> bool:
+    """Runs `write` in a savepoint. Returns False, after logging the error under `action`, if it failed."""
+    try:
+        with transaction.atomic(using=using):
+            write()
+    except Exception as e:
+        logger.error(f"{action} failed with error: {e}", exc_info=True)
+        return False
+    return True
+
+
+def _save_update(instance: models.Model, fields_by_action: dict):
+    """Writes the fields queued for a row at once, or action by action if that fails."""
+    using = router.db_for_write(type(instance), instance=instance)
+    if len(fields_by_action) > 1:
+        try:
+            with transaction.atomic(using=using):
+                instance.save(update_fields=sorted(set().union(*fields_by_action.values())))
+            return
+        except Exception:
+            pass  # Retried per action below, so only the failing action's fields are lost.
+    for action, fields in fields_by_action.items():
+        _write_in_savepoint(action, lambda: instance.save(update_fields=sorted(fields)), using=using)
+
+
+def _insert(model, queued: list, using) -> list:
+    """Inserts the queued (instance, action) pairs with one bulk_create, or row by row if that fails. Returns the inserted instances."""
+    instances = [instance for instance, _ in queued]
+    if len(queued) > 1:
+        try:
+            with transaction.atomic(using=using):
+                model.objects.bulk_create(instances)
+            return instances
+        except Exception:
+            pass  # Retried per row below, so only the failing rows are lost.
+    return [
+        instance for instance, action in queued
+        if _write_in_savepoint(action, lambda: model.objects.bulk_create([instance]), using=using)
+    ]
+
+
+class FlowWriteBuffer:
+    def __init__(self):
+        self.updates = {}  # (model label, pk) -> (instance, {action: set of field names})
+        self.creates = {}  # model class -> [(unsaved instance, action)]
+        self.states = {}  # contact id -> (state, update_fields or None for all fields)
+        self.instances = {}  # lookups memoized for the cycle, e.g. ('customer_profile', contact id)
+
+    def flush(self):
+        from .flow_state_store import write_flow_state  # flow_state_store imports this module
+
+        updates, self.updates = self.updates, {}
+        for instance, fields_by_action in updates.values():
+            _save_update(instance, fields_by_action)
+
+        creates, self.creates = self.creates, {}
+        for model, queued in creates.items():
+            using = router.db_for_write(model)
+            for instance, _ in queued:
+                pre_save.send(sender=model, instance=instance, raw=False, using=using, update_fields=None)
+            for instance in _insert(model, queued, using):
+                post_save.send(sender=model, instance=instance, created=True, raw=False, using=using, update_fields=None)
+
+        states, self.states = self.states, {}
+        for contact_id, (state, update_fields) in states.items():
+            _write_in_savepoint(
+                f"Contact {contact_id}: saving the flow state",
+                lambda: write_flow_state(state, update_fields=update_fields),
+            )
+        # From here on the database is the source of truth again.
+        self.instances.clear()
+
+        if updates or creates or states:
+            logger.debug(
+                f"Flushed flow writes: {len(updates)} update(s), "
+                f"{sum(len(instances) for instances in creates.values())} insert(s), {len(states)} flow state(s)."
+            )
+
+
+def current_write_buffer():
+    return getattr(_local, 'buffer', None)
+
+
+def buffer_flow_writes(func):
+    """Decorates process_message_for_flow to collect its writes and flush them when it returns."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if current_write_buffer() is not None:
+            return func(*args, **kwargs)
+        buffer = FlowWriteBuffer()
+        _local.buffer = buffer
+        try:
+            result = func(*args, **kwargs)
+            buffer.flush()
+            return result
+        finally:
+            _local.buffer = None
+    return wrapper
+
+
+def flush_writes():
+    """Writes everything buffered so far, before something reads it back from the database."""
+    buffer = current_write_buffer()
+    if buffer is not None:
+        buffer.flush()
+
+
+def save_fields(instance: models.Model, update_fields: list, action: str = None):
+    """
+    `instance.save(update_fields=update_fields)`, merged with the instance's other
+    pending updates. `action` names the queuing action in the log if the write fails.
+    """
+    buffer = current_write_buffer()
+    if buffer is None or instance.pk is None:
+        instance.save(update_fields=update_fields)
+        return
+    action = action or f"Update of {instance._meta.label} {instance.pk}"
+    # Convert the values now, so bad values still fail in the action that set them.
+    for field_name in update_fields:
+        field = instance._meta.get_field(field_name)
+        field.get_prep_value(getattr(instance, field.attname))
+    key = (instance._meta.label_lower, instance.pk)
+    pending = buffer.updates.get(key)
+    if pending is None:
+        buffer.updates[key] = (instance, {action: set(update_fields)})
+    elif pending[0] is instance:
+        pending[1].setdefault(action, set()).update(update_fields)
+    else:
+        # Another in-memory copy of the row: write the older one so neither loses its values.
+        _save_update(*buffer.updates.pop(key))
+        buffer.updates[key] = (instance, {action: set(update_fields)})
+
+
+def add_instance(instance: models.Model, action: str = None) -> bool:
+    """
+    Inserts a new, unsaved instance. Returns True if the insert was buffered (the
+    instance has no pk until the flush), False if it was saved right away.
+    `action` names the queuing action in the log if the insert fails.
+    """
+    buffer = current_write_buffer()
+    if buffer is None or type(instance).save is not models.Model.save:
+        instance.save(force_insert=True)
+        return False
+    action = action or f"Insert of a {instance._meta.label}"
+    buffer.creates.setdefault(type(instance), []).append((instance, action))
+    return True
+
+
+def buffer_flow_state(state, update_fields) -> bool:
+    """Keeps `state` as the contact's pending state. Returns False if no buffer is active."""
+    buffer = current_write_buffer()
+    if buffer is None:
+        return False
+    pending = buffer.states.get(state.contact_id)
+    if pending is not None:
+        if pending[0] is not state or pending[1] is None or update_fields is None:
+            # A full save is pending, or this is another instance of the state: write it whole.
+            update_fields = None
+        else:
+            update_fields = sorted(set(pending[1]) | set(update_fields))
+    buffer.states[state.contact_id] = (state, update_fields)
+    return True
+
+
+def pending_flow_state(contact_id):
+    buffer = current_write_buffer()
+    if buffer is None:
+        return None
+    pending = buffer.states.get(contact_id)
+    return pending[0] if pending is not None else None
+
+
+def discard_flow_state(contact_id):
+    buffer = current_write_buffer()
+    if buffer is not None:
+        buffer.states.pop(contact_id, None)
+
+
+def memoized_instance(key):
+    """Returns an instance remembered for `key` in this cycle, or None."""
+    buffer = current_write_buffer()
+    return buffer.instances.get(key) if buffer is not None else None
+
+
+def remember_instance(key, instance):
+    buffer = current_write_buffer()
+    if buffer is not None:
+        buffer.instances[key] = instance
@@ -3,6 +3,8 @@ import requests
 import logging
 import os # For os.path.basename
 
+from meta_integration.graph_client import get_graph_client
+
 logger = logging.getLogger(__name__)
 
 def actual_upload_to_whatsapp_api(
@@ -38,7 +40,7 @@ def actual_upload_to_whatsapp_api(
                 f"[WhatsApp API Upload] Attempting to upload {file_path} (type: {mime_type}) "
                 f"to WhatsApp for Phone ID {phone_number_id} using API {api_version}."
             )
-            response = requests.post(url, headers=headers, files=files_payload, timeout=60) # 60-second timeout
+            response = get_graph_client().post(url, endpoint='media_upload', headers=headers, files=files_payload, timeout=60) # 60-second timeout
 
         response.raise_for_status()  # Raises an HTTPError for bad responses (4XX or 5XX)
         
@@ -1,7 +1,7 @@
 # whatsappcrm_backend/meta_integration/admin.py
 
 from django.contrib import admin
-from .models import MetaAppConfig, WebhookEventLog
+from .models import MetaAppConfig, WebhookEventLog, WebhookInboxEntry
 
 @admin.register(MetaAppConfig)
 class MetaAppConfigAdmin(admin.ModelAdmin):
@@ -55,3 +55,13 @@ class WebhookEventLogAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         # Optimize query by prefetching related MetaAppConfig
         return super().get_queryset(request).select_related('app_config', 'message')
+
+
+@admin.register(WebhookInboxEntry)
+class WebhookInboxEntryAdmin(admin.ModelAdmin):
+    list_display = ('id', 'app_config', 'received_at', 'processed_at', 'attempts')
+    list_filter = ('app_config', 'received_at', 'processed_at')
+    search_fields = ('body', 'last_error')
+    readonly_fields = ('app_config', 'body', 'received_at', 'processed_at', 'claimed_at', 'attempts', 'last_error')
+    date_hierarchy = 'received_at'
+    list_per_page = 25
@@ -0,0 +1,118 @@
+# whatsappcrm_backend/meta_integration/bulk_sender.py
+
+"""
+Bulk sender for broadcast template messages.
+
+`send_message_batch` sends a batch of already-created, pre-rendered messages
+from one task: the messages and their contacts are loaded with one query, up
+to BROADCAST_BULK_SEND_CONCURRENCY requests are in flight at once over the
+pooled GraphApiClient session, every request takes a token from the per-number
+send throttle, and wamids/statuses are written back with a single bulk_update.
+
+The messaging worker runs gevent, so the worker threads below are greenlets
+sharing the pooled keep-alive connections; this replaces an asyncio/httpx event
+loop, which would not mix with the gevent pool.
+
+Messages whose failure is safe to retry (graph_retry_delay: a rate limit, or a
+connection that was never established) are handed to `send_whatsapp_message_task`
+after the suggested delay, which retries them individually. Permanent failures are marked failed without the per-message
+admin notification, which would flood admins during a large broadcast.
+
+The batch claims its messages ('pending_dispatch' -> 'queued') before sending,
+like the per-message task, so a message queued twice is sent once.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.utils import timezone
+
+from conversations.models import Message
+from .throttle import acquire_send_token
+from .utils import send_whatsapp_message
+
+logger = logging.getLogger(__name__)
+
+
+def _send_one(message, config):
+    """
+    Sends one message of the batch. Any exception becomes that message's failure
+    response, so one bad message can't stop the batch from recording the others.
+    """
+    try:
+        # Wait as long as it takes: the batch owns its slot on the worker.
+        acquire_send_token(config.phone_number_id, message.contact.whatsapp_id, max_wait=float('inf'))
+        return send_whatsapp_message(
+            to_phone_number=message.contact.whatsapp_id,
+            message_type=message.message_type,
+            data=message.content_payload,
+            config=config,
+        )
+    except Exception as e:
+        logger.error(f"Bulk sender: unexpected error sending message {message.id}: {e}", exc_info=True)
+        return {'error': str(e), 'error_type': type(e).__name__}
+
+
+def _retry_after(api_response):
+    """The Graph client's retry delay for a failed send, or None if it must not be retried."""
+    if not isinstance(api_response, dict):
+        return None
+    return api_response.get('retry_after')
+
+
+def send_message_batch(message_ids: list, config, concurrency: int = None) -> dict:
+    """
+    Claims and sends the 'pending_dispatch' messages among `message_ids` using `config`.
+    Returns a dict of counts: sent, failed and requeued.
+    """
+    from .tasks import send_whatsapp_message_task
+
+    concurrency = concurrency or settings.BROADCAST_BULK_SEND_CONCURRENCY
+    # Claim the batch's pending messages; the claim time tells them apart from
+    # messages another task claimed, which are left to that task.
+    claimed_at = timezone.now()
+    Message.objects.filter(id__in=message_ids, direction='out', status='pending_dispatch').update(
+        status='queued', status_timestamp=claimed_at
+    )
+    messages = list(
+        Message.objects.select_related('contact')
+        .filter(id__in=message_ids, status='queued', status_timestamp=claimed_at)
+    )
+    if not messages:
+        return {'sent': 0, 'failed': 0, 'requeued': 0}
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(messages))) as executor:
+        responses = list(executor.map(lambda message: _send_one(message, config), messages))
+
+    now = timezone.now()
+    to_update, requeue = [], []
+    for message, api_response in zip(messages, responses):
+        if api_response and api_response.get('messages') and api_response['messages'][0].get('id'):
+            message.wamid = api_response['messages'][0]['id']
+            message.status = 'sent'
+            message.error_details = None
+        elif _retry_after(api_response) is not None:
+            requeue.append((message.id, _retry_after(api_response)))
+            continue
+        else:
+            message.status = 'failed'
+            message.error_details = api_response or {'error': 'Meta API call failed or returned unexpected response.'}
+        message.status_timestamp = now
+        to_update.append(message)
+
+    Message.objects.bulk_update(to_update, ['wamid', 'status', 'error_details', 'status_timestamp'])
+    if requeue:
+        # Released, so the per-message task can claim them again.
+        Message.objects.filter(id__in=[message_id for message_id, _ in requeue], status='queued').update(
+            status='pending_dispatch'
+        )
+    for message_id, countdown in requeue:
+        send_whatsapp_message_task.apply_async(args=[message_id, config.id], countdown=countdown)
+
+    totals = {
+        'sent': sum(1 for message in to_update if message.status == 'sent'),
+        'failed': sum(1 for message in to_update if message.status == 'failed'),
+        'requeued': len(requeue),
+    }
+    logger.info(f"Bulk sender: batch of {len(messages)} message(s) via {config.phone_number_id}: {totals}")
+    return totals
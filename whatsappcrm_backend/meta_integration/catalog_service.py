@@ -60,6 +60,7 @@ import logging
 import json
 from django.conf import settings
 from .models import MetaAppConfig
+from .graph_client import get_graph_client
 from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
@@ -246,7 +247,7 @@ class MetaCatalogService:
         logger.info(f"Creating product in Meta Catalog: {product.name} (SKU: {product.sku})")
         logger.debug(f"Payload: {json.dumps(data, indent=2)}")
         
-        response = requests.post(url, headers=self._get_headers(), json=data, timeout=30)
+        response = get_graph_client().post(url, endpoint='catalog_products', headers=self._get_headers(), json=data, timeout=30)
         
         # Log the full response for debugging
         try:
@@ -329,7 +330,7 @@ class MetaCatalogService:
         logger.info(f"Updating product in Meta Catalog: {product.name} (Catalog ID: {product.whatsapp_catalog_id})")
         logger.debug(f"Payload: {json.dumps(data, indent=2)}")
         
-        response = requests.post(url, headers=self._get_headers(), json=data, timeout=30)
+        response = get_graph_client().post(url, endpoint='catalog_product', headers=self._get_headers(), json=data, timeout=30)
         
         # Log the full response for debugging
         try:
@@ -408,7 +409,7 @@ class MetaCatalogService:
         
         logger.info(f"Deleting product from Meta Catalog: {product.name} (Catalog ID: {product.whatsapp_catalog_id})")
         
-        response = requests.delete(url, headers=self._get_headers())
+        response = get_graph_client().delete(url, endpoint='catalog_product', headers=self._get_headers(), timeout=30)
         
         # Log the full response for debugging
         try:
@@ -480,7 +481,7 @@ class MetaCatalogService:
         )
         logger.debug(f"Payload: {json.dumps(data, indent=2)}")
         
-        response = requests.post(url, headers=self._get_headers(), json=data, timeout=30)
+        response = get_graph_client().post(url, endpoint='catalog_product', headers=self._get_headers(), json=data, timeout=30)
         
         try:
             response.raise_for_status()
@@ -556,7 +557,7 @@ class MetaCatalogService:
         logger.debug(f"Payload: {json.dumps(payload, indent=2)}")
         
         # Batch operations use a longer timeout (60s) to accommodate processing of multiple items
-        response = requests.post(url, headers=self._get_headers(), json=payload, timeout=60)
+        response = get_graph_client().post(url, endpoint='catalog_batch', headers=self._get_headers(), json=payload, timeout=60)
         
         try:
             response.raise_for_status()
@@ -599,7 +600,7 @@ class MetaCatalogService:
         
         logger.info(f"Fetching product from Meta Catalog: {product.name} (Catalog ID: {product.whatsapp_catalog_id})")
         
-        response = requests.get(url, headers=self._get_headers(), params=params, timeout=30)
+        response = get_graph_client().get(url, endpoint='catalog_product', headers=self._get_headers(), params=params, timeout=30)
         
         try:
             response.raise_for_status()
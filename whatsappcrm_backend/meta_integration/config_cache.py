@@ -0,0 +1,108 @@
+# whatsappcrm_backend/meta_integration/config_cache.py
+
+"""
+Process-local cache of MetaAppConfig rows.
+
+Every webhook, every outgoing message and most notification paths need a
+MetaAppConfig, and those rows almost never change. The whole table (a handful
+of rows) is loaded into a snapshot indexed by pk, phone_number_id and "active".
+The snapshot is served from process memory.
+
+Invalidation:
+  * post_save/post_delete on MetaAppConfig (see signals.py) drops the local
+    snapshot and bumps a shared Redis version key on commit.
+  * Other processes compare their snapshot's version with the Redis key at most
+    every META_CONFIG_CACHE_CHECK_SECONDS and reload when it moved.
+  * Without Redis, snapshots expire after META_CONFIG_CACHE_TTL_SECONDS.
+
+Lookups return copies, so callers can't mutate the shared snapshot.
+"""
+import copy
+import logging
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from whatsappcrm_backend.redis_client import bump_shared_version, read_shared_version
+from .models import MetaAppConfig
+
+logger = logging.getLogger(__name__)
+
+CONFIG_VERSION_KEY = 'meta:app_config:version'
+
+_snapshot = None
+
+
+class _ConfigSnapshot:
+    def __init__(self, configs, version):
+        self.by_pk = {config.pk: config for config in configs}
+        self.by_phone_number_id = {config.phone_number_id: config for config in configs}
+        self.active = [config for config in configs if config.is_active]
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.checked_at = self.loaded_at
+
+
+def _get_snapshot():
+    global _snapshot
+    snapshot = _snapshot
+    now = time.monotonic()
+    if snapshot is not None and now - snapshot.checked_at < settings.META_CONFIG_CACHE_CHECK_SECONDS:
+        return snapshot
+
+    shared_version = read_shared_version(CONFIG_VERSION_KEY)
+    if snapshot is not None:
+        if shared_version is not None and shared_version == snapshot.version:
+            snapshot.checked_at = now
+            return snapshot
+        if shared_version is None and now - snapshot.loaded_at < settings.META_CONFIG_CACHE_TTL_SECONDS:
+            snapshot.checked_at = now
+            return snapshot
+
+    snapshot = _ConfigSnapshot(list(MetaAppConfig.objects.all()), shared_version)
+    _snapshot = snapshot
+    logger.debug(f"Loaded {len(snapshot.by_pk)} MetaAppConfig(s) into the process cache (version {shared_version}).")
+    return snapshot
+
+
+def get_config_by_pk(pk) -> MetaAppConfig:
+    """Cached equivalent of `MetaAppConfig.objects.get(pk=pk)`."""
+    config = _get_snapshot().by_pk.get(int(pk))
+    if config is None:
+        raise MetaAppConfig.DoesNotExist(f"MetaAppConfig with pk {pk} does not exist.")
+    return copy.copy(config)
+
+
+def get_config_by_phone_number_id(phone_number_id) -> MetaAppConfig:
+    """Cached equivalent of `MetaAppConfig.objects.get(phone_number_id=phone_number_id)`."""
+    config = _get_snapshot().by_phone_number_id.get(str(phone_number_id))
+    if config is None:
+        raise MetaAppConfig.DoesNotExist(f"MetaAppConfig with phone_number_id {phone_number_id} does not exist.")
+    return copy.copy(config)
+
+
+def get_active_config() -> MetaAppConfig:
+    """Cached equivalent of `MetaAppConfig.objects.get(is_active=True)`."""
+    active = _get_snapshot().active
+    if not active:
+        raise MetaAppConfig.DoesNotExist("No active MetaAppConfig.")
+    if len(active) > 1:
+        raise MetaAppConfig.MultipleObjectsReturned("More than one MetaAppConfig is active.")
+    return copy.copy(active[0])
+
+
+def invalidate_config_cache():
+    """
+    Drops this process's snapshot right away and, once the surrounding transaction
+    commits, drops it again and bumps the shared version so other processes reload.
+    """
+    global _snapshot
+    _snapshot = None
+
+    def _on_commit():
+        global _snapshot
+        _snapshot = None
+        bump_shared_version(CONFIG_VERSION_KEY)
+
+    transaction.on_commit(_on_commit)
@@ -0,0 +1,185 @@
+# whatsappcrm_backend/meta_integration/graph_client.py
+
+"""
+Shared, pooled HTTP client for the Meta Graph API.
+
+Each worker process keeps one `requests.Session` with a keep-alive connection
+pool to graph.facebook.com, instead of opening a new TLS connection per call.
+Errors are classified by Meta error code:
+  * rate_limited - throughput/pair limits; nothing was sent, safe to retry later.
+  * transient    - Meta-side hiccups (5xx, codes 1/2/131000/131016/133004).
+  * auth         - expired or invalid token/permissions.
+  * permanent    - bad request or undeliverable; retrying cannot help.
+
+The client sends each request once and never sleeps. graph_retry_delay() says
+whether a failure is safe to retry and after how long, and the calling Celery
+task schedules the retry with that countdown. Safe failures are rate limits,
+connections that were never established (so nothing reached Meta), and any
+network or transient error on an idempotent (GET/DELETE) call. A POST that
+failed after its connection was established, e.g. a read timeout or a dropped
+connection, may already have been processed by Meta and is not retried.
+
+Every call records its latency in a per-endpoint histogram.
+"""
+import logging
+import os
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3 import exceptions as urllib3_exceptions
+
+from .metrics import GRAPH_API_LATENCY_SECONDS, GRAPH_API_RETRIES
+
+logger = logging.getLogger(__name__)
+
+GRAPH_API_BASE_URL = "https://graph.facebook.com"
+
+
+def graph_api_base_url() -> str:
+    """GRAPH_API_BASE_URL, unless overridden in settings (e.g. a local stub server)."""
+    return getattr(settings, 'GRAPH_API_BASE_URL', None) or GRAPH_API_BASE_URL
+
+ERROR_CLASS_RATE_LIMITED = 'rate_limited'
+ERROR_CLASS_TRANSIENT = 'transient'
+ERROR_CLASS_AUTH = 'auth'
+ERROR_CLASS_PERMANENT = 'permanent'
+
+# https://developers.facebook.com/docs/whatsapp/cloud-api/support/error-codes
+RATE_LIMIT_ERROR_CODES = {4, 17, 32, 613, 80007, 130429, 131048, 131056}
+TRANSIENT_ERROR_CODES = {1, 2, 131000, 131016, 133004}
+AUTH_ERROR_CODES = {0, 3, 10, 190, 200, 299}
+
+
+def classify_graph_error(status_code: int, error_body) -> str:
+    """Maps a Graph API error response to one of the ERROR_CLASS_* values."""
+    code = None
+    if isinstance(error_body, dict):
+        error = error_body.get('error', error_body)
+        if isinstance(error, dict):
+            code = error.get('code')
+    if code in RATE_LIMIT_ERROR_CODES or status_code == 429:
+        return ERROR_CLASS_RATE_LIMITED
+    if code in AUTH_ERROR_CODES or status_code in (401, 403):
+        return ERROR_CLASS_AUTH
+    if code in TRANSIENT_ERROR_CODES or status_code >= 500:
+        return ERROR_CLASS_TRANSIENT
+    return ERROR_CLASS_PERMANENT
+
+
+def _response_error_class(response) -> str:
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    return classify_graph_error(response.status_code, body)
+
+
+def _connection_not_established(error: requests.exceptions.RequestException) -> bool:
+    """True if the request failed before a connection to Meta existed, so nothing was sent."""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, 'reason', reason)  # urllib3 wraps the cause in MaxRetryError
+    return isinstance(reason, (urllib3_exceptions.NewConnectionError, urllib3_exceptions.ConnectTimeoutError))
+
+
+def graph_retry_delay(method: str, *, response=None, error=None, attempt: int = 1, endpoint: str = None):
+    """
+    Returns the seconds to wait before retrying a failed Graph call (its
+    `response`, or the requests `error` it raised), or None if it must not be
+    retried. `attempt` is 1 for the first retry. The delay backs off
+    exponentially from GRAPH_API_RETRY_BACKOFF_SECONDS and honours Retry-After.
+    """
+    idempotent = method.upper() in ('GET', 'HEAD', 'DELETE')
+    retry_after = None
+    if error is not None:
+        if not (idempotent or _connection_not_established(error)):
+            return None
+        reason = 'network_error'
+    elif response is not None and response.status_code >= 400:
+        reason = _response_error_class(response)
+        if not (reason == ERROR_CLASS_RATE_LIMITED or (reason == ERROR_CLASS_TRANSIENT and idempotent)):
+            return None
+        retry_after = response.headers.get('Retry-After')
+    else:
+        return None
+
+    delay = settings.GRAPH_API_RETRY_BACKOFF_SECONDS * (2 ** (max(attempt, 1) - 1))
+    if retry_after and retry_after.isdigit():
+        delay = max(delay, float(retry_after))
+    GRAPH_API_RETRIES.labels(endpoint=endpoint or 'unknown', reason=reason).inc()
+    return delay
+
+
+class GraphApiClient:
+    """
+    Thin wrapper around a pooled `requests.Session`.
+
+    Methods return the `requests.Response` so callers keep their existing
+    `raise_for_status()` / HTTPError handling; requests exceptions propagate.
+    Nothing is retried here; see graph_retry_delay().
+    """
+
+    def __init__(self, pool_connections: int = None, pool_maxsize: int = None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections or settings.GRAPH_API_POOL_CONNECTIONS,
+            pool_maxsize=pool_maxsize or settings.GRAPH_API_POOL_MAXSIZE,
+            max_retries=0,  # Retries are scheduled by the calling task, see graph_retry_delay().
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method: str, url: str, *, endpoint: str, **kwargs) -> requests.Response:
+        """
+        Sends a request. `url` may be absolute (e.g. media CDN URLs) or a path
+        relative to graph_api_base_url(). `endpoint` is the metrics label.
+        """
+        method = method.upper()
+        if not url.startswith('http'):
+            url = f"{graph_api_base_url()}/{url.lstrip('/')}"
+
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            GRAPH_API_LATENCY_SECONDS.labels(endpoint=endpoint, method=method, outcome='network_error').observe(time.perf_counter() - started)
+            raise
+        GRAPH_API_LATENCY_SECONDS.labels(
+            endpoint=endpoint, method=method, outcome=f"{response.status_code // 100}xx"
+        ).observe(time.perf_counter() - started)
+        return response
+
+    def get(self, url: str, *, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, endpoint=endpoint, **kwargs)
+
+    def post(self, url: str, *, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, endpoint=endpoint, **kwargs)
+
+    def delete(self, url: str, *, endpoint: str, **kwargs) -> requests.Response:
+        return self.request('DELETE', url, endpoint=endpoint, **kwargs)
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_graph_client() -> GraphApiClient:
+    """
+    Returns this worker process's shared GraphApiClient. It is re-created after
+    a fork, so prefork children never share sockets with their parent.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = GraphApiClient()
+                _client_pid = pid
+    return _client
@@ -0,0 +1,68 @@
+# whatsappcrm_backend/meta_integration/idempotency.py
+
+"""
+Redis idempotency gate for webhook redeliveries.
+
+Meta redelivers webhooks aggressively. The gate claims an event identifier (a
+wamid for messages, "<wamid>_<status>" for statuses) with SET NX plus a TTL
+before any Postgres work happens, so a redelivery within the TTL is dropped
+straight away. In ack-first mode the view also claims "body_<sha256>" of the
+raw request body before writing the inbox row, so a redelivered body is not
+stored twice.
+"""
+import logging
+
+import redis
+from django.conf import settings
+
+from whatsappcrm_backend.redis_client import get_redis_client, mark_redis_unavailable
+from .metrics import WEBHOOK_DUPLICATES_SUPPRESSED
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_EVENT_KEY_PREFIX = 'meta:webhook_event:'
+
+
+def claim_webhook_event(identifier: str, event_kind: str):
+    """
+    Atomically claims `identifier`.
+
+    Returns True if this delivery is the first one seen within the TTL, and False
+    for a duplicate (counted in WEBHOOK_DUPLICATES_SUPPRESSED). Returns None if
+    Redis is unavailable; the caller then relies on the existing
+    WebhookEventLog check.
+    """
+    if not identifier:
+        return None
+    client = get_redis_client()
+    if client is None:
+        return None
+    try:
+        claimed = client.set(
+            f"{WEBHOOK_EVENT_KEY_PREFIX}{identifier}", 1,
+            nx=True, ex=settings.META_WEBHOOK_IDEMPOTENCY_TTL_SECONDS,
+        )
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return None
+    if not claimed:
+        WEBHOOK_DUPLICATES_SUPPRESSED.labels(event_kind=event_kind).inc()
+        logger.info(f"Suppressed duplicate webhook delivery for '{identifier}' ({event_kind}).")
+        return False
+    return True
+
+
+def release_webhook_events(identifiers: list):
+    """
+    Releases claims made for a delivery that failed, so that Meta's retry of the
+    same event is processed instead of being suppressed.
+    """
+    if not identifiers:
+        return
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        client.delete(*[f"{WEBHOOK_EVENT_KEY_PREFIX}{identifier}" for identifier in identifiers])
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
@@ -0,0 +1,110 @@
+# whatsappcrm_backend/meta_integration/management/commands/benchmark_broadcast_send.py
+
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+
+from conversations.models import Contact, Message
+from meta_integration.bulk_sender import send_message_batch
+from meta_integration.models import MetaAppConfig
+from meta_integration.tasks import send_whatsapp_message_task
+
+
+class _StubGraphHandler(BaseHTTPRequestHandler):
+    """Accepts every POST /messages after `latency` seconds, like a healthy Graph API."""
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so connection pooling is measured too.
+    latency = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        body = json.dumps({
+            'messaging_product': 'whatsapp',
+            'messages': [{'id': f"wamid.BENCH{uuid.uuid4().hex}"}],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        'Compares broadcast send throughput (messages/second) of the per-message task path '
+        'and the bulk sender against a local stub Graph API server. All rows created are rolled back.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=200, help='Messages to send per path.')
+        parser.add_argument('--latency-ms', type=int, default=50, help='Simulated Graph API latency per request.')
+        parser.add_argument('--concurrency', type=int, default=16, help='Bulk sender concurrency.')
+        parser.add_argument(
+            '--throttle', action='store_true',
+            help='Keep the configured per-number send throttle instead of disabling it for the run.'
+        )
+
+    def handle(self, *args, **options):
+        _StubGraphHandler.latency = options['latency_ms'] / 1000.0
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _StubGraphHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        overrides = {'GRAPH_API_BASE_URL': f"http://127.0.0.1:{server.server_port}"}
+        if not options['throttle']:
+            overrides.update(META_THROTTLE_MESSAGES_PER_SECOND=1e9, META_THROTTLE_BURST=10**9, META_THROTTLE_PAIR_PER_MINUTE=0)
+
+        try:
+            with override_settings(**overrides), transaction.atomic():
+                config = MetaAppConfig(
+                    name='Benchmark (rolled back)', verify_token='bench', access_token='bench',
+                    phone_number_id=f"bench{uuid.uuid4().hex[:10]}", waba_id='bench', is_active=False,
+                )
+                config.save()
+                per_task = self._run(config, options['messages'], self._send_per_task, 'per_task')
+                bulk = self._run(
+                    config, options['messages'],
+                    lambda ids: send_message_batch(ids, config, concurrency=options['concurrency']), 'bulk'
+                )
+                transaction.set_rollback(True)
+        finally:
+            server.shutdown()
+
+        self.stdout.write(f"Stub latency: {options['latency_ms']} ms, {options['messages']} messages per path.")
+        self.stdout.write(f"  per-message task path: {per_task:8.1f} msg/s (executed in-process, without broker round trips)")
+        self.stdout.write(f"  bulk sender:           {bulk:8.1f} msg/s (concurrency {options['concurrency']})")
+        if per_task:
+            self.stdout.write(self.style.SUCCESS(f"  speed-up: {bulk / per_task:.1f}x"))
+
+    def _send_per_task(self, message_ids):
+        for message_id in message_ids:
+            send_whatsapp_message_task.apply(args=[message_id, self._config_id], kwargs={'sequenced': True})
+
+    def _run(self, config, count, send, label) -> float:
+        self._config_id = config.id
+        contacts = Contact.objects.bulk_create([
+            Contact(whatsapp_id=f"bench-{label}-{uuid.uuid4().hex[:12]}") for _ in range(count)
+        ])
+        messages = Message.objects.bulk_create([
+            Message(
+                contact=contact, app_config=config, direction='out', message_type='template',
+                content_payload={'name': 'benchmark', 'language': {'code': 'en_US'}, 'components': []},
+                status='pending_dispatch',
+            )
+            for contact in contacts
+        ])
+        started = time.perf_counter()
+        send([message.id for message in messages])
+        elapsed = time.perf_counter() - started
+        sent = Message.objects.filter(id__in=[message.id for message in messages], status='sent').count()
+        if sent != count:
+            self.stderr.write(f"{label}: only {sent}/{count} messages were marked sent.")
+        return sent / elapsed if elapsed else 0.0
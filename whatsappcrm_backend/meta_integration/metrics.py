@@ -0,0 +1,56 @@
+# whatsappcrm_backend/meta_integration/metrics.py
+
+"""
+Prometheus metrics for the Meta integration.
+
+The web process exports them through django_prometheus at /prometheus/. Celery
+workers update them in their own process registry, which each worker process serves
+on WORKER_METRICS_PORT (see whatsappcrm_backend/worker_metrics.py).
+"""
+from prometheus_client import Counter, Gauge, Histogram
+
+WEBHOOK_INBOX_DEPTH = Gauge(
+    'whatsappcrm_webhook_inbox_depth',
+    'Webhook bodies stored in the inbox and not yet processed.'
+)
+WEBHOOK_INBOX_LAG_SECONDS = Gauge(
+    'whatsappcrm_webhook_inbox_lag_seconds',
+    'Age in seconds of the oldest unprocessed webhook inbox entry.'
+)
+WEBHOOK_INBOX_ENTRIES_PROCESSED = Counter(
+    'whatsappcrm_webhook_inbox_entries_processed_total',
+    'Webhook inbox entries drained by the consumer, by outcome.',
+    ['outcome']
+)
+META_STATUS_UPDATES = Counter(
+    'whatsappcrm_meta_status_updates_total',
+    'Message status webhooks handled by the coalescing status path, by outcome.',
+    ['outcome']
+)
+WEBHOOK_DUPLICATES_SUPPRESSED = Counter(
+    'whatsappcrm_webhook_duplicates_suppressed_total',
+    'Webhook redeliveries dropped by the Redis idempotency gate, by event kind (message, status, delivery).',
+    ['event_kind']
+)
+GRAPH_API_LATENCY_SECONDS = Histogram(
+    'whatsappcrm_graph_api_request_seconds',
+    'Latency of Meta Graph API calls, by endpoint.',
+    ['endpoint', 'method', 'outcome'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+)
+GRAPH_API_RETRIES = Counter(
+    'whatsappcrm_graph_api_retries_total',
+    'Failed Graph API calls that were safe to retry (see graph_retry_delay), by endpoint and reason.',
+    ['endpoint', 'reason']
+)
+SEND_THROTTLE_TOKENS = Gauge(
+    'whatsappcrm_send_throttle_tokens',
+    'Tokens left in the outbound send bucket of a sending number, as last seen by this process.',
+    ['phone_number_id']
+)
+SEND_THROTTLE_WAIT_SECONDS = Histogram(
+    'whatsappcrm_send_throttle_wait_seconds',
+    'Time outbound sends spent waiting on the send throttle, by sending number.',
+    ['phone_number_id'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0)
+)
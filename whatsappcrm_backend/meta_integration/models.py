@@ -16,9 +16,12 @@ class MetaAppConfigManager(models.Manager):
         (e.g., from admin actions or scheduled tasks) where the "from" number
         is not otherwise specified. The webhook receiver identifies configs by
         phone_number_id and does not rely on this method.
+
+        Served from the process-local config cache (see config_cache.py).
         """
+        from .config_cache import get_active_config
         try:
-            return self.get(is_active=True)
+            return get_active_config()
         except MetaAppConfig.DoesNotExist:
             logger.critical("CRITICAL: No active Meta App Configuration found. Proactive message sending will fail.")
             raise
@@ -177,3 +180,41 @@ class WebhookEventLog(models.Model):
             models.Index(fields=['event_type', 'received_at']),
             models.Index(fields=['processing_status', 'event_type']),
         ]
+
+
+class WebhookInboxEntry(models.Model):
+    """
+    Append-only inbox of raw, signature-verified webhook bodies.
+
+    Used when META_WEBHOOK_ACK_FIRST is enabled: the webhook view only stores the
+    body here and returns 200 to Meta straight away, and
+    `process_webhook_inbox_task` drains the inbox in batches.
+    """
+    app_config = models.ForeignKey(
+        MetaAppConfig,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        help_text="Configuration whose app secret verified this body."
+    )
+    body = models.TextField(help_text="Raw request body exactly as received from Meta.")
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True, help_text="Set once the consumer has dispatched the body.")
+    claimed_at = models.DateTimeField(
+        null=True, blank=True,
+        help_text="Set while a consumer is processing the entry; a claim older than META_WEBHOOK_INBOX_CLAIM_TIMEOUT_SECONDS is taken over."
+    )
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+
+    def __str__(self):
+        state = 'processed' if self.processed_at else 'pending'
+        return f"Inbox entry {self.pk} ({state}) received {self.received_at.strftime('%Y-%m-%d %H:%M:%S')}"
+
+    class Meta:
+        verbose_name = "Webhook Inbox Entry"
+        verbose_name_plural = "Webhook Inbox Entries"
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['processed_at', 'id']),
+        ]
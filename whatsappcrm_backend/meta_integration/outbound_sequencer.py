@@ -0,0 +1,216 @@
+# whatsappcrm_backend/meta_integration/outbound_sequencer.py
+
+"""
+Per-contact ordered outbound queue.
+
+Messages to the same contact must reach WhatsApp in order. Each contact gets a
+Redis sorted set of pending message ids (scored by id, so the oldest message
+always goes first) and an "inflight" key holding the message currently being
+sent. A message is only dispatched to `send_whatsapp_message_task` when nothing
+is in flight for its contact. The next message is released when:
+  * Graph accepts the previous message (default), or
+  * its sent/delivered status webhook arrives, if META_OUTBOUND_RELEASE_ON_DELIVERY is set, or
+  * the previous message fails permanently.
+
+The inflight key has a TTL (META_OUTBOUND_INFLIGHT_TTL_SECONDS), so a lost
+message can stall its contact's queue for at most that long. A send that the
+throttle reschedules or that Celery retries extends its inflight key past the
+rescheduled run.
+`release_stalled_outbound_queues_task` sweeps queues whose inflight key has
+expired.
+
+Status releases run after the status update commits. Meta can report a status
+before the send task has stored the message's wamid; such a status is
+remembered under its wamid for the inflight TTL, and the send task releases the
+queue itself once it saves that wamid.
+
+Without Redis, `enqueue_outbound_message` returns False and callers dispatch
+directly.
+"""
+import logging
+
+import redis
+from django.conf import settings
+from django.db import transaction
+
+from whatsappcrm_backend.redis_client import get_redis_client, mark_redis_unavailable
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_KEY_PREFIX = 'meta:outbound:'
+# Kept outside OUTBOUND_KEY_PREFIX so release_stalled_queues() doesn't take these for queues.
+EARLY_STATUS_KEY_PREFIX = 'meta:outbound_early_status:'
+RELEASE_STATUSES = ('sent', 'delivered', 'read', 'failed')
+
+# KEYS[1] = pending zset, KEYS[2] = inflight key, ARGV[1] = inflight TTL
+_RELEASE_NEXT_LUA = """
+if redis.call('EXISTS', KEYS[2]) == 1 then return false end
+local popped = redis.call('ZPOPMIN', KEYS[1])
+if #popped == 0 then return false end
+redis.call('SET', KEYS[2], popped[1], 'EX', ARGV[1])
+return popped[1]
+"""
+
+# KEYS[1] = inflight key, ARGV[1] = message id
+_COMPLETE_LUA = """
+local inflight = redis.call('GET', KEYS[1])
+if inflight and string.sub(inflight, 1, #ARGV[1] + 1) == ARGV[1] .. ':' then
+    redis.call('DEL', KEYS[1])
+    return 1
+end
+return 0
+"""
+
+# KEYS[1] = inflight key, ARGV[1] = message id, ARGV[2] = minimum TTL
+_EXTEND_LUA = """
+local inflight = redis.call('GET', KEYS[1])
+if inflight and string.sub(inflight, 1, #ARGV[1] + 1) == ARGV[1] .. ':' then
+    if redis.call('TTL', KEYS[1]) < tonumber(ARGV[2]) then
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return 1
+end
+return 0
+"""
+
+
+def _queue_keys(contact_id):
+    queue_key = f"{OUTBOUND_KEY_PREFIX}{contact_id}"
+    return queue_key, f"{queue_key}:inflight"
+
+
+def _release_next(client, contact_id):
+    """Dispatches the oldest pending message for the contact if none is in flight."""
+    from .tasks import send_whatsapp_message_task
+
+    queue_key, inflight_key = _queue_keys(contact_id)
+    member = client.register_script(_RELEASE_NEXT_LUA)(
+        keys=[queue_key, inflight_key], args=[settings.META_OUTBOUND_INFLIGHT_TTL_SECONDS]
+    )
+    if not member:
+        return None
+    message_id, config_id = (int(part) for part in member.decode().split(':'))
+    send_whatsapp_message_task.apply_async(args=[message_id, config_id], kwargs={'sequenced': True})
+    logger.debug(f"Outbound sequencer released message {message_id} for contact {contact_id}.")
+    return message_id
+
+
+def enqueue_outbound_message(message_id: int, config_id: int, contact_id: int) -> bool:
+    """
+    Adds an outgoing message to its contact's ordered queue and dispatches it
+    right away if nothing else is in flight. Call after the Message row has been
+    committed. Returns False if Redis is unavailable.
+    """
+    client = get_redis_client()
+    if client is None:
+        return False
+    queue_key, _ = _queue_keys(contact_id)
+    try:
+        client.zadd(queue_key, {f"{message_id}:{config_id}": message_id})
+        _release_next(client, contact_id)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return False
+    return True
+
+
+def complete_outbound_message(contact_id: int, message_id: int):
+    """
+    Marks `message_id` as done for its contact and releases the next queued
+    message. Does nothing if the message is no longer the one in flight.
+    """
+    client = get_redis_client()
+    if client is None:
+        return
+    _, inflight_key = _queue_keys(contact_id)
+    try:
+        if client.register_script(_COMPLETE_LUA)(keys=[inflight_key], args=[message_id]):
+            _release_next(client, contact_id)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+
+
+def extend_inflight(contact_id: int, message_id: int, seconds: float):
+    """
+    Keeps `message_id`'s inflight key alive for at least `seconds` plus the
+    usual inflight TTL, while its send is rescheduled by the throttle or retried.
+    """
+    client = get_redis_client()
+    if client is None:
+        return
+    _, inflight_key = _queue_keys(contact_id)
+    ttl = int(seconds) + 1 + settings.META_OUTBOUND_INFLIGHT_TTL_SECONDS
+    try:
+        client.register_script(_EXTEND_LUA)(keys=[inflight_key], args=[message_id, ttl])
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+
+
+def release_after_status(message):
+    """
+    Status webhook hook: releases the contact's next message once this one is
+    reported as sent or delivered (or any later state), if
+    META_OUTBOUND_RELEASE_ON_DELIVERY is set. The release runs once the status
+    update has committed.
+    """
+    if settings.META_OUTBOUND_RELEASE_ON_DELIVERY and message.status in RELEASE_STATUSES:
+        contact_id, message_id = message.contact_id, message.id
+        transaction.on_commit(lambda: complete_outbound_message(contact_id, message_id))
+
+
+def remember_unmatched_statuses(wamids: list):
+    """
+    Status webhook hook for statuses whose wamid matches no message yet, because
+    the send task hasn't stored it. Lets release_if_status_arrived() release the
+    queue when it does. Only used with META_OUTBOUND_RELEASE_ON_DELIVERY.
+    """
+    if not settings.META_OUTBOUND_RELEASE_ON_DELIVERY or not wamids:
+        return
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        pipe = client.pipeline()
+        for wamid in wamids:
+            pipe.set(f"{EARLY_STATUS_KEY_PREFIX}{wamid}", 1, ex=settings.META_OUTBOUND_INFLIGHT_TTL_SECONDS)
+        pipe.execute()
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+
+
+def release_if_status_arrived(message):
+    """
+    Send task hook, called after the wamid is saved: releases the contact's
+    next message if a status for the wamid arrived before it was stored.
+    """
+    if not settings.META_OUTBOUND_RELEASE_ON_DELIVERY or not message.wamid:
+        return
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        arrived = client.delete(f"{EARLY_STATUS_KEY_PREFIX}{message.wamid}")
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return
+    if arrived:
+        logger.debug(f"Outbound sequencer: status for {message.wamid} arrived before its wamid was stored; releasing.")
+        complete_outbound_message(message.contact_id, message.id)
+
+
+def release_stalled_queues() -> int:
+    """Releases the next message of every queue whose inflight key has expired."""
+    client = get_redis_client()
+    if client is None:
+        return 0
+    released = 0
+    try:
+        for key in client.scan_iter(match=f"{OUTBOUND_KEY_PREFIX}*", count=500):
+            key = key.decode()
+            if key.endswith(':inflight'):
+                continue
+            if _release_next(client, key[len(OUTBOUND_KEY_PREFIX):]):
+                released += 1
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+    return released
@@ -1,4 +1,8 @@
-from django.dispatch import Signal
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal, receiver
+
+from .models import MetaAppConfig
+from .config_cache import invalidate_config_cache
 
 # Signal sent when a message fails to send after all retries.
 # Providing args: message_instance
@@ -9,3 +13,10 @@ message_send_failed = Signal()
 # The Celery tasks (create_whatsapp_catalog_product, update_whatsapp_catalog_product,
 # delete_whatsapp_catalog_product) remain available in tasks.py for manual triggering
 # or admin actions if needed.
+
+
+@receiver(post_save, sender=MetaAppConfig)
+@receiver(post_delete, sender=MetaAppConfig)
+def invalidate_meta_app_config_cache(sender, instance, **kwargs):
+    """Keeps the process-local MetaAppConfig cache in step with the database."""
+    invalidate_config_cache()
@@ -0,0 +1,315 @@
+# whatsappcrm_backend/meta_integration/status_updates.py
+
+"""
+Buffered, coalesced application of message status webhooks.
+
+A broadcast of N templates produces roughly 3N status callbacks (sent, delivered,
+read). With META_STATUS_BATCHING enabled, the webhook view pushes each status onto
+a Redis list instead of touching the database. `apply_buffered_status_updates_task`
+drains the list after a short window. It keeps only the furthest state per wamid
+and writes all messages of the batch with a single bulk_update.
+
+A drained batch is moved to its own processing list
+(`meta:status_buffer:batch:<id>`, indexed in a sorted set by drain time) rather
+than deleted. The processing list is acked, i.e. deleted, only once the batch's
+transaction has committed. A failing batch is pushed back onto the buffer, and a
+batch left behind by a crashed worker is requeued by the next flush after
+META_STATUS_BATCH_REQUEUE_SECONDS.
+"""
+import json
+import logging
+import time
+import uuid
+from datetime import datetime
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from conversations.models import Message
+from whatsappcrm_backend.redis_client import get_redis_client, mark_redis_unavailable
+from .models import WebhookEventLog
+from .metrics import META_STATUS_UPDATES
+from .outbound_sequencer import RELEASE_STATUSES, release_after_status, remember_unmatched_statuses
+
+logger = logging.getLogger(__name__)
+
+STATUS_BUFFER_KEY = 'meta:status_buffer'
+STATUS_FLUSH_SCHEDULED_KEY = 'meta:status_buffer:flush_scheduled'
+STATUS_BATCH_KEY_PREFIX = 'meta:status_buffer:batch:'
+STATUS_BATCHES_KEY = 'meta:status_buffer:batches'
+
+# KEYS[1] = buffer, KEYS[2] = new batch list, KEYS[3] = batch index
+# ARGV = batch size, now
+_DRAIN_LUA = """
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items == 0 then return items end
+redis.call('LTRIM', KEYS[1], #items, -1)
+redis.call('RPUSH', KEYS[2], unpack(items))
+redis.call('ZADD', KEYS[3], ARGV[2], KEYS[2])
+return items
+"""
+
+# KEYS[1] = batch list, KEYS[2] = buffer, KEYS[3] = batch index
+_REQUEUE_LUA = """
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+if #items > 0 then redis.call('RPUSH', KEYS[2], unpack(items)) end
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[3], KEYS[1])
+return #items
+"""
+
+# Statuses only ever move forward. 'failed' and 'deleted' are terminal and win over
+# anything Meta reported before them.
+STATUS_RANK = {
+    'pending_dispatch': 0,
+    'queued': 1,
+    'sent': 2,
+    'delivered': 3,
+    'read': 4,
+    'failed': 5,
+    'deleted': 6,
+}
+
+
+def _status_rank(status_value):
+    return STATUS_RANK.get(status_value, -1)
+
+
+def _parse_status_timestamp(ts_str):
+    if ts_str and str(ts_str).isdigit():
+        return timezone.make_aware(datetime.fromtimestamp(int(ts_str)))
+    return timezone.now()
+
+
+def buffer_status_update(status_data: dict, metadata: dict, app_config, waba_id: str = None) -> bool:
+    """
+    Appends a status webhook to the shared buffer and makes sure a flush is scheduled.
+    Returns False if Redis is unavailable, in which case the caller should apply
+    the status inline.
+    """
+    from .tasks import apply_buffered_status_updates_task
+
+    client = get_redis_client()
+    if client is None:
+        return False
+
+    window = settings.META_STATUS_BATCH_WINDOW_SECONDS
+    item = json.dumps({
+        'status': status_data,
+        'app_config_id': app_config.id if app_config else None,
+        'waba_id': waba_id,
+        'phone_number_id': metadata.get('phone_number_id'),
+    })
+    try:
+        pipe = client.pipeline()
+        pipe.rpush(STATUS_BUFFER_KEY, item)
+        # The flag expires on its own if the scheduled flush is ever lost.
+        pipe.set(STATUS_FLUSH_SCHEDULED_KEY, 1, nx=True, ex=window + 60)
+        _, needs_flush = pipe.execute()
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return False
+
+    META_STATUS_UPDATES.labels(outcome='buffered').inc()
+    if needs_flush:
+        transaction.on_commit(lambda: apply_buffered_status_updates_task.apply_async(countdown=window))
+    return True
+
+
+def drain_status_buffer(batch_size: int):
+    """
+    Atomically moves up to `batch_size` buffered status items into a new
+    processing list. Returns (batch key, items); pass the key to
+    ack_status_batch() once the items are committed, or to
+    requeue_status_batch() if applying them failed.
+    """
+    client = get_redis_client()
+    if client is None:
+        return None, []
+    batch_key = f"{STATUS_BATCH_KEY_PREFIX}{uuid.uuid4().hex}"
+    try:
+        raw_items = client.register_script(_DRAIN_LUA)(
+            keys=[STATUS_BUFFER_KEY, batch_key, STATUS_BATCHES_KEY], args=[batch_size, time.time()]
+        )
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return None, []
+    return batch_key, [json.loads(raw) for raw in raw_items]
+
+
+def ack_status_batch(batch_key: str):
+    """Deletes a processing list whose items have been committed."""
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        pipe = client.pipeline(transaction=True)
+        pipe.delete(batch_key)
+        pipe.zrem(STATUS_BATCHES_KEY, batch_key)
+        pipe.execute()
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+
+
+def requeue_status_batch(batch_key: str) -> int:
+    """Pushes a processing list's items back onto the buffer. Returns how many were requeued."""
+    client = get_redis_client()
+    if client is None:
+        return 0
+    try:
+        return client.register_script(_REQUEUE_LUA)(keys=[batch_key, STATUS_BUFFER_KEY, STATUS_BATCHES_KEY])
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return 0
+
+
+def requeue_abandoned_status_batches() -> int:
+    """Requeues processing lists older than META_STATUS_BATCH_REQUEUE_SECONDS, left by crashed workers."""
+    client = get_redis_client()
+    if client is None:
+        return 0
+    try:
+        abandoned = client.zrangebyscore(
+            STATUS_BATCHES_KEY, '-inf', time.time() - settings.META_STATUS_BATCH_REQUEUE_SECONDS
+        )
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return 0
+    requeued = sum(requeue_status_batch(key.decode()) for key in abandoned)
+    if requeued:
+        logger.warning(f"Requeued {requeued} status updates from {len(abandoned)} abandoned batches.")
+    return requeued
+
+
+def clear_flush_flag():
+    """Lets the next buffered status schedule a new flush."""
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        client.delete(STATUS_FLUSH_SCHEDULED_KEY)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+
+
+def coalesce_status_items(items: list) -> dict:
+    """
+    Folds raw status items into one entry per wamid that holds the furthest status.
+    Conversation and pricing data are taken from whichever callback carried them,
+    because Meta usually sends them only on 'sent'. The 'errors' of a failed
+    status are kept with it.
+    """
+    coalesced = {}
+    for item in items:
+        status_data = item.get('status') or {}
+        wamid = status_data.get('id')
+        status_value = status_data.get('status')
+        if not wamid or not status_value:
+            continue
+
+        entry = coalesced.setdefault(wamid, {
+            'status': None, 'timestamp': None,
+            'conversation_id': None, 'pricing_model': None, 'errors': None,
+        })
+        if _status_rank(status_value) >= _status_rank(entry['status']):
+            entry['status'] = status_value
+            entry['timestamp'] = _parse_status_timestamp(status_data.get('timestamp'))
+            # Meta explains 'failed' statuses in an 'errors' list.
+            entry['errors'] = status_data.get('errors') or entry['errors']
+        if isinstance(status_data.get('conversation'), dict):
+            entry['conversation_id'] = status_data['conversation'].get('id') or entry['conversation_id']
+        if isinstance(status_data.get('pricing'), dict):
+            entry['pricing_model'] = status_data['pricing'].get('pricing_model') or entry['pricing_model']
+    return coalesced
+
+
+@transaction.atomic
+def apply_status_items(items: list) -> dict:
+    """
+    Applies a batch of raw status items: one SELECT for the affected messages, one
+    bulk_update, and (depending on META_STATUS_EVENT_LOGGING) one bulk_create of
+    WebhookEventLog rows. A status never moves a message backwards.
+    """
+    from conversations.signals import broadcast_message_update
+
+    coalesced = coalesce_status_items(items)
+    if not coalesced:
+        return {'received': len(items), 'updated': 0, 'stale': 0, 'unmatched': 0}
+
+    messages = {
+        msg.wamid: msg for msg in
+        Message.objects.select_related('contact').filter(wamid__in=coalesced.keys(), direction='out')
+    }
+
+    to_update = []
+    updated_count = stale_count = 0
+    for wamid, entry in coalesced.items():
+        msg = messages.get(wamid)
+        if msg is None:
+            continue
+        changed = False
+        if entry['conversation_id'] and entry['conversation_id'] != msg.conversation_id_from_meta:
+            msg.conversation_id_from_meta = entry['conversation_id']
+            changed = True
+        if entry['pricing_model'] and entry['pricing_model'] != msg.pricing_model_from_meta:
+            msg.pricing_model_from_meta = entry['pricing_model']
+            changed = True
+        if _status_rank(entry['status']) > _status_rank(msg.status):
+            msg.status = entry['status']
+            msg.status_timestamp = entry['timestamp']
+            if entry['status'] == 'failed' and entry['errors']:
+                msg.error_details = {'errors': entry['errors']}
+            updated_count += 1
+            changed = True
+        else:
+            stale_count += 1
+        if changed:
+            to_update.append(msg)
+
+    if to_update:
+        Message.objects.bulk_update(
+            to_update,
+            ['status', 'status_timestamp', 'conversation_id_from_meta', 'pricing_model_from_meta', 'error_details'],
+            batch_size=500,
+        )
+        # bulk_update skips post_save, so push the new statuses to the UI explicitly.
+        transaction.on_commit(lambda: [broadcast_message_update(msg) for msg in to_update])
+        for msg in to_update:
+            release_after_status(msg)
+
+    unmatched_count = len(coalesced) - len(messages)
+    if unmatched_count:
+        remember_unmatched_statuses([
+            wamid for wamid, entry in coalesced.items()
+            if wamid not in messages and entry['status'] in RELEASE_STATUSES
+        ])
+    if settings.META_STATUS_EVENT_LOGGING == 'bulk':
+        now = timezone.now()
+        WebhookEventLog.objects.bulk_create([
+            WebhookEventLog(
+                event_identifier=f"{item['status'].get('id')}_{item['status'].get('status')}",
+                app_config_id=item.get('app_config_id'),
+                message=messages.get(item['status'].get('id')),
+                waba_id_received=item.get('waba_id'),
+                phone_number_id_received=item.get('phone_number_id'),
+                event_type='message_status',
+                payload_object_type='whatsapp_business_account',
+                payload=item['status'],
+                processed_at=now,
+                processing_status='processed' if item['status'].get('id') in messages else 'ignored',
+                processing_notes="Applied in coalesced status batch.",
+            )
+            for item in items if item.get('status')
+        ], batch_size=500)
+
+    META_STATUS_UPDATES.labels(outcome='applied').inc(updated_count)
+    META_STATUS_UPDATES.labels(outcome='stale').inc(stale_count)
+    META_STATUS_UPDATES.labels(outcome='unmatched').inc(unmatched_count)
+    return {
+        'received': len(items),
+        'updated': updated_count,
+        'stale': stale_count,
+        'unmatched': unmatched_count,
+    }
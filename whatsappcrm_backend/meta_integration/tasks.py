@@ -1,37 +1,65 @@
 # whatsappcrm_backend/meta_integration/tasks.py
 
+import json
 import logging
 import tempfile
 import os
 from celery import shared_task
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from django.db.models import Q
 from datetime import timedelta
 
 from .utils import send_whatsapp_message, send_read_receipt_api, download_whatsapp_media
-from .models import MetaAppConfig
+from .models import MetaAppConfig, WebhookInboxEntry
+from .config_cache import get_config_by_pk
+from .outbound_sequencer import (
+    enqueue_outbound_message, complete_outbound_message, extend_inflight, release_if_status_arrived,
+)
+from .throttle import acquire_send_token
 from .signals import message_send_failed
 from conversations.models import Message, Contact # To update message status
 from products_and_services.models import Product
 from .catalog_service import MetaCatalogService
+from .metrics import WEBHOOK_INBOX_DEPTH, WEBHOOK_INBOX_LAG_SECONDS, WEBHOOK_INBOX_ENTRIES_PROCESSED
 
 
 logger = logging.getLogger(__name__)
 
+
+def _fail_send_permanently(task, outgoing_msg, sequenced: bool):
+    """Saves a send failure that won't be retried, notifies, and frees the contact's sequencer slot."""
+    outgoing_msg.status_timestamp = timezone.now()
+    outgoing_msg.save(update_fields=['status', 'error_details', 'status_timestamp'])
+    message_send_failed.send(sender=task.__class__, message_instance=outgoing_msg)
+    if sequenced:
+        complete_outbound_message(outgoing_msg.contact_id, outgoing_msg.id)
+
+
 @shared_task(bind=True, max_retries=10, default_retry_delay=3, queue='msg_sending')
-def send_whatsapp_message_task(self, outgoing_message_id: int, active_config_id: int):
+def send_whatsapp_message_task(self, outgoing_message_id: int, active_config_id: int, sequenced: bool = False):
     """
     Celery task to send a WhatsApp message asynchronously.
     Updates the Message object's status based on the outcome.
 
+    Ordering per contact is handled by the outbound sequencer (outbound_sequencer.py).
+    Direct `.delay()` calls are routed into the contact's queue first, and the
+    sequencer re-dispatches this task with `sequenced=True` when it is the message's turn.
+
+    Right before sending, the message is claimed ('pending_dispatch' -> 'queued') with a
+    conditional update; a task that loses the claim skips the message, so duplicate
+    tasks for one message send it once.
+
     Args:
         outgoing_message_id (int): The ID of the outgoing Message object to send.
         active_config_id (int): The ID of the active MetaAppConfig to use for sending.
+        sequenced (bool): True when dispatched by the outbound sequencer.
     """
     
     try:
         outgoing_msg = Message.objects.select_related('contact').get(pk=outgoing_message_id)
-        active_config = MetaAppConfig.objects.get(pk=active_config_id)
+        active_config = get_config_by_pk(active_config_id)
     except Message.DoesNotExist:
         logger.error(f"send_whatsapp_message_task: Message with ID {outgoing_message_id} not found. Task cannot proceed.")
         return # Cannot retry if message doesn't exist
@@ -43,6 +71,14 @@ def send_whatsapp_message_task(self, outgoing_message_id: int, active_config_id:
             outgoing_msg.error_details = {'error': f'MetaAppConfig ID {active_config_id} not found for sending.'}
             outgoing_msg.status_timestamp = timezone.now()
             outgoing_msg.save(update_fields=['status', 'error_details', 'status_timestamp'])
+            if sequenced:
+                complete_outbound_message(outgoing_msg.contact_id, outgoing_msg.id)
+        return
+
+    if not sequenced and outgoing_msg.direction == 'out' and enqueue_outbound_message(
+        outgoing_msg.id, active_config.id, outgoing_msg.contact_id
+    ):
+        logger.debug(f"send_whatsapp_message_task: Message ID {outgoing_message_id} handed to the outbound sequencer.")
         return
 
     if outgoing_msg.direction != 'out':
@@ -52,36 +88,43 @@ def send_whatsapp_message_task(self, outgoing_message_id: int, active_config_id:
     # Avoid resending if already sent successfully or in a final failed state without retries
     if outgoing_msg.wamid and outgoing_msg.status == 'sent':
         logger.info(f"send_whatsapp_message_task: Message ID {outgoing_message_id} (WAMID: {outgoing_msg.wamid}) already marked as sent. Skipping.")
+        if sequenced:
+            complete_outbound_message(outgoing_msg.contact_id, outgoing_msg.id)
         return
     if outgoing_msg.status == 'failed' and self.request.retries >= self.max_retries:
          logger.warning(f"send_whatsapp_message_task: Message ID {outgoing_message_id} already failed and max retries reached. Skipping.")
+         if sequenced:
+             complete_outbound_message(outgoing_msg.contact_id, outgoing_msg.id)
          return
 
-    # To ensure sequential delivery, check for preceding messages that are either:
-    # 1. Still pending dispatch (these should always be sent first).
-    # 2. Were sent recently but not yet confirmed as delivered. We'll wait for a short period
-    #    (e.g., 2 minutes) for the delivery receipt. This prevents sending a new message
-    #    before the previous one is confirmed delivered by WhatsApp's servers.
-    stale_threshold = timezone.now() - timedelta(seconds=20)
-
-    # NEW: Add a threshold for stale pending messages to prevent deadlocks.
-    # If a message has been pending for more than 5 minutes, assume it's stuck and proceed.
-    stale_pending_threshold = timezone.now() - timedelta(minutes=1)
-
-    # Find the specific message causing the halt for better logging
-    # A message is halting if it's a preceding message for the same contact AND
-    # 1. It is still pending dispatch (must wait for it to be sent).
-    # OR
-    # 2. It was sent very recently, and we are waiting for a delivery receipt to ensure order.
-    halting_message = Message.objects.filter(
-        Q(contact=outgoing_msg.contact),
-        Q(direction='out'),
-        Q(id__lt=outgoing_msg.id),
-        (
-            Q(status='pending_dispatch', timestamp__gte=stale_pending_threshold) | # Only wait for RECENTLY created pending messages.
-            Q(status='sent', status_timestamp__gte=stale_threshold) # Wait for recently sent messages to be delivered.
-        )
-    ).order_by('-id').first() # Get the most recent one for logging
+    # Fallback ordering when Redis (and so the sequencer) is unavailable.
+    halting_message = None
+    if not sequenced:
+        # To ensure sequential delivery, check for preceding messages that are either:
+        # 1. Still pending dispatch (these should always be sent first).
+        # 2. Were sent recently but not yet confirmed as delivered. We'll wait for a short period
+        #    (e.g., 2 minutes) for the delivery receipt. This prevents sending a new message
+        #    before the previous one is confirmed delivered by WhatsApp's servers.
+        stale_threshold = timezone.now() - timedelta(seconds=20)
+
+        # NEW: Add a threshold for stale pending messages to prevent deadlocks.
+        # If a message has been pending for more than 5 minutes, assume it's stuck and proceed.
+        stale_pending_threshold = timezone.now() - timedelta(minutes=1)
+
+        # Find the specific message causing the halt for better logging
+        # A message is halting if it's a preceding message for the same contact AND
+        # 1. It is still pending dispatch (must wait for it to be sent).
+        # OR
+        # 2. It was sent very recently, and we are waiting for a delivery receipt to ensure order.
+        halting_message = Message.objects.filter(
+            Q(contact=outgoing_msg.contact),
+            Q(direction='out'),
+            Q(id__lt=outgoing_msg.id),
+            (
+                Q(status__in=['pending_dispatch', 'queued'], timestamp__gte=stale_pending_threshold) | # Only wait for RECENTLY created pending messages.
+                Q(status='sent', status_timestamp__gte=stale_threshold) # Wait for recently sent messages to be delivered.
+            )
+        ).order_by('-id').first() # Get the most recent one for logging
 
     if halting_message:
         logger.warning(
@@ -101,8 +144,29 @@ def send_whatsapp_message_task(self, outgoing_message_id: int, active_config_id:
             message_send_failed.send(sender=self.__class__, message_instance=outgoing_msg)
             return
 
+    # Shared per-number (and optionally per-recipient) send rate, so bursts don't end in Graph rate-limit errors.
+    throttle_wait = acquire_send_token(active_config.phone_number_id, outgoing_msg.contact.whatsapp_id)
+    if throttle_wait:
+        # Rescheduled rather than retried, so throttling doesn't use up the task's retries.
+        if sequenced:
+            extend_inflight(outgoing_msg.contact_id, outgoing_msg.id, throttle_wait)
+        send_whatsapp_message_task.apply_async(
+            args=[outgoing_message_id, active_config_id], kwargs={'sequenced': sequenced}, countdown=throttle_wait
+        )
+        return
+
+    # Claim the message, so a copy of this task (e.g. re-queued by the broadcast stall sweep) can't send it twice.
+    if not Message.objects.filter(pk=outgoing_msg.pk, status='pending_dispatch').update(
+        status='queued', status_timestamp=timezone.now()
+    ):
+        logger.info(f"send_whatsapp_message_task: Message ID {outgoing_message_id} is no longer pending dispatch. Skipping.")
+        if sequenced:
+            complete_outbound_message(outgoing_msg.contact_id, outgoing_msg.id)
+        return
+
     logger.info(f"Task send_whatsapp_message_task started for Message ID: {outgoing_message_id}, Contact: {outgoing_msg.contact.whatsapp_id}")
 
+    api_response = None
     try:
         # content_payload should contain the 'data' part for send_whatsapp_message
         # and message_type should be the Meta API message type
@@ -113,7 +177,8 @@ def send_whatsapp_message_task(self, outgoing_message_id: int, active_config_id:
             to_phone_number=outgoing_msg.contact.whatsapp_id,
             message_type=outgoing_msg.message_type, # This should be 'text', 'template', 'interactive'
             data=outgoing_msg.content_payload, # This is the actual data for the type
-            config=active_config
+            config=active_config,
+            attempt=self.request.retries + 1,
         )
 
         if api_response and api_response.get('messages') and api_response['messages'][0].get('id'):
@@ -144,22 +209,37 @@ def send_whatsapp_message_task(self, outgoing_message_id: int, active_config_id:
         logger.error(f"Exception in send_whatsapp_message_task for Message ID {outgoing_message_id}: {e}", exc_info=True)
         outgoing_msg.status = 'failed'
         outgoing_msg.error_details = {'error': str(e), 'type': type(e).__name__}
+        if isinstance(api_response, dict) and api_response.get('retry_after') is None:
+            # A permanent error, or the request may have reached Meta: a retry could send the message twice.
+            logger.error(f"Send of Message ID {outgoing_message_id} must not be retried. Marking as failed.")
+            _fail_send_permanently(self, outgoing_msg, sequenced)
+            return
         try:
-            # Retry the task if it's a network issue or a temporary problem
-            # Celery will automatically retry based on max_retries and default_retry_delay.
-            raise self.retry(exc=e) # Re-raise to trigger Celery's retry mechanism
+            # Retry after the Graph client's backed-off delay when the send got that far,
+            # otherwise after the task's default_retry_delay.
+            countdown = api_response['retry_after'] if isinstance(api_response, dict) else self.default_retry_delay
+            if sequenced:
+                # Keep the contact's slot until the retry runs, or the next message would overtake this one.
+                extend_inflight(outgoing_msg.contact_id, outgoing_msg.id, countdown)
+            # Release the claim: the request never reached Meta, and the retry claims the message again.
+            Message.objects.filter(pk=outgoing_msg.pk, status='queued').update(status='pending_dispatch')
+            raise self.retry(exc=e, countdown=countdown)
         except self.MaxRetriesExceededError:
             logger.error(f"Max retries exceeded for sending Message ID {outgoing_message_id}.")
             # This is a permanent failure. Save the final state and send the notification signal.
-            outgoing_msg.status_timestamp = timezone.now()
-            outgoing_msg.save(update_fields=['status', 'error_details', 'status_timestamp'])
-            message_send_failed.send(sender=self.__class__, message_instance=outgoing_msg)
+            _fail_send_permanently(self, outgoing_msg, sequenced)
             return # Exit after handling permanent failure
 
     # This block is now only reached on success or during retries (before an exception is raised).
     outgoing_msg.status_timestamp = timezone.now()
     outgoing_msg.save(update_fields=['wamid', 'status', 'error_details', 'status_timestamp'])
 
+    # Accepted by Graph: let the contact's next message go, unless we wait for the status webhook.
+    if sequenced and not settings.META_OUTBOUND_RELEASE_ON_DELIVERY:
+        complete_outbound_message(outgoing_msg.contact_id, outgoing_msg.id)
+    elif sequenced and outgoing_msg.wamid:
+        release_if_status_arrived(outgoing_msg)
+
 
 @shared_task(bind=True, max_retries=3, default_retry_delay=10, queue='msg_sending')
 def send_read_receipt_task(self, wamid: str, config_id: int, show_typing_indicator: bool = False):
@@ -168,7 +248,7 @@ def send_read_receipt_task(self, wamid: str, config_id: int, show_typing_indicat
     """
     logger.info(f"Task send_read_receipt_task started for WAMID: {wamid} (Typing: {show_typing_indicator})")
     try:
-        active_config = MetaAppConfig.objects.get(pk=config_id)
+        active_config = get_config_by_pk(config_id)
     except MetaAppConfig.DoesNotExist:
         logger.error(f"send_read_receipt_task: MetaAppConfig with ID {config_id} not found. Task cannot proceed.")
         return  # Cannot retry if config is missing
@@ -188,6 +268,162 @@ def send_read_receipt_task(self, wamid: str, config_id: int, show_typing_indicat
             logger.error(f"Max retries exceeded for sending read receipt for WAMID {wamid}.")
 
 
+@shared_task(name="meta_integration.process_webhook_inbox_task")
+def process_webhook_inbox_task(batch_size: int = None):
+    """
+    Drains the webhook inbox filled by MetaWebhookAPIView in ack-first mode.
+
+    Entries are claimed in id order in a short transaction (SELECT ... SKIP
+    LOCKED, then claimed_at is set and committed), so several workers can drain
+    concurrently without double-processing and no row lock is held while
+    webhooks are dispatched. Each claimed body then runs through the same
+    dispatch as the synchronous webhook path in its own transaction, which also
+    marks it processed; a failing body is rolled back entirely and stays
+    pending, and its 'unhandled_exception' event log is written after the
+    rollback. A claim left behind by a crashed worker expires after
+    META_WEBHOOK_INBOX_CLAIM_TIMEOUT_SECONDS.
+    """
+    from .views import MetaWebhookAPIView
+
+    log_prefix = "[Webhook Inbox]"
+    batch_size = batch_size or settings.META_WEBHOOK_INBOX_BATCH_SIZE
+    max_attempts = settings.META_WEBHOOK_INBOX_MAX_ATTEMPTS
+    webhook_view = MetaWebhookAPIView()
+    processed_count = failed_count = 0
+    last_seen_id = 0  # Failed entries stay pending; never revisit them within one run.
+
+    while True:
+        with transaction.atomic():
+            now = timezone.now()
+            stale_claim = now - timedelta(seconds=settings.META_WEBHOOK_INBOX_CLAIM_TIMEOUT_SECONDS)
+            batch = list(
+                WebhookInboxEntry.objects.select_for_update(skip_locked=True)
+                .select_related('app_config')
+                .filter(processed_at__isnull=True, attempts__lt=max_attempts, id__gt=last_seen_id)
+                .filter(Q(claimed_at__isnull=True) | Q(claimed_at__lt=stale_claim))
+                .order_by('id')[:batch_size]
+            )
+            if not batch:
+                break
+            for entry in batch:
+                entry.claimed_at = now
+                entry.attempts += 1
+            WebhookInboxEntry.objects.bulk_update(batch, ['claimed_at', 'attempts'])
+        last_seen_id = batch[-1].id
+
+        for entry in batch:
+            payload = None
+            try:
+                with transaction.atomic():
+                    if entry.app_config is None:
+                        raise ValueError("MetaAppConfig for this entry no longer exists.")
+                    payload = json.loads(entry.body)
+                    response = webhook_view.process_payload(payload, entry.app_config, log_failure=False)
+                    if response.status_code != 200:
+                        raise ValueError(f"Dispatch returned HTTP {response.status_code}.")
+                    WebhookInboxEntry.objects.filter(pk=entry.pk).update(
+                        processed_at=timezone.now(), claimed_at=None, last_error=None
+                    )
+            except Exception as e:
+                failed_count += 1
+                WebhookInboxEntry.objects.filter(pk=entry.pk).update(claimed_at=None, last_error=str(e)[:1000])
+                if payload is not None:
+                    # Outside the rolled back transaction, so the failure stays logged.
+                    webhook_view.log_processing_failure(payload, entry.app_config, e, f"inbox entry {entry.id}")
+                if entry.attempts >= max_attempts:
+                    logger.error(f"{log_prefix} Entry {entry.id} failed {entry.attempts} times and will not be retried: {e}")
+                else:
+                    logger.warning(f"{log_prefix} Entry {entry.id} failed (attempt {entry.attempts}): {e}")
+                WEBHOOK_INBOX_ENTRIES_PROCESSED.labels(outcome='failed').inc()
+            else:
+                processed_count += 1
+                WEBHOOK_INBOX_ENTRIES_PROCESSED.labels(outcome='processed').inc()
+
+    pending = WebhookInboxEntry.objects.filter(processed_at__isnull=True, attempts__lt=max_attempts)
+    oldest = pending.order_by('id').values_list('received_at', flat=True).first()
+    depth = pending.count()
+    lag_seconds = (timezone.now() - oldest).total_seconds() if oldest else 0.0
+    WEBHOOK_INBOX_DEPTH.set(depth)
+    WEBHOOK_INBOX_LAG_SECONDS.set(lag_seconds)
+    logger.info(
+        f"{log_prefix} Drained inbox: {processed_count} processed, {failed_count} failed. "
+        f"Depth: {depth}, lag: {lag_seconds:.1f}s."
+    )
+    return {'processed': processed_count, 'failed': failed_count, 'depth': depth, 'lag_seconds': lag_seconds}
+
+
+@shared_task(name="meta_integration.apply_buffered_status_updates_task")
+def apply_buffered_status_updates_task():
+    """
+    Flushes the status buffer filled by the webhook view when META_STATUS_BATCHING
+    is enabled, applying each batch with a single bulk_update.
+    """
+    from .status_updates import (
+        ack_status_batch, apply_status_items, clear_flush_flag, drain_status_buffer,
+        requeue_abandoned_status_batches, requeue_status_batch,
+    )
+
+    log_prefix = "[Status Batch]"
+    clear_flush_flag()
+    requeue_abandoned_status_batches()
+    totals = {'received': 0, 'updated': 0, 'stale': 0, 'unmatched': 0}
+    while True:
+        batch_key, items = drain_status_buffer(settings.META_STATUS_BATCH_SIZE)
+        if not items:
+            break
+        try:
+            # apply_status_items is atomic, so it has committed once it returns.
+            result = apply_status_items(items)
+        except Exception:
+            requeued = requeue_status_batch(batch_key)
+            logger.exception(f"{log_prefix} Failed to apply a batch; requeued {requeued} status callbacks.")
+            raise
+        ack_status_batch(batch_key)
+        for key in totals:
+            totals[key] += result[key]
+
+    if totals['received']:
+        logger.info(
+            f"{log_prefix} Applied {totals['received']} status callbacks: {totals['updated']} messages updated, "
+            f"{totals['stale']} stale, {totals['unmatched']} without a matching outgoing message."
+        )
+    return totals
+
+
+@shared_task(name="meta_integration.send_broadcast_batch_task", queue='msg_sending')
+def send_broadcast_batch_task(message_ids: list, config_id: int):
+    """
+    Sends a batch of pre-rendered broadcast messages concurrently from one task
+    (see bulk_sender.py). Used when BROADCAST_SEND_MODE is 'bulk'.
+    """
+    from .bulk_sender import send_message_batch
+
+    try:
+        config = get_config_by_pk(config_id)
+    except MetaAppConfig.DoesNotExist:
+        logger.error(f"send_broadcast_batch_task: MetaAppConfig with ID {config_id} not found.")
+        Message.objects.filter(id__in=message_ids, status='pending_dispatch').update(
+            status='failed', error_details={'error': f'MetaAppConfig ID {config_id} not found for sending.'},
+            status_timestamp=timezone.now(),
+        )
+        return
+    return send_message_batch(message_ids, config)
+
+
+@shared_task(name="meta_integration.release_stalled_outbound_queues_task")
+def release_stalled_outbound_queues_task():
+    """
+    Releases per-contact outbound queues whose in-flight message never reported
+    back (e.g. a lost task), once its in-flight marker has expired.
+    """
+    from .outbound_sequencer import release_stalled_queues
+
+    released = release_stalled_queues()
+    if released:
+        logger.warning(f"[Outbound Sequencer] Released {released} stalled contact queue(s).")
+    return released
+
+
 @shared_task(name="meta_integration.download_whatsapp_media_task")
 def download_whatsapp_media_task(media_id: str, config_id: int) -> str | None:
     """
@@ -196,7 +432,7 @@ def download_whatsapp_media_task(media_id: str, config_id: int) -> str | None:
     """
     log_prefix = f"[Media Download Task - Media ID: {media_id}]"
     try:
-        config = MetaAppConfig.objects.get(pk=config_id)
+        config = get_config_by_pk(config_id)
         # The download_whatsapp_media function returns a tuple or None.
         download_result = download_whatsapp_media(media_id, config)
 
@@ -1,3 +1,7 @@
+import hashlib
+import hmac
+import json
+
 from django.test import TestCase, override_settings
 from unittest.mock import patch, MagicMock, PropertyMock
 from .catalog_service import MetaCatalogService, PLACEHOLDER_IMAGE_PATH
@@ -409,3 +413,695 @@ class GoogleProductCategoryTestCase(TestCase):
         
         # Verify google_product_category is NOT in the payload
         self.assertNotIn('google_product_category', product_data)
+
+
+class WebhookInboxTestCase(TestCase):
+    """Tests for ack-first webhook ingestion and the inbox consumer."""
+
+    def setUp(self):
+        from .models import MetaAppConfig
+        self.config = MetaAppConfig.objects.create(
+            name='Inbox Config',
+            verify_token='verify',
+            access_token='token',
+            app_secret='secret',
+            phone_number_id='1234567890',
+            waba_id='waba',
+            is_active=True,
+        )
+        self.body = json.dumps({
+            'object': 'whatsapp_business_account',
+            'entry': [{'id': 'waba', 'changes': [{
+                'field': 'messages',
+                'value': {'metadata': {'phone_number_id': '1234567890'}, 'statuses': []},
+            }]}],
+        }).encode('utf-8')
+
+    def _post_webhook(self, signature):
+        from django.test import RequestFactory
+        from .views import MetaWebhookAPIView
+
+        request = RequestFactory().post(
+            '/crm-api/meta/webhook/',
+            data=self.body,
+            content_type='application/json',
+            HTTP_X_HUB_SIGNATURE_256=signature,
+        )
+        return MetaWebhookAPIView.as_view()(request)
+
+    def _signature(self, body):
+        return 'sha256=' + hmac.new(b'secret', body, hashlib.sha256).hexdigest()
+
+    @override_settings(META_WEBHOOK_ACK_FIRST=True)
+    @patch('meta_integration.views.process_webhook_inbox_task')
+    @patch('meta_integration.views.MetaWebhookAPIView.process_payload')
+    def test_ack_first_stores_body_without_processing(self, mock_process_payload, mock_inbox_task):
+        from .models import WebhookInboxEntry
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self._post_webhook(self._signature(self.body))
+
+        self.assertEqual(response.status_code, 200)
+        mock_process_payload.assert_not_called()
+        mock_inbox_task.delay.assert_called_once()
+        entry = WebhookInboxEntry.objects.get()
+        self.assertEqual(entry.body, self.body.decode('utf-8'))
+        self.assertEqual(entry.app_config, self.config)
+        self.assertIsNone(entry.processed_at)
+
+    @override_settings(META_WEBHOOK_ACK_FIRST=True)
+    @patch('meta_integration.views.process_webhook_inbox_task')
+    @patch('meta_integration.views.claim_webhook_event', side_effect=[True, False])
+    def test_ack_first_drops_redelivered_body_before_insert(self, mock_claim, mock_inbox_task):
+        from .models import WebhookInboxEntry
+
+        first = self._post_webhook(self._signature(self.body))
+        second = self._post_webhook(self._signature(self.body))
+
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(WebhookInboxEntry.objects.count(), 1)
+        expected_identifier = f"body_{hashlib.sha256(self.body).hexdigest()}"
+        mock_claim.assert_called_with(expected_identifier, 'delivery')
+
+    @override_settings(META_WEBHOOK_ACK_FIRST=True)
+    def test_ack_first_rejects_bad_signature(self):
+        from .models import WebhookInboxEntry
+
+        response = self._post_webhook('sha256=deadbeef')
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(WebhookInboxEntry.objects.exists())
+
+    @patch('meta_integration.views.MetaWebhookAPIView.process_payload')
+    def test_consumer_processes_entries_and_reports_depth(self, mock_process_payload):
+        from django.http import HttpResponse
+        from .models import WebhookInboxEntry
+        from .tasks import process_webhook_inbox_task
+
+        mock_process_payload.side_effect = [HttpResponse(status=200), HttpResponse(status=500)]
+        ok_entry = WebhookInboxEntry.objects.create(app_config=self.config, body=self.body.decode('utf-8'))
+        failing_entry = WebhookInboxEntry.objects.create(app_config=self.config, body=self.body.decode('utf-8'))
+
+        result = process_webhook_inbox_task(batch_size=10)
+
+        self.assertEqual(result['processed'], 1)
+        self.assertEqual(result['failed'], 1)
+        self.assertEqual(result['depth'], 1)
+        ok_entry.refresh_from_db()
+        failing_entry.refresh_from_db()
+        self.assertIsNotNone(ok_entry.processed_at)
+        self.assertIsNone(failing_entry.processed_at)
+        self.assertEqual(failing_entry.attempts, 1)
+        self.assertIn('500', failing_entry.last_error)
+
+    def test_failed_entry_rolls_back_its_partial_work(self):
+        from .models import WebhookEventLog, WebhookInboxEntry
+        from .tasks import process_webhook_inbox_task
+
+        def partial_dispatch(payload, config, log_failure=True):
+            WebhookEventLog.objects.create(app_config=config, event_identifier='wamid.PARTIAL', event_type='message_text', payload={})
+            raise RuntimeError('dispatch blew up')
+
+        entry = WebhookInboxEntry.objects.create(app_config=self.config, body=self.body.decode('utf-8'))
+        with patch('meta_integration.views.MetaWebhookAPIView.process_payload', side_effect=partial_dispatch):
+            result = process_webhook_inbox_task(batch_size=10)
+
+        self.assertEqual(result['failed'], 1)
+        self.assertFalse(WebhookEventLog.objects.filter(event_identifier='wamid.PARTIAL').exists())
+        failure_log = WebhookEventLog.objects.get(event_type='unhandled_exception')
+        self.assertIn(f"inbox entry {entry.id}", failure_log.processing_notes)
+        self.assertIn('dispatch blew up', failure_log.processing_notes)
+        entry.refresh_from_db()
+        self.assertIsNone(entry.processed_at)
+        self.assertIsNone(entry.claimed_at)
+        self.assertIn('dispatch blew up', entry.last_error)
+
+    @override_settings(META_WEBHOOK_INBOX_CLAIM_TIMEOUT_SECONDS=300)
+    @patch('meta_integration.views.MetaWebhookAPIView.process_payload')
+    def test_only_unclaimed_or_stale_entries_are_taken(self, mock_process_payload):
+        from datetime import timedelta
+        from django.http import HttpResponse
+        from django.utils import timezone
+        from .models import WebhookInboxEntry
+        from .tasks import process_webhook_inbox_task
+
+        mock_process_payload.return_value = HttpResponse(status=200)
+        now = timezone.now()
+        claimed = WebhookInboxEntry.objects.create(app_config=self.config, body=self.body.decode('utf-8'), claimed_at=now)
+        stale = WebhookInboxEntry.objects.create(
+            app_config=self.config, body=self.body.decode('utf-8'), claimed_at=now - timedelta(seconds=600)
+        )
+
+        result = process_webhook_inbox_task(batch_size=10)
+
+        self.assertEqual(result['processed'], 1)
+        claimed.refresh_from_db()
+        stale.refresh_from_db()
+        self.assertIsNone(claimed.processed_at)
+        self.assertIsNotNone(stale.processed_at)
+
+
+class StatusCoalescingTestCase(TestCase):
+    """Tests for the buffered, coalesced status webhook path."""
+
+    def setUp(self):
+        from conversations.models import Contact, Message
+        # bulk_create keeps the dashboard/broadcast post_save handlers (which need a broker) out of the test.
+        self.contact = Contact.objects.bulk_create([Contact(whatsapp_id='263770000001', name='Status Tester')])[0]
+        self.msg_a, self.msg_b = Message.objects.bulk_create([
+            Message(contact=self.contact, wamid='wamid.A', direction='out', message_type='text',
+                    content_payload={'body': 'a'}, status='sent'),
+            Message(contact=self.contact, wamid='wamid.B', direction='out', message_type='text',
+                    content_payload={'body': 'b'}, status='read'),
+        ])
+
+    def _item(self, wamid, status_value, **extra):
+        return {'status': {'id': wamid, 'status': status_value, 'timestamp': '1700000000', **extra},
+                'app_config_id': None, 'waba_id': 'waba', 'phone_number_id': '123'}
+
+    def test_coalesce_keeps_furthest_status_and_conversation(self):
+        from .status_updates import coalesce_status_items
+
+        coalesced = coalesce_status_items([
+            self._item('wamid.A', 'read'),
+            self._item('wamid.A', 'sent', conversation={'id': 'conv-1'}),
+            self._item('wamid.A', 'delivered'),
+        ])
+
+        self.assertEqual(coalesced['wamid.A']['status'], 'read')
+        self.assertEqual(coalesced['wamid.A']['conversation_id'], 'conv-1')
+
+    @override_settings(META_STATUS_EVENT_LOGGING='bulk')
+    def test_apply_updates_in_bulk_without_moving_backwards(self):
+        from .models import WebhookEventLog
+        from .status_updates import apply_status_items
+
+        # savepoint, select messages, bulk_update, bulk_create logs, release
+        with self.assertNumQueries(5):
+            result = apply_status_items([
+                self._item('wamid.A', 'delivered'),
+                self._item('wamid.A', 'read'),
+                self._item('wamid.B', 'delivered'),
+                self._item('wamid.unknown', 'sent'),
+            ])
+
+        self.msg_a.refresh_from_db()
+        self.msg_b.refresh_from_db()
+        self.assertEqual(self.msg_a.status, 'read')
+        self.assertEqual(self.msg_b.status, 'read')
+        self.assertEqual(result, {'received': 4, 'updated': 1, 'stale': 1, 'unmatched': 1})
+        self.assertEqual(WebhookEventLog.objects.filter(event_type='message_status').count(), 4)
+
+    @override_settings(META_STATUS_EVENT_LOGGING='skip')
+    def test_apply_can_skip_log_rows(self):
+        from .models import WebhookEventLog
+        from .status_updates import apply_status_items
+
+        apply_status_items([self._item('wamid.A', 'delivered')])
+
+        self.msg_a.refresh_from_db()
+        self.assertEqual(self.msg_a.status, 'delivered')
+        self.assertFalse(WebhookEventLog.objects.exists())
+
+    @override_settings(META_STATUS_EVENT_LOGGING='skip')
+    def test_failed_status_keeps_meta_errors(self):
+        from .status_updates import apply_status_items
+
+        errors = [{'code': 131026, 'title': 'Message undeliverable'}]
+        apply_status_items([self._item('wamid.A', 'delivered'), self._item('wamid.A', 'failed', errors=errors)])
+
+        self.msg_a.refresh_from_db()
+        self.assertEqual(self.msg_a.status, 'failed')
+        self.assertEqual(self.msg_a.error_details, {'errors': errors})
+
+    @override_settings(META_STATUS_BATCH_SIZE=1000)
+    @patch('meta_integration.status_updates.clear_flush_flag')
+    @patch('meta_integration.status_updates.requeue_abandoned_status_batches')
+    @patch('meta_integration.status_updates.ack_status_batch')
+    @patch('meta_integration.status_updates.requeue_status_batch', return_value=1)
+    @patch('meta_integration.status_updates.apply_status_items', side_effect=RuntimeError('db down'))
+    @patch('meta_integration.status_updates.drain_status_buffer')
+    def test_failed_batch_is_requeued_not_acked(self, mock_drain, mock_apply, mock_requeue, mock_ack, *_):
+        from .tasks import apply_buffered_status_updates_task
+
+        mock_drain.return_value = ('meta:status_buffer:batch:x', [self._item('wamid.A', 'delivered')])
+
+        with self.assertRaises(RuntimeError):
+            apply_buffered_status_updates_task()
+
+        mock_requeue.assert_called_once_with('meta:status_buffer:batch:x')
+        mock_ack.assert_not_called()
+
+    @patch('meta_integration.status_updates.get_redis_client', return_value=None)
+    def test_buffer_reports_unavailable_redis(self, mock_client):
+        from .status_updates import buffer_status_update
+
+        self.assertFalse(buffer_status_update({'id': 'wamid.A', 'status': 'read'}, {}, None))
+
+
+class MetaAppConfigCacheTestCase(TestCase):
+    """Tests for the process-local MetaAppConfig cache."""
+
+    def setUp(self):
+        from .models import MetaAppConfig
+        self.config = MetaAppConfig.objects.create(
+            name='Cached Config', verify_token='verify', access_token='token',
+            phone_number_id='555000111', waba_id='waba', is_active=True,
+        )
+
+    @patch('whatsappcrm_backend.redis_client.get_redis_client', return_value=None)
+    def test_lookups_are_served_from_memory(self, mock_client):
+        from .models import MetaAppConfig
+        from . import config_cache
+
+        config_cache.get_active_config()  # warm the snapshot
+        with self.assertNumQueries(0):
+            self.assertEqual(config_cache.get_config_by_pk(self.config.pk).name, 'Cached Config')
+            self.assertEqual(config_cache.get_config_by_phone_number_id('555000111').pk, self.config.pk)
+            self.assertEqual(MetaAppConfig.objects.get_active_config().pk, self.config.pk)
+        with self.assertRaises(MetaAppConfig.DoesNotExist):
+            config_cache.get_config_by_phone_number_id('unknown')
+
+    @patch('whatsappcrm_backend.redis_client.get_redis_client', return_value=None)
+    def test_save_invalidates_and_copies_are_isolated(self, mock_client):
+        from . import config_cache
+
+        cached = config_cache.get_config_by_pk(self.config.pk)
+        cached.access_token = 'mutated-by-caller'
+        self.assertEqual(config_cache.get_config_by_pk(self.config.pk).access_token, 'token')
+
+        self.config.access_token = 'rotated'
+        self.config.save()
+        self.assertEqual(config_cache.get_config_by_pk(self.config.pk).access_token, 'rotated')
+
+    def test_reloads_when_shared_version_moves(self):
+        from . import config_cache
+
+        mock_redis = MagicMock()
+        mock_redis.get.return_value = b'1'
+        with patch('whatsappcrm_backend.redis_client.get_redis_client', return_value=mock_redis), \
+                override_settings(META_CONFIG_CACHE_CHECK_SECONDS=0):
+            config_cache.get_active_config()
+            with self.assertNumQueries(0):
+                config_cache.get_active_config()
+            mock_redis.get.return_value = b'2'
+            with self.assertNumQueries(1):
+                config_cache.get_active_config()
+
+
+class WebhookIdempotencyGateTestCase(TestCase):
+    """Tests for the Redis SET NX gate in front of webhook processing."""
+
+    def setUp(self):
+        from .models import MetaAppConfig
+        self.config = MetaAppConfig.objects.create(
+            name='Gate Config', verify_token='verify', access_token='token',
+            phone_number_id='777000111', waba_id='waba', is_active=True,
+        )
+        self.payload = {
+            'object': 'whatsapp_business_account',
+            'entry': [{'id': 'waba', 'changes': [{
+                'field': 'messages',
+                'value': {
+                    'metadata': {'phone_number_id': '777000111'},
+                    'statuses': [{'id': 'wamid.GATE', 'status': 'delivered', 'timestamp': '1700000000'}],
+                },
+            }]}],
+        }
+
+    def test_claim_uses_set_nx_with_ttl(self):
+        from .idempotency import claim_webhook_event
+
+        mock_redis = MagicMock()
+        mock_redis.set.side_effect = [True, None]
+        with patch('meta_integration.idempotency.get_redis_client', return_value=mock_redis), \
+                override_settings(META_WEBHOOK_IDEMPOTENCY_TTL_SECONDS=60):
+            self.assertTrue(claim_webhook_event('wamid.X', 'message'))
+            self.assertFalse(claim_webhook_event('wamid.X', 'message'))
+        mock_redis.set.assert_called_with('meta:webhook_event:wamid.X', 1, nx=True, ex=60)
+
+    @patch('meta_integration.views.claim_webhook_event', return_value=False)
+    @patch('meta_integration.views.MetaWebhookAPIView.handle_status_update')
+    def test_duplicate_is_dropped_before_database_work(self, mock_handle_status, mock_claim):
+        from .models import WebhookEventLog
+        from .views import MetaWebhookAPIView
+
+        response = MetaWebhookAPIView().process_payload(self.payload, self.config)
+
+        self.assertEqual(response.status_code, 200)
+        mock_claim.assert_called_once_with('wamid.GATE_delivered', 'status')
+        mock_handle_status.assert_not_called()
+        self.assertFalse(WebhookEventLog.objects.exists())
+
+    @patch('meta_integration.views.claim_webhook_event', return_value=None)
+    @patch('meta_integration.views.MetaWebhookAPIView.handle_status_update')
+    def test_falls_back_to_log_check_without_redis(self, mock_handle_status, mock_claim):
+        from .models import WebhookEventLog
+        from .views import MetaWebhookAPIView
+
+        MetaWebhookAPIView().process_payload(self.payload, self.config)
+
+        mock_handle_status.assert_called_once()
+        self.assertTrue(WebhookEventLog.objects.filter(event_identifier='wamid.GATE_delivered').exists())
+
+
+class OutboundSequencerTestCase(TestCase):
+    """Tests for the per-contact outbound sequencer integration in send_whatsapp_message_task."""
+
+    def setUp(self):
+        from conversations.models import Contact, Message
+        from .models import MetaAppConfig
+        self.config = MetaAppConfig.objects.create(
+            name='Sequencer Config', verify_token='verify', access_token='token',
+            phone_number_id='888000111', waba_id='waba', is_active=True,
+        )
+        self.contact = Contact.objects.bulk_create([Contact(whatsapp_id='263770000002', name='Sequenced')])[0]
+        self.message = Message.objects.bulk_create([
+            Message(contact=self.contact, app_config=self.config, direction='out', message_type='text',
+                    content_payload={'body': 'hello'}, status='pending_dispatch'),
+        ])[0]
+
+    @patch('meta_integration.tasks.send_whatsapp_message')
+    @patch('meta_integration.tasks.enqueue_outbound_message', return_value=True)
+    def test_direct_dispatch_is_handed_to_sequencer(self, mock_enqueue, mock_send):
+        from .tasks import send_whatsapp_message_task
+
+        send_whatsapp_message_task.apply(args=[self.message.id, self.config.id])
+
+        mock_enqueue.assert_called_once_with(self.message.id, self.config.id, self.contact.id)
+        mock_send.assert_not_called()
+
+    @override_settings(META_OUTBOUND_RELEASE_ON_DELIVERY=False)
+    @patch('meta_integration.tasks.complete_outbound_message')
+    @patch('meta_integration.tasks.send_whatsapp_message', return_value={'messages': [{'id': 'wamid.SEQ'}]})
+    def test_sequenced_send_releases_next_on_acceptance(self, mock_send, mock_complete):
+        from .tasks import send_whatsapp_message_task
+
+        send_whatsapp_message_task.apply(args=[self.message.id, self.config.id], kwargs={'sequenced': True})
+
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, 'sent')
+        self.assertEqual(self.message.wamid, 'wamid.SEQ')
+        mock_complete.assert_called_once_with(self.contact.id, self.message.id)
+
+    @override_settings(META_OUTBOUND_RELEASE_ON_DELIVERY=True)
+    @patch('meta_integration.outbound_sequencer.complete_outbound_message')
+    def test_release_on_delivery_waits_for_status(self, mock_complete):
+        from .outbound_sequencer import release_after_status
+
+        self.message.status = 'pending_dispatch'
+        with self.captureOnCommitCallbacks(execute=True):
+            release_after_status(self.message)
+        mock_complete.assert_not_called()
+
+        self.message.status = 'delivered'
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            release_after_status(self.message)
+            mock_complete.assert_not_called()
+        self.assertEqual(len(callbacks), 1)
+        mock_complete.assert_called_once_with(self.contact.id, self.message.id)
+
+    @override_settings(META_OUTBOUND_RELEASE_ON_DELIVERY=True)
+    @patch('meta_integration.tasks.release_if_status_arrived')
+    @patch('meta_integration.tasks.complete_outbound_message')
+    @patch('meta_integration.tasks.send_whatsapp_message', return_value={'messages': [{'id': 'wamid.EARLY'}]})
+    def test_release_on_delivery_checks_for_early_status(self, mock_send, mock_complete, mock_release_if_arrived):
+        from .tasks import send_whatsapp_message_task
+
+        send_whatsapp_message_task.apply(args=[self.message.id, self.config.id], kwargs={'sequenced': True})
+
+        mock_complete.assert_not_called()
+        released_message = mock_release_if_arrived.call_args.args[0]
+        self.assertEqual(released_message.wamid, 'wamid.EARLY')
+
+    @override_settings(META_OUTBOUND_RELEASE_ON_DELIVERY=True, META_OUTBOUND_INFLIGHT_TTL_SECONDS=60)
+    @patch('meta_integration.outbound_sequencer.complete_outbound_message')
+    def test_early_status_releases_once_wamid_is_stored(self, mock_complete):
+        from .outbound_sequencer import release_if_status_arrived, remember_unmatched_statuses
+
+        mock_redis = MagicMock()
+        mock_redis.delete.return_value = 1
+        with patch('meta_integration.outbound_sequencer.get_redis_client', return_value=mock_redis):
+            remember_unmatched_statuses(['wamid.EARLY'])
+            self.message.wamid = 'wamid.EARLY'
+            release_if_status_arrived(self.message)
+
+        mock_redis.pipeline.return_value.set.assert_called_once_with(
+            'meta:outbound_early_status:wamid.EARLY', 1, ex=60
+        )
+        mock_redis.delete.assert_called_once_with('meta:outbound_early_status:wamid.EARLY')
+        mock_complete.assert_called_once_with(self.contact.id, self.message.id)
+
+    @patch('meta_integration.tasks.extend_inflight')
+    @patch('meta_integration.tasks.acquire_send_token', return_value=5.0)
+    @patch('meta_integration.tasks.send_whatsapp_message_task.apply_async')
+    def test_throttle_reschedule_extends_inflight(self, mock_apply_async, mock_throttle, mock_extend):
+        from .tasks import send_whatsapp_message_task
+
+        send_whatsapp_message_task.apply(args=[self.message.id, self.config.id], kwargs={'sequenced': True})
+
+        mock_extend.assert_called_once_with(self.contact.id, self.message.id, 5.0)
+        mock_apply_async.assert_called_once()
+
+
+    @patch('meta_integration.tasks.complete_outbound_message')
+    @patch('meta_integration.tasks.send_whatsapp_message',
+           return_value={'error': 'Read timed out.', 'error_type': 'RequestException', 'retry_after': None})
+    def test_send_that_may_have_reached_meta_fails_without_retry(self, mock_send, mock_complete):
+        from .tasks import send_whatsapp_message_task
+
+        with patch.object(send_whatsapp_message_task, 'retry') as mock_retry:
+            send_whatsapp_message_task.apply(args=[self.message.id, self.config.id], kwargs={'sequenced': True})
+
+        mock_retry.assert_not_called()
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, 'failed')
+        mock_complete.assert_called_once_with(self.contact.id, self.message.id)
+
+    @patch('meta_integration.tasks.extend_inflight')
+    @patch('meta_integration.tasks.send_whatsapp_message',
+           return_value={'error': {'error': {'code': 130429}}, 'status_code': 429, 'retry_after': 4.0})
+    def test_retryable_send_uses_the_graph_delay(self, mock_send, mock_extend):
+        from celery.exceptions import Retry
+        from .tasks import send_whatsapp_message_task
+
+        with patch.object(send_whatsapp_message_task, 'retry', side_effect=Retry()) as mock_retry:
+            send_whatsapp_message_task.apply(args=[self.message.id, self.config.id], kwargs={'sequenced': True})
+
+        self.assertEqual(mock_send.call_args.kwargs['attempt'], 1)
+        self.assertEqual(mock_retry.call_args.kwargs['countdown'], 4.0)
+        # The retry keeps the contact's slot, so the next message can't overtake it.
+        mock_extend.assert_called_once_with(self.contact.id, self.message.id, 4.0)
+        # The claim is released for the retry to take again.
+        self.message.refresh_from_db()
+        self.assertEqual(self.message.status, 'pending_dispatch')
+
+    @patch('meta_integration.tasks.complete_outbound_message')
+    @patch('meta_integration.tasks.send_whatsapp_message')
+    def test_message_claimed_by_another_task_is_not_sent_again(self, mock_send, mock_complete):
+        from conversations.models import Message
+        from .tasks import send_whatsapp_message_task
+
+        Message.objects.filter(pk=self.message.pk).update(status='queued')
+
+        send_whatsapp_message_task.apply(args=[self.message.id, self.config.id], kwargs={'sequenced': True})
+
+        mock_send.assert_not_called()
+        mock_complete.assert_called_once_with(self.contact.id, self.message.id)
+
+class GraphApiClientTestCase(TestCase):
+    """Tests for Meta error classification and retry behaviour in GraphApiClient."""
+
+    def _response(self, status_code, body=None):
+        response = MagicMock()
+        response.status_code = status_code
+        response.headers = {}
+        response.json.return_value = body or {}
+        return response
+
+    def test_classify_graph_error(self):
+        from .graph_client import (
+            classify_graph_error, ERROR_CLASS_RATE_LIMITED, ERROR_CLASS_TRANSIENT,
+            ERROR_CLASS_AUTH, ERROR_CLASS_PERMANENT,
+        )
+        self.assertEqual(classify_graph_error(400, {'error': {'code': 130429}}), ERROR_CLASS_RATE_LIMITED)
+        self.assertEqual(classify_graph_error(401, {'error': {'code': 190}}), ERROR_CLASS_AUTH)
+        self.assertEqual(classify_graph_error(500, {'error': {'code': 131000}}), ERROR_CLASS_TRANSIENT)
+        self.assertEqual(classify_graph_error(400, {'error': {'code': 131026}}), ERROR_CLASS_PERMANENT)
+        self.assertEqual(classify_graph_error(503, None), ERROR_CLASS_TRANSIENT)
+
+    def test_client_sends_once_without_sleeping(self):
+        from .graph_client import GraphApiClient
+
+        client = GraphApiClient()
+        limited = self._response(400, {'error': {'code': 130429}})
+        with patch.object(client.session, 'request', return_value=limited) as mock_request, \
+                patch('meta_integration.graph_client.time.sleep') as mock_sleep:
+            response = client.post('v19.0/123/messages', endpoint='messages', json={})
+
+        self.assertIs(response, limited)
+        mock_request.assert_called_once()
+        self.assertEqual(mock_request.call_args[0][1], 'https://graph.facebook.com/v19.0/123/messages')
+        mock_sleep.assert_not_called()
+
+    @override_settings(GRAPH_API_RETRY_BACKOFF_SECONDS=0.5)
+    def test_retry_delay_for_responses(self):
+        from .graph_client import graph_retry_delay
+
+        limited = self._response(400, {'error': {'code': 130429}})
+        limited.headers = {'Retry-After': '7'}
+        self.assertEqual(graph_retry_delay('POST', response=limited), 7.0)
+        self.assertEqual(graph_retry_delay('GET', response=self._response(500, {'error': {'code': 131000}}), attempt=3), 2.0)
+        # A transient error on a POST may have been processed by Meta.
+        self.assertIsNone(graph_retry_delay('POST', response=self._response(500, {'error': {'code': 131000}})))
+        self.assertIsNone(graph_retry_delay('POST', response=self._response(400, {'error': {'code': 131026}})))
+
+    @override_settings(GRAPH_API_RETRY_BACKOFF_SECONDS=0.5)
+    def test_post_network_errors_retry_only_before_connecting(self):
+        import requests
+        from urllib3.exceptions import MaxRetryError, NewConnectionError, ProtocolError
+        from .graph_client import graph_retry_delay
+
+        refused = requests.exceptions.ConnectionError(
+            MaxRetryError(None, '/messages', reason=NewConnectionError(None, 'Connection refused'))
+        )
+        dropped = requests.exceptions.ConnectionError(ProtocolError('Connection aborted.'))
+
+        self.assertEqual(graph_retry_delay('POST', error=requests.exceptions.ConnectTimeout()), 0.5)
+        self.assertEqual(graph_retry_delay('POST', error=refused), 0.5)
+        self.assertIsNone(graph_retry_delay('POST', error=dropped))
+        self.assertIsNone(graph_retry_delay('POST', error=requests.exceptions.ReadTimeout()))
+        self.assertEqual(graph_retry_delay('GET', error=requests.exceptions.ReadTimeout()), 0.5)
+
+
+class SendThrottleTestCase(TestCase):
+    """Tests for the outbound send throttle."""
+
+    @override_settings(META_THROTTLE_MAX_WAIT_SECONDS=1)
+    @patch('meta_integration.throttle.time.sleep')
+    @patch('meta_integration.throttle.try_acquire_send_token', side_effect=[0.2, 0.0])
+    def test_short_wait_blocks_then_acquires(self, mock_try, mock_sleep):
+        from .throttle import acquire_send_token
+
+        self.assertEqual(acquire_send_token('123', '263770000003'), 0.0)
+        mock_sleep.assert_called_once_with(0.2)
+
+    @override_settings(META_THROTTLE_MAX_WAIT_SECONDS=1)
+    @patch('meta_integration.throttle.time.sleep')
+    @patch('meta_integration.throttle.try_acquire_send_token', return_value=6.0)
+    def test_long_wait_is_returned_to_caller(self, mock_try, mock_sleep):
+        from .throttle import acquire_send_token
+
+        self.assertEqual(acquire_send_token('123', '263770000003'), 6.0)
+        mock_sleep.assert_not_called()
+
+    @patch('meta_integration.throttle.get_redis_client', return_value=None)
+    def test_no_throttle_without_redis(self, mock_redis):
+        from .throttle import try_acquire_send_token
+
+        self.assertEqual(try_acquire_send_token('123'), 0.0)
+
+    @patch('meta_integration.tasks.send_whatsapp_message')
+    @patch('meta_integration.tasks.acquire_send_token', return_value=3.0)
+    def test_throttled_send_is_rescheduled(self, mock_acquire, mock_send):
+        from conversations.models import Contact, Message
+        from .models import MetaAppConfig
+        from .tasks import send_whatsapp_message_task
+
+        config = MetaAppConfig.objects.create(
+            name='Throttle Config', verify_token='verify', access_token='token',
+            phone_number_id='888000222', waba_id='waba', is_active=True,
+        )
+        contact = Contact.objects.bulk_create([Contact(whatsapp_id='263770000003', name='Throttled')])[0]
+        message = Message.objects.bulk_create([
+            Message(contact=contact, app_config=config, direction='out', message_type='text',
+                    content_payload={'body': 'hello'}, status='pending_dispatch'),
+        ])[0]
+
+        with patch.object(send_whatsapp_message_task, 'apply_async') as mock_apply_async:
+            send_whatsapp_message_task.apply(args=[message.id, config.id], kwargs={'sequenced': True})
+
+        mock_acquire.assert_called_once_with('888000222', '263770000003')
+        mock_send.assert_not_called()
+        mock_apply_async.assert_called_once_with(
+            args=[message.id, config.id], kwargs={'sequenced': True}, countdown=3.0
+        )
+
+
+class BulkSenderTestCase(TestCase):
+    """Tests for the concurrent broadcast bulk sender."""
+
+    def setUp(self):
+        from conversations.models import Contact, Message
+        from .models import MetaAppConfig
+        self.config = MetaAppConfig.objects.create(
+            name='Bulk Config', verify_token='verify', access_token='token',
+            phone_number_id='888000333', waba_id='waba', is_active=True,
+        )
+        contacts = Contact.objects.bulk_create([
+            Contact(whatsapp_id=f'26377200000{i}', name=f'Bulk {i}') for i in range(3)
+        ])
+        self.messages = Message.objects.bulk_create([
+            Message(contact=contact, app_config=self.config, direction='out', message_type='template',
+                    content_payload={'name': 'promo'}, status='pending_dispatch')
+            for contact in contacts
+        ])
+
+    @patch('meta_integration.bulk_sender.acquire_send_token', return_value=0.0)
+    @patch('meta_integration.bulk_sender.send_whatsapp_message')
+    def test_batch_writes_back_results(self, mock_send, mock_acquire):
+        from conversations.models import Message
+        from .bulk_sender import send_message_batch
+
+        responses = {
+            '263772000000': {'messages': [{'id': 'wamid.BULK0'}]},
+            '263772000001': {'error': {'code': 131026}, 'status_code': 400, 'error_class': 'permanent'},
+            '263772000002': {'error': {'code': 130429}, 'status_code': 400, 'error_class': 'rate_limited',
+                             'retry_after': 3.0},
+        }
+        mock_send.side_effect = lambda to_phone_number, **kwargs: responses[to_phone_number]
+
+        with patch('meta_integration.tasks.send_whatsapp_message_task.apply_async') as mock_requeue:
+            totals = send_message_batch([m.id for m in self.messages], self.config, concurrency=2)
+
+        self.assertEqual(totals, {'sent': 1, 'failed': 1, 'requeued': 1})
+        statuses = dict(Message.objects.filter(id__in=[m.id for m in self.messages]).values_list('contact__whatsapp_id', 'status'))
+        self.assertEqual(statuses, {'263772000000': 'sent', '263772000001': 'failed', '263772000002': 'pending_dispatch'})
+        self.assertEqual(Message.objects.get(wamid='wamid.BULK0').contact.whatsapp_id, '263772000000')
+        mock_requeue.assert_called_once_with(args=[self.messages[2].id, self.config.id], countdown=3.0)
+        self.assertEqual(mock_acquire.call_count, 3)
+
+    @patch('meta_integration.bulk_sender.acquire_send_token', return_value=0.0)
+    @patch('meta_integration.bulk_sender.send_whatsapp_message')
+    def test_exception_fails_only_its_message(self, mock_send, mock_acquire):
+        from conversations.models import Message
+        from .bulk_sender import send_message_batch
+
+        def send(to_phone_number, **kwargs):
+            if to_phone_number == '263772000001':
+                raise KeyError('components')
+            return {'messages': [{'id': f'wamid.{to_phone_number}'}]}
+        mock_send.side_effect = send
+
+        totals = send_message_batch([m.id for m in self.messages], self.config, concurrency=2)
+
+        self.assertEqual(totals, {'sent': 2, 'failed': 1, 'requeued': 0})
+        failed = Message.objects.get(contact__whatsapp_id='263772000001')
+        self.assertEqual(failed.status, 'failed')
+        self.assertEqual(failed.error_details['error_type'], 'KeyError')
+
+    @patch('meta_integration.bulk_sender.acquire_send_token', return_value=0.0)
+    @patch('meta_integration.bulk_sender.send_whatsapp_message')
+    def test_batch_skips_messages_claimed_elsewhere(self, mock_send, mock_acquire):
+        from conversations.models import Message
+        from .bulk_sender import send_message_batch
+
+        Message.objects.filter(pk=self.messages[0].pk).update(status='queued')
+        Message.objects.filter(pk=self.messages[1].pk).update(status='delivered')
+        mock_send.return_value = {'messages': [{'id': 'wamid.BULK2'}]}
+
+        totals = send_message_batch([m.id for m in self.messages], self.config, concurrency=2)
+
+        self.assertEqual(totals, {'sent': 1, 'failed': 0, 'requeued': 0})
+        mock_send.assert_called_once()
+        self.assertEqual(mock_send.call_args.kwargs['to_phone_number'], '263772000002')
@@ -0,0 +1,116 @@
+# whatsappcrm_backend/meta_integration/throttle.py
+
+"""
+Distributed token-bucket throttle for outbound messages.
+
+Every messaging worker shares one Redis bucket per sending number
+(MetaAppConfig.phone_number_id), refilled at META_THROTTLE_MESSAGES_PER_SECOND
+up to META_THROTTLE_BURST tokens. When META_THROTTLE_PAIR_PER_MINUTE is set,
+a second, smaller bucket per (sending number, recipient) pair mirrors Meta's
+pair rate limit. Both buckets are checked and debited in one Lua call, so a
+message only consumes tokens when it is allowed through.
+
+Without Redis, sends are not throttled and Graph rate-limit errors are left to
+the sending task's retry (see graph_retry_delay in graph_client.py).
+"""
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+from whatsappcrm_backend.redis_client import get_redis_client, mark_redis_unavailable
+from .metrics import SEND_THROTTLE_TOKENS, SEND_THROTTLE_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+THROTTLE_KEY_PREFIX = 'meta:throttle:'
+
+# KEYS[1] = number bucket, KEYS[2] = pair bucket (optional)
+# ARGV = now, number rate, number burst, pair rate, pair burst
+# Returns {allowed, number tokens left (string), wait in seconds (string)}.
+_TOKEN_BUCKET_LUA = """
+local now = tonumber(ARGV[1])
+local function refill(key, rate, burst)
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    return math.min(burst, tokens + math.max(0, now - ts) * rate)
+end
+local function store(key, tokens, rate, burst)
+    redis.call('HSET', key, 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+
+local rate, burst = tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = refill(KEYS[1], rate, burst)
+local wait = 0
+if tokens < 1 then wait = (1 - tokens) / rate end
+
+local pair_tokens, pair_rate, pair_burst
+if #KEYS > 1 then
+    pair_rate, pair_burst = tonumber(ARGV[4]), tonumber(ARGV[5])
+    pair_tokens = refill(KEYS[2], pair_rate, pair_burst)
+    if pair_tokens < 1 then wait = math.max(wait, (1 - pair_tokens) / pair_rate) end
+end
+
+if wait > 0 then
+    return {0, tostring(tokens), tostring(wait)}
+end
+store(KEYS[1], tokens - 1, rate, burst)
+if #KEYS > 1 then store(KEYS[2], pair_tokens - 1, pair_rate, pair_burst) end
+return {1, tostring(tokens - 1), '0'}
+"""
+
+
+def try_acquire_send_token(phone_number_id: str, recipient: str = None) -> float:
+    """
+    Tries to take one token for a message from `phone_number_id` to `recipient`.
+    Returns 0.0 when the message may be sent now, otherwise the number of
+    seconds until a token is expected to be available. Returns 0.0 if Redis is
+    unavailable.
+    """
+    client = get_redis_client()
+    if client is None:
+        return 0.0
+    keys = [f"{THROTTLE_KEY_PREFIX}{phone_number_id}"]
+    pair_rate = settings.META_THROTTLE_PAIR_PER_MINUTE / 60.0
+    if recipient and pair_rate > 0:
+        keys.append(f"{THROTTLE_KEY_PREFIX}{phone_number_id}:{recipient}")
+    try:
+        allowed, tokens, wait = client.register_script(_TOKEN_BUCKET_LUA)(keys=keys, args=[
+            time.time(),
+            settings.META_THROTTLE_MESSAGES_PER_SECOND, settings.META_THROTTLE_BURST,
+            pair_rate, settings.META_THROTTLE_PAIR_BURST,
+        ])
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return 0.0
+    SEND_THROTTLE_TOKENS.labels(phone_number_id=phone_number_id).set(float(tokens))
+    return 0.0 if allowed else float(wait)
+
+
+def acquire_send_token(phone_number_id: str, recipient: str = None, max_wait: float = None) -> float:
+    """
+    Blocks (cooperatively under gevent) until a token is available or `max_wait`
+    seconds (default META_THROTTLE_MAX_WAIT_SECONDS) have been spent waiting.
+
+    Returns 0.0 once a token has been taken. Otherwise returns the remaining
+    expected wait, so the caller can reschedule the send instead of holding a
+    worker slot.
+    """
+    if max_wait is None:
+        max_wait = settings.META_THROTTLE_MAX_WAIT_SECONDS
+    started = time.monotonic()
+    while True:
+        wait = try_acquire_send_token(phone_number_id, recipient)
+        waited = time.monotonic() - started
+        if not wait:
+            if waited:
+                SEND_THROTTLE_WAIT_SECONDS.labels(phone_number_id=phone_number_id).observe(waited)
+            return 0.0
+        if waited + wait > max_wait:
+            SEND_THROTTLE_WAIT_SECONDS.labels(phone_number_id=phone_number_id).observe(waited)
+            logger.info(f"Send throttle for {phone_number_id}: no token within {max_wait}s, deferring by {wait:.2f}s.")
+            return wait
+        time.sleep(wait)
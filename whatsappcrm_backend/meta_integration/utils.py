@@ -7,6 +7,7 @@ from typing import Optional, Tuple
 # from django.conf import settings # No longer using settings for API creds
 from .models import MetaAppConfig # Import the model
 from django.core.exceptions import ObjectDoesNotExist
+from .graph_client import get_graph_client, classify_graph_error, graph_api_base_url, graph_retry_delay
 
 logger = logging.getLogger(__name__)
 
@@ -24,7 +25,7 @@ def get_active_meta_config_for_sending():
         logger.critical("CRITICAL: Multiple active Meta App Configurations found. Please fix in Django Admin. Message sending may be unpredictable.")
         return None # Or select the first one, but it's better to enforce a single active config
 
-def send_whatsapp_message(to_phone_number: str, message_type: str, data: dict, config: MetaAppConfig = None):
+def send_whatsapp_message(to_phone_number: str, message_type: str, data: dict, config: MetaAppConfig = None, attempt: int = 1):
     """
     Sends a WhatsApp message using the Meta Graph API.
     Uses MetaAppConfig from the database.
@@ -35,9 +36,13 @@ def send_whatsapp_message(to_phone_number: str, message_type: str, data: dict, c
         data (dict): The payload specific to the message type.
         config (MetaAppConfig, optional): The MetaAppConfig instance to use. 
                                           If None, tries to fetch the active one.
+        attempt (int, optional): 1 for the first send; the 'retry_after' of a failed
+                                 send backs off with it.
     Returns:
         dict: The JSON response from Meta API on success.
-              On error, returns a dict with 'error' key containing error details.
+              On error, returns a dict with 'error' key containing error details
+              and 'retry_after', the seconds to wait before retrying (None if the
+              send must not be retried, see graph_retry_delay).
               Returns None only if config is not available.
     """
     if not config:
@@ -56,7 +61,7 @@ def send_whatsapp_message(to_phone_number: str, message_type: str, data: dict, c
     #     logger.error("Meta API settings (version, phone_number_id, access_token) are not configured in the active DB record.")
     #     return None
 
-    url = f"https://graph.facebook.com/{api_version}/{phone_number_id}/messages"
+    url = f"{graph_api_base_url()}/{api_version}/{phone_number_id}/messages"
     
     headers = {
         "Authorization": f"Bearer {access_token}",
@@ -79,7 +84,7 @@ def send_whatsapp_message(to_phone_number: str, message_type: str, data: dict, c
     logger.debug(f"Sending WhatsApp message via config '{config.name}'. URL: {url}, Payload: {json.dumps(payload)}")
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=20)
+        response = get_graph_client().post(url, endpoint='messages', headers=headers, json=payload, timeout=20)
         response.raise_for_status()
         
         response_json = response.json()
@@ -95,26 +100,33 @@ def send_whatsapp_message(to_phone_number: str, message_type: str, data: dict, c
             return {
                 'error': error_details,
                 'status_code': e.response.status_code,
-                'error_type': 'HTTPError'
+                'error_type': 'HTTPError',
+                'error_class': classify_graph_error(e.response.status_code, error_details),
+                'retry_after': graph_retry_delay('POST', response=e.response, attempt=attempt, endpoint='messages'),
             }
         except json.JSONDecodeError:
             logger.error("Could not decode Meta API error response as JSON.")
             return {
                 'error': e.response.text,
                 'status_code': e.response.status_code,
-                'error_type': 'HTTPError'
+                'error_type': 'HTTPError',
+                'error_class': classify_graph_error(e.response.status_code, None),
+                'retry_after': graph_retry_delay('POST', response=e.response, attempt=attempt, endpoint='messages'),
             }
     except requests.exceptions.RequestException as e:
         logger.error(f"Error sending message to {to_phone_number} via config '{config.name}': {e}")
         return {
             'error': str(e),
-            'error_type': 'RequestException'
+            'error_type': 'RequestException',
+            # None unless the connection was never established, as Meta may have accepted the message.
+            'retry_after': graph_retry_delay('POST', error=e, attempt=attempt, endpoint='messages'),
         }
     except Exception as e:
         logger.error(f"An unexpected error occurred while sending message to {to_phone_number} via config '{config.name}': {e}", exc_info=True)
         return {
             'error': str(e),
-            'error_type': type(e).__name__
+            'error_type': type(e).__name__,
+            'retry_after': None,  # The request may have gone out; don't send it again.
         }
 
 def send_read_receipt_api(wamid: str, config: MetaAppConfig, show_typing_indicator: bool = False):
@@ -152,7 +164,7 @@ def send_read_receipt_api(wamid: str, config: MetaAppConfig, show_typing_indicat
     logger.debug(f"Sending read receipt via config '{config.name}'. URL: {url}, Payload: {json.dumps(payload)}")
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=15)
+        response = get_graph_client().post(url, endpoint='read_receipt', headers=headers, json=payload, timeout=15)
         response.raise_for_status()
         
         response_json = response.json()
@@ -226,7 +238,7 @@ def download_whatsapp_media(media_id: str, config: MetaAppConfig) -> Optional[Tu
     headers = {"Authorization": f"Bearer {config.access_token}"}
     
     try:
-        response = requests.get(get_url_endpoint, headers=headers, timeout=10)
+        response = get_graph_client().get(get_url_endpoint, endpoint='media_info', headers=headers, timeout=10)
         response.raise_for_status()
         media_info = response.json()
         media_url = media_info.get("url")
@@ -237,8 +249,9 @@ def download_whatsapp_media(media_id: str, config: MetaAppConfig) -> Optional[Tu
             return None
 
         # 2. Download Media Content from the obtained URL
-        media_response = requests.get(
+        media_response = get_graph_client().get(
             media_url,
+            endpoint='media_download',
             headers={"Authorization": f"Bearer {config.access_token}"},
             timeout=20
         )
@@ -22,7 +22,7 @@ from rest_framework.exceptions import ParseError
 
 
 
-from .models import MetaAppConfig, WebhookEventLog # EVENT_TYPE_CHOICES removed from here
+from .models import MetaAppConfig, WebhookEventLog, WebhookInboxEntry # EVENT_TYPE_CHOICES removed from here
 from .serializers import (
     MetaAppConfigSerializer,
     WebhookEventLogSerializer,
@@ -34,7 +34,11 @@ from .serializers import (
 # from flows.services import process_message_for_flow # Imported locally in _handle_message
 # from conversations.services import get_or_create_contact_by_wa_id # Imported locally in post
 from conversations.models import Message # Imported locally in _handle_message
-from .tasks import send_read_receipt_task
+from .tasks import send_read_receipt_task, process_webhook_inbox_task
+from .status_updates import buffer_status_update
+from .config_cache import get_config_by_phone_number_id
+from .idempotency import claim_webhook_event, release_webhook_events
+from .outbound_sequencer import RELEASE_STATUSES, release_after_status, remember_unmatched_statuses
 
 logger = logging.getLogger('meta_integration') # Using the app-specific logger from your original file
 
@@ -166,10 +170,7 @@ class MetaWebhookAPIView(View):
         logger.debug("Webhook signature verified successfully.")
         return True
 
-    @transaction.atomic
     def post(self, request: HttpRequest, *args, **kwargs): # app_id_or_name removed as it's not in urls.py for this view
-        from conversations.services import get_or_create_contact_by_wa_id
-
         logger.info("Webhook POST request received.")
         logger.debug(f"Request headers: {request.headers}")
 
@@ -192,7 +193,7 @@ class MetaWebhookAPIView(View):
         try:
             phone_id_from_payload = payload.get("entry", [{}])[0].get("changes", [{}])[0].get("value", {}).get("metadata", {}).get("phone_number_id")
             if phone_id_from_payload:
-                target_config = MetaAppConfig.objects.get(phone_number_id=phone_id_from_payload)
+                target_config = get_config_by_phone_number_id(phone_id_from_payload)
             else:
                 logger.warning("Could not find phone_number_id in webhook payload. Will fall back to active config if possible.")
                 target_config = get_active_meta_config()
@@ -226,135 +227,198 @@ class MetaWebhookAPIView(View):
             )
             return HttpResponse("Invalid signature", status=403)
 
+        # 4. Ack-first mode: persist the verified body and let the inbox consumer do the work.
+        if getattr(settings, 'META_WEBHOOK_ACK_FIRST', False):
+            # A redelivery carries the same body, so drop it before it becomes a second inbox row.
+            delivery_identifier = f"body_{hashlib.sha256(request.body).hexdigest()}"
+            claimed = claim_webhook_event(delivery_identifier, 'delivery')
+            if claimed is False:
+                return HttpResponse("EVENT_RECEIVED", status=200)
+            try:
+                inbox_entry = WebhookInboxEntry.objects.create(app_config=target_config, body=raw_payload_str)
+            except Exception:
+                if claimed:
+                    release_webhook_events([delivery_identifier])
+                raise
+            transaction.on_commit(lambda: process_webhook_inbox_task.delay())
+            logger.info(f"Webhook body stored in inbox (Entry ID: {inbox_entry.id}). Acknowledging immediately.")
+            return HttpResponse("EVENT_RECEIVED", status=200)
+
+        try:
+            return self.process_payload(payload, target_config)
+        except Exception:
+            return HttpResponse("Internal Server Error processing event.", status=500)
+
+    def process_payload(self, payload: dict, target_config: MetaAppConfig, log_failure: bool = True):
+        """
+        Dispatches every entry/change of an already verified webhook payload.
+        Called inline by `post`, or by `process_webhook_inbox_task` in ack-first mode.
+
+        All of the dispatch runs in one transaction. If it fails, that transaction
+        is rolled back, the idempotency claims are released, the failure is
+        logged and the exception is re-raised to the caller. A caller that runs
+        this inside its own transaction passes `log_failure=False` and calls
+        log_processing_failure() once that transaction has rolled back.
+        """
+        from conversations.services import get_or_create_contact_by_wa_id
+
         log_entry = None # Initialize
+        claimed_identifiers = [] # Released again if processing fails, so Meta's retry is not suppressed
         base_log_defaults = {
             'app_config': target_config, 'payload_object_type': payload.get("object")
         }
 
         try:
-            # The complex dispatch logic from your meta_integration/views.py post method
-            # (identifying messages, statuses, errors from payload structure)
-            if payload.get("object") == "whatsapp_business_account":
-                for entry_idx, entry in enumerate(payload.get("entry", [])):
-                    waba_id = entry.get("id")
-                    for change_idx, change in enumerate(entry.get("changes", [])):
-                        value = change.get("value", {})
-                        field = change.get("field")
-                        metadata = value.get("metadata", {})
-                        phone_id = metadata.get("phone_number_id")
-                        logger.info(f"Processing entry[{entry_idx}].change[{change_idx}]: field='{field}', phone_id='{phone_id}'")
-                        log_defaults_for_change = {**base_log_defaults, 'waba_id_received': waba_id, 'phone_number_id_received': phone_id}
-
-                        if field == "messages":
-                            if "messages" in value:
-                                for msg_data in value["messages"]:
-                                    wamid = msg_data.get("id")
-                                    # Use update_or_create for WebhookEventLog to handle retries from Meta
-                                    log_entry, created_log = WebhookEventLog.objects.update_or_create(
-                                        event_identifier=wamid,
-                                        app_config=target_config,
-                                        defaults={
-                                            'payload_object_type': payload.get("object"),
-                                            'waba_id_received': waba_id,
-                                            'phone_number_id_received': phone_id,
-                                            'event_type': f"message_{msg_data.get('type', 'unknown')}",
-                                            'payload': msg_data,
-                                            'processing_status': 'pending' # Reset to pending if reprocessing
-                                        }
-                                    )
-                                    if created_log or log_entry.processing_status in ['pending', 'pending_reprocessing', 'error']: # Process if new or needs reprocessing
-                                        contact_wa_id = msg_data.get("from")
-                                        profile_name = value.get("contacts", [{}])[0].get("profile", {}).get("name", "Unknown")
-                                        contact, _ = get_or_create_contact_by_wa_id(
-                                            wa_id=contact_wa_id,
-                                            name=profile_name,
-                                            meta_app_config=target_config
+            with transaction.atomic():
+                # The complex dispatch logic from your meta_integration/views.py post method
+                # (identifying messages, statuses, errors from payload structure)
+                if payload.get("object") == "whatsapp_business_account":
+                    for entry_idx, entry in enumerate(payload.get("entry", [])):
+                        waba_id = entry.get("id")
+                        for change_idx, change in enumerate(entry.get("changes", [])):
+                            value = change.get("value", {})
+                            field = change.get("field")
+                            metadata = value.get("metadata", {})
+                            phone_id = metadata.get("phone_number_id")
+                            logger.info(f"Processing entry[{entry_idx}].change[{change_idx}]: field='{field}', phone_id='{phone_id}'")
+                            log_defaults_for_change = {**base_log_defaults, 'waba_id_received': waba_id, 'phone_number_id_received': phone_id}
+
+                            if field == "messages":
+                                if "messages" in value:
+                                    for msg_data in value["messages"]:
+                                        wamid = msg_data.get("id")
+                                        # Fast idempotency gate; None means Redis is down and the log check below decides.
+                                        claimed = claim_webhook_event(wamid, 'message')
+                                        if claimed is False:
+                                            continue
+                                        if claimed:
+                                            claimed_identifiers.append(wamid)
+                                        # Use update_or_create for WebhookEventLog to handle retries from Meta
+                                        log_entry, created_log = WebhookEventLog.objects.update_or_create(
+                                            event_identifier=wamid,
+                                            app_config=target_config,
+                                            defaults={
+                                                'payload_object_type': payload.get("object"),
+                                                'waba_id_received': waba_id,
+                                                'phone_number_id_received': phone_id,
+                                                'event_type': f"message_{msg_data.get('type', 'unknown')}",
+                                                'payload': msg_data,
+                                                'processing_status': 'pending' # Reset to pending if reprocessing
+                                            }
                                         )
-                                        self._handle_message(msg_data, metadata, value, target_config, log_entry, contact)
-                                    else:
-                                        logger.info(f"Skipping already processed/ignored WebhookEventLog for WAMID: {wamid} (DB ID: {log_entry.id})")
+                                        if created_log or log_entry.processing_status in ['pending', 'pending_reprocessing', 'error']: # Process if new or needs reprocessing
+                                            contact_wa_id = msg_data.get("from")
+                                            profile_name = value.get("contacts", [{}])[0].get("profile", {}).get("name", "Unknown")
+                                            contact, _ = get_or_create_contact_by_wa_id(
+                                                wa_id=contact_wa_id,
+                                                name=profile_name,
+                                                meta_app_config=target_config
+                                            )
+                                            self._handle_message(msg_data, metadata, value, target_config, log_entry, contact)
+                                            if claimed and log_entry.processing_status == 'error':
+                                                # Keep 'error' events open to Meta's retry, as the log check above does.
+                                                release_webhook_events([wamid])
+                                                claimed_identifiers.remove(wamid)
+                                        else:
+                                            logger.info(f"Skipping already processed/ignored WebhookEventLog for WAMID: {wamid} (DB ID: {log_entry.id})")
                             
-                            elif "statuses" in value:
-                                for status_data in value["statuses"]:
-                                    wamid = status_data.get("id") # This is the WAMID of the message being updated
-                                    status_val = status_data.get("status")
+                                elif "statuses" in value:
+                                    for status_data in value["statuses"]:
+                                        wamid = status_data.get("id") # This is the WAMID of the message being updated
+                                        status_val = status_data.get("status")
                                     
-                                    # Create a more unique identifier for status updates to avoid overwriting.
-                                    # A single message (wamid) can have multiple statuses (sent, delivered, read).
-                                    status_identifier = f"{wamid}_{status_val}"
-
-                                    log_entry, _ = WebhookEventLog.objects.update_or_create(
-                                        event_identifier=status_identifier, app_config=target_config,
-                                        defaults={'event_type': 'message_status', 
-                                                  **log_defaults_for_change, 'payload': status_data, 
-                                                  'processing_status': 'pending'}
-                                    )
-                                    self.handle_status_update(status_data, metadata, target_config, log_entry)
-                            # Add elif for "errors" here similar to above if needed
-                            elif "errors" in value:
-                                for error_data in value["errors"]:
-                                    # This is for errors related to a specific message attempt
-                                    error_code = error_data.get('code')
-                                    log_id = f"error_{error_code}_{timezone.now().timestamp()}"
-                                    log_entry, _ = WebhookEventLog.objects.update_or_create(
-                                        event_identifier=log_id, app_config=target_config, event_type='error',
-                                        defaults={**log_defaults_for_change, 'payload': error_data, 'processing_status': 'pending'}
-                                    )
-                                    self.handle_error_notification(error_data, metadata, target_config, log_entry)
+                                        # Create a more unique identifier for status updates to avoid overwriting.
+                                        # A single message (wamid) can have multiple statuses (sent, delivered, read).
+                                        status_identifier = f"{wamid}_{status_val}"
+
+                                        claimed = claim_webhook_event(status_identifier, 'status')
+                                        if claimed is False:
+                                            continue
+                                        if claimed:
+                                            claimed_identifiers.append(status_identifier)
+
+                                        # Batched path: buffer in Redis and let the flush task coalesce and bulk-apply.
+                                        if settings.META_STATUS_BATCHING and buffer_status_update(status_data, metadata, target_config, waba_id):
+                                            continue
+
+                                        log_entry, _ = WebhookEventLog.objects.update_or_create(
+                                            event_identifier=status_identifier, app_config=target_config,
+                                            defaults={'event_type': 'message_status', 
+                                                      **log_defaults_for_change, 'payload': status_data, 
+                                                      'processing_status': 'pending'}
+                                        )
+                                        self.handle_status_update(status_data, metadata, target_config, log_entry)
+                                        if claimed and log_entry.processing_status == 'error':
+                                            release_webhook_events([status_identifier])
+                                            claimed_identifiers.remove(status_identifier)
+                                # Add elif for "errors" here similar to above if needed
+                                elif "errors" in value:
+                                    for error_data in value["errors"]:
+                                        # This is for errors related to a specific message attempt
+                                        error_code = error_data.get('code')
+                                        log_id = f"error_{error_code}_{timezone.now().timestamp()}"
+                                        log_entry, _ = WebhookEventLog.objects.update_or_create(
+                                            event_identifier=log_id, app_config=target_config, event_type='error',
+                                            defaults={**log_defaults_for_change, 'payload': error_data, 'processing_status': 'pending'}
+                                        )
+                                        self.handle_error_notification(error_data, metadata, target_config, log_entry)
+                                else:
+                                    logger.warning(f"Change field is 'messages' but no 'messages' or 'statuses' key. Value keys: {value.keys()}")
+                            # Add other field handlers ('message_template_status_update', etc.)
+                            elif field == "account_update":
+                                log_entry, _ = WebhookEventLog.objects.update_or_create(
+                                    event_identifier=f"{field}_{value.get('event', 'unknown')}_{entry.get('id', 'unknown')}_{timezone.now().timestamp()}",
+                                    app_config=target_config, event_type='account_update',
+                                    defaults={**log_defaults_for_change, 'payload': value, 'processing_status': 'pending'}
+                                )
+                                self.handle_account_update(value, metadata, target_config, log_entry)
+                            elif field == "message_template_status_update":
+                                log_entry, _ = WebhookEventLog.objects.update_or_create(
+                                    event_identifier=f"{field}_{value.get('message_template_id')}_{value.get('event')}",
+                                    app_config=target_config, event_type='template_status',
+                                    defaults={**log_defaults_for_change, 'payload': value, 'processing_status': 'pending'}
+                                )
+                                self.handle_template_status_update(value, metadata, target_config, log_entry)
                             else:
-                                logger.warning(f"Change field is 'messages' but no 'messages' or 'statuses' key. Value keys: {value.keys()}")
-                        # Add other field handlers ('message_template_status_update', etc.)
-                        elif field == "account_update":
-                            log_entry, _ = WebhookEventLog.objects.update_or_create(
-                                event_identifier=f"{field}_{value.get('event', 'unknown')}_{entry.get('id', 'unknown')}_{timezone.now().timestamp()}",
-                                app_config=target_config, event_type='account_update',
-                                defaults={**log_defaults_for_change, 'payload': value, 'processing_status': 'pending'}
-                            )
-                            self.handle_account_update(value, metadata, target_config, log_entry)
-                        elif field == "message_template_status_update":
-                            log_entry, _ = WebhookEventLog.objects.update_or_create(
-                                event_identifier=f"{field}_{value.get('message_template_id')}_{value.get('event')}",
-                                app_config=target_config, event_type='template_status',
-                                defaults={**log_defaults_for_change, 'payload': value, 'processing_status': 'pending'}
-                            )
-                            self.handle_template_status_update(value, metadata, target_config, log_entry)
-                        else:
-                            generic_event_id = f"{field}_{entry.get('id', 'unknown')}_{change_idx}_{timezone.now().timestamp()}"
-                            log_entry, _ = WebhookEventLog.objects.update_or_create(
-                                event_identifier=generic_event_id, app_config=target_config, event_type=field or 'unknown_field',
-                                defaults={**log_defaults_for_change, 'payload': value, 'processing_status': 'pending'}
-                            )
-                            logger.warning(f"Unhandled change field '{field}'. Logged with ID {log_entry.id}")
-                            self._save_log(log_entry, 'ignored', f"Unhandled field: {field}")
-
-
-            else: # Other object types
-                generic_event_id = f"{payload.get('object', 'unknown_object')}_{timezone.now().timestamp()}"
-                log_entry, _ = WebhookEventLog.objects.update_or_create(
-                    event_identifier=generic_event_id, app_config=target_config,
-                    defaults={**base_log_defaults, 'payload': payload, 'processing_status': 'pending'}
-                )
-                logger.warning(f"Received webhook for unhandled object type: {payload.get('object')}")
-                self._save_log(log_entry, 'ignored', f"Unhandled object: {payload.get('object')}")
+                                generic_event_id = f"{field}_{entry.get('id', 'unknown')}_{change_idx}_{timezone.now().timestamp()}"
+                                log_entry, _ = WebhookEventLog.objects.update_or_create(
+                                    event_identifier=generic_event_id, app_config=target_config, event_type=field or 'unknown_field',
+                                    defaults={**log_defaults_for_change, 'payload': value, 'processing_status': 'pending'}
+                                )
+                                logger.warning(f"Unhandled change field '{field}'. Logged with ID {log_entry.id}")
+                                self._save_log(log_entry, 'ignored', f"Unhandled field: {field}")
+
+
+                else: # Other object types
+                    generic_event_id = f"{payload.get('object', 'unknown_object')}_{timezone.now().timestamp()}"
+                    log_entry, _ = WebhookEventLog.objects.update_or_create(
+                        event_identifier=generic_event_id, app_config=target_config,
+                        defaults={**base_log_defaults, 'payload': payload, 'processing_status': 'pending'}
+                    )
+                    logger.warning(f"Received webhook for unhandled object type: {payload.get('object')}")
+                    self._save_log(log_entry, 'ignored', f"Unhandled object: {payload.get('object')}")
 
-            return HttpResponse("EVENT_RECEIVED", status=200)
+                return HttpResponse("EVENT_RECEIVED", status=200)
 
         except Exception as e: # Catch-all for other unexpected errors during processing
             logger.error(f"General error processing webhook: {e}", exc_info=True)
-            current_payload_for_log = payload if 'payload' in locals() else {'raw_error_body': raw_payload_str, 'exception_point': 'general_processing'}
-            
-            if log_entry and log_entry.pk: # If log_entry was created
-                self._save_log(log_entry, 'failed', f"General processing error: {str(e)[:250]}")
-            else: # If error happened before log_entry for this specific event part was created
-                 WebhookEventLog.objects.create(
-                    **base_log_defaults,
-                    event_identifier=f"error_{timezone.now().timestamp()}",
-                    processing_status='failed',
-                    payload=current_payload_for_log,
-                    event_type='unhandled_exception',
-                    processing_notes=f"General processing error: {str(e)[:250]}"
-                )
-            return HttpResponse("Internal Server Error processing event.", status=500)
+            release_webhook_events(claimed_identifiers)
+            # Event log rows written during dispatch were rolled back, so record the failure separately.
+            if log_failure:
+                self.log_processing_failure(payload, target_config, e, log_entry.event_identifier if log_entry else None)
+            raise
+
+    def log_processing_failure(self, payload: dict, target_config: MetaAppConfig, error: Exception, location: str = None):
+        """Records a payload whose dispatch failed as an 'unhandled_exception' WebhookEventLog."""
+        WebhookEventLog.objects.create(
+            app_config=target_config,
+            payload_object_type=payload.get("object"),
+            event_identifier=f"error_{timezone.now().timestamp()}",
+            processing_status='failed',
+            payload=payload,
+            event_type='unhandled_exception',
+            processing_notes=f"General processing error{f' at {location}' if location else ''}: {str(error)[:250]}"
+        )
 
     # _save_log method from your original file
     def _save_log(self, log_entry: WebhookEventLog, status_val: str, notes: str = None):
@@ -877,9 +941,13 @@ class MetaWebhookAPIView(View):
                     msg_to_update.pricing_model_from_meta = status_data['pricing'].get('pricing_model')
                     update_fields_list.append('pricing_model_from_meta')
                 msg_to_update.save(update_fields=update_fields_list)
+                release_after_status(msg_to_update)
                 notes.append("DB record updated.")
                 self._save_log(log_entry, 'processed', " ".join(notes))
-            else: self._save_log(log_entry, 'ignored', f"No matching outgoing msg for WAMID {wamid}.")
+            else:
+                if status_value in RELEASE_STATUSES:
+                    remember_unmatched_statuses([wamid])
+                self._save_log(log_entry, 'ignored', f"No matching outgoing msg for WAMID {wamid}.")
         except Exception as e: logger.error(f"Error updating status for WAMID {wamid}: {e}", exc_info=True); self._save_log(log_entry, 'error', str(e))
 
     def handle_error_notification(self, error_data, metadata, app_config, log_entry: WebhookEventLog):
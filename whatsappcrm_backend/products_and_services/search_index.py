@@ -0,0 +1,178 @@
+# whatsappcrm_backend/products_and_services/search_index.py
+
+"""
+In-process BM25 search over the active products, used by the AI shopping
+assistant (flows/tasks.py) to put only the products relevant to the
+conversation into its prompt.
+
+The index is built from one `.values()` query over active products. Each
+product is a document made of its name (counted 3 times), category (2
+times), product type and description. Documents are kept as an inverted
+index: term -> [(product position, term frequency)], plus the document
+lengths and each term's IDF. A search scores only the products that contain
+one of the query's terms.
+
+Saves of Product and ProductCategory (see signals.py) invalidate the index
+like meta_integration/config_cache.py does, through the shared version in
+PRODUCT_SEARCH_VERSION_KEY (PRODUCT_SEARCH_INDEX_CHECK_SECONDS and
+PRODUCT_SEARCH_INDEX_TTL_SECONDS).
+
+Product rows held by the index are shared and must be treated as read-only.
+"""
+import logging
+import math
+import re
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+
+from whatsappcrm_backend.redis_client import bump_shared_version, read_shared_version
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+PRODUCT_SEARCH_VERSION_KEY = 'products:search_index:version'
+
+PRODUCT_SEARCH_FIELDS = ('id', 'name', 'description', 'price', 'currency', 'category__name', 'product_type')
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+NAME_WEIGHT = 3
+CATEGORY_WEIGHT = 2
+
+_TOKEN_RE = re.compile(r'[a-z0-9]+(?:\.[0-9]+)?')
+STOPWORDS = frozenset((
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'can', 'do', 'for', 'from', 'have', 'i', 'in',
+    'is', 'it', 'me', 'my', 'need', 'of', 'on', 'or', 'our', 'please', 'so', 'that', 'the', 'this', 'to',
+    'want', 'we', 'what', 'which', 'will', 'with', 'would', 'you', 'your',
+))
+
+_index = None
+
+
+def tokenize(text: str) -> list:
+    """Lowercased word tokens without stopwords, with plurals folded ('batteries' -> 'battery')."""
+    tokens = []
+    for token in _TOKEN_RE.findall((text or '').lower()):
+        if token in STOPWORDS:
+            continue
+        if len(token) > 4 and token.endswith('ies'):
+            token = token[:-3] + 'y'
+        elif len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+
+class ProductSearchIndex:
+    """Immutable BM25 index over a list of product rows, built for one shared version."""
+
+    def __init__(self, products: list, version):
+        self.products = products
+        self.version = version
+        self.loaded_at = time.monotonic()
+        self.checked_at = self.loaded_at
+
+        postings = {}
+        self.lengths = []
+        for position, product in enumerate(products):
+            terms = Counter(tokenize(product.get('description')))
+            terms.update(tokenize(product.get('product_type')))
+            for term in tokenize(product.get('category__name')):
+                terms[term] += CATEGORY_WEIGHT
+            for term in tokenize(product.get('name')):
+                terms[term] += NAME_WEIGHT
+            self.lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                postings.setdefault(term, []).append((position, frequency))
+
+        self.postings = postings
+        count = len(products)
+        self.average_length = (sum(self.lengths) / count) if count else 0.0
+        self.idf = {
+            term: math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5)) for term, docs in postings.items()
+        }
+
+    def search(self, query_terms: dict, limit: int) -> list:
+        """
+        Returns up to `limit` product rows, best BM25 match first, for
+        {term: weight}. Products matching no term fill the remaining places in
+        catalog order, so the assistant always sees some products.
+        """
+        scores = {}
+        for term, weight in query_terms.items():
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = self.idf[term] * weight
+            for position, frequency in docs:
+                norm = K1 * (1 - B + B * self.lengths[position] / self.average_length)
+                scores[position] = scores.get(position, 0.0) + idf * frequency * (K1 + 1) / (frequency + norm)
+
+        ranked = sorted(scores, key=lambda position: (-scores[position], position))[:limit]
+        if len(ranked) < limit:
+            matched = set(ranked)
+            ranked.extend(position for position in range(len(self.products)) if position not in matched)
+            ranked = ranked[:limit]
+        return [self.products[position] for position in ranked]
+
+
+def get_product_search_index() -> ProductSearchIndex:
+    global _index
+    index = _index
+    now = time.monotonic()
+    if index is not None and now - index.checked_at < settings.PRODUCT_SEARCH_INDEX_CHECK_SECONDS:
+        return index
+
+    shared_version = read_shared_version(PRODUCT_SEARCH_VERSION_KEY)
+    if index is not None:
+        if shared_version is not None and shared_version == index.version:
+            index.checked_at = now
+            return index
+        if shared_version is None and now - index.loaded_at < settings.PRODUCT_SEARCH_INDEX_TTL_SECONDS:
+            index.checked_at = now
+            return index
+
+    started = time.perf_counter()
+    products = list(Product.objects.filter(is_active=True).order_by('id').values(*PRODUCT_SEARCH_FIELDS))
+    index = ProductSearchIndex(products, shared_version)
+    _index = index
+    logger.info(
+        f"Built product search index: {len(products)} products, {len(index.postings)} terms "
+        f"in {(time.perf_counter() - started) * 1000:.1f}ms (version {shared_version})."
+    )
+    return index
+
+
+def search_products(message_text: str, history_texts: list = (), limit: int = 20) -> list:
+    """
+    Returns the `limit` active products most relevant to the user's message,
+    helped by the recent conversation (`history_texts`, weighted half).
+    """
+    query_terms = {}
+    for text in history_texts:
+        for term in tokenize(text):
+            query_terms[term] = 0.5
+    for term in tokenize(message_text):
+        query_terms[term] = 1.0
+    return get_product_search_index().search(query_terms, limit)
+
+
+def invalidate_product_search_index():
+    """
+    Drops this process's index right away and, once the surrounding transaction
+    commits, drops it again and bumps the shared version so other processes rebuild.
+    """
+    global _index
+    _index = None
+
+    def _on_commit():
+        global _index
+        _index = None
+        bump_shared_version(PRODUCT_SEARCH_VERSION_KEY)
+
+    transaction.on_commit(_on_commit)
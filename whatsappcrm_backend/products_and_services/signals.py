@@ -581,3 +581,28 @@ def auto_create_ssr_for_solar_orders(sender, instance, created, **kwargs):
         # Clear the processing flag
         if hasattr(instance, '_processing_ssr_creation'):
             delattr(instance, '_processing_ssr_creation')
+
+
+# ============================================================================
+# Product Search Index Signals
+# ============================================================================
+
+from .models import ProductCategory
+from .search_index import invalidate_product_search_index
+
+# Product fields the search index reads; saves touching none of them keep it.
+SEARCH_INDEXED_PRODUCT_FIELDS = frozenset((
+    'name', 'description', 'price', 'currency', 'category', 'category_id', 'product_type', 'is_active',
+))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductCategory)
+@receiver(post_delete, sender=ProductCategory)
+def invalidate_search_index_on_product_change(sender, instance, **kwargs):
+    """Keeps the AI shopping assistant's product search index in step with the catalog."""
+    update_fields = kwargs.get('update_fields')
+    if sender is Product and update_fields and not SEARCH_INDEXED_PRODUCT_FIELDS.intersection(update_fields):
+        return
+    invalidate_product_search_index()
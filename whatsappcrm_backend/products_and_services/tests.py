@@ -1146,7 +1146,7 @@ class MetaCatalogServiceMethodsTestCase(TestCase):
         )
     
     @patch('meta_integration.catalog_service.MetaAppConfig.objects.get_active_config')
-    @patch('meta_integration.catalog_service.requests.post')
+    @patch('meta_integration.graph_client.GraphApiClient.post')
     def test_set_product_visibility_published(self, mock_post, mock_get_config):
         """Test setting product visibility to published"""
         from meta_integration.catalog_service import MetaCatalogService
@@ -1178,7 +1178,7 @@ class MetaCatalogServiceMethodsTestCase(TestCase):
         self.assertEqual(requests_list[0]['data']['visibility'], 'published')
     
     @patch('meta_integration.catalog_service.MetaAppConfig.objects.get_active_config')
-    @patch('meta_integration.catalog_service.requests.get')
+    @patch('meta_integration.graph_client.GraphApiClient.get')
     def test_get_product_from_catalog(self, mock_get, mock_get_config):
         """Test getting product from Meta catalog"""
         from meta_integration.catalog_service import MetaCatalogService
@@ -1607,3 +1607,50 @@ class ZohoAdminViewTest(TestCase):
         
         # Task should be triggered
         mock_task.assert_called_once()
+
+
+@patch('whatsappcrm_backend.redis_client.get_redis_client', return_value=None)
+class ProductSearchIndexTestCase(TestCase):
+    """Tests for the AI shopping assistant's product search index (search_index.py)."""
+
+    def setUp(self):
+        from .search_index import invalidate_product_search_index
+
+        batteries = ProductCategory.objects.create(name='Batteries')
+        panels = ProductCategory.objects.create(name='Solar Panels')
+        self.battery = Product.objects.create(
+            name='10kWh Lithium Battery', product_type='hardware', category=batteries, price=3200,
+            description='Lithium iron phosphate battery bank for backup power.',
+        )
+        self.panel = Product.objects.create(
+            name='550W Mono Panel', product_type='hardware', category=panels, price=200,
+            description='High efficiency monocrystalline solar panel.',
+        )
+        self.inverter = Product.objects.create(
+            name='5kW Hybrid Inverter', product_type='hardware', price=1200,
+            description='Pure sine wave inverter with MPPT charge controller.',
+        )
+        Product.objects.create(name='Retired Inverter', product_type='hardware', is_active=False)
+        invalidate_product_search_index()
+
+    def test_products_are_ranked_by_relevance_to_the_message(self, mock_redis):
+        from .search_index import search_products
+
+        results = search_products('I need batteries for backup', limit=2)
+        self.assertEqual(results[0]['id'], self.battery.id)
+
+        results = search_products('which panels?', ['Looking for an inverter and solar panels'], limit=3)
+        self.assertEqual([row['id'] for row in results[:2]], [self.panel.id, self.inverter.id])
+        self.assertNotIn('Retired Inverter', [row['name'] for row in results])
+
+    def test_unmatched_messages_still_get_products_and_changes_rebuild_the_index(self, mock_redis):
+        from .search_index import search_products
+
+        self.assertEqual(len(search_products('hello', limit=2)), 2)
+
+        self.battery.name = 'Gel Storage Bank'
+        self.battery.save()
+        self.assertEqual(search_products('gel storage', limit=1)[0]['id'], self.battery.id)
+
+        with self.assertNumQueries(0):
+            search_products('gel storage', limit=1)
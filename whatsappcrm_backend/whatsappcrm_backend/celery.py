@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_init, worker_process_init
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'whatsappcrm_backend.settings')
@@ -14,6 +15,24 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Load task modules from all registered Django apps
 app.autodiscover_tasks()
 
+
+# Each worker process serves its own metrics registry; see worker_metrics.py.
+@worker_init.connect
+def start_main_process_metrics(sender=None, **kwargs):
+    from .worker_metrics import is_prefork_pool, start_worker_metrics_server
+
+    # Prefork children start their own server below; the main process runs no tasks.
+    if not is_prefork_pool(getattr(sender, 'pool_cls', None)):
+        start_worker_metrics_server()
+
+
+@worker_process_init.connect
+def start_child_process_metrics(**kwargs):
+    from billiard.process import current_process
+    from .worker_metrics import start_worker_metrics_server
+
+    start_worker_metrics_server(offset=getattr(current_process(), 'index', 0) or 0)
+
 # Test task with result storage
 @app.task(bind=True)
 def debug_task(self):
@@ -0,0 +1,87 @@
+# whatsappcrm_backend/whatsappcrm_backend/redis_client.py
+
+"""
+Shared Redis connection for application-level state (buffers, locks, counters).
+
+Celery uses DB 0 and Channels DB 1; application state lives in REDIS_APP_DB.
+Callers must treat Redis as optional: `get_redis_client()` returns None when
+Redis is unreachable, and every caller keeps a database fallback.
+
+Process-local caches (meta_integration/config_cache.py, flows/flow_graph.py,
+products_and_services/search_index.py) share a version counter per cache:
+a save bumps it on commit with bump_shared_version(), and every process
+compares its copy with read_shared_version() and reloads when it moved.
+"""
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+# After a connection failure, don't retry Redis until this monotonic timestamp,
+# so an outage doesn't add a connect timeout to every request.
+_unavailable_until = 0.0
+
+
+def _build_url():
+    password = settings.REDIS_PASSWORD
+    auth = f":{password}@" if password else ""
+    return f"redis://{auth}{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_APP_DB}"
+
+
+def get_redis_client():
+    """
+    Returns a `redis.Redis` client backed by a process-wide connection pool,
+    or None if Redis is currently marked as unavailable.
+    """
+    global _pool
+    if time.monotonic() < _unavailable_until:
+        return None
+    if _pool is None:
+        _pool = redis.ConnectionPool.from_url(
+            getattr(settings, 'REDIS_APP_URL', None) or _build_url(),
+            socket_connect_timeout=settings.REDIS_APP_SOCKET_TIMEOUT,
+            socket_timeout=settings.REDIS_APP_SOCKET_TIMEOUT,
+            health_check_interval=30,
+        )
+    return redis.Redis(connection_pool=_pool)
+
+
+def mark_redis_unavailable(exc: Exception = None):
+    """
+    Called by code that caught a `redis.RedisError`. Skips Redis for
+    REDIS_APP_RETRY_SECONDS so callers go straight to their fallback path.
+    """
+    global _unavailable_until
+    _unavailable_until = time.monotonic() + settings.REDIS_APP_RETRY_SECONDS
+    logger.warning(
+        f"Redis unavailable ({exc}). Falling back to the database for "
+        f"{settings.REDIS_APP_RETRY_SECONDS}s."
+    )
+
+
+def read_shared_version(key: str):
+    """Returns the shared version stored under `key` ('0' if never bumped), or None if Redis is unavailable."""
+    client = get_redis_client()
+    if client is None:
+        return None
+    try:
+        version = client.get(key)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
+        return None
+    return version.decode() if version else '0'
+
+
+def bump_shared_version(key: str):
+    """Moves the shared version under `key` on, so other processes reload their copy."""
+    client = get_redis_client()
+    if client is None:
+        return
+    try:
+        client.incr(key)
+    except redis.RedisError as e:
+        mark_redis_unavailable(e)
@@ -306,6 +306,13 @@ else:
     # Development mode only - no password
     CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', f'redis://{REDIS_HOST}:{REDIS_PORT}/0')
 
+# Application state (buffers, locks, counters) uses its own Redis DB.
+# See whatsappcrm_backend/redis_client.py; every user of it has a DB fallback.
+REDIS_APP_DB = int(os.getenv('REDIS_APP_DB', '2'))
+REDIS_APP_URL = os.getenv('REDIS_APP_URL', None)
+REDIS_APP_SOCKET_TIMEOUT = float(os.getenv('REDIS_APP_SOCKET_TIMEOUT', '0.5'))
+REDIS_APP_RETRY_SECONDS = int(os.getenv('REDIS_APP_RETRY_SECONDS', '30'))
+
 CELERY_RESULT_BACKEND = 'django-db' # Use a different DB for results
 CELERY_ACCEPT_CONTENT = ['json'] # Content types to accept
 CELERY_TASK_SERIALIZER = 'json'  # How tasks are serialized
@@ -355,8 +362,13 @@ CELERY_TASK_ROUTES = {
     # --- Outgoing message dispatch + read receipts -> messaging worker ---
     'meta_integration.tasks.send_whatsapp_message_task': {'queue': 'msg_sending'},
     'meta_integration.tasks.send_read_receipt_task': {'queue': 'msg_sending'},
+    'meta_integration.release_stalled_outbound_queues_task': {'queue': 'msg_sending'},
+    'meta_integration.send_broadcast_batch_task': {'queue': 'msg_sending'},
     # --- Inbound media download -> messaging worker (whatsapp) ---
     'meta_integration.download_whatsapp_media_task': {'queue': 'whatsapp'},
+    # --- Ack-first webhook inbox consumer -> messaging worker (whatsapp) ---
+    'meta_integration.process_webhook_inbox_task': {'queue': 'whatsapp'},
+    'meta_integration.apply_buffered_status_updates_task': {'queue': 'whatsapp'},
     # --- Flow engine (generates the reply) -> dedicated flow worker ---
     'flows.tasks.process_flow_for_message_task': {'queue': 'flow_processing'},
     # --- Gemini AI work -> flow worker (gevent, I/O-bound: greenlets yield while
@@ -426,6 +438,31 @@ CELERY_BEAT_SCHEDULE = {
         # Runs every hour at the top of the hour.
         'schedule': crontab(minute=0, hour='*'),
     },
+    'drain-webhook-inbox': {
+        'task': 'meta_integration.process_webhook_inbox_task',
+        # Safety net for ack-first mode; each stored webhook also queues a drain.
+        'schedule': crontab(minute='*'),
+    },
+    'flush-status-buffer': {
+        'task': 'meta_integration.apply_buffered_status_updates_task',
+        # Safety net for META_STATUS_BATCHING; flushes are normally scheduled on demand.
+        'schedule': crontab(minute='*'),
+    },
+    'release-stalled-outbound-queues': {
+        'task': 'meta_integration.release_stalled_outbound_queues_task',
+        # Frees per-contact outbound queues whose in-flight message never reported back.
+        'schedule': crontab(minute='*'),
+    },
+    'resume-stalled-broadcasts': {
+        'task': 'conversations.resume_stalled_broadcasts_task',
+        # Resumes chunked broadcast dispatch from its checkpoint after a worker crash.
+        'schedule': crontab(minute='*'),
+    },
+    'persist-flow-states': {
+        'task': 'flows.persist_flow_states_task',
+        # Safety net for FLOW_STATE_BACKEND=redis; persists are normally scheduled on demand.
+        'schedule': crontab(minute='*'),
+    },
     'cleanup-idle-conversations': {
         'task': 'flows.cleanup_idle_conversations_task',
         # Runs every 5 minutes to check for idle sessions.
@@ -475,6 +512,138 @@ ADMIN_NOTIFICATION_FALLBACK_TEMPLATE_NAME = os.getenv('ADMIN_NOTIFICATION_FALLBA
 # Frontend Dashboard URL for admin redirects (configurable across environments)
 FRONTEND_DASHBOARD_URL = os.getenv('FRONTEND_DASHBOARD_URL', 'https://dashboard.hanna.co.zw')
 
+# --- Meta Webhook Ingestion ---
+# Ack-first mode: the webhook view only verifies the signature, stores the raw body
+# in the WebhookInboxEntry table and returns 200 to Meta. process_webhook_inbox_task
+# drains the inbox in batches. Disabled by default (inline processing).
+META_WEBHOOK_ACK_FIRST = os.getenv('META_WEBHOOK_ACK_FIRST', 'False') == 'True'
+META_WEBHOOK_INBOX_BATCH_SIZE = int(os.getenv('META_WEBHOOK_INBOX_BATCH_SIZE', '50'))
+META_WEBHOOK_INBOX_MAX_ATTEMPTS = int(os.getenv('META_WEBHOOK_INBOX_MAX_ATTEMPTS', '5'))
+META_WEBHOOK_INBOX_CLAIM_TIMEOUT_SECONDS = int(os.getenv('META_WEBHOOK_INBOX_CLAIM_TIMEOUT_SECONDS', '300'))
+# Redis SET NX gate that drops webhook redeliveries (same wamid / wamid_status)
+# before any database work. Falls back to the WebhookEventLog check without Redis.
+META_WEBHOOK_IDEMPOTENCY_TTL_SECONDS = int(os.getenv('META_WEBHOOK_IDEMPOTENCY_TTL_SECONDS', '86400'))
+# Outgoing messages are queued per contact in Redis (meta_integration/outbound_sequencer.py).
+# The next message is released when Graph accepts the previous one, or, with
+# RELEASE_ON_DELIVERY, when its sent/delivered status webhook arrives. The
+# in-flight marker expires after INFLIGHT_TTL seconds so a lost message can't
+# stall a contact forever; a throttled send extends it. A status that arrives
+# before its wamid is stored is remembered for INFLIGHT_TTL seconds.
+META_OUTBOUND_RELEASE_ON_DELIVERY = os.getenv('META_OUTBOUND_RELEASE_ON_DELIVERY', 'False') == 'True'
+META_OUTBOUND_INFLIGHT_TTL_SECONDS = int(os.getenv('META_OUTBOUND_INFLIGHT_TTL_SECONDS', '60'))
+# MetaAppConfig rows are cached per process (meta_integration/config_cache.py).
+# Each process checks the shared Redis version key at most every CHECK seconds;
+# without Redis, a snapshot is reloaded after TTL seconds.
+META_CONFIG_CACHE_CHECK_SECONDS = float(os.getenv('META_CONFIG_CACHE_CHECK_SECONDS', '5'))
+META_CONFIG_CACHE_TTL_SECONDS = float(os.getenv('META_CONFIG_CACHE_TTL_SECONDS', '60'))
+# Flow definitions are compiled into a per-process graph (flows/flow_graph.py),
+# invalidated the same way as the MetaAppConfig cache.
+FLOW_GRAPH_CACHE_CHECK_SECONDS = float(os.getenv('FLOW_GRAPH_CACHE_CHECK_SECONDS', '5'))
+FLOW_GRAPH_CACHE_TTL_SECONDS = float(os.getenv('FLOW_GRAPH_CACHE_TTL_SECONDS', '60'))
+# Compiled Jinja templates of flow step configs kept per process (flows/services.py).
+FLOW_TEMPLATE_CACHE_SIZE = int(os.getenv('FLOW_TEMPLATE_CACHE_SIZE', '2048'))
+# query_model actions with `cache_ttl_seconds` cache their results per process
+# (flows/query_cache.py), at most SIZE queries. Saves of a cached model reach other
+# processes through Redis within CHECK seconds.
+FLOW_QUERY_CACHE_SIZE = int(os.getenv('FLOW_QUERY_CACHE_SIZE', '512'))
+FLOW_QUERY_CACHE_CHECK_SECONDS = float(os.getenv('FLOW_QUERY_CACHE_CHECK_SECONDS', '5'))
+# The AI shopping assistant's product search index (products_and_services/search_index.py)
+# is built per process and invalidated the same way as the MetaAppConfig cache.
+PRODUCT_SEARCH_INDEX_CHECK_SECONDS = float(os.getenv('PRODUCT_SEARCH_INDEX_CHECK_SECONDS', '5'))
+PRODUCT_SEARCH_INDEX_TTL_SECONDS = float(os.getenv('PRODUCT_SEARCH_INDEX_TTL_SECONDS', '300'))
+# Gemini chat history per contact and AI mode (flows/ai_sessions.py), kept in Redis for
+# TTL seconds. Turns beyond TOKEN_BUDGET (estimated) are rolled into a summary of at most
+# SUMMARY_MAX_CHARS characters.
+AI_SESSION_TTL_SECONDS = int(os.getenv('AI_SESSION_TTL_SECONDS', '3600'))
+AI_SESSION_TOKEN_BUDGET = int(os.getenv('AI_SESSION_TOKEN_BUDGET', '6000'))
+AI_SESSION_SUMMARY_MAX_CHARS = int(os.getenv('AI_SESSION_SUMMARY_MAX_CHARS', '4000'))
+# Gemini request scheduler (ai_integration/scheduler.py): a Redis token bucket per AIProvider
+# at its rate_limit_limit per minute (REQUESTS_PER_MINUTE when unset). Email extraction leaves
+# INTERACTIVE_RESERVE tokens for customer chats. Requests wait up to MAX_WAIT seconds for a
+# token before falling back to the task's retry; a 429 holds all requests for COOLDOWN seconds.
+# Email extraction doesn't wait in its worker: it reschedules its task for when a token is
+# expected, at most BACKGROUND_MAX_SLOT_RETRIES times, apart from its retries on API errors.
+GEMINI_REQUESTS_PER_MINUTE = int(os.getenv('GEMINI_REQUESTS_PER_MINUTE', '60'))
+GEMINI_INTERACTIVE_RESERVE = int(os.getenv('GEMINI_INTERACTIVE_RESERVE', '2'))
+GEMINI_INTERACTIVE_MAX_WAIT_SECONDS = float(os.getenv('GEMINI_INTERACTIVE_MAX_WAIT_SECONDS', '20'))
+GEMINI_BACKGROUND_MAX_WAIT_SECONDS = float(os.getenv('GEMINI_BACKGROUND_MAX_WAIT_SECONDS', '120'))
+GEMINI_BACKGROUND_MAX_SLOT_RETRIES = int(os.getenv('GEMINI_BACKGROUND_MAX_SLOT_RETRIES', '30'))
+GEMINI_RATE_LIMIT_COOLDOWN_SECONDS = float(os.getenv('GEMINI_RATE_LIMIT_COOLDOWN_SECONDS', '60'))
+# Prometheus endpoint for Celery workers (whatsappcrm_backend/worker_metrics.py). Each
+# worker process serves the metrics its tasks update on this port; prefork child N uses
+# PORT + N. Unset or 0 disables it. The web process keeps exporting through /prometheus/.
+# Kept outside the CELERY_ namespace so Celery does not read it as one of its settings.
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', '0'))
+WORKER_METRICS_ADDR = os.getenv('WORKER_METRICS_ADDR', '0.0.0.0')
+# Per-step flow profiling (flows/profiling.py): Prometheus histograms of step wall time,
+# queries, template rendering, actions and transitions per flow and step, plus one trace
+# log line for a SAMPLE_RATE share of messages and for every message slower than SLOW_TRACE seconds.
+FLOW_PROFILING_ENABLED = os.getenv('FLOW_PROFILING_ENABLED', 'True') == 'True'
+FLOW_PROFILE_TRACE_SAMPLE_RATE = float(os.getenv('FLOW_PROFILE_TRACE_SAMPLE_RATE', '0.01'))
+FLOW_PROFILE_SLOW_TRACE_SECONDS = float(os.getenv('FLOW_PROFILE_SLOW_TRACE_SECONDS', '2'))
+# Flow state backend (flows/flow_state_store.py). 'database' keeps ContactFlowState in
+# its table. 'redis' keeps active states in a Redis hash per contact that expires after
+# REDIS_TTL seconds (keep it above the 5 minute idle cleanup threshold) and writes them
+# behind to the table every PERSIST_WINDOW seconds, PERSIST_BATCH_SIZE contacts per batch.
+# A batch left behind by a crashed worker is requeued after PERSIST_REQUEUE seconds.
+# `manage.py reconcile_flow_states` compares the hashes with the table. Locked reads take a
+# per-contact Redis lock, waiting up to LOCK_WAIT seconds; a lock that is never released
+# expires after LOCK_TIMEOUT seconds.
+FLOW_STATE_BACKEND = os.getenv('FLOW_STATE_BACKEND', 'database')
+FLOW_STATE_REDIS_TTL_SECONDS = int(os.getenv('FLOW_STATE_REDIS_TTL_SECONDS', '900'))
+FLOW_STATE_PERSIST_WINDOW_SECONDS = int(os.getenv('FLOW_STATE_PERSIST_WINDOW_SECONDS', '2'))
+FLOW_STATE_PERSIST_BATCH_SIZE = int(os.getenv('FLOW_STATE_PERSIST_BATCH_SIZE', '500'))
+FLOW_STATE_PERSIST_REQUEUE_SECONDS = int(os.getenv('FLOW_STATE_PERSIST_REQUEUE_SECONDS', '300'))
+FLOW_STATE_LOCK_WAIT_SECONDS = float(os.getenv('FLOW_STATE_LOCK_WAIT_SECONDS', '10'))
+FLOW_STATE_LOCK_TIMEOUT_SECONDS = float(os.getenv('FLOW_STATE_LOCK_TIMEOUT_SECONDS', '30'))
+# Status webhooks: buffer in Redis for a short window, keep the furthest state per
+# wamid and apply each batch with one bulk_update. Falls back to inline processing
+# when Redis is unavailable. META_STATUS_EVENT_LOGGING is 'bulk' (one bulk_create
+# of WebhookEventLog rows per batch) or 'skip' (no log rows for batched statuses).
+# A drained batch stays in a Redis processing list until it commits; one left
+# behind by a crashed worker is requeued after BATCH_REQUEUE_SECONDS.
+META_STATUS_BATCHING = os.getenv('META_STATUS_BATCHING', 'False') == 'True'
+META_STATUS_BATCH_WINDOW_SECONDS = int(os.getenv('META_STATUS_BATCH_WINDOW_SECONDS', '2'))
+META_STATUS_BATCH_SIZE = int(os.getenv('META_STATUS_BATCH_SIZE', '1000'))
+META_STATUS_EVENT_LOGGING = os.getenv('META_STATUS_EVENT_LOGGING', 'bulk')
+META_STATUS_BATCH_REQUEUE_SECONDS = int(os.getenv('META_STATUS_BATCH_REQUEUE_SECONDS', '300'))
+# Shared Graph API client (meta_integration/graph_client.py): one pooled keep-alive
+# requests.Session per worker process. POOL_MAXSIZE bounds concurrent connections
+# to graph.facebook.com per process; raise it for high-concurrency gevent workers.
+# The client never retries in-process: tasks retry safe failures with a Celery
+# countdown starting at RETRY_BACKOFF seconds (or Meta's Retry-After).
+GRAPH_API_POOL_CONNECTIONS = int(os.getenv('GRAPH_API_POOL_CONNECTIONS', '10'))
+GRAPH_API_POOL_MAXSIZE = int(os.getenv('GRAPH_API_POOL_MAXSIZE', '50'))
+GRAPH_API_RETRY_BACKOFF_SECONDS = float(os.getenv('GRAPH_API_RETRY_BACKOFF_SECONDS', '0.5'))
+# Outbound send throttle (meta_integration/throttle.py): a Redis token bucket per
+# sending phone_number_id, shared by all messaging workers. PAIR_PER_MINUTE > 0
+# adds a per-recipient bucket for Meta's pair rate limit. A send that can't get a
+# token within MAX_WAIT seconds is rescheduled instead of holding a worker slot.
+META_THROTTLE_MESSAGES_PER_SECOND = float(os.getenv('META_THROTTLE_MESSAGES_PER_SECOND', '80'))
+META_THROTTLE_BURST = int(os.getenv('META_THROTTLE_BURST', '80'))
+META_THROTTLE_PAIR_PER_MINUTE = float(os.getenv('META_THROTTLE_PAIR_PER_MINUTE', '0'))
+META_THROTTLE_PAIR_BURST = int(os.getenv('META_THROTTLE_PAIR_BURST', '5'))
+META_THROTTLE_MAX_WAIT_SECONDS = float(os.getenv('META_THROTTLE_MAX_WAIT_SECONDS', '5'))
+# Broadcasts are dispatched in chunks of CHUNK_SIZE recipients (conversations/broadcasts.py),
+# checkpointed on the Broadcast row. A broadcast with no progress for STALL seconds is
+# resumed by beat. Counters are refreshed every REFRESH seconds after all sends are queued.
+# A broadcast message still pending, or claimed by a send ('queued') that never
+# finished, after SEND_CLAIM seconds is re-queued by the stall sweep.
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '500'))
+BROADCAST_STALL_SECONDS = int(os.getenv('BROADCAST_STALL_SECONDS', '300'))
+BROADCAST_SEND_CLAIM_SECONDS = int(os.getenv('BROADCAST_SEND_CLAIM_SECONDS', '900'))
+BROADCAST_PROGRESS_REFRESH_SECONDS = int(os.getenv('BROADCAST_PROGRESS_REFRESH_SECONDS', '30'))
+BROADCAST_PROGRESS_MAX_CHECKS = int(os.getenv('BROADCAST_PROGRESS_MAX_CHECKS', '120'))
+# 'per_message' queues one send_whatsapp_message_task per recipient. 'bulk' queues one
+# send_broadcast_batch_task per BULK_SEND_BATCH_SIZE messages, which sends them with up
+# to BULK_SEND_CONCURRENCY concurrent requests (meta_integration/bulk_sender.py).
+BROADCAST_SEND_MODE = os.getenv('BROADCAST_SEND_MODE', 'per_message')
+BROADCAST_BULK_SEND_BATCH_SIZE = int(os.getenv('BROADCAST_BULK_SEND_BATCH_SIZE', '100'))
+BROADCAST_BULK_SEND_CONCURRENCY = int(os.getenv('BROADCAST_BULK_SEND_CONCURRENCY', '16'))
+# Overrides https://graph.facebook.com for message sends, e.g. to point the
+# benchmark_broadcast_send command at a local stub server.
+GRAPH_API_BASE_URL = os.getenv('GRAPH_API_BASE_URL', None)
+
 
 # --- Logging Configuration ---
 LOGGING = {
@@ -0,0 +1,51 @@
+# whatsappcrm_backend/whatsappcrm_backend/worker_metrics.py
+
+"""
+Prometheus endpoint for Celery workers.
+
+Metrics updated inside tasks (status batching, Graph API retries, the outbound
+sequencer, flow profiling, the Gemini scheduler, ...) live in the registry of the
+worker process that ran the task, which the web process's /prometheus/ endpoint
+cannot see. With WORKER_METRICS_PORT set, every worker process serves its
+own registry with prometheus_client's HTTP server:
+
+- gevent and solo workers run their tasks in the main process, which listens on
+  WORKER_METRICS_PORT.
+- prefork workers run their tasks in child processes. Child N listens on
+  WORKER_METRICS_PORT + N, so a worker with --concurrency=2 uses two
+  consecutive ports. A replaced child reuses the index, and so the port, of the
+  one it replaces.
+"""
+import logging
+
+from django.conf import settings
+from prometheus_client import start_http_server
+
+logger = logging.getLogger(__name__)
+
+PREFORK_POOLS = ('prefork', 'processes')
+
+
+def is_prefork_pool(pool_cls) -> bool:
+    """True if `pool_cls` (a pool alias or class) is Celery's prefork pool."""
+    if isinstance(pool_cls, str):
+        return pool_cls in PREFORK_POOLS
+    return getattr(pool_cls, '__module__', '') == 'celery.concurrency.prefork'
+
+
+def start_worker_metrics_server(offset: int = 0):
+    """
+    Serves this process's metrics on WORKER_METRICS_PORT + offset.
+    Returns the port, or None if worker metrics are disabled or the port is taken.
+    """
+    base_port = settings.WORKER_METRICS_PORT
+    if not base_port:
+        return None
+    port = base_port + offset
+    try:
+        start_http_server(port, addr=settings.WORKER_METRICS_ADDR)
+    except OSError as e:
+        logger.error(f"Could not start the worker metrics server on port {port}: {e}")
+        return None
+    logger.info(f"Serving worker metrics on port {port}.")
+    return port